@@ -0,0 +1,186 @@
+from collections.abc import Mapping
+from dataclasses import dataclass
+from threading import Lock
+from time import monotonic
+from typing import Dict, Optional
+
+
+@dataclass(frozen=True)
+class Cep2ActuatorState:
+    """ State of a light: on/off and its color in the CIE xy color space, as used by zigbee2mqtt.
+    """
+
+    state: str
+    color_x: float = None
+    color_y: float = None
+
+    # Devices report the color with a different precision than the one that was set, so colors are
+    # compared with this tolerance.
+    COLOR_TOLERANCE = 0.01
+
+    def matches(self, other: "Cep2ActuatorState") -> bool:
+        """ Checks if two states are equivalent. The color is ignored when the lights are off, or
+        when one of the states does not have a color.
+        """
+        if self.state != other.state:
+            return False
+        if self.state == "OFF":
+            return True
+        if None in (self.color_x, self.color_y, other.color_x, other.color_y):
+            return True
+
+        return (abs(self.color_x - other.color_x) <= self.COLOR_TOLERANCE and
+                abs(self.color_y - other.color_y) <= self.COLOR_TOLERANCE)
+
+    @classmethod
+    def from_payload(cls, payload: Mapping) -> Optional["Cep2ActuatorState"]:
+        """ Creates a state from the payload that zigbee2mqtt publishes on zigbee2mqtt/<device>.
+
+        Returns:
+            Optional[Cep2ActuatorState]: the state, or None if the payload has no state.
+        """
+        state = payload.get("state")
+        if state is None:
+            return None
+
+        color = payload.get("color") or {}
+
+        return cls(state=state, color_x=color.get("x"), color_y=color.get("y"))
+
+
+@dataclass
+class Cep2ActuatorCacheStats:
+    """ Counters of the publishes decided by a Cep2ActuatorCache.
+    """
+
+    sent: int = 0
+    suppressed: int = 0
+
+
+class _Cep2ActuatorEntry:
+    __slots__ = ("desired", "reported", "published_at")
+
+    def __init__(self):
+        self.desired = None
+        self.reported = None
+        self.published_at = 0.0
+
+
+class Cep2ActuatorCache:
+    """ This class keeps, for each actuator, the last state that was requested (desired) and the
+    last state that the device reported to zigbee2mqtt. It is used to avoid publishing a state that
+    the device already has.
+
+    A state is published if it is different from the last desired state, if the device reported a
+    different state after the settle time has passed (e.g. the previous command was lost), or if the
+    refresh interval has passed since the last publish.
+    """
+
+    def __init__(self, refresh_interval: Optional[float] = None, settle_time: float = 2.0):
+        """ Class initializer.
+
+        Args:
+            refresh_interval (Optional[float]): if set, an unchanged state is published again after
+                this number of seconds. Defaults to None, i.e. never.
+            settle_time (float): seconds given to a device to report a new state, before assuming
+                that the command was not applied. Defaults to 2 seconds.
+        """
+        self.__refresh_interval = refresh_interval
+        self.__settle_time = settle_time
+        self.__entries = {}
+        self.__lock = Lock()
+        self.__stats = Cep2ActuatorCacheStats()
+
+    @property
+    def stats(self) -> Cep2ActuatorCacheStats:
+        with self.__lock:
+            return Cep2ActuatorCacheStats(**self.__stats.__dict__)
+
+    def desired(self, device_id: str) -> Optional[Cep2ActuatorState]:
+        entry = self.__entries.get(device_id)
+
+        return entry.desired if entry else None
+
+    def reported(self, device_id: str) -> Optional[Cep2ActuatorState]:
+        entry = self.__entries.get(device_id)
+
+        return entry.reported if entry else None
+
+    def desired_states(self) -> Dict[str, Cep2ActuatorState]:
+        """ Returns the desired state of every actuator that was commanded, by ID.
+        """
+        with self.__lock:
+            return {d: e.desired for d, e in self.__entries.items() if e.desired is not None}
+
+    def set_desired(self, device_id: str, desired: Cep2ActuatorState) -> None:
+        """ Records a desired state without publishing it, e.g. while the client is not connected.
+        The client publishes the desired states again when it reconnects.
+        """
+        with self.__lock:
+            entry = self.__entries.get(device_id)
+            if entry is None:
+                entry = self.__entries[device_id] = _Cep2ActuatorEntry()
+            entry.desired = desired
+
+    def should_publish(self,
+                       device_id: str,
+                       desired: Cep2ActuatorState,
+                       force: bool = False) -> bool:
+        """ Decides if a state must be published and, if so, records it as the desired state.
+
+        Args:
+            device_id (str): ID (friendly name) of the actuator.
+            desired (Cep2ActuatorState): state to apply.
+            force (bool): if True, the state is always published. Defaults to False.
+
+        Returns:
+            bool: True if the state must be published.
+        """
+        now = monotonic()
+
+        with self.__lock:
+            entry = self.__entries.get(device_id)
+            if entry is None:
+                entry = self.__entries[device_id] = _Cep2ActuatorEntry()
+
+            elapsed = now - entry.published_at
+            publish = (force or
+                       entry.desired is None or
+                       not desired.matches(entry.desired) or
+                       (entry.reported is not None and
+                        not desired.matches(entry.reported) and
+                        elapsed >= self.__settle_time) or
+                       (self.__refresh_interval is not None and
+                        elapsed >= self.__refresh_interval))
+
+            if publish:
+                entry.desired = desired
+                entry.published_at = now
+                self.__stats.sent += 1
+            else:
+                self.__stats.suppressed += 1
+
+            return publish
+
+    def update_reported(self, device_id: str, payload: Mapping) -> None:
+        """ Updates the reported state of an actuator from a message published by zigbee2mqtt.
+        Devices that were never commanded are ignored, so sensors are not cached.
+
+        Args:
+            device_id (str): ID (friendly name) of the device.
+            payload (Mapping): JSON payload of the message. It is only accessed if the device is an
+                actuator, so a Cep2LazyPayload is not decoded for sensors.
+        """
+        entry = self.__entries.get(device_id)
+        if entry is None:
+            return
+
+        try:
+            reported = Cep2ActuatorState.from_payload(payload)
+        except (ValueError, TypeError):
+            # The payload is not a JSON object.
+            return
+
+        if reported is not None:
+            with self.__lock:
+                entry.reported = reported
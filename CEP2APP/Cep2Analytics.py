@@ -0,0 +1,332 @@
+""" Medication adherence statistics computed from the HEUCOD events sent by the controller.
+
+The events can be read from a file (JSON lines, or a JSON array as exported by the server), from a
+Cep2EventStore, or given as columns. The computations are vectorized with NumPy, so years of events
+of hundreds of patients are processed in seconds.
+
+Usage:
+    python Cep2Analytics.py events.jsonl [--before MINUTES] [--after MINUTES]
+"""
+import argparse
+import json
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, time, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from Cep2EventStore import Cep2EventStore
+
+
+@dataclass
+class Cep2AdherenceReport:
+    """ Adherence of one patient of a home in the analyzed period.
+    """
+
+    patient_id: str
+    location: Optional[str]
+    # Number of doses whose window ended in the analyzed period.
+    doses: int = 0
+    # Doses taken inside the window (from window_before minutes before the medication time to
+    # window_after minutes after it).
+    on_time: int = 0
+    # Doses taken after the window, but before the window of the next dose.
+    late: int = 0
+    # Doses that were not taken.
+    missed: int = 0
+    # Times the pillbox was moved outside the window (HEUCOD event 81493).
+    outside_window: int = 0
+    # Minutes between the medication time and the moment each taken dose was taken. Negative values
+    # are doses taken before the medication time.
+    lateness: np.ndarray = field(default_factory=lambda: np.empty(0))
+    # Number of doses taken in each room, i.e. the room where the patient acknowledged the reminder.
+    ack_rooms: Dict[Optional[str], int] = field(default_factory=dict)
+
+    @property
+    def on_time_rate(self) -> float:
+        return self.on_time / self.doses if self.doses else 0.0
+
+    def lateness_percentiles(self, percentiles: Sequence[float] = (50, 90, 99)) -> Dict[float, float]:
+        if not len(self.lateness):
+            return {p: float("nan") for p in percentiles}
+
+        return dict(zip(percentiles, np.percentile(self.lateness, percentiles).tolist()))
+
+    def lateness_histogram(self, bins: Sequence[float]) -> Tuple[np.ndarray, np.ndarray]:
+        """ Returns the number of taken doses in each lateness bin, see numpy.histogram().
+        """
+        return np.histogram(self.lateness, bins=bins)
+
+
+class Cep2AdherenceAnalyzer:
+    """ This class computes the adherence of the patients from their HEUCOD events.
+
+    The doses of each patient are the medication times of every day of the analyzed period. A
+    "Medication taken" event (82295) belongs to the last dose whose window started before it, like
+    in Cep2MedicationReminder, i.e. it is between the beginning of the window of the dose and the
+    beginning of the window of the next dose. Only the first event of each dose is counted, and the
+    events of doses outside the period (e.g. the last dose, if its window did not end) are ignored.
+    The room where the dose was taken is the room of the last room movement event (82099) of the
+    same home before it.
+
+    The homes are told apart by the location of the events, and the patients by the pillbox that
+    sent the event. Every home gets a report for each patient of medication_times, even without
+    events, so a patient who never took the medication is reported with all the doses missed.
+    """
+
+    TAKEN = 82295
+    OUTSIDE_WINDOW = 81493
+    ROOM_MOVEMENT = 82099
+
+    def __init__(self,
+                 medication_times: Dict[str, List[Tuple[int, int]]],
+                 window_before: int = 1,
+                 window_after: int = 1,
+                 pillbox_to_patient: Optional[Dict[str, str]] = None):
+        """ Class initializer.
+
+        Args:
+            medication_times (Dict[str, List[Tuple[int, int]]]): medication times of each patient,
+                as (hour, minute), like Cep2Home.medicationTimes.
+            window_before (int): minutes of the window before the medication time. Defaults to 1.
+            window_after (int): minutes of the window after the medication time. Defaults to 1.
+            pillbox_to_patient (Optional[Dict[str, str]]): patient of each pillbox sensor. Defaults
+                to the configuration of Cep2Home, {"pillboxSensor": "patient"}.
+        """
+        self.__medication_times = {p: sorted(time(h, m) for h, m in doses)
+                                   for p, doses in medication_times.items()}
+        self.__window_before = window_before * 60.0
+        self.__window_after = window_after * 60.0
+        self.__pillbox_to_patient = pillbox_to_patient or {"pillboxSensor": "patient"}
+
+    def analyze(self,
+                timestamps: Sequence[float],
+                event_types: Sequence[int],
+                device_ids: Sequence[Optional[str]],
+                locations: Optional[Sequence[Optional[str]]] = None,
+                start: Optional[datetime] = None,
+                end: Optional[datetime] = None) -> List[Cep2AdherenceReport]:
+        """ Computes the adherence of each patient of each home.
+
+        Args:
+            timestamps (Sequence[float]): UNIX time of each event, in seconds.
+            event_types (Sequence[int]): HEUCOD type (event_type_enum) of each event.
+            device_ids (Sequence[Optional[str]]): device of each event.
+            locations (Optional[Sequence[Optional[str]]]): home of each event. Defaults to None,
+                i.e. all the events are of the same home.
+            start (Optional[datetime]): beginning of the analyzed period. Defaults to the beginning
+                of the day of the first event.
+            end (Optional[datetime]): end of the analyzed period. Defaults to the time of the last
+                event.
+
+        Returns:
+            List[Cep2AdherenceReport]: a report per patient and home. Without events, the reports
+            are only computed if the period is given, for a home with location None.
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        event_types = np.asarray(event_types, dtype=np.int64)
+        devices = np.asarray(device_ids, dtype=object)
+        locations = np.asarray(locations if locations is not None else [None] * len(timestamps),
+                               dtype=object)
+        if not len(timestamps) and (start is None or end is None):
+            return []
+
+        if start is None:
+            start = datetime.combine(datetime.fromtimestamp(timestamps.min()).date(), time())
+        if end is None:
+            end = datetime.fromtimestamp(timestamps.max())
+
+        # Strings are replaced by integer codes, so they can be compared and sorted as numbers.
+        location_names, location_codes = self.__encode(locations)
+        if not location_names:
+            location_names = [None]
+
+        taken = np.isin(event_types, (self.TAKEN, self.OUTSIDE_WINDOW))
+        patients = np.array([self.__pillbox_to_patient.get(d) for d in devices[taken]], dtype=object)
+        known = patients != None  # noqa: E711, element-wise comparison
+        taken_ts = timestamps[taken][known]
+        taken_types = event_types[taken][known]
+        # The configured patients are encoded first, so they have codes even without events.
+        configured = list(self.__medication_times)
+        patient_names, patient_codes = self.__encode(np.array(configured + list(patients[known]),
+                                                              dtype=object))
+        patient_codes = patient_codes[len(configured):]
+        taken_locations = location_codes[taken][known]
+
+        rooms = event_types == self.ROOM_MOVEMENT
+        room_groups = self.__groups(location_codes[rooms], timestamps[rooms],
+                                    (timestamps[rooms], devices[rooms]))
+
+        reports = []
+        # The doses only depend on the patient, so they are shared by the homes.
+        doses_cache = {}
+        patient_count = max(len(patient_names), 1)
+        keys = taken_locations * patient_count + patient_codes
+        groups = self.__groups(keys, taken_ts, (taken_ts, taken_types))
+        # Every configured patient of every home, and the other patients with events.
+        all_keys = sorted(set(groups) | {location * patient_count + patient
+                                         for location in range(len(location_names))
+                                         for patient in range(len(configured))})
+        no_events = (np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64))
+        for key in all_keys:
+            ts, types = groups.get(key, no_events)
+            location, patient = divmod(key, patient_count)
+            doses = doses_cache.get(patient)
+            if doses is None:
+                doses = doses_cache[patient] = self.__doses(patient_names[patient], start, end)
+            reports.append(self.__report(patient_names[patient],
+                                         location_names[location],
+                                         doses,
+                                         ts,
+                                         types,
+                                         room_groups.get(location)))
+
+        return reports
+
+    def analyze_events(self, events: Iterable[Dict[str, Any]], **kwargs) -> List[Cep2AdherenceReport]:
+        """ Computes the adherence from decoded HEUCOD events (dictionaries with the JSON names of
+        the attributes, as sent to the server). See analyze() for the other arguments.
+        """
+        timestamps, event_types, device_ids, locations = [], [], [], []
+        for event in events:
+            timestamp = event.get("timestamp")
+            # Timestamps are ISO strings in the events of Cep2WebDeviceEvent, and UNIX times when
+            # they are serialized from a datetime.
+            if isinstance(timestamp, str):
+                timestamp = datetime.fromisoformat(timestamp).timestamp()
+            if timestamp is None:
+                continue
+            timestamps.append(timestamp)
+            event_types.append(event.get("eventTypeEnum") or 0)
+            device_ids.append(event.get("id"))
+            locations.append(event.get("location"))
+
+        return self.analyze(timestamps, event_types, device_ids, locations, **kwargs)
+
+    def analyze_file(self, path: str, **kwargs) -> List[Cep2AdherenceReport]:
+        """ Computes the adherence from a file with HEUCOD events, in JSON lines format or as a JSON
+        array. See analyze() for the other arguments.
+        """
+        with open(path, "r", encoding="utf-8") as events_file:
+            content = events_file.read()
+
+        if content.lstrip().startswith("["):
+            events = json.loads(content)
+        else:
+            events = [json.loads(line) for line in content.splitlines() if line.strip()]
+
+        return self.analyze_events(events, **kwargs)
+
+    def analyze_store(self,
+                      store: Cep2EventStore,
+                      start: Optional[datetime] = None,
+                      end: Optional[datetime] = None) -> List[Cep2AdherenceReport]:
+        """ Computes the adherence from the events of a Cep2EventStore in the given period.
+        """
+        columns = store.columns(start, end, (self.TAKEN, self.OUTSIDE_WINDOW, self.ROOM_MOVEMENT))
+
+        return self.analyze(columns["timestamp"], columns["event_type"], columns["device_id"],
+                            columns["location"], start=start, end=end)
+
+    def __doses(self, patient: str, start: datetime, end: datetime) -> Tuple[np.ndarray, np.ndarray]:
+        """ Returns the UNIX times of the doses of a patient from the day of the beginning of the
+        period to the day after its end, so the last dose of the period has a next dose, and
+        whether each of them is in the period, i.e. its window ended in the period.
+        """
+        doses = []
+        day = start.date()
+        while day <= end.date() + timedelta(days=1):
+            # The times are converted one by one, so changes of the daylight saving time are
+            # taken into account.
+            doses.extend(datetime.combine(day, t).timestamp()
+                         for t in self.__medication_times.get(patient, []))
+            day += timedelta(days=1)
+
+        doses = np.array(doses, dtype=np.float64)
+
+        return doses, (doses >= start.timestamp()) & (doses + self.__window_after <= end.timestamp())
+
+    def __report(self,
+                 patient: str,
+                 location: Optional[str],
+                 doses: Tuple[np.ndarray, np.ndarray],
+                 timestamps: np.ndarray,
+                 types: np.ndarray,
+                 rooms: Optional[Tuple[np.ndarray, np.ndarray]]) -> Cep2AdherenceReport:
+        doses, in_period = doses
+        report = Cep2AdherenceReport(patient, location, doses=int(np.count_nonzero(in_period)))
+        report.outside_window = int(np.count_nonzero(types == self.OUTSIDE_WINDOW))
+
+        taken = timestamps[types == self.TAKEN]
+        # Each event belongs to the last dose whose window started before it, i.e. it is before the
+        # window of the next dose. The doses include the day after the period, so the last dose of
+        # the period has a next dose, and the events of doses outside the period are ignored.
+        dose_index = np.searchsorted(doses - self.__window_before, taken, side="right") - 1
+        valid = dose_index >= 0
+        valid[valid] = in_period[dose_index[valid]]
+        taken, dose_index = taken[valid], dose_index[valid]
+        # The events are sorted by time, so the first index of each dose is its first event.
+        dose_index, first = np.unique(dose_index, return_index=True)
+        taken = taken[first]
+
+        lateness = taken - doses[dose_index]
+        report.lateness = lateness / 60.0
+        report.on_time = int(np.count_nonzero(lateness <= self.__window_after))
+        report.late = len(lateness) - report.on_time
+        report.missed = report.doses - len(lateness)
+
+        if rooms is not None and len(taken):
+            room_ts, room_devices = rooms
+            room_index = np.searchsorted(room_ts, taken, side="right") - 1
+            # None if the patient had not been seen in any room before taking the dose.
+            ack_rooms = np.where(room_index >= 0, room_devices[np.maximum(room_index, 0)], None)
+            report.ack_rooms = dict(Counter(ack_rooms.tolist()))
+
+        return report
+
+    @staticmethod
+    def __encode(values: np.ndarray) -> Tuple[List[Any], np.ndarray]:
+        """ Replaces the values by integer codes. Returns the values of the codes and the codes.
+        """
+        names = {}
+        codes = np.fromiter((names.setdefault(v, len(names)) for v in values), dtype=np.int64,
+                            count=len(values))
+
+        return list(names), codes
+
+    @staticmethod
+    def __groups(keys: np.ndarray,
+                 timestamps: np.ndarray,
+                 columns: Tuple[np.ndarray, ...]) -> Dict[int, Tuple[np.ndarray, ...]]:
+        """ Splits the columns by key, each group sorted by time, with a single sort.
+        """
+        if not len(keys):
+            return {}
+
+        order = np.lexsort((timestamps, keys))
+        keys = keys[order]
+        bounds = np.flatnonzero(np.diff(keys)) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(keys)]))
+
+        columns = [c[order] for c in columns]
+
+        return {int(keys[s]): tuple(c[s:e] for c in columns) for s, e in zip(starts, ends)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Medication adherence of the patients")
+    parser.add_argument("events", help="file with HEUCOD events, in JSON lines format or as an array")
+    parser.add_argument("--time", action="append", default=[],
+                        help="medication time of the patient, as HH:MM (default: 16:18)")
+    parser.add_argument("--before", type=int, default=1, help="minutes of the window before")
+    parser.add_argument("--after", type=int, default=1, help="minutes of the window after")
+    args = parser.parse_args()
+
+    times = [tuple(map(int, t.split(":"))) for t in args.time] or [(16, 18)]
+    analyzer = Cep2AdherenceAnalyzer({"patient": times}, args.before, args.after)
+    for report in analyzer.analyze_file(args.events):
+        print(f"{report.location} {report.patient_id}: {report.on_time}/{report.doses} on time "
+              f"({report.on_time_rate:.0%}), {report.late} late, {report.missed} missed, "
+              f"{report.outside_window} outside the window")
+        print(f"  lateness (minutes): {report.lateness_percentiles()}")
+        print(f"  rooms: {report.ack_rooms}")
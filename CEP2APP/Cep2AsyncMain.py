@@ -0,0 +1,27 @@
+import asyncio
+from Cep2Controller import Cep2AsyncController
+from Cep2Model import Cep2Model, Cep2ZigbeeDevice
+
+
+async def main() -> None:
+    # Create a data model and add a list of known Zigbee devices.
+    devices_model = Cep2Model()
+    devices_model.add([Cep2ZigbeeDevice("bedRoom", "pir"),
+                       Cep2ZigbeeDevice("livingRoom", "pir"),
+                       Cep2ZigbeeDevice("pillboxSensor", "vibration sensor")])
+
+    # Create a controller and give it the data model that was instantiated. Unlike Cep2Main, the
+    # whole gateway runs in this event loop.
+    controller = Cep2AsyncController(devices_model)
+    await controller.start()
+
+    print("Waiting for events...")
+
+    try:
+        await controller.run()
+    finally:
+        await controller.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,630 @@
+""" Microbenchmarks of the hot paths of the gateway.
+
+Usage:
+    python Cep2Benchmark.py parse [--stream FILE] [--count N]
+    python Cep2Benchmark.py heucod [--count N]
+    python Cep2Benchmark.py events [--count N]
+    python Cep2Benchmark.py wire [--count N] [--batch-size N]
+    python Cep2Benchmark.py ingest [--requests N] [--batch-size N] [--clients N]
+    python Cep2Benchmark.py stages [--stream FILE] [--count N] [--devices N] [--history FILE]
+                                   [--max-regression PCT]
+
+The zigbee2mqtt stream can be a recording in JSON lines format, where each line is an object with
+the fields "topic" and "payload". If no recording is given, a synthetic stream with the typical mix
+of a home (mostly sensor reports from devices the controller does not use, a few bridge logs) is
+generated.
+
+The wire benchmark compares the formats of the uplink batches (JSON and the binary format of
+Cep2WireFormat, with and without compression): bytes per event and encode/decode throughput.
+
+The ingest benchmark measures the events per second stored by Cep2IngestServer, with several
+clients sending single events and batches, in JSON and in the binary format.
+
+The stages benchmark measures each stage of the path of an event (parse, model lookup, conversion
+to HEUCOD, serialization, uplink) and the whole pipeline, with local stand-ins for the broker and
+the PHP server (see Cep2Replay). For each stage it reports the throughput, the p50 and p99 latency
+of a single operation and the memory allocated per operation. With --history, the results are
+appended to a JSON lines file and compared with the previous run with the same parameters, and with
+--max-regression the command fails if a stage got slower than the given percentage.
+"""
+import argparse
+import json
+import platform
+import random
+import re
+import subprocess
+import sys
+import tracemalloc
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from time import perf_counter, perf_counter_ns
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from uuid import UUID
+from Cep2Heucod import (HeucodCompactEvent, HeucodEvent, HeucodEventBatch, HeucodEventJsonEncoder,
+                        HeucodEventSerializer, HeucodEventType)
+from Cep2Model import Cep2Model, Cep2ZigbeeDevice
+from Cep2WebClient import Cep2WebClient, Cep2WebDeviceEvent
+from Cep2WireFormat import compressions, compress, decode_batch, decode_documents, decompress, \
+    encode_batch
+from Cep2Zigbee2mqttClient import Cep2Zigbee2mqttMessage, Cep2Zigbee2mqttMessageType
+
+
+def synthetic_stream(count: int, seed: int = 0, devices: int = 20) -> List[Tuple[str, str]]:
+    """ Generates a zigbee2mqtt stream as a list of (topic, payload) tuples.
+
+    Args:
+        count (int): number of messages.
+        seed (int): seed of the random generator. Defaults to 0.
+        devices (int): number of devices of the home that the controller does not use. Defaults to
+            20.
+    """
+    rng = random.Random(seed)
+    stream = []
+
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.35:
+            room = rng.choice(["bedRoom", "livingRoom"])
+            payload = {"battery": 100, "illuminance": rng.randint(0, 30), "linkquality": 120,
+                       "occupancy": rng.random() < 0.8, "voltage": 3000}
+            stream.append((f"zigbee2mqtt/{room}", json.dumps(payload)))
+        elif kind < 0.45:
+            payload = {"angle": {"x": 1, "y": -88, "z": 1}, "battery": 97, "linkquality": 100,
+                       "strength": rng.randint(1, 40), "vibration": rng.random() < 0.5}
+            stream.append(("zigbee2mqtt/pillboxSensor", json.dumps(payload)))
+        elif kind < 0.90:
+            # Devices of the home that the controller does not use, e.g. plugs and climate sensors.
+            device = f"device{rng.randint(0, devices)}"
+            payload = {"humidity": rng.uniform(30, 60), "linkquality": rng.randint(50, 200),
+                       "power": rng.uniform(0, 100), "temperature": rng.uniform(18, 24)}
+            stream.append((f"zigbee2mqtt/{device}", json.dumps(payload)))
+        elif kind < 0.97:
+            light = rng.choice(["kitchenLight", "bedroomLight", "livingroomLight"])
+            payload = {"brightness": 254, "color": {"x": 0.15, "y": 0.75}, "linkquality": 90,
+                       "state": "ON"}
+            stream.append((f"zigbee2mqtt/{light}", json.dumps(payload)))
+        else:
+            payload = {"level": "info", "message": "MQTT publish: topic 'zigbee2mqtt/bedRoom'"}
+            stream.append(("zigbee2mqtt/bridge/logging", json.dumps(payload)))
+
+    return stream
+
+
+def load_stream(path: str) -> List[Tuple[str, str]]:
+    with open(path, "r", encoding="utf-8") as recording:
+        records = [json.loads(line) for line in recording if line.strip()]
+
+    return [(r["topic"], r["payload"]) for r in records]
+
+
+def synthetic_events(count: int, seed: int = 0) -> List[HeucodEvent]:
+    """ Generates HEUCOD events like the ones sent by Cep2Home, with a few attributes of the other
+    types handled by the serializer (UUID, datetime and HeucodEventType).
+    """
+    rng = random.Random(seed)
+    events = []
+
+    for i in range(count):
+        event = HeucodEvent()
+        event.id = rng.choice(["bedRoom", "livingRoom", "pillboxSensor"])
+        event.event_type_enum = rng.choice([82099, 82295, 81493])
+        event.description = rng.choice([True, "Medication taken", "Pillbox moved outside window"])
+        event.timestamp = datetime(2024, 5, 16, 12, 0, i % 60).isoformat()
+        event.device_model = rng.choice(["pir", "vibration sensor", None])
+        event.location = "home"
+        if i % 4 == 0:
+            event.id_ = UUID(int=rng.getrandbits(128))
+            event.start_time = datetime(2024, 5, 16, 12, 0, i % 60)
+            event.event_type = HeucodEventType.RoomMovementEvent
+            event.signal_to_noise_ratio = rng.uniform(0, 30)
+        events.append(event)
+
+    return events
+
+
+def legacy_parse(topic: str, message: str) -> Cep2Zigbee2mqttMessage:
+    """ Implementation of Cep2Zigbee2mqttMessage.parse() before the topic router, kept as the
+    baseline of the parse benchmark.
+    """
+    if topic == "zigbee2mqtt/bridge/state":
+        instance = Cep2Zigbee2mqttMessage(type_=Cep2Zigbee2mqttMessageType.BRIDGE_STATE,
+                                          topic=topic,
+                                          state=message)
+    elif topic in ["zigbee2mqtt/bridge/event", "zigbee2mqtt/bridge/logging"]:
+        type_ = {"zigbee2mqtt/bridge/event": Cep2Zigbee2mqttMessageType.BRIDGE_EVENT,
+                 "zigbee2mqtt/bridge/log": Cep2Zigbee2mqttMessageType.BRIDGE_LOG}.get(topic)
+        message_json = json.loads(message)
+        instance = Cep2Zigbee2mqttMessage(type_=type_,
+                                          topic=topic,
+                                          data=message_json.get("data"),
+                                          message=message_json.get("message"),
+                                          meta=message_json.get("meta"))
+    elif topic in ["zigbee2mqtt/bridge/config",
+                   "zigbee2mqtt/bridge/info",
+                   "zigbee2mqtt/bridge/devices",
+                   "zigbee2mqtt/bridge/groups",
+                   "zigbee2mqtt/bridge/request/health_check",
+                   "zigbee2mqtt/bridge/response/health_check"]:
+        instance = None
+    else:
+        instance = Cep2Zigbee2mqttMessage(type_=Cep2Zigbee2mqttMessageType.DEVICE_EVENT,
+                                          topic=topic,
+                                          event=json.loads(message))
+
+    return instance
+
+
+def legacy_from_json(event: str) -> HeucodEvent:
+    """ Key conversion of HeucodEvent.from_json() before the cached key table, kept as the baseline
+    of the events benchmark. The attributes are set directly, since the original implementation
+    ended with dataclasses.replace(), which fails because HeucodEvent is not a dataclass.
+    """
+    instance = HeucodEvent()
+    for k, v in json.loads(event).items():
+        if k != "id":
+            key_tokens = re.split("(?=[A-Z])", k)
+            setattr(instance, "_".join([t.lower() for t in key_tokens]), v)
+        else:
+            instance.id_ = v
+
+    return instance
+
+
+def measure_memory(name: str, function: Callable[[], object], count: int) -> float:
+    """ Prints the memory allocated by a function, per item, keeping its result alive while
+    measuring.
+
+    Returns:
+        float: bytes per item.
+    """
+    tracemalloc.start()
+    result = function()
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    print(f"{name:<40} {allocated / count:>14,.0f} bytes/event")
+
+    return allocated / count
+
+
+def measure(name: str, function: Callable[[], int], repeat: int = 3) -> float:
+    """ Runs a function several times and prints the best throughput.
+
+    Args:
+        name (str): name of the measurement.
+        function (Callable[[], int]): function to measure. It returns the number of operations it
+            executed.
+        repeat (int): number of runs. Defaults to 3.
+
+    Returns:
+        float: best throughput, in operations per second.
+    """
+    best = 0.0
+    for _ in range(repeat):
+        start = perf_counter()
+        operations = function()
+        best = max(best, operations / (perf_counter() - start))
+    print(f"{name:<40} {best:>14,.0f} ops/s")
+
+    return best
+
+
+def bench_parse(args: argparse.Namespace) -> None:
+    stream = load_stream(args.stream) if args.stream else synthetic_stream(args.count)
+    # The controller only reads the payload of the devices it knows.
+    used = {"bedRoom", "livingRoom", "pillboxSensor"}
+
+    def run(parse):
+        def loop():
+            for topic, payload in stream:
+                message = parse(topic, payload)
+                if message and message.type_ == Cep2Zigbee2mqttMessageType.DEVICE_EVENT:
+                    device_id = message.topic.split("/")[1]
+                    if device_id in used:
+                        message.event.get("occupancy")
+            return len(stream)
+        return loop
+
+    def run_router():
+        for topic, payload in stream:
+            message = Cep2Zigbee2mqttMessage.parse(topic, payload)
+            if message and message.type_ == Cep2Zigbee2mqttMessageType.DEVICE_EVENT:
+                if message.device_id in used:
+                    message.event.get("occupancy")
+        return len(stream)
+
+    print(f"parse: {len(stream)} messages")
+    before = measure("legacy parse (messages)", run(legacy_parse))
+    after = measure("router + lazy payload (messages)", run_router)
+    if Cep2Zigbee2mqttMessage.set_json_backend(True):
+        after = measure("router + lazy payload + orjson", run_router)
+        Cep2Zigbee2mqttMessage.set_json_backend(False)
+    print(f"speedup: {after / before:.2f}x")
+
+
+def bench_heucod(args: argparse.Namespace) -> None:
+    events = synthetic_events(args.count)
+    serializer = HeucodEventSerializer()
+
+    # Both serializers must produce the same documents, only the order of the keys can change.
+    for event in events[:1000]:
+        legacy = json.loads(json.dumps(event, cls=HeucodEventJsonEncoder))
+        if legacy != json.loads(serializer.to_json(event)):
+            raise AssertionError(f"Different serialization: {legacy}")
+
+    def run(serialize):
+        def loop():
+            for event in events:
+                serialize(event)
+            return len(events)
+        return loop
+
+    print(f"heucod: {len(events)} events")
+    before = measure("HeucodEventJsonEncoder (events)",
+                     run(lambda e: json.dumps(e, cls=HeucodEventJsonEncoder)), repeat=1)
+    after = measure("HeucodEventSerializer.to_json (events)", run(serializer.to_json), repeat=1)
+    measure("HeucodEventSerializer.to_bytes (events)", run(serializer.to_bytes), repeat=1)
+    print(f"speedup: {after / before:.2f}x")
+
+
+def bench_events(args: argparse.Namespace) -> None:
+    documents = [e.to_json() for e in synthetic_events(args.count)]
+
+    def run(parse):
+        def loop():
+            for document in documents:
+                parse(document)
+            return len(documents)
+        return loop
+
+    def build_batch():
+        batch = HeucodEventBatch()
+        for document in documents:
+            batch.append_json(document)
+        return batch
+
+    print(f"events: {len(documents)} events")
+    before = measure("legacy from_json (events)", run(legacy_from_json))
+    after = measure("HeucodEvent.from_json (events)", run(HeucodEvent.from_json))
+    measure("HeucodCompactEvent.from_json (events)", run(HeucodCompactEvent.from_json))
+    measure("HeucodEventBatch.append_json (events)", lambda: len(build_batch()))
+    print(f"speedup: {after / before:.2f}x")
+
+    # The memory of the JSON documents is not included, only the events built from them.
+    measure_memory("HeucodEvent", lambda: [HeucodEvent.from_json(d) for d in documents],
+                   len(documents))
+    measure_memory("HeucodCompactEvent",
+                   lambda: [HeucodCompactEvent.from_json(d) for d in documents], len(documents))
+    measure_memory("HeucodEventBatch", build_batch, len(documents))
+
+
+def bench_wire(args: argparse.Namespace) -> None:
+    rng = random.Random(0)
+    # The events sent by the homes: their timestamps are unique, unlike the synthetic events.
+    home_events = [Cep2WebDeviceEvent(device_id=d, device_type=t, measurement=m, heucod_event=c,
+                                      location="home").to_heucod()
+                   for d, t, m, c in (rng.choice([("bedRoom", "pir", True, 82099),
+                                                  ("livingRoom", "pir", True, 82099),
+                                                  ("pillboxSensor", "vibration sensor",
+                                                   "Medication taken", 82295)])
+                                      for _ in range(args.count))]
+    datasets = [("synthetic", [e.to_json() for e in synthetic_events(args.count)]),
+                ("home", home_events)]
+
+    def json_body(batch: List[str], compression: Optional[str]) -> bytes:
+        return compress(("[" + ",".join(batch) + "]").encode("utf-8"), compression)
+
+    variants = [("json", json_body, lambda b, c: json.loads(decompress(b, c)), None),
+                ("json+gzip", json_body, lambda b, c: json.loads(decompress(b, c)), "gzip")]
+    variants += [(f"binary+{c}" if c else "binary", encode_batch, decode_documents, c)
+                 for c in [None, *compressions()]]
+
+    for dataset, documents in datasets:
+        batches = [documents[i:i + args.batch_size]
+                   for i in range(0, len(documents), args.batch_size)]
+
+        # The binary format must give back the same documents and events as JSON.
+        for batch in batches[:20]:
+            for compression in [None, *compressions()]:
+                body = encode_batch(batch, compression)
+                if decode_documents(body, compression) != [json.loads(d) for d in batch]:
+                    raise AssertionError(f"Different documents with {compression}")
+                decoded = [e.__dict__ for e in decode_batch(body, compression)]
+                if decoded != [HeucodEvent.from_json(d).__dict__ for d in batch]:
+                    raise AssertionError(f"Different events with {compression}")
+
+        print(f"wire: {len(documents)} {dataset} events, batches of {args.batch_size}")
+        json_size = None
+        for name, encode, decode, compression in variants:
+            bodies = [encode(b, compression) for b in batches]
+            size = sum(map(len, bodies)) / len(documents)
+            json_size = json_size or size
+
+            def encode_all():
+                for batch in batches:
+                    encode(batch, compression)
+                return len(documents)
+
+            def decode_all():
+                for body in bodies:
+                    decode(body, compression)
+                return len(documents)
+
+            print(f"{name:<14} {size:>8.1f} bytes/event ({size / json_size:>5.1%} of JSON)")
+            measure("  encode (events)", encode_all, repeat=1)
+            measure("  decode (events)", decode_all, repeat=1)
+
+
+def bench_ingest(args: argparse.Namespace) -> None:
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from Cep2IngestServer import Cep2IngestServer
+
+    documents = [e.to_json() for e in synthetic_events(args.requests * args.batch_size)]
+    print(f"ingest: {args.clients} clients, {args.requests} requests per run")
+
+    with tempfile.TemporaryDirectory() as directory:
+        server = Cep2IngestServer(f"{directory}/events.db", port=0)
+        server.start()
+        try:
+            for name, batch_size, wire_format in [("send_event", 1, "json"),
+                                                  (f"send_events({args.batch_size})",
+                                                   args.batch_size, "json"),
+                                                  (f"send_events({args.batch_size}) binary",
+                                                   args.batch_size, "binary")]:
+                clients = [Cep2WebClient(server.url, wire_format=wire_format)
+                           for _ in range(args.clients)]
+                batches = [documents[i * batch_size:(i + 1) * batch_size]
+                           for i in range(args.requests)]
+
+                def send(i):
+                    client = clients[i % len(clients)]
+                    if batch_size == 1:
+                        return client.send_event(batches[i][0])
+                    return client.send_events(batches[i])
+
+                stored = server.stats.events
+                start = perf_counter()
+                with ThreadPoolExecutor(args.clients) as executor:
+                    statuses = list(executor.map(send, range(len(batches))))
+                elapsed = perf_counter() - start
+                if any(s != 200 for s in statuses):
+                    raise AssertionError(f"Requests failed: {set(statuses)}")
+                events = server.stats.events - stored
+                print(f"{name:<40} {events / elapsed:>14,.0f} events/s "
+                      f"({len(batches) / elapsed:,.0f} requests/s)")
+                for client in clients:
+                    client.close()
+            stats = server.stats
+            print(f"{stats.events} events stored in {stats.transactions} transactions, "
+                  f"{server.count()} in the database")
+        finally:
+            server.stop()
+
+
+@dataclass
+class StageResult:
+    """ Results of a stage of the stages benchmark. The latencies are in microseconds.
+    """
+
+    name: str
+    operations: int
+    throughput: float
+    p50: float
+    p99: float
+    bytes_per_operation: Optional[float] = None
+
+
+def measure_stage(name: str,
+                  function: Callable[[Any], object],
+                  items: List[Any],
+                  repeat: int = 3,
+                  memory_sample: int = 10000) -> StageResult:
+    """ Measures a stage by calling a function with each item.
+
+    The throughput is the best of several runs of a plain loop. The latencies are measured in a
+    separate run, timing each call, since the timer adds its own overhead. The memory is the memory
+    allocated by the results of the first memory_sample calls, kept alive while measuring.
+    """
+    best = 0.0
+    for _ in range(repeat):
+        start = perf_counter()
+        for item in items:
+            function(item)
+        best = max(best, len(items) / (perf_counter() - start))
+
+    latencies = []
+    for item in items:
+        start = perf_counter_ns()
+        function(item)
+        latencies.append(perf_counter_ns() - start)
+    latencies.sort()
+
+    sample = items[:memory_sample]
+    tracemalloc.start()
+    results = [function(item) for item in sample]
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del results
+
+    result = StageResult(name=name,
+                         operations=len(items),
+                         throughput=best,
+                         p50=latencies[len(latencies) // 2] / 1000,
+                         p99=latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] / 1000,
+                         bytes_per_operation=allocated / len(sample))
+    print_stage(result)
+
+    return result
+
+
+def print_stage(result: StageResult) -> None:
+    memory = f"{result.bytes_per_operation:>10,.0f} B/op" if result.bytes_per_operation is not None \
+        else ""
+    print(f"{result.name:<28} {result.throughput:>12,.0f} ops/s "
+          f"p50 {result.p50:>9.2f} us  p99 {result.p99:>9.2f} us {memory}")
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_history(path: str,
+                    parameters: Dict[str, Any],
+                    results: List[StageResult],
+                    max_regression: Optional[float]) -> bool:
+    """ Compares the results with the last run in the history file with the same parameters, and
+    appends them to the file.
+
+    Returns:
+        bool: False if a stage regressed more than max_regression percent (lower throughput or
+            higher p99 latency).
+    """
+    previous = None
+    try:
+        with open(path, "r", encoding="utf-8") as history:
+            for line in history:
+                if line.strip():
+                    run = json.loads(line)
+                    if run.get("parameters") == parameters:
+                        previous = run
+    except FileNotFoundError:
+        pass
+
+    passed = True
+    if previous is not None:
+        print(f"compared with {previous.get('revision') or 'unknown revision'} "
+              f"({previous['time']}):")
+        before = {r["name"]: r for r in previous["results"]}
+        for result in results:
+            old = before.get(result.name)
+            if old is None:
+                continue
+            throughput = (result.throughput / old["throughput"] - 1) * 100
+            p99 = (result.p99 / old["p99"] - 1) * 100 if old["p99"] else 0.0
+            regressed = max_regression is not None and \
+                (-throughput > max_regression or p99 > max_regression)
+            passed = passed and not regressed
+            print(f"{result.name:<28} throughput {throughput:>+7.1f}%  p99 {p99:>+7.1f}%"
+                  f"{'  REGRESSION' if regressed else ''}")
+
+    with open(path, "a", encoding="utf-8") as history:
+        history.write(json.dumps({"time": datetime.now().isoformat(timespec="seconds"),
+                                  "revision": git_revision(),
+                                  "python": platform.python_version(),
+                                  "parameters": parameters,
+                                  "results": [asdict(r) for r in results]}) + "\n")
+
+    return passed
+
+
+def bench_stages(args: argparse.Namespace) -> bool:
+    # Imported here since Cep2Replay uses the streams of this module.
+    from Cep2Replay import Cep2HttpSink, replay, timed_stream
+
+    stream = load_stream(args.stream) if args.stream else \
+        synthetic_stream(args.count, devices=args.devices)
+    used = {"bedRoom": "pir", "livingRoom": "pir", "pillboxSensor": "vibration sensor"}
+    model = Cep2Model()
+    model.add([Cep2ZigbeeDevice(i, t) for i, t in used.items()])
+    model.add([Cep2ZigbeeDevice(f"device{i}", "power plug") for i in range(args.devices + 1)])
+
+    messages = [m for m in (Cep2Zigbee2mqttMessage.parse(t, p) for t, p in stream) if m]
+    device_ids = [m.device_id for m in messages
+                  if m.type_ == Cep2Zigbee2mqttMessageType.DEVICE_EVENT]
+    web_events = [Cep2WebDeviceEvent(device_id=i, device_type=used[i], measurement=True,
+                                     heucod_event=82099, location="home")
+                  for i in device_ids if i in used]
+    heucod_events = [HeucodEvent.from_json(e.to_heucod()) for e in web_events]
+    documents = [e.to_json() for e in heucod_events]
+    serializer = HeucodEventSerializer()
+    print(f"stages: {len(stream)} messages, {len(model)} devices, {len(web_events)} events")
+
+    results = [
+        measure_stage("parse", lambda m: Cep2Zigbee2mqttMessage.parse(*m), stream),
+        measure_stage("model.find", model.find, device_ids),
+        measure_stage("to_heucod", Cep2WebDeviceEvent.to_heucod, web_events),
+        measure_stage("HeucodEventJsonEncoder",
+                      lambda e: json.dumps(e, cls=HeucodEventJsonEncoder), heucod_events),
+        measure_stage("HeucodEventSerializer", serializer.to_json, heucod_events),
+    ]
+
+    # The uplink is measured against a local HTTP server, so the results show the cost of the
+    # client and of HTTP, not of the network. Fewer operations are done since each is a request.
+    sink = Cep2HttpSink()
+    sink.start()
+    client = Cep2WebClient(sink.url)
+    try:
+        single = documents[:min(len(documents), args.requests)]
+        results.append(measure_stage("send_event", client.send_event, single, repeat=1,
+                                     memory_sample=100))
+        batches = [documents[i:i + args.batch_size]
+                   for i in range(0, min(len(documents), args.requests * args.batch_size),
+                                  args.batch_size)]
+        results.append(measure_stage(f"send_events({args.batch_size})", client.send_events,
+                                     batches, repeat=1, memory_sample=100))
+    finally:
+        client.close()
+        sink.stop()
+
+    # The whole pipeline, through the fake broker, the controller and the uplink.
+    report = replay(timed_stream(stream[:args.pipeline_count], 10))
+    result = StageResult(name="pipeline",
+                         operations=report.handled,
+                         throughput=report.throughput,
+                         p50=report.latency[50] * 1000,
+                         p99=report.latency[99] * 1000)
+    print_stage(result)
+    results.append(result)
+
+    if args.history:
+        parameters = {"stream": args.stream, "count": len(stream), "devices": args.devices,
+                      "requests": args.requests, "batch_size": args.batch_size,
+                      "pipeline_count": args.pipeline_count}
+        return compare_history(args.history, parameters, results, args.max_regression)
+
+    return True
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "heucod": bench_heucod,
+    "events": bench_events,
+    "wire": bench_wire,
+    "ingest": bench_ingest,
+    "stages": bench_stages,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the gateway's hot paths")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS) + ["all"])
+    parser.add_argument("--count", type=int, default=100000,
+                        help="number of synthetic messages/events (default: 100000)")
+    parser.add_argument("--stream", help="recorded zigbee2mqtt stream, in JSON lines format")
+    parser.add_argument("--devices", type=int, default=20,
+                        help="devices not used by the controller, in the stream and the model "
+                             "(default: 20)")
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="HTTP requests of the uplink stages (default: 1000)")
+    parser.add_argument("--batch-size", type=int, default=50,
+                        help="events per request of the send_events stage and of the wire "
+                             "benchmark (default: 50)")
+    parser.add_argument("--clients", type=int, default=4,
+                        help="concurrent clients of the ingest benchmark (default: 4)")
+    parser.add_argument("--pipeline-count", type=int, default=20000,
+                        help="messages replayed through the whole pipeline (default: 20000)")
+    parser.add_argument("--history", help="JSON lines file where the stages results are kept")
+    parser.add_argument("--max-regression", type=float,
+                        help="fail if a stage is this percentage slower than the previous run")
+    args = parser.parse_args()
+
+    passed = True
+    for name, benchmark in BENCHMARKS.items():
+        if args.benchmark in (name, "all"):
+            passed = benchmark(args) is not False and passed
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from threading import Lock
+from typing import Dict, Optional, Tuple
+from Cep2WebClient import (Cep2AsyncWebClient, Cep2ConfigResponse, Cep2WebClient, check_variables,
+                          parse_variables)
+
+
+@dataclass
+class Cep2ConfigEntry:
+    """ Last configuration retrieved from a URL, and the validators used to ask the server whether
+    it changed.
+    """
+
+    url: str
+    # The medication schedule, as (variable1, variable2, variable3).
+    variables: tuple
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # SHA-256 of the body, used when the server does not send ETag nor Last-Modified.
+    content_hash: Optional[str] = None
+    # When the configuration was last confirmed by the server, in ISO format.
+    fetched_at: Optional[str] = None
+
+
+class Cep2ConfigCache:
+    """ This class keeps the last configuration (medication schedule) retrieved from each URL, in
+    memory and in a JSON file, so that:
+
+    - the configuration is not downloaded again if it did not change: the requests are conditional
+      (If-None-Match/If-Modified-Since), and a body with the same hash as the cached one is not
+      considered a change either, for servers that do not support conditional requests.
+    - the last known configuration is used when the server can not be reached, also after a
+      restart of the gateway.
+
+    A configuration that is not a valid schedule (see check_variables()) is not cached: the last
+    valid one is kept.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """ Class initializer.
+
+        Args:
+            path (Optional[str]): JSON file where the cache is persisted. If None, it is only kept
+                in memory.
+        """
+        self.__path = path
+        self.__entries: Dict[str, Cep2ConfigEntry] = {}
+        self.__lock = Lock()
+        self.__load()
+
+    def get(self, url: str) -> Optional[tuple]:
+        """ Returns the cached configuration of a URL, or None if it was never retrieved.
+        """
+        with self.__lock:
+            entry = self.__entries.get(url)
+
+            return entry.variables if entry else None
+
+    def entry(self, url: str) -> Optional[Cep2ConfigEntry]:
+        with self.__lock:
+            return self.__entries.get(url)
+
+    def refresh(self, client: Cep2WebClient) -> Tuple[Optional[tuple], bool]:
+        """ Retrieves the configuration of the client's URL if it changed. If the server can not be
+        reached, the cached configuration is returned.
+
+        Returns:
+            Tuple[Optional[tuple], bool]: the configuration, None if it is unknown, and whether it
+                changed since it was last retrieved.
+        """
+        url = client.host
+        entry = self.entry(url)
+        try:
+            response = client.retrieve_config(entry.etag if entry else None,
+                                              entry.last_modified if entry else None)
+        except (ConnectionError, RuntimeError) as ex:
+            print(f"{ex}, using the cached configuration")
+            return (entry.variables if entry else None), False
+
+        return self.__update(url, response)
+
+    async def refresh_async(self, client: Cep2AsyncWebClient) -> Tuple[Optional[tuple], bool]:
+        """ asyncio variant of refresh().
+        """
+        url = client.host
+        entry = self.entry(url)
+        try:
+            response = await client.retrieve_config(entry.etag if entry else None,
+                                                    entry.last_modified if entry else None)
+        except (ConnectionError, RuntimeError) as ex:
+            print(f"{ex}, using the cached configuration")
+            return (entry.variables if entry else None), False
+
+        return self.__update(url, response)
+
+    def __update(self, url: str, response: Cep2ConfigResponse) -> Tuple[Optional[tuple], bool]:
+        now = datetime.now().isoformat(timespec="seconds")
+
+        with self.__lock:
+            entry = self.__entries.get(url)
+            if response.status == 304 and entry is not None:
+                entry.fetched_at = now
+                return entry.variables, False
+
+            if response.body is None:
+                # A 304 without a cached configuration, e.g. if the cache file was removed.
+                return None, False
+            content_hash = hashlib.sha256(response.body).hexdigest()
+            changed = entry is None or entry.content_hash != content_hash
+            if changed:
+                try:
+                    variables = parse_variables(json.loads(response.body))
+                except ValueError as ex:
+                    # The previous configuration is kept, and the document is not cached.
+                    print(f"Invalid configuration from {url}: {ex}")
+                    return (entry.variables if entry else None), False
+            else:
+                variables = entry.variables
+            entry = Cep2ConfigEntry(url=url,
+                                    variables=variables,
+                                    etag=response.etag,
+                                    last_modified=response.last_modified,
+                                    content_hash=content_hash,
+                                    fetched_at=now)
+            self.__entries[url] = entry
+            self.__save()
+
+            return entry.variables, changed
+
+    def __load(self) -> None:
+        if not self.__path or not os.path.exists(self.__path):
+            return
+
+        try:
+            with open(self.__path, "r", encoding="utf-8") as cache:
+                for record in json.load(cache):
+                    record["variables"] = check_variables(record["variables"])
+                    self.__entries[record["url"]] = Cep2ConfigEntry(**record)
+        except (ValueError, KeyError, TypeError) as ex:
+            # A corrupted cache is ignored, the configuration is retrieved again.
+            print(f"Error reading the configuration cache {self.__path}: {ex}")
+            self.__entries.clear()
+
+    def __save(self) -> None:
+        """ Writes the cache to its file. The caller must hold the lock.
+        """
+        if not self.__path:
+            return
+
+        # The file is replaced atomically, so a power loss does not leave a truncated cache.
+        temporary = f"{self.__path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as cache:
+            json.dump([asdict(e) for e in self.__entries.values()], cache)
+            cache.flush()
+            os.fsync(cache.fileno())
+        os.replace(temporary, self.__path)
@@ -1,177 +1,445 @@
-from hmac import new
-from itertools import count
+import asyncio
+import random
+from threading import Thread
+from time import monotonic
+from typing import Dict, List, Optional, Union
+from Cep2ConfigCache import Cep2ConfigCache
+from Cep2Debouncer import Cep2DebouncerStats, Cep2EventDebouncer
+from Cep2EventStore import Cep2EventStore
+from Cep2Home import Cep2Home
+from Cep2Metrics import METRICS
 from Cep2Model import Cep2Model
-from Cep2WebClient import Cep2WebClient, Cep2WebDeviceEvent
-from Cep2Zigbee2mqttClient import (Cep2Zigbee2mqttClient,
-                                   Cep2Zigbee2mqttMessage, Cep2Zigbee2mqttMessageType)
-import time
+from Cep2Scheduler import Cep2AsyncScheduler, Cep2Clock, Cep2Scheduler
+from Cep2WebClient import Cep2AsyncWebClient, Cep2AsyncWebUplink, Cep2WebClient, Cep2WebUplink
+from Cep2Zigbee2mqttClient import (Cep2AsyncZigbee2mqttClient, Cep2Zigbee2mqttClient,
+                                   Cep2Zigbee2mqttMessage)
 from datetime import datetime, timedelta
-from threading import Thread
+from Cep2Dispatcher import Cep2OverflowPolicy
+from paho.mqtt.client import Client as MqttClient
+
+# Time from the reception of a message until a home finished handling it, see Cep2Metrics.
+_MESSAGE_SECONDS = METRICS.histogram("cep2_message_latency_seconds",
+                                     "Time from the reception of a message until it is handled")
+
+
+def _start_metrics(port: Optional[int], dump_interval: Optional[float]) -> None:
+    """ Enables the metrics if the controller is configured to expose them.
+    """
+    if port is not None:
+        port = METRICS.serve(port)
+        print(f"Metrics available at http://127.0.0.1:{port}/metrics")
+    if dump_interval is not None:
+        METRICS.start_dump(dump_interval)
+
+
+def _next_update_time(now: datetime, update_time: datetime, jitter: float) -> datetime:
+    """ Returns the next time of the daily update after now, with a random delay of up to jitter
+    seconds.
+    """
+    updateTime = datetime.combine(now.date(), update_time.time())
+    if updateTime <= now:
+        updateTime = updateTime + timedelta(days=1)
+
+    return updateTime + timedelta(seconds=random.uniform(0, jitter))
+
+
+def _apply_schedule(home: Cep2Home, schedule: tuple) -> None:
+    """ Gives a home the medication schedule of the server. A schedule that the home can not use
+    is reported, and the home keeps its current schedule, so the controller still starts.
+    """
+    try:
+        home.update_schedule(*schedule)
+    except (ValueError, TypeError, IndexError) as ex:
+        print(f"Invalid medication schedule for {home.home_id}: {ex}")
+
 
 class Cep2Controller:
     HTTP_HOST = "http://172.20.10.6/receive_data.php"  # Replace with your server's IP
     HTTP_HOST_RETRIEVE = "http://172.20.10.6/retrieve_variables.php"
     MQTT_BROKER_HOST = "localhost"
     MQTT_BROKER_PORT = 1883
-    medicationTime = datetime(2024, 5, 16, 16, 18)
-    timeWindowBefore = 1 #time window before medication time for the patient to take the medication
-    timeWindowAfter = 1 #time window after medication time for the patient to take the medication
+    MQTT_CLIENT_ID = None # ID of the persistent MQTT session. None uses cep2-<host name>-<first base topic>
+    MQTT_RECONNECT_DELAY = (0.1, 1.0) # Minimum and maximum seconds between attempts to reconnect to the broker
+    DISPATCH_WORKERS = 4 # Number of threads handling the zigbee2mqtt events, see Cep2Zigbee2mqttClient
+    DISPATCH_KEEP_FIELDS = ("vibration", "occupancy") # Fields of the events handled by the rules, never coalesced when the dispatcher is full
+    UPLINK_SPOOL_PATH = "uplink_spool.jsonl" # File where the events are kept while the server is down
+    UPLINK_WIRE_FORMAT = "json" # "binary" sends the events in the compact format of Cep2WireFormat, with JSON as fallback
+    UPLINK_COMPRESSION = None # Compression of the binary batches, "gzip" or "zstd"
+    EVENT_STORE_PATH = None # Directory of the local history of the events, see Cep2EventStore. None disables it
+    HEALTH_CHECK_ON_START = True # Whether start() starts the periodic health checks of the zigbee2mqtt instances
+    HEALTH_CHECK_INTERVAL = 300 # Seconds between health checks, see Cep2Zigbee2mqttClient.health()
+    METRICS_PORT = None # Port of the local metrics endpoint (http://127.0.0.1:<port>/metrics), see Cep2Metrics. None disables it
+    METRICS_DUMP_INTERVAL = None # Seconds between summaries of the metrics printed. None disables them
+    #Fields whose repeated reports are discarded, see Cep2EventDebouncer. Empty disables it. occupancy must not be
+    #debounced: the occupancy engine of the homes adds up the repeated reports of the motion sensors
+    DEBOUNCE_FIELDS = ("vibration",)
+    DEBOUNCE_WINDOW = 30.0 # Seconds after which an unchanged report is handled again. None only handles changes
+    CONFIG_CACHE_PATH = "config_cache.json" # File where the last medication schedules are kept, see Cep2ConfigCache. None keeps them in memory
+    CONFIG_REFRESH_JITTER = 900 # Maximum random delay, in seconds, of the daily update, so many gateways do not request it at the same time
+    RULES_RELOAD_INTERVAL = 10 # Seconds between checks of the rules files of the homes, see Cep2Rules. None disables the reload
     dailyUpdateTime = datetime(2024, 5, 16, 23, 59)
-    currentRoom = "Stue"
-    runningThread = True
-    medicationTaken = False #variable for checking if the medication has been taken
-    HeucodNum = 0 #number for identifying the event in the Heucod standard
-    EventDescription = "" #variable for the description of the Heucod event
-    #Below is the dictionary containing the connection between the motion sensors and the lights in the rooms
-    sensorToActuator = {
-        "bedRoom": "bedroomLight",
-        "livingRoom": "livingroomLight",
-    }
-
-    def __init__(self, devices_model: Cep2Model) -> None:
-        self.__devices_model = devices_model
+
+    def __init__(self,
+                 homes: Union[Cep2Model, List[Cep2Home]],
+                 clock: Optional[Cep2Clock] = None,
+                 mqtt_client: Optional[MqttClient] = None) -> None:
+        """ Class initializer.
+
+        Args:
+            homes (Union[Cep2Model, List[Cep2Home]]): the homes served by the controller. If a
+                Cep2Model is given, the controller serves a single home with those devices and the
+                default configuration of Cep2Home.
+            clock (Optional[Cep2Clock]): clock of the scheduler. Defaults to the wall clock.
+            mqtt_client (Optional[MqttClient]): MQTT client used to connect to the broker, see
+                Cep2Zigbee2mqttClient. Defaults to a new paho Client.
+        """
+        if isinstance(homes, Cep2Model):
+            homes = [Cep2Home("home", homes)]
+        #Below is the dictionary containing the homes, by the base topic of their zigbee2mqtt instance
+        self.__homes = {h.base_topic: h for h in homes}
+        if len(self.__homes) != len(homes):
+            raise ValueError("Each home must have a different base topic")
+
+        # A single MQTT connection receives the messages of all the homes.
         self.__z2m_client = Cep2Zigbee2mqttClient(host=self.MQTT_BROKER_HOST,
                                                   port=self.MQTT_BROKER_PORT,
-                                                  on_message_clbk=self.__zigbee2mqtt_event_received)
-        
-    #Time loop running on a thread for handling most real time events, explained in the report
-    def timeLoop(self):
-        while self.runningThread:
-            nowTime = datetime.now()
-            if nowTime > self.dailyUpdateTime:
-                client = Cep2WebClient(self.HTTP_HOST_RETRIEVE)
-                var1, self.timeWindowBefore, self.timeWindowAfter = client.retrieve_variables()
-                self.medicationTime = datetime(2024, 5, 16, var1[0], var1[1])
-                self.medicationTaken = False
-                self.dailyUpdateTime = self.dailyUpdateTime + timedelta(days=1)
-
-            if nowTime > self.medicationTime + timedelta(minutes=self.timeWindowAfter):
-                if self.currentRoom in self.sensorToActuator:
-                    self.__z2m_client.change_state(self.sensorToActuator[self.currentRoom], "ON", 0.7, 0.29)
-                else:
-                    print(f"Unknown room: {self.currentRoom}")
-                self.__z2m_client.change_state("kitchenLight", "ON", 0.7, 0.29)
-
-            elif nowTime > self.medicationTime:
-                if self.currentRoom in self.sensorToActuator:
-                    self.__z2m_client.change_state(self.sensorToActuator[self.currentRoom], "ON", 0.45, 0.5)
-                else:
-                    print(f"Unknown room: {self.currentRoom}")
-                self.__z2m_client.change_state("kitchenLight", "ON", 0.45, 0.5)
-
-            elif nowTime > self.medicationTime - timedelta(minutes=self.timeWindowBefore):
-                if self.currentRoom in self.sensorToActuator:
-                    self.__z2m_client.change_state(self.sensorToActuator[self.currentRoom], "ON", 0.15, 0.75)
-                else:
-                    print(f"Unknown room: {self.currentRoom}")
-                self.__z2m_client.change_state("kitchenLight", "ON", 0.15, 0.75)
-
-            time.sleep(5) # Delay 5 seconds
+                                                  on_message_clbk=self.__zigbee2mqtt_event_received,
+                                                  base_topics=list(self.__homes),
+                                                  workers=self.DISPATCH_WORKERS,
+                                                  overflow_policy=Cep2OverflowPolicy.COALESCE,
+                                                  keep_fields=self.DISPATCH_KEEP_FIELDS,
+                                                  mqtt_client=mqtt_client,
+                                                  client_id=self.MQTT_CLIENT_ID,
+                                                  min_reconnect_delay=self.MQTT_RECONNECT_DELAY[0],
+                                                  max_reconnect_delay=self.MQTT_RECONNECT_DELAY[1])
+        # The uplink sends the events to the server in the background, so a slow or unreachable
+        # server does not delay the processing of the zigbee2mqtt events. It is shared by all homes.
+        self.__uplink = Cep2WebUplink(Cep2WebClient(self.HTTP_HOST,
+                                                    wire_format=self.UPLINK_WIRE_FORMAT,
+                                                    compression=self.UPLINK_COMPRESSION),
+                                      spool_path=self.UPLINK_SPOOL_PATH)
+        # One client per configuration URL, so homes sharing a URL share its connection.
+        self.__config_clients: Dict[str, Cep2WebClient] = {}
+        # The reminders are driven by the deadlines of the scheduler, so nothing is done between
+        # transitions of the reminder phases. The clock can be replaced, e.g. by a Cep2ManualClock
+        # to run the reminders in accelerated time.
+        self.__scheduler = Cep2Scheduler(clock)
+        self.__event_store = Cep2EventStore(self.EVENT_STORE_PATH) if self.EVENT_STORE_PATH else None
+        # Repeated sensor reports are discarded before the homes handle them and send them to the server.
+        self.__debouncer = Cep2EventDebouncer(self.DEBOUNCE_FIELDS, self.DEBOUNCE_WINDOW) \
+            if self.DEBOUNCE_FIELDS else None
+        self.__config_cache = Cep2ConfigCache(self.CONFIG_CACHE_PATH)
+
+        for home in homes:
+            home.attach(self.__z2m_client, self.__uplink, self.__scheduler, self.__event_store)
+
+    @property
+    def scheduler(self) -> Cep2Scheduler:
+        return self.__scheduler
+
+    @property
+    def event_store(self) -> Optional[Cep2EventStore]:
+        return self.__event_store
+
+    @property
+    def debouncer_stats(self) -> Optional[Cep2DebouncerStats]:
+        return self.__debouncer.stats if self.__debouncer else None
+
+    @property
+    def uplink(self) -> Cep2WebUplink:
+        return self.__uplink
+
+    @property
+    def zigbee2mqtt_client(self) -> Cep2Zigbee2mqttClient:
+        return self.__z2m_client
+
+    @property
+    def homes(self) -> List[Cep2Home]:
+        return list(self.__homes.values())
+
+    def home(self, home_id: str) -> Optional[Cep2Home]:
+        return next((h for h in self.__homes.values() if h.home_id == home_id), None)
 
     #Start function for starting the controller
     def start(self) -> None:
+        _start_metrics(self.METRICS_PORT, self.METRICS_DUMP_INTERVAL)
+        if self.__z2m_client.dispatcher_stats is not None:
+            METRICS.gauge("cep2_dispatcher_pending", "Messages waiting in the dispatcher's queues",
+                          lambda: self.__z2m_client.dispatcher_stats.pending)
+        METRICS.gauge("cep2_uplink_queue_depth", "Events waiting to be sent to the server",
+                      lambda: self.__uplink.stats.queue_depth)
+        self.__uplink.start()
         self.__z2m_client.connect()
-        timeThread = Thread(target=self.timeLoop)
-        timeThread.start()
-        print("Thread started")
-        print(f"Zigbee2Mqtt is {self.__z2m_client.check_health()}")
-
-    #Function for blinking a light
-    def blink(self, light_sensor_id) -> None:
-        counter = 0
-        while counter <= 1:
-            self.__z2m_client.change_state(light_sensor_id, "ON", 0.7, 0.28)
-            time.sleep(1)
-            self.__z2m_client.change_state(light_sensor_id, "OFF", 0.7, 0.28)
-            time.sleep(1)
-            counter += 1
-        return
+        for home in self.__homes.values():
+            #the last schedule retrieved is used until the next daily update, even if the server is down
+            schedule = self.__config_cache.get(home.config_url or self.HTTP_HOST_RETRIEVE)
+            if schedule is not None:
+                _apply_schedule(home, schedule)
+            home.start()
+        self.__schedule_daily_update()
+        self.__schedule_rules_reload()
+        self.__scheduler.start()
+        print("Scheduler started")
+        #the health is checked in the background with the MQTT connection of the client, so start() does
+        #not wait for the responses. The results are printed when they arrive
+        if self.HEALTH_CHECK_ON_START:
+            self.__z2m_client.start_health_monitor(self.HEALTH_CHECK_INTERVAL)
 
     #Stop function for stopping the controller
     def stop(self) -> None:
+        self.__scheduler.stop()
         self.__z2m_client.disconnect()
+        self.__uplink.stop()
+        # The server is only stopped if the controller started it.
+        if self.METRICS_PORT is not None or self.METRICS_DUMP_INTERVAL is not None:
+            METRICS.stop()
+        if self.__event_store is not None:
+            self.__event_store.close()
+
+    #Function for scheduling the daily update of the medication schedule from the server. A random delay
+    #is added, so the gateways of many homes do not request their schedules at the same time
+    def __schedule_daily_update(self) -> None:
+        self.__scheduler.schedule_at(_next_update_time(self.__scheduler.now(),
+                                                       self.dailyUpdateTime,
+                                                       self.CONFIG_REFRESH_JITTER),
+                                     self.__start_daily_update)
+
+    #Function for checking periodically if the rules files of the homes changed. The rules are compiled
+    #again without restarting the MQTT connection, see Cep2Home.reload_rules()
+    def __schedule_rules_reload(self) -> None:
+        if self.RULES_RELOAD_INTERVAL is None or not any(h.rulesPath for h in self.__homes.values()):
+            return
+
+        def reload():
+            for home in self.__homes.values():
+                home.reload_rules()
+            self.__schedule_rules_reload()
+
+        self.__scheduler.schedule_in(timedelta(seconds=self.RULES_RELOAD_INTERVAL), reload)
+
+    #Callback of the scheduler, the update runs on its own thread so the reminders are not delayed
+    #while the schedules are retrieved
+    def __start_daily_update(self) -> None:
+        Thread(target=self.__daily_update, daemon=True).start()
+
+    #Function retrieving the medication schedule of each home, once a day. A schedule is only
+    #downloaded if it changed, and the cached one is kept if the server can not be reached
+    def __daily_update(self) -> None:
+        #schedules retrieved in this update, by URL, so a URL shared by several homes is retrieved once
+        schedules = {}
+        try:
+            for home in self.__homes.values():
+                url = home.config_url or self.HTTP_HOST_RETRIEVE
+                if url not in schedules:
+                    if url not in self.__config_clients:
+                        self.__config_clients[url] = Cep2WebClient(url)
+                    schedules[url] = self.__config_cache.refresh(self.__config_clients[url])
+                schedule, changed = schedules[url]
+                if changed:
+                    _apply_schedule(home, schedule)
+        except Exception as ex:
+            # An error must not stop the daily updates.
+            print(f"Error updating the schedules: {ex}")
+        finally:
+            self.__schedule_daily_update()
 
     #Function for handling Zigbee2Mqtt events, this is running on a separate thread executing each time an event is received
     def __zigbee2mqtt_event_received(self, message: Cep2Zigbee2mqttMessage) -> None:
-        occupancy = False
         if not message:
             return
+        if self.__debouncer and not self.__debouncer.accept(message):
+            return
 
         print(
             f"zigbee2mqtt event received on topic {message.topic}: {message.data}")
 
-        if message.type_ != Cep2Zigbee2mqttMessageType.DEVICE_EVENT:
+        home = self.__homes.get(message.base_topic)
+        if home:
+            home.handle_message(message)
+            if METRICS.enabled and message.received_at is not None:
+                _MESSAGE_SECONDS.observe(monotonic() - message.received_at)
+
+
+class Cep2AsyncController:
+    """ asyncio variant of Cep2Controller. The MQTT client, the uplink, the scheduler and the handling
+    of the zigbee2mqtt events run in a single event loop, without extra threads:
+
+        controller = Cep2AsyncController(devices_model)
+        await controller.start()
+        await controller.run()
+
+    The homes are the same Cep2Home objects used by Cep2Controller.
+    """
+
+    HTTP_HOST = Cep2Controller.HTTP_HOST
+    HTTP_HOST_RETRIEVE = Cep2Controller.HTTP_HOST_RETRIEVE
+    MQTT_BROKER_HOST = Cep2Controller.MQTT_BROKER_HOST
+    MQTT_BROKER_PORT = Cep2Controller.MQTT_BROKER_PORT
+    MQTT_CLIENT_ID = Cep2Controller.MQTT_CLIENT_ID
+    MQTT_RECONNECT_DELAY = Cep2Controller.MQTT_RECONNECT_DELAY
+    HEALTH_CHECK_ON_START = Cep2Controller.HEALTH_CHECK_ON_START
+    HEALTH_CHECK_INTERVAL = Cep2Controller.HEALTH_CHECK_INTERVAL
+    UPLINK_SPOOL_PATH = Cep2Controller.UPLINK_SPOOL_PATH
+    UPLINK_WIRE_FORMAT = Cep2Controller.UPLINK_WIRE_FORMAT
+    UPLINK_COMPRESSION = Cep2Controller.UPLINK_COMPRESSION
+    EVENT_STORE_PATH = Cep2Controller.EVENT_STORE_PATH
+    METRICS_PORT = Cep2Controller.METRICS_PORT
+    METRICS_DUMP_INTERVAL = Cep2Controller.METRICS_DUMP_INTERVAL
+    DEBOUNCE_FIELDS = Cep2Controller.DEBOUNCE_FIELDS
+    DEBOUNCE_WINDOW = Cep2Controller.DEBOUNCE_WINDOW
+    CONFIG_CACHE_PATH = Cep2Controller.CONFIG_CACHE_PATH
+    CONFIG_REFRESH_JITTER = Cep2Controller.CONFIG_REFRESH_JITTER
+    RULES_RELOAD_INTERVAL = Cep2Controller.RULES_RELOAD_INTERVAL
+    dailyUpdateTime = Cep2Controller.dailyUpdateTime
+
+    def __init__(self, homes: Union[Cep2Model, List[Cep2Home]], clock: Optional[Cep2Clock] = None) -> None:
+        """ Class initializer, see Cep2Controller.
+        """
+        if isinstance(homes, Cep2Model):
+            homes = [Cep2Home("home", homes)]
+        self.__homes = {h.base_topic: h for h in homes}
+        if len(self.__homes) != len(homes):
+            raise ValueError("Each home must have a different base topic")
+
+        self.__z2m_client = Cep2AsyncZigbee2mqttClient(host=self.MQTT_BROKER_HOST,
+                                                       port=self.MQTT_BROKER_PORT,
+                                                       base_topics=list(self.__homes),
+                                                       client_id=self.MQTT_CLIENT_ID,
+                                                       min_reconnect_delay=self.MQTT_RECONNECT_DELAY[0],
+                                                       max_reconnect_delay=self.MQTT_RECONNECT_DELAY[1])
+        self.__uplink = Cep2AsyncWebUplink(Cep2AsyncWebClient(self.HTTP_HOST,
+                                                              wire_format=self.UPLINK_WIRE_FORMAT,
+                                                              compression=self.UPLINK_COMPRESSION),
+                                           spool_path=self.UPLINK_SPOOL_PATH)
+        self.__config_clients: Dict[str, Cep2AsyncWebClient] = {}
+        self.__scheduler = Cep2AsyncScheduler(clock)
+        self.__event_store = Cep2EventStore(self.EVENT_STORE_PATH) if self.EVENT_STORE_PATH else None
+        # Repeated sensor reports are discarded before the homes handle them and send them to the server.
+        self.__debouncer = Cep2EventDebouncer(self.DEBOUNCE_FIELDS, self.DEBOUNCE_WINDOW) \
+            if self.DEBOUNCE_FIELDS else None
+        self.__config_cache = Cep2ConfigCache(self.CONFIG_CACHE_PATH)
+        self.__daily_update_task = None
+        self.__health_task = None
+
+        for home in homes:
+            home.attach(self.__z2m_client, self.__uplink, self.__scheduler, self.__event_store)
+
+    @property
+    def scheduler(self) -> Cep2AsyncScheduler:
+        return self.__scheduler
+
+    @property
+    def event_store(self) -> Optional[Cep2EventStore]:
+        return self.__event_store
+
+    @property
+    def debouncer_stats(self) -> Optional[Cep2DebouncerStats]:
+        return self.__debouncer.stats if self.__debouncer else None
+
+    @property
+    def homes(self) -> List[Cep2Home]:
+        return list(self.__homes.values())
+
+    def home(self, home_id: str) -> Optional[Cep2Home]:
+        return next((h for h in self.__homes.values() if h.home_id == home_id), None)
+
+    async def start(self) -> None:
+        _start_metrics(self.METRICS_PORT, self.METRICS_DUMP_INTERVAL)
+        METRICS.gauge("cep2_uplink_queue_depth", "Events waiting to be sent to the server",
+                      lambda: self.__uplink.stats.queue_depth)
+        await self.__uplink.start()
+        await self.__z2m_client.connect()
+        for home in self.__homes.values():
+            schedule = self.__config_cache.get(home.config_url or self.HTTP_HOST_RETRIEVE)
+            if schedule is not None:
+                _apply_schedule(home, schedule)
+            home.start()
+        self.__schedule_daily_update()
+        self.__schedule_rules_reload()
+        self.__scheduler.start()
+        print("Scheduler started")
+        if self.HEALTH_CHECK_ON_START:
+            self.__health_task = asyncio.get_running_loop().create_task(
+                self.__z2m_client.monitor_health(self.HEALTH_CHECK_INTERVAL))
+
+    async def run(self) -> None:
+        """ Handles the zigbee2mqtt events until the controller is stopped.
+        """
+        async for message in self.__z2m_client:
+            self.__zigbee2mqtt_event_received(message)
+
+    async def stop(self) -> None:
+        self.__scheduler.stop()
+        if self.__health_task:
+            self.__health_task.cancel()
+        await self.__z2m_client.disconnect()
+        await self.__uplink.stop()
+        # The server is only stopped if the controller started it.
+        if self.METRICS_PORT is not None or self.METRICS_DUMP_INTERVAL is not None:
+            METRICS.stop()
+        for client in self.__config_clients.values():
+            await client.close()
+        if self.__event_store is not None:
+            self.__event_store.close()
+
+    def __schedule_daily_update(self) -> None:
+        self.__scheduler.schedule_at(_next_update_time(self.__scheduler.now(),
+                                                       self.dailyUpdateTime,
+                                                       self.CONFIG_REFRESH_JITTER),
+                                     self.__start_daily_update)
+
+    #See Cep2Controller.__schedule_rules_reload()
+    def __schedule_rules_reload(self) -> None:
+        if self.RULES_RELOAD_INTERVAL is None or not any(h.rulesPath for h in self.__homes.values()):
             return
 
-        tokens = message.topic.split("/")
-        if len(tokens) <= 1:
+        def reload():
+            for home in self.__homes.values():
+                home.reload_rules()
+            self.__schedule_rules_reload()
+
+        self.__scheduler.schedule_in(timedelta(seconds=self.RULES_RELOAD_INTERVAL), reload)
+
+    #Callback of the scheduler, the update is run as a task so the event loop is not blocked while
+    #the schedules are retrieved
+    def __start_daily_update(self) -> None:
+        self.__daily_update_task = asyncio.get_running_loop().create_task(self.__daily_update())
+
+    async def __daily_update(self) -> None:
+        #the schedules are retrieved concurrently, once per URL
+        urls = list(dict.fromkeys(home.config_url or self.HTTP_HOST_RETRIEVE
+                                  for home in self.__homes.values()))
+        try:
+            for url in urls:
+                if url not in self.__config_clients:
+                    self.__config_clients[url] = Cep2AsyncWebClient(url)
+            #the cache returns the cached schedule if the server can not be reached
+            results = await asyncio.gather(*(
+                self.__config_cache.refresh_async(self.__config_clients[url]) for url in urls))
+            schedules = dict(zip(urls, results))
+            for home in self.__homes.values():
+                schedule, changed = schedules[home.config_url or self.HTTP_HOST_RETRIEVE]
+                if changed:
+                    _apply_schedule(home, schedule)
+        except Exception as ex:
+            # An error must not stop the daily updates.
+            print(f"Error updating the schedules: {ex}")
+        finally:
+            self.__schedule_daily_update()
+
+    def __zigbee2mqtt_event_received(self, message: Cep2Zigbee2mqttMessage) -> None:
+        if self.__debouncer and not self.__debouncer.accept(message):
             return
 
-        device_id = tokens[1]
-
-        device = self.__devices_model.find(device_id)
-
-        #variable for checking if a new event has occured
-        new_update = False
-
-        #conditional for handling events from the vibration sensor, explained in the report.
-        if device_id == "pillboxSensor":
-            vibration = message.event["vibration"]
-            nowTime = datetime.now()
-            if vibration and nowTime > self.medicationTime - timedelta(minutes=self.timeWindowBefore) and self.medicationTaken == False:
-                self.__z2m_client.change_state("kitchenLight", "OFF", 0, 0)
-                self.__z2m_client.change_state(self.sensorToActuator[self.currentRoom], "OFF", 0, 0)
-                self.medicationTime = self.medicationTime + timedelta(days=1)
-                self.runningThread = True
-                self.medicationTaken = True
-                self.HeucodNum = 82295
-                self.EventDescription = "Medication taken"
-                print("Medication has been taken")
-                new_update = True
-
-            elif vibration:
-                self.HeucodNum = 81493
-                self.EventDescription = "Pillbox moved outside window"
-                print("ERROR")
-                new_update = True
-                self.blink("kitchenLight")
-                
-
-        if device_id == "bedRoom" or device_id == "livingRoom":
-            occupancy = message.event["occupancy"]
-        
-        #This conditional is for handling events from the motion sensors.
-        if occupancy:
-            nowTime = datetime.now()
-
-            #This case is for when the patient is being reminded but is changing rooms
-            if device_id != self.currentRoom and not self.medicationTaken and nowTime > self.medicationTime - timedelta(minutes=self.timeWindowBefore):
-                self.__z2m_client.change_state(self.sensorToActuator[self.currentRoom], "OFF", 0, 0)
-                self.__z2m_client.change_state(self.sensorToActuator[device_id], "ON", 0.15, 0.75)
-                self.currentRoom = device_id
-                new_update = True
-                print(f"Current room is {self.currentRoom}")
-            #and this is for all other cases
-            else:
-                self.currentRoom = device_id
-                new_update = True
-                print(f"Current room is {self.currentRoom}")
-            self.HeucodNum = 82099
-            self.EventDescription = occupancy
-            new_update = True
-
-
-
-        #if a new event has occured i.e. the patient moved to a different room or picked up the pillboc, an event is sent to the server
-        if new_update:
-            print("sending event")
-            web_event = Cep2WebDeviceEvent(device_id=device.id_,
-                                            device_type=device.type_,
-                                            measurement=self.EventDescription,
-                                            heucod_event=self.HeucodNum)
-            client = Cep2WebClient(self.HTTP_HOST)
+        print(
+            f"zigbee2mqtt event received on topic {message.topic}: {message.data}")
+
+        home = self.__homes.get(message.base_topic)
+        if home:
             try:
-                status_code = client.send_event(web_event.to_heucod())
-                print(f"Status code: {status_code}")
-            except ConnectionError as ex:
-                print(f"{ex}")
\ No newline at end of file
+                home.handle_message(message)
+            except Exception as ex:
+                # An error in one event must not stop the handling of the others.
+                print(f"Error handling zigbee2mqtt event: {ex}")
+            if METRICS.enabled and message.received_at is not None:
+                _MESSAGE_SECONDS.observe(monotonic() - message.received_at)
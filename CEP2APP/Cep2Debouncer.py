@@ -0,0 +1,122 @@
+from dataclasses import dataclass, field
+from threading import Lock
+from time import monotonic
+from typing import Dict, Iterable, Optional, Tuple
+from Cep2Zigbee2mqttClient import (Cep2LazyPayload, Cep2Zigbee2mqttMessage,
+                                   Cep2Zigbee2mqttMessageType)
+
+
+@dataclass
+class Cep2DebouncerStats:
+    """ Snapshot of the counters of a Cep2EventDebouncer.
+    """
+
+    # Device events with a watched field that were given to the controller.
+    forwarded: int = 0
+    # Device events that only repeated the last forwarded values, and were discarded.
+    collapsed: int = 0
+    # Collapsed events of each device, by "<base topic>/<friendly name>".
+    collapsed_by_device: Dict[str, int] = field(default_factory=dict)
+
+
+class Cep2EventDebouncer:
+    """ This class discards the repeated reports of sensors before they reach the controller.
+
+    Sensors publish their whole state each time they report, e.g. a motion sensor publishes
+    occupancy: true every few seconds while someone is in the room. For each device, the debouncer
+    remembers the last forwarded value of the watched fields (e.g. occupancy and vibration) and
+    only forwards a report if one of them changed, or if window seconds have passed since the
+    value was forwarded. Reports without any watched field, and all the other messages, are always
+    forwarded.
+
+    The window is what makes the debouncer safe to use with the motion sensors: if the patient
+    leaves a room and comes back before the sensor reported occupancy: false, the report of the
+    room is forwarded again once the window has passed, so the current room is eventually updated.
+
+    The occupancy reports must not be debounced when they are fused by a Cep2OccupancyEngine, as
+    Cep2Home does: the engine adds up the repeated reports of the current room, which are also the
+    ones that cancel the move to a room reported by mistake.
+    """
+
+    def __init__(self, fields: Iterable[str] = ("occupancy", "vibration"),
+                 window: Optional[float] = 30.0):
+        """ Class initializer.
+
+        Args:
+            fields (Iterable[str]): fields of the device events whose repeated values are
+                discarded. Defaults to occupancy and vibration.
+            window (Optional[float]): time, in seconds, after which an unchanged value is
+                forwarded again. If None, only changes are forwarded. Defaults to 30 seconds.
+        """
+        self.__fields = tuple(fields)
+        self.__quoted_fields = tuple(f'"{f}"' for f in self.__fields)
+        self.__window = window
+        # Last forwarded values of each device: key -> {field: (value, time)}.
+        self.__last: Dict[str, Dict[str, Tuple[object, float]]] = {}
+        self.__stats = Cep2DebouncerStats()
+        # The events of different devices can be handled by different threads.
+        self.__lock = Lock()
+
+    @property
+    def stats(self) -> Cep2DebouncerStats:
+        with self.__lock:
+            return Cep2DebouncerStats(forwarded=self.__stats.forwarded,
+                                      collapsed=self.__stats.collapsed,
+                                      collapsed_by_device=dict(self.__stats.collapsed_by_device))
+
+    def accept(self, message: Cep2Zigbee2mqttMessage) -> bool:
+        """ Decides whether a message must be given to the controller.
+
+        Args:
+            message (Cep2Zigbee2mqttMessage): a parsed zigbee2mqtt message.
+
+        Returns:
+            bool: False if the message only repeats the last forwarded values of its device.
+        """
+        if message.type_ != Cep2Zigbee2mqttMessageType.DEVICE_EVENT or message.event is None:
+            return True
+
+        event = message.event
+        # Most devices (plugs, climate sensors, ...) have none of the watched fields. Their payload
+        # is not decoded here if a substring search shows that it does not have them.
+        if isinstance(event, Cep2LazyPayload) and \
+                not any(k in event.raw for k in self.__quoted_fields):
+            return True
+
+        values = [(f, event.get(f)) for f in self.__fields]
+        values = [(f, v) for f, v in values if v is not None]
+        if not values:
+            return True
+
+        # The paho timestamp is used when available, so the time waited in the queues is ignored.
+        now = message.received_at if message.received_at is not None else monotonic()
+        key = f"{message.base_topic}/{message.device_id}"
+
+        with self.__lock:
+            last = self.__last.setdefault(key, {})
+            for f, value in values:
+                previous = last.get(f)
+                if previous is None or previous[0] != value or \
+                        (self.__window is not None and now - previous[1] >= self.__window):
+                    break
+            else:
+                self.__stats.collapsed += 1
+                self.__stats.collapsed_by_device[key] = \
+                    self.__stats.collapsed_by_device.get(key, 0) + 1
+                return False
+
+            for f, value in values:
+                last[f] = (value, now)
+            self.__stats.forwarded += 1
+
+            return True
+
+    def reset(self, device: Optional[str] = None) -> None:
+        """ Forgets the last values of a device, "<base topic>/<friendly name>", or of all the
+        devices, so their next report is forwarded.
+        """
+        with self.__lock:
+            if device is None:
+                self.__last.clear()
+            else:
+                self.__last.pop(device, None)
@@ -0,0 +1,207 @@
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
+from threading import Condition, Thread
+from time import monotonic
+from typing import Any, Callable, Dict, Optional
+from zlib import crc32
+
+
+class Cep2OverflowPolicy(Enum):
+    """ Enumeration with the actions that the dispatcher can take when a worker queue is full. The
+    caller never waits, since it is usually the network thread of the MQTT client.
+    """
+
+    # The new message is discarded.
+    DROP_NEWEST = "drop_newest"
+    # The oldest message in the queue is discarded.
+    DROP_OLDEST = "drop_oldest"
+    # The message replaces the most recent pending message of the same device, if both can be
+    # coalesced. Otherwise, the oldest message in the queue is discarded as in DROP_OLDEST.
+    COALESCE = "coalesce"
+
+
+@dataclass
+class Cep2DispatcherStats:
+    """ Snapshot of the counters of a Cep2Dispatcher.
+    """
+
+    submitted: int = 0
+    processed: int = 0
+    dropped: int = 0
+    coalesced: int = 0
+    pending: int = 0
+
+
+class _Cep2DispatcherEntry:
+    """ A message waiting in a worker queue. It is mutable so that a message can be coalesced, i.e.
+    replaced by a newer one of the same device, without losing its position in the queue.
+    """
+
+    __slots__ = ("key", "item", "enqueued_at")
+
+    def __init__(self, key: str, item: Any, enqueued_at: float):
+        self.key = key
+        self.item = item
+        self.enqueued_at = enqueued_at
+
+
+class _Cep2DispatcherShard:
+    """ A worker thread and its queue. All the messages of one device are handled by the same
+    shard, so they are processed in the order they were received.
+    """
+
+    def __init__(self, dispatcher, index: int):
+        self.condition = Condition()
+        self.queue = deque()
+        # Most recent pending entry of each device, used to coalesce messages.
+        self.latest = {}
+        # Counters of this shard. Each shard keeps its own, so they are only updated while holding
+        # the shard's lock (or by the shard's thread, for processed).
+        self.stats = Cep2DispatcherStats()
+        self.thread = Thread(target=dispatcher._run_shard,
+                             args=(self,),
+                             name=f"Cep2Dispatcher-{index}",
+                             daemon=True)
+
+
+class Cep2Dispatcher:
+    """ This class dispatches messages to a pool of worker threads.
+
+    Each message is submitted with a key, usually the friendly name of the device that published it.
+    Messages with the same key always go to the same worker, so they are handled in order, while
+    messages of different devices are handled in parallel. This way, a handler that blocks for one
+    device (for example, blinking the kitchen light after a pillbox event) does not delay the events
+    of the other devices.
+
+    The queue of each worker is bounded. When it is full, the overflow policy given in the
+    initializer decides which message is discarded, so submit() never blocks the caller.
+    """
+
+    def __init__(self,
+                 handler: Callable[[Any], None],
+                 workers: int = 4,
+                 max_queue: int = 1000,
+                 overflow_policy: Cep2OverflowPolicy = Cep2OverflowPolicy.DROP_NEWEST,
+                 can_coalesce: Optional[Callable[[Any], bool]] = None):
+        """ Class initializer.
+
+        Args:
+            handler (Callable[[Any], None]): function that processes each message.
+            workers (int): number of worker threads. Defaults to 4.
+            max_queue (int): maximum number of pending messages per worker. Defaults to 1000.
+            overflow_policy (Cep2OverflowPolicy): action taken when a queue is full. Defaults to
+                Cep2OverflowPolicy.DROP_NEWEST.
+            can_coalesce (Optional[Callable[[Any], bool]]): with Cep2OverflowPolicy.COALESCE,
+                returns False for the messages that must not replace, or be replaced by, another
+                message, e.g. a state change handled by the rules. If None, all the messages can be
+                coalesced.
+        """
+        if workers < 1:
+            raise ValueError("The dispatcher needs at least one worker")
+
+        self.__handler = handler
+        self.__max_queue = max_queue
+        self.__overflow_policy = overflow_policy
+        self.__can_coalesce = can_coalesce
+        self.__running = False
+        self.__shards = [_Cep2DispatcherShard(self, i) for i in range(workers)]
+
+    @property
+    def stats(self) -> Cep2DispatcherStats:
+        stats = Cep2DispatcherStats()
+        for shard in self.__shards:
+            stats.submitted += shard.stats.submitted
+            stats.processed += shard.stats.processed
+            stats.dropped += shard.stats.dropped
+            stats.coalesced += shard.stats.coalesced
+            stats.pending += len(shard.queue)
+
+        return stats
+
+    def device_lag(self) -> Dict[str, float]:
+        """ Returns, for each device with pending messages, how long (in seconds) its oldest pending
+        message has been waiting in the queue.
+        """
+        now = monotonic()
+        lag = {}
+        for shard in self.__shards:
+            with shard.condition:
+                for entry in shard.queue:
+                    # Queues are ordered, so the first entry found of a device is the oldest.
+                    if entry.key not in lag:
+                        lag[entry.key] = now - entry.enqueued_at
+
+        return lag
+
+    def start(self) -> None:
+        if self.__running:
+            return
+
+        self.__running = True
+        for shard in self.__shards:
+            shard.thread.start()
+
+    def stop(self) -> None:
+        """ Stops the workers. Messages still in the queues are discarded.
+        """
+        self.__running = False
+        for shard in self.__shards:
+            with shard.condition:
+                shard.condition.notify_all()
+
+    def submit(self, key: str, item: Any) -> None:
+        """ Adds a message to the queue of the worker responsible for the given key.
+
+        Args:
+            key (str): key used to select the worker, e.g. the device's friendly name.
+            item (Any): message that will be given to the handler.
+        """
+        # crc32 is used instead of hash() since it is cheap and does not change between runs.
+        shard = self.__shards[crc32(key.encode("utf-8")) % len(self.__shards)]
+
+        with shard.condition:
+            shard.stats.submitted += 1
+
+            if len(shard.queue) >= self.__max_queue:
+                if self.__overflow_policy == Cep2OverflowPolicy.DROP_NEWEST:
+                    shard.stats.dropped += 1
+                    return
+                latest = shard.latest.get(key)
+                if self.__overflow_policy == Cep2OverflowPolicy.COALESCE and latest is not None and \
+                        (self.__can_coalesce is None or
+                         (self.__can_coalesce(item) and self.__can_coalesce(latest.item))):
+                    # Replace the content of the pending entry. It keeps its position in the queue
+                    # and its enqueue time, so the reported lag is still the one of the oldest
+                    # message.
+                    latest.item = item
+                    shard.stats.coalesced += 1
+                    return
+                dropped = shard.queue.popleft()
+                if shard.latest.get(dropped.key) is dropped:
+                    del shard.latest[dropped.key]
+                shard.stats.dropped += 1
+
+            entry = _Cep2DispatcherEntry(key, item, monotonic())
+            shard.queue.append(entry)
+            shard.latest[key] = entry
+            shard.condition.notify()
+
+    def _run_shard(self, shard: _Cep2DispatcherShard) -> None:
+        while True:
+            with shard.condition:
+                while not shard.queue and self.__running:
+                    shard.condition.wait()
+                if not self.__running:
+                    return
+                entry = shard.queue.popleft()
+                if shard.latest.get(entry.key) is entry:
+                    del shard.latest[entry.key]
+
+            try:
+                self.__handler(entry.item)
+            except Exception as ex:
+                # An exception in the handler must not stop the worker, otherwise all the devices
+                # of this shard would stop being processed.
+                print(f"Error handling message from {entry.key}: {ex}")
+            shard.stats.processed += 1
@@ -0,0 +1,261 @@
+from datetime import timedelta
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+from Cep2Scheduler import Cep2Scheduler, Cep2Timer
+from Cep2Zigbee2mqttClient import Cep2AsyncZigbee2mqttClient, Cep2Zigbee2mqttClient
+
+
+class Cep2LightEffect:
+    """ An effect running on a light, returned by the functions of Cep2LightEffects. Its steps are
+    timers of the scheduler, so a running effect does not use any thread.
+    """
+
+    def __init__(self, light: str, name: str):
+        self.light = light
+        self.name = name
+        self.timers: List[Cep2Timer] = []
+        # Command published when the effect is cancelled, e.g. to stop a native effect.
+        self.on_cancel: Optional[Dict[str, Any]] = None
+        self.cancelled = False
+        self.finished = False
+
+    @property
+    def running(self) -> bool:
+        return not self.cancelled and not self.finished
+
+
+class Cep2LightEffects:
+    """ This class runs light effects (blink, pulse and color ramps) on the lights of a zigbee2mqtt
+    instance.
+
+    The steps of the effects are scheduled on the scheduler shared by the controller, instead of
+    sleeping or starting a thread per effect, so many effects can run at the same time and the
+    handling of the zigbee2mqtt events is never blocked. A light runs one effect at a time: starting
+    an effect cancels the one running on the light, and cancel() must be called before changing the
+    state of a light, so that the steps left of an effect do not override the new state.
+
+    The steps of an effect are published with send_command(), i.e. they do not change the state
+    desired for the light in the client. When an effect ends, the desired state is restored.
+
+    Lights that support the effect and transition commands of zigbee2mqtt (e.g. Philips Hue) can be
+    declared as native: the effect is then executed by the light itself, with one or two messages
+    instead of one per step.
+    """
+
+    # Brightness (0-254) of the lights while pulsing.
+    PULSE_BRIGHTNESS = (254, 40)
+
+    def __init__(self,
+                 z2m_client: Union[Cep2Zigbee2mqttClient, Cep2AsyncZigbee2mqttClient],
+                 scheduler: Cep2Scheduler,
+                 base_topic: Optional[str] = None,
+                 native_lights: Iterable[str] = ()):
+        """ Class initializer.
+
+        Args:
+            z2m_client (Union[Cep2Zigbee2mqttClient, Cep2AsyncZigbee2mqttClient]): client used to
+                command the lights.
+            scheduler (Cep2Scheduler): scheduler where the steps of the effects are executed.
+            base_topic (Optional[str]): base topic of the zigbee2mqtt instance of the lights.
+            native_lights (Iterable[str]): lights that support zigbee2mqtt's effect and transition
+                commands.
+        """
+        self.__z2m_client = z2m_client
+        self.__scheduler = scheduler
+        self.__base_topic = base_topic
+        self.__native_lights = set(native_lights)
+        # The effect running on each light.
+        self.__effects: Dict[str, Cep2LightEffect] = {}
+        self.__lock = Lock()
+
+    def running(self, light: str) -> Optional[Cep2LightEffect]:
+        with self.__lock:
+            return self.__effects.get(light)
+
+    def blink(self,
+              light: str,
+              color: Tuple[float, float] = (0.7, 0.28),
+              times: int = 2,
+              period: timedelta = timedelta(seconds=2)) -> Cep2LightEffect:
+        """ Turns a light on and off several times, and then restores its state.
+
+        Args:
+            light (str): friendly name of the light.
+            color (Tuple[float, float]): color (x, y) of the light while on.
+            times (int): number of times the light is turned on.
+            period (timedelta): duration of each on/off cycle. The light is on half of it.
+        """
+        if light in self.__native_lights:
+            # zigbee2mqtt's blink lasts about one second and the light restores its state.
+            return self.__start(light, "blink", [(timedelta(0), {"effect": "blink"})], restore=False)
+
+        on = {"state": "ON", "color": {"x": color[0], "y": color[1]}}
+        steps = []
+        for i in range(times):
+            steps.append((period * i, on))
+            steps.append((period * i + period / 2, {"state": "OFF"}))
+
+        return self.__start(light, "blink", steps, end=period * times)
+
+    def pulse(self,
+              light: str,
+              color: Tuple[float, float],
+              duration: timedelta,
+              period: timedelta = timedelta(seconds=2)) -> Cep2LightEffect:
+        """ Makes the brightness of a light go up and down for some time, and then restores its
+        state.
+
+        Args:
+            light (str): friendly name of the light.
+            color (Tuple[float, float]): color (x, y) of the light.
+            duration (timedelta): duration of the effect.
+            period (timedelta): duration of each cycle of brightness.
+        """
+        if light in self.__native_lights:
+            effect = self.__start(light,
+                                  "pulse",
+                                  [(timedelta(0), {"effect": "breathe"}),
+                                   (duration, {"effect": "stop_effect"})],
+                                  end=duration)
+            effect.on_cancel = {"effect": "stop_effect"}
+            return effect
+
+        # The light goes to each brightness with a transition of half a period.
+        transition = period.total_seconds() / 2
+        steps = []
+        at = timedelta(0)
+        i = 0
+        while at < duration:
+            steps.append((at, {"state": "ON",
+                               "color": {"x": color[0], "y": color[1]},
+                               "brightness": self.PULSE_BRIGHTNESS[i % 2],
+                               "transition": transition}))
+            at += period / 2
+            i += 1
+        # The brightness is left at the maximum before the state of the light is restored.
+        steps.append((duration, {"brightness": self.PULSE_BRIGHTNESS[0]}))
+
+        return self.__start(light, "pulse", steps, end=duration)
+
+    def ramp(self,
+             light: str,
+             start: Tuple[float, float],
+             end: Tuple[float, float],
+             duration: timedelta,
+             steps: int = 10) -> Cep2LightEffect:
+        """ Changes the color of a light gradually. Unlike the other effects, the final color is
+        kept: it becomes the state desired for the light.
+
+        Args:
+            light (str): friendly name of the light.
+            start (Tuple[float, float]): initial color (x, y).
+            end (Tuple[float, float]): final color (x, y).
+            duration (timedelta): duration of the change.
+            steps (int): number of intermediate colors, for lights that are not native.
+        """
+        def final():
+            self.__z2m_client.change_state(light, "ON", end[0], end[1], force=True,
+                                           base_topic=self.__base_topic)
+
+        if light in self.__native_lights:
+            command = {"state": "ON",
+                       "color": {"x": end[0], "y": end[1]},
+                       "transition": duration.total_seconds()}
+            return self.__start(light, "ramp",
+                                [(timedelta(0), {"state": "ON",
+                                                 "color": {"x": start[0], "y": start[1]}}),
+                                 (timedelta(0), command)],
+                                end=duration, restore=False, on_end=final)
+
+        commands = []
+        for i in range(steps):
+            fraction = i / steps
+            commands.append((duration * fraction,
+                             {"state": "ON",
+                              "color": {"x": start[0] + (end[0] - start[0]) * fraction,
+                                        "y": start[1] + (end[1] - start[1]) * fraction}}))
+
+        return self.__start(light, "ramp", commands, end=duration, restore=False, on_end=final)
+
+    def cancel(self, light: str) -> bool:
+        """ Cancels the effect running on a light. The state of the light is not restored, since
+        this is called before changing it.
+
+        Returns:
+            bool: True if an effect was running.
+        """
+        with self.__lock:
+            effect = self.__effects.pop(light, None)
+        if effect is None:
+            return False
+
+        self.__cancel(effect)
+
+        return True
+
+    def cancel_all(self) -> None:
+        with self.__lock:
+            effects = list(self.__effects.values())
+            self.__effects.clear()
+        for effect in effects:
+            self.__cancel(effect)
+
+    def __cancel(self, effect: Cep2LightEffect) -> None:
+        effect.cancelled = True
+        for timer in effect.timers:
+            timer.cancel()
+        if effect.on_cancel is not None:
+            self.__send(effect.light, effect.on_cancel)
+
+    def __start(self,
+                light: str,
+                name: str,
+                steps: List[Tuple[timedelta, Dict[str, Any]]],
+                end: timedelta = timedelta(0),
+                restore: bool = True,
+                on_end: Optional[Callable[[], None]] = None) -> Cep2LightEffect:
+        effect = Cep2LightEffect(light, name)
+
+        with self.__lock:
+            previous = self.__effects.get(light)
+            self.__effects[light] = effect
+        if previous is not None:
+            self.__cancel(previous)
+
+        for delay, command in steps:
+            effect.timers.append(self.__scheduler.schedule_in(
+                delay, lambda c=command: self.__step(effect, c)))
+        effect.timers.append(self.__scheduler.schedule_in(
+            end, lambda: self.__finish(effect, restore, on_end)))
+
+        return effect
+
+    def __step(self, effect: Cep2LightEffect, command: Dict[str, Any]) -> None:
+        if effect.cancelled:
+            return
+        self.__send(effect.light, command)
+
+    def __finish(self,
+                 effect: Cep2LightEffect,
+                 restore: bool,
+                 on_end: Optional[Callable[[], None]]) -> None:
+        with self.__lock:
+            if effect.cancelled or self.__effects.get(effect.light) is not effect:
+                return
+            del self.__effects[effect.light]
+        effect.finished = True
+
+        if on_end is not None:
+            on_end()
+        elif restore:
+            desired = self.__z2m_client.desired_state(effect.light, base_topic=self.__base_topic)
+            if desired is None or desired.state == "OFF":
+                self.__send(effect.light, {"state": "OFF"})
+            else:
+                self.__z2m_client.change_state(effect.light, desired.state, desired.color_x,
+                                               desired.color_y, force=True,
+                                               base_topic=self.__base_topic)
+
+    def __send(self, light: str, command: Dict[str, Any]) -> None:
+        # While the client is disconnected the command is discarded, and the effect is not shown.
+        self.__z2m_client.send_command(light, command, base_topic=self.__base_topic)
@@ -0,0 +1,573 @@
+import json
+import mmap
+import os
+import struct
+from bisect import bisect_left
+from dataclasses import dataclass
+from datetime import datetime, time
+from threading import RLock
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+from Cep2Heucod import HeucodCompactEvent, HeucodEvent
+
+
+@dataclass(slots=True)
+class Cep2StoredEvent:
+    """ An event read from a Cep2EventStore.
+    """
+
+    timestamp: datetime
+    event_type_enum: int
+    device_id: Optional[str]
+    description: Any
+    location: Optional[str] = None
+
+
+def _fsync_directory(path: str) -> None:
+    """ Writes the entries of a directory (i.e. created, renamed and removed files) to disk. Not
+    supported on Windows, where it does nothing.
+    """
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    descriptor = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class _Cep2StringTable:
+    """ Table of the values stored in the string columns (device, description and location). Each
+    different value is stored once, JSON encoded, in a text file with one value per line, and the
+    columns store its index (the line number). Values are JSON encoded so their type is kept, e.g. a
+    description can be a boolean.
+    """
+
+    def __init__(self, path: str):
+        self.__path = path
+        self.__values: List[str] = []
+        self.__indexes: Dict[str, int] = {}
+        # Values already decoded by decoded(), by index.
+        self.__decoded: List[Any] = []
+
+        if os.path.exists(path):
+            with open(path, "rb") as table:
+                data = table.read()
+            # A value that was only partially written (e.g. during a power loss) is not used by any
+            # event, since the events are written after the values. It is removed.
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                with open(path, "r+b") as table:
+                    table.truncate(end)
+            for line in data[:end].decode("utf-8").splitlines():
+                self.__indexes[line] = len(self.__values)
+                self.__values.append(line)
+
+        self.__file = open(path, "a", encoding="utf-8")
+
+    def close(self) -> None:
+        self.__file.close()
+
+    def index(self, value: Any, create: bool = True) -> int:
+        """ Returns the index of a value, adding it to the table if needed. None is stored as -1.
+        If create is False and the value is not in the table, -2 is returned.
+        """
+        if value is None:
+            return -1
+
+        encoded = json.dumps(value)
+        index = self.__indexes.get(encoded)
+        if index is None:
+            if not create:
+                return -2
+            index = self.__indexes[encoded] = len(self.__values)
+            self.__values.append(encoded)
+            self.__file.write(f"{encoded}\n")
+            self.__file.flush()
+
+        return index
+
+    def value(self, index: int) -> Any:
+        return json.loads(self.__values[index]) if index >= 0 else None
+
+    def decoded(self) -> List[Any]:
+        """ Returns all the values, decoded, in the order of their indexes.
+        """
+        while len(self.__decoded) < len(self.__values):
+            self.__decoded.append(json.loads(self.__values[len(self.__decoded)]))
+
+        return self.__decoded
+
+
+class _Cep2Segment:
+    """ A file with a fixed capacity of events, stored by columns. The file is memory-mapped, and
+    each column is accessed as an array of its type:
+
+        header | timestamp (float64) | event type (int32) | device | description | location (int32)
+
+    The header stores the number of events, whether they are sorted by time, and the minimum and
+    maximum timestamps, which allow to skip segments when querying a time range.
+    """
+
+    MAGIC = b"CEP2EVS1"
+    HEADER = struct.Struct("<8sIIB3xdd")
+    HEADER_SIZE = 64
+    # Name and type (array code) of each column.
+    COLUMNS = (("timestamp", "d"), ("event_type", "i"), ("device", "i"), ("description", "i"),
+               ("location", "i"))
+
+    def __init__(self, path: str, capacity: int):
+        self.path = path
+        exists = os.path.exists(path)
+        size = self.HEADER_SIZE + capacity * sum(struct.calcsize(c) for _, c in self.COLUMNS)
+
+        self.__file = open(path, "r+b" if exists else "w+b")
+        if not exists:
+            # The file is created with its final size, most file systems do not allocate the space
+            # until it is written.
+            self.__file.truncate(size)
+        self.__mmap = mmap.mmap(self.__file.fileno(), 0)
+
+        if exists:
+            magic, capacity, self.count, sorted_, self.min_time, self.max_time = \
+                self.HEADER.unpack_from(self.__mmap)
+            if magic != self.MAGIC:
+                raise ValueError(f"{path} is not an event store segment")
+            self.sorted = bool(sorted_)
+        else:
+            self.count = 0
+            self.sorted = True
+            self.min_time = float("inf")
+            self.max_time = float("-inf")
+            self.__write_header(capacity)
+        self.capacity = capacity
+
+        view = memoryview(self.__mmap)
+        self.__views = [view]
+        self.columns = {}
+        offset = self.HEADER_SIZE
+        for name, code in self.COLUMNS:
+            length = capacity * struct.calcsize(code)
+            column = view[offset:offset + length].cast(code)
+            self.__views.append(column)
+            self.columns[name] = column
+            offset += length
+
+        # Rows of each device, built the first time a device is queried.
+        self.__device_rows: Optional[Dict[int, List[int]]] = None
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def append(self, row: Tuple[float, int, int, int, int]) -> None:
+        position = self.count
+        for (name, _), value in zip(self.COLUMNS, row):
+            self.columns[name][position] = value
+
+        timestamp = row[0]
+        if timestamp < self.max_time:
+            self.sorted = False
+        self.min_time = min(self.min_time, timestamp)
+        self.max_time = max(self.max_time, timestamp)
+        # The number of events is updated after the columns, so an event that was only partially
+        # written is not read.
+        self.count += 1
+        self.__write_header(self.capacity)
+
+        if self.__device_rows is not None:
+            self.__device_rows.setdefault(row[2], []).append(position)
+
+    def rows(self, start: Optional[float], end: Optional[float]) -> Iterable[int]:
+        """ Returns the positions of the events in the time range [start, end).
+        """
+        if self.count == 0 or (start is not None and self.max_time < start) or \
+                (end is not None and self.min_time >= end):
+            return range(0)
+
+        timestamps = self.columns["timestamp"]
+        if self.sorted:
+            lo = bisect_left(timestamps, start, 0, self.count) if start is not None else 0
+            hi = bisect_left(timestamps, end, 0, self.count) if end is not None else self.count
+            return range(lo, hi)
+
+        return [i for i in range(self.count)
+                if (start is None or timestamps[i] >= start) and (end is None or timestamps[i] < end)]
+
+    def device_rows(self, device: int, start: Optional[float], end: Optional[float]) -> List[int]:
+        """ Returns the positions of the events of a device in the time range [start, end).
+        """
+        if self.__device_rows is None:
+            self.__device_rows = {}
+            devices = self.columns["device"]
+            for i in range(self.count):
+                self.__device_rows.setdefault(devices[i], []).append(i)
+
+        rows = self.__device_rows.get(device, [])
+        if start is None and end is None:
+            return rows
+
+        in_range = self.rows(start, end)
+        if isinstance(in_range, range):
+            # The rows of the device are sorted, so the ones in the range are found by bisection.
+            return rows[bisect_left(rows, in_range.start):bisect_left(rows, in_range.stop)]
+
+        in_range = set(in_range)
+        return [i for i in rows if i in in_range]
+
+    def row(self, position: int) -> Tuple[float, int, int, int, int]:
+        return tuple(self.columns[name][position] for name, _ in self.COLUMNS)
+
+    def flush(self) -> None:
+        self.__mmap.flush()
+
+    def close(self) -> None:
+        self.flush()
+        # The views must be released before closing the memory map.
+        for view in reversed(self.__views):
+            view.release()
+        self.__mmap.close()
+        self.__file.close()
+
+    def __write_header(self, capacity: int) -> None:
+        self.HEADER.pack_into(self.__mmap, 0, self.MAGIC, capacity, self.count, self.sorted,
+                              self.min_time, self.max_time)
+
+
+class Cep2EventStore:
+    """ This class keeps the history of the HEUCOD events of the gateway on disk, so it can be
+    analyzed locally, without retrieving the events from the server.
+
+    The events are appended to segments: memory-mapped files with a fixed capacity, where each
+    attribute (timestamp, event type, device, description and location) is stored as a column. When
+    a segment is full, a new one is started (rollover). Queries only read the segments that overlap
+    the requested time range and, inside a segment, find the range by bisection when the events
+    were appended in time order. The events of a device are found with a per-segment index, so
+    queries like "all pillbox events in the last 30 days" do not scan the whole history.
+
+    compact() removes the events older than a retention time and rewrites the remaining ones sorted
+    by time, in full segments. It can be interrupted at any point (e.g. by a power loss): the store
+    is then opened with the old segments, or completes the compaction when it is opened.
+
+    Events are written to the memory map and reach the disk when the operating system decides, or
+    when flush() or close() are called.
+    """
+
+    SEGMENT_CAPACITY = 65536
+    STRINGS_FILE = "strings.jsonl"
+    # Segments replaced by a compaction that was not completed.
+    COMPACTION_FILE = "compaction.json"
+
+    def __init__(self, path: str, segment_capacity: Optional[int] = None):
+        """ Class initializer. The store is created if it does not exist.
+
+        Args:
+            path (str): directory of the store.
+            segment_capacity (Optional[int]): number of events of a segment. Defaults to
+                SEGMENT_CAPACITY. Existing segments keep their capacity.
+        """
+        self.__path = path
+        self.__capacity = segment_capacity or self.SEGMENT_CAPACITY
+        self.__lock = RLock()
+        os.makedirs(path, exist_ok=True)
+
+        self.__strings = _Cep2StringTable(os.path.join(path, self.STRINGS_FILE))
+        self.__recover()
+        self.__segments: List[_Cep2Segment] = []
+        for name in sorted(os.listdir(path)):
+            if name.startswith("segment-") and name.endswith(".evs"):
+                self.__segments.append(_Cep2Segment(os.path.join(path, name), self.__capacity))
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return sum(s.count for s in self.__segments)
+
+    @property
+    def segments(self) -> int:
+        return len(self.__segments)
+
+    def append(self, event: Union[HeucodEvent, HeucodCompactEvent, str]) -> None:
+        """ Stores a HEUCOD event.
+
+        Args:
+            event (Union[HeucodEvent, HeucodCompactEvent, str]): the event, or the event encoded in
+                JSON, e.g. as returned by Cep2WebDeviceEvent.to_heucod().
+        """
+        if isinstance(event, str):
+            event = HeucodCompactEvent.from_json(event)
+        elif isinstance(event, HeucodEvent):
+            event = HeucodCompactEvent.from_event(event)
+
+        # Cep2WebDeviceEvent sets the id attribute, instead of id_.
+        device_id = event.id_ if event.id_ is not None else getattr(event, "id", None)
+
+        self.append_record(self.__to_datetime(event.timestamp),
+                           event.event_type_enum,
+                           device_id,
+                           event.description,
+                           event.location)
+
+    def append_record(self,
+                      timestamp: datetime,
+                      event_type_enum: int,
+                      device_id: Optional[str],
+                      description: Any = None,
+                      location: Optional[str] = None) -> None:
+        """ Stores an event given by its attributes.
+        """
+        with self.__lock:
+            row = (timestamp.timestamp(),
+                   int(event_type_enum) if event_type_enum is not None else 0,
+                   self.__strings.index(device_id),
+                   self.__strings.index(description),
+                   self.__strings.index(location))
+            self.__active_segment().append(row)
+
+    def query(self,
+              start: Optional[datetime] = None,
+              end: Optional[datetime] = None,
+              device_id: Optional[str] = None,
+              event_types: Optional[Iterable[int]] = None,
+              location: Optional[str] = None,
+              time_of_day: Optional[Tuple[time, time]] = None) -> List[Cep2StoredEvent]:
+        """ Returns the events that match all the given conditions, sorted by time.
+
+        Args:
+            start (Optional[datetime]): only events at or after this time.
+            end (Optional[datetime]): only events before this time.
+            device_id (Optional[str]): only events of this device.
+            event_types (Optional[Iterable[int]]): only events of these types (event_type_enum).
+            location (Optional[str]): only events of this location (home).
+            time_of_day (Optional[Tuple[time, time]]): only events whose time of the day is in the
+                range [from, to), e.g. (time(2), time(5)) for events between 02:00 and 05:00. If
+                from is later than to, the range wraps around midnight.
+
+        Returns:
+            List[Cep2StoredEvent]: the events.
+        """
+        start_ts = start.timestamp() if start else None
+        end_ts = end.timestamp() if end else None
+        types = set(int(t) for t in event_types) if event_types is not None else None
+        results = []
+
+        with self.__lock:
+            device = self.__strings.index(device_id, create=False) if device_id else None
+            location_index = self.__strings.index(location, create=False) if location else None
+            if device == -2 or location_index == -2:
+                # The value was never stored, so no event can match.
+                return []
+
+            for segment in self.__segments:
+                if device is not None:
+                    rows = segment.device_rows(device, start_ts, end_ts)
+                else:
+                    rows = segment.rows(start_ts, end_ts)
+
+                columns = segment.columns
+                timestamps = columns["timestamp"]
+                for i in rows:
+                    if types is not None and columns["event_type"][i] not in types:
+                        continue
+                    if location_index is not None and columns["location"][i] != location_index:
+                        continue
+                    timestamp = datetime.fromtimestamp(timestamps[i])
+                    if time_of_day and not self.__in_time_of_day(timestamp.time(), *time_of_day):
+                        continue
+                    results.append(Cep2StoredEvent(timestamp,
+                                                   columns["event_type"][i],
+                                                   self.__strings.value(columns["device"][i]),
+                                                   self.__strings.value(columns["description"][i]),
+                                                   self.__strings.value(columns["location"][i])))
+
+        # Segments are sorted internally in the usual case, so this is a linear merge.
+        results.sort(key=lambda e: e.timestamp)
+
+        return results
+
+    def columns(self,
+                start: Optional[datetime] = None,
+                end: Optional[datetime] = None,
+                event_types: Optional[Iterable[int]] = None) -> Dict[str, list]:
+        """ Returns the events in a time range by columns, without creating an object per event.
+        This is meant for bulk processing, e.g. by Cep2Analytics.
+
+        Args:
+            start (Optional[datetime]): only events at or after this time.
+            end (Optional[datetime]): only events before this time.
+            event_types (Optional[Iterable[int]]): only events of these types (event_type_enum).
+
+        Returns:
+            Dict[str, list]: lists "timestamp" (UNIX time, in seconds), "event_type", "device_id",
+            "description" and "location", with one item per event, in storage order.
+        """
+        start_ts = start.timestamp() if start else None
+        end_ts = end.timestamp() if end else None
+        types = set(int(t) for t in event_types) if event_types is not None else None
+        result = {name: [] for name in ("timestamp", "event_type", "device_id", "description",
+                                        "location")}
+
+        with self.__lock:
+            # The index -1 (None) selects the None added at the end of the values.
+            values = self.__strings.decoded() + [None]
+            for segment in self.__segments:
+                rows = segment.rows(start_ts, end_ts)
+                columns = segment.columns
+                if isinstance(rows, range):
+                    # Contiguous rows are copied as slices of the columns.
+                    selected = {name: columns[name][rows.start:rows.stop].tolist()
+                                for name, _ in segment.COLUMNS}
+                else:
+                    selected = {name: [columns[name][i] for i in rows] for name, _ in segment.COLUMNS}
+                if types is not None:
+                    keep = [i for i, t in enumerate(selected["event_type"]) if t in types]
+                    selected = {name: [column[i] for i in keep] for name, column in selected.items()}
+
+                result["timestamp"].extend(selected["timestamp"])
+                result["event_type"].extend(selected["event_type"])
+                result["device_id"].extend(values[i] for i in selected["device"])
+                result["description"].extend(values[i] for i in selected["description"])
+                result["location"].extend(values[i] for i in selected["location"])
+
+        return result
+
+    def rollover(self) -> None:
+        """ Closes the current segment, the next event is stored in a new one.
+        """
+        with self.__lock:
+            if self.__segments and self.__segments[-1].count > 0:
+                self.__segments[-1].flush()
+                self.__segments.append(self.__new_segment())
+
+    def compact(self, retain_after: Optional[datetime] = None) -> int:
+        """ Rewrites the store with the events sorted by time in full segments, removing the events
+        older than the retention time.
+
+        Args:
+            retain_after (Optional[datetime]): events before this time are removed. Defaults to
+                None, i.e. all events are kept.
+
+        Returns:
+            int: number of events removed.
+        """
+        limit = retain_after.timestamp() if retain_after else None
+
+        with self.__lock:
+            old = self.__segments
+            rows = []
+            for segment in old:
+                # Segments completely older than the retention time are not read.
+                if limit is not None and segment.max_time < limit:
+                    continue
+                rows.extend(segment.row(i) for i in segment.rows(limit, None))
+            rows.sort(key=lambda r: r[0])
+            removed = sum(s.count for s in old) - len(rows)
+
+            # The new segments are numbered after the old ones, and written with a temporary name.
+            # Until they are complete, the store is opened with the old segments (the temporary
+            # files are discarded by __recover()).
+            first = self.__next_number()
+            new = []
+            for offset in range(0, len(rows), self.__capacity):
+                path = self.__segment_path(first + len(new)) + ".tmp"
+                if os.path.exists(path):
+                    # Left by a compaction that failed, e.g. when the disk was full.
+                    os.remove(path)
+                segment = _Cep2Segment(path, self.__capacity)
+                for row in rows[offset:offset + self.__capacity]:
+                    segment.append(row)
+                segment.close()
+                new.append(os.path.basename(segment.path))
+            for segment in old:
+                segment.close()
+            self.__segments = []
+
+            # The list of the old segments is the commit of the compaction: once it is on disk,
+            # __recover() completes the compaction instead of discarding it.
+            compaction = os.path.join(self.__path, self.COMPACTION_FILE)
+            with open(compaction + ".tmp", "w", encoding="utf-8") as file:
+                json.dump({"remove": [os.path.basename(s.path) for s in old], "rename": new}, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(compaction + ".tmp", compaction)
+            _fsync_directory(self.__path)
+            self.__recover()
+
+            for name in new:
+                path = os.path.join(self.__path, name[:-len(".tmp")])
+                self.__segments.append(_Cep2Segment(path, self.__capacity))
+
+        return removed
+
+    def flush(self) -> None:
+        with self.__lock:
+            for segment in self.__segments:
+                segment.flush()
+
+    def close(self) -> None:
+        with self.__lock:
+            for segment in self.__segments:
+                segment.close()
+            self.__segments = []
+            self.__strings.close()
+
+    def __recover(self) -> None:
+        # Completes a compaction that was committed, i.e. renames its new segments and removes the
+        # old ones, or discards the segments of a compaction that was not.
+        compaction = os.path.join(self.__path, self.COMPACTION_FILE)
+        if os.path.exists(compaction):
+            with open(compaction, encoding="utf-8") as file:
+                committed = json.load(file)
+            for name in committed["rename"]:
+                path = os.path.join(self.__path, name)
+                if os.path.exists(path):
+                    os.replace(path, path[:-len(".tmp")])
+            _fsync_directory(self.__path)
+            for name in committed["remove"]:
+                path = os.path.join(self.__path, name)
+                if os.path.exists(path):
+                    os.remove(path)
+            os.remove(compaction)
+        for name in os.listdir(self.__path):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(self.__path, name))
+        _fsync_directory(self.__path)
+
+    def __active_segment(self) -> _Cep2Segment:
+        if not self.__segments or self.__segments[-1].full:
+            if self.__segments:
+                self.__segments[-1].flush()
+            self.__segments.append(self.__new_segment())
+
+        return self.__segments[-1]
+
+    def __new_segment(self) -> _Cep2Segment:
+        return _Cep2Segment(self.__segment_path(self.__next_number()), self.__capacity)
+
+    def __next_number(self) -> int:
+        if not self.__segments:
+            return 0
+        name = os.path.basename(self.__segments[-1].path)
+
+        return int(name[len("segment-"):-len(".evs")]) + 1
+
+    def __segment_path(self, number: int) -> str:
+        return os.path.join(self.__path, f"segment-{number:08d}.evs")
+
+    @staticmethod
+    def __to_datetime(timestamp: Any) -> datetime:
+        # Timestamps are ISO strings in the events of Cep2WebDeviceEvent, and UNIX times (seconds)
+        # when they are serialized from a datetime.
+        if isinstance(timestamp, datetime):
+            return timestamp
+        if isinstance(timestamp, str):
+            return datetime.fromisoformat(timestamp)
+        if isinstance(timestamp, (int, float)):
+            return datetime.fromtimestamp(timestamp)
+
+        return datetime.now()
+
+    @staticmethod
+    def __in_time_of_day(value: time, from_: time, to: time) -> bool:
+        if from_ <= to:
+            return from_ <= value < to
+
+        return value >= from_ or value < to
@@ -2,12 +2,44 @@ from __future__ import annotations
 import json
 import re
 from copy import deepcopy
-from dataclasses import dataclass, replace as dataclass_replace
+from dataclasses import dataclass
 from datetime import datetime, timezone
 from enum import Enum
-from typing import Any, Union
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Union
 from uuid import UUID
 
+
+# Cache of the names of the attributes of the JSON documents (camel case) converted to the names of
+# the HeucodEvent attributes (snake case). Only the HEUCOD attributes are cached, so the documents
+# received from other sources (e.g. by the ingest server) do not grow it without limit.
+_SNAKE_KEYS: Dict[str, str] = {}
+
+
+def _snake_key(key: str) -> str:
+    name = _SNAKE_KEYS.get(key)
+    if name is None:
+        if key != "id":
+            name = "_".join([t.lower() for t in re.split("(?=[A-Z])", key)])
+        else:
+            # The id_ attribtues is an exception of the naming standard. In Python, id is a
+            # reserved word and its use for naming variables/attribtues/... should be avoided.
+            # Thus the name id_.
+            name = "id_"
+        if name in HEUCOD_ATTRIBUTES:
+            _SNAKE_KEYS[key] = name
+
+    return name
+
+
+def _decode(event: str) -> dict:
+    if not event:
+        raise ValueError("The string can't be empty or None")
+
+    try:
+        return json.loads(event)
+    except json.JSONDecodeError as ex:
+        raise ex from None
+
 class HeucodEventJsonEncoder(json.JSONEncoder):
     def default(self, obj):  # pylint: disable=E0202
         def to_camel(key):
@@ -58,6 +90,83 @@ class HeucodEventJsonEncoder(json.JSONEncoder):
         return result
 
 
+class HeucodEventSerializer:
+    """ Serializer of HeucodEvent objects. It produces the same JSON documents as
+    HeucodEventJsonEncoder, but much faster:
+
+    - The camel case name of each attribute is computed once and cached, instead of for every
+      event.
+    - The attributes are read from the object's __dict__ without copying it, and only the attributes
+      that are not None are emitted.
+    - UUID, datetime and HeucodEventType values are converted while the document is built.
+
+    The keys are emitted in the order of the object's attributes, which might be different from the
+    order of HeucodEventJsonEncoder. A single instance can be shared by several threads.
+    """
+
+    def __init__(self):
+        # Attribute name -> (JSON name, True if it is the id_ attribute).
+        self.__keys = {}
+        self.__encode = json.JSONEncoder().encode
+        try:
+            import orjson
+            self.__encode_bytes = orjson.dumps
+        except ImportError:
+            self.__encode_bytes = lambda obj: self.__encode(obj).encode("utf-8")
+
+    def to_dict(self, event: Union[HeucodEvent, HeucodCompactEvent]) -> dict:
+        keys = self.__keys
+        result = {}
+
+        attributes = event.items() if isinstance(event, HeucodCompactEvent) else event.__dict__.items()
+        for k, v in attributes:
+            if v is None:
+                continue
+
+            key = keys.get(k)
+            if key is None:
+                key = keys[k] = self.__json_key(k)
+            name, is_id = key
+
+            # Most of the values are strings and numbers, which are stored as they are.
+            if is_id:
+                result[name] = v if isinstance(v, str) else str(v)
+            elif type(v) in (str, int, float, bool):
+                result[name] = v
+            elif isinstance(v, UUID):
+                result[name] = str(v)
+            elif isinstance(v, datetime):
+                result[name] = int(v.timestamp())
+            elif isinstance(v, HeucodEventType):
+                result[name] = str(v)
+            else:
+                result[name] = v
+
+        return result
+
+    def to_json(self, event: Union[HeucodEvent, HeucodCompactEvent]) -> str:
+        return self.__encode(self.to_dict(event))
+
+    def to_bytes(self, event: Union[HeucodEvent, HeucodCompactEvent]) -> bytes:
+        """ Serializes an event to UTF-8 encoded JSON, ready to be sent in an HTTP request. orjson
+        is used if it is installed.
+        """
+        return self.__encode_bytes(self.to_dict(event))
+
+    @staticmethod
+    def __json_key(key: str) -> tuple:
+        # Same rules as HeucodEventJsonEncoder: id_ is renamed to id, and the other attributes are
+        # converted from snake case to camel case.
+        if key == "id_":
+            return "id", True
+
+        first, *others = key.split("_")
+        if first == "id" or not others:
+            return key, False
+
+        return "".join([first.lower(), *map(str.title, others)]), False
+
+
 class HeucodEvent:
     # --------------------  General event properties --------------------
     # The unique ID of the event. Usually a GUID or UUID but one is free to choose.
@@ -165,32 +274,24 @@ class HeucodEvent:
     link_quality: float = None
     # -------------------- Python class specific attributes --------------------
     json_encoder = HeucodEventJsonEncoder
+    # Serializer used by to_json() and to_bytes() when json_encoder is not changed.
+    serializer = HeucodEventSerializer()
 
     @classmethod
     def from_json(cls, event: str) -> HeucodEvent:
-        if not event:
-            raise ValueError("The string can't be empty or None")
-
-        try:
-            json_obj = json.loads(event)
-        except json.JSONDecodeError as ex:
-            raise ex from None
+        return cls.from_dict(_decode(event))
 
+    @classmethod
+    def from_dict(cls, json_obj: dict) -> HeucodEvent:
+        """ Creates an event from a decoded JSON document, e.g. an element of a batch.
+        """
+        if not isinstance(json_obj, dict):
+            raise ValueError(f"A HEUCOD event must be a JSON object, not {type(json_obj).__name__}")
+
+        # The names of the JSON attributes are converted to snake case (from camel case) with the
+        # cached table, and stored directly in the new instance.
         instance = cls()
-
-        # Convert the names of the JSON attributes to snake case (from camel case).
-        obj_dict = {}
-        for k, v in json_obj.items():
-            if k != "id":
-                key_tokens = re.split("(?=[A-Z])", k)
-                obj_dict["_".join([t.lower() for t in key_tokens])] = v
-            else:
-                # The id_ attribtues is an exception of the naming standard. In Python, id is a
-                # reserved word and its use for naming variables/attribtues/... should be avoided.
-                # Thus the name id_.
-                obj_dict["id_"] = v
-
-        instance = dataclass_replace(instance, **obj_dict)
+        instance.__dict__.update({_snake_key(k): v for k, v in json_obj.items()})
 
         return instance
 
@@ -198,14 +299,244 @@ class HeucodEvent:
         if not self.json_encoder:
             raise TypeError("A converter was not specified. Use the converter attribute to do so.")
 
+        if self.json_encoder is HeucodEventJsonEncoder:
+            return self.serializer.to_json(self)
+
         # The dumps function looks tries to serialize the JSON string based in the JSON encoder that
         # is passed in the second argument. In this case, it will be the class HeucodEventJsonEncoder,
         # that inherits json.JSONEncoder. It has only the default() function this is called by
         # dumps() when serializing the class.
         return json.dumps(self, cls=self.json_encoder)
 
+    def to_bytes(self) -> bytes:
+        """ Serializes the event to UTF-8 encoded JSON, see HeucodEventSerializer.to_bytes().
+        """
+        if self.json_encoder is HeucodEventJsonEncoder:
+            return self.serializer.to_bytes(self)
+
+        return self.to_json().encode("utf-8")
+
+
+class HeucodCompactEvent:
+    """ Compact, read-only representation of a HEUCOD event, for tools that keep many events in
+    memory (e.g. the server or the replay tools).
+
+    A HeucodEvent stores its attributes in a dictionary. Instead, each compact event only has slots
+    for the attributes that are set: events with the same set of attributes (the same shape) share a
+    class, created the first time the shape is seen, whose __slots__ are those attributes. The other
+    HEUCOD attributes read as None, like in HeucodEvent. Events are created with from_json(),
+    from_event() or create().
+
+    Attributes that can not be slots (names that are not identifiers, or that are used by the
+    class, e.g. items) are kept in a dictionary instead, see _HeucodDictEvent.
+    """
+
+    __slots__ = ()
+    # Names of the attributes of the shape, in order.
+    _fields: Tuple[str, ...] = ()
+    # Classes of the shapes, by the names of their attributes, and by the names of the attributes
+    # in JSON.
+    _shapes: Dict[Tuple[str, ...], tuple] = {}
+    _json_shapes: Dict[Tuple[str, ...], tuple] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called when the attribute is not a slot of the shape.
+        if name in HEUCOD_ATTRIBUTES:
+            return None
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("HeucodCompactEvent objects are read-only")
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, HeucodCompactEvent):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __repr__(self) -> str:
+        attributes = ", ".join(f"{k}={v!r}" for k, v in self.items())
+        return f"HeucodCompactEvent({attributes})"
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        """ Returns the attributes that are set, as (name, value) tuples.
+        """
+        return ((k, getattr(self, k)) for k in self._fields)
+
+    def to_event(self) -> HeucodEvent:
+        event = HeucodEvent()
+        event.__dict__.update(self.items())
+
+        return event
+
+    def to_json(self) -> str:
+        return HeucodEvent.serializer.to_json(self)
+
+    @classmethod
+    def create(cls, **attributes: Any) -> HeucodCompactEvent:
+        return cls._build(cls._shape(tuple(attributes)), attributes.values())
+
+    @classmethod
+    def from_event(cls, event: HeucodEvent) -> HeucodCompactEvent:
+        attributes = event.__dict__
+
+        return cls._build(cls._shape(tuple(attributes)), attributes.values())
+
+    @classmethod
+    def from_json(cls, event: str) -> HeucodCompactEvent:
+        json_obj = _decode(event)
+        # The shapes are also cached by the names of the JSON attributes, so the names are not
+        # converted to snake case for each event.
+        keys = tuple(json_obj)
+        shape = cls._json_shapes.get(keys)
+        if shape is None:
+            shape = cls._json_shapes[keys] = cls._shape(tuple(map(_snake_key, keys)))
+
+        return cls._build(shape, json_obj.values())
+
+    @classmethod
+    def _shape(cls, fields: Tuple[str, ...]) -> tuple:
+        """ Returns the class of a shape and the setters of its slots.
+        """
+        shape = cls._shapes.get(fields)
+        if shape is None:
+            if len(set(fields)) < len(fields) or \
+                    not all(f.isidentifier() and f not in _RESERVED_NAMES for f in fields):
+                # The events of this shape are kept in a dictionary, see _build().
+                shape = cls._shapes[fields] = (_HeucodDictEvent, fields)
+                return shape
+            shape_cls = type("HeucodCompactEvent", (HeucodCompactEvent,),
+                             {"__slots__": fields, "_fields": fields})
+            # The setters of the slot descriptors are used, since __setattr__ is disabled.
+            shape = cls._shapes[fields] = (shape_cls, [shape_cls.__dict__[f].__set__ for f in fields])
+
+        return shape
+
+    @staticmethod
+    def _build(shape: tuple, values: Iterable[Any]) -> HeucodCompactEvent:
+        shape_cls, setters = shape
+        if shape_cls is _HeucodDictEvent:
+            return _HeucodDictEvent(zip(setters, values))
+        instance = object.__new__(shape_cls)
+        for setter, value in zip(setters, values):
+            setter(instance, value)
+
+        return instance
+
+
+class _HeucodDictEvent(HeucodCompactEvent):
+    """ HeucodCompactEvent whose attributes are kept in a dictionary, for the attributes that can not
+    be slots.
+    """
+
+    __slots__ = ("_attributes",)
+
+    def __init__(self, attributes: Iterable[Tuple[str, Any]]):
+        object.__setattr__(self, "_attributes", dict(attributes))
+
+    def __getattr__(self, name: str) -> Any:
+        try:
+            return self._attributes[name]
+        except KeyError:
+            return HeucodCompactEvent.__getattr__(self, name)
+
+    @property
+    def _fields(self) -> Tuple[str, ...]:
+        return tuple(self._attributes)
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        return iter(self._attributes.items())
+
+
+# Names that the attributes of the events can not have as slots, since the classes use them.
+_RESERVED_NAMES = frozenset(dir(_HeucodDictEvent))
+
+
+class HeucodEventBatch:
+    """ Columnar container of HEUCOD events. Each attribute is stored in its own list, with one item
+    per event (None if the event does not have the attribute), and only the attributes used by some
+    event have a list. Repeated string values (device IDs, locations, ...) are stored once.
+
+    This is the most compact way to keep many events in memory, and the columns can be processed
+    directly, e.g. to count the events of a type. Single events are returned as HeucodCompactEvent.
+    """
+
+    # Maximum number of different strings remembered per attribute to store repeated values once.
+    # Attributes with more values (e.g. timestamps) are stored as they are.
+    DEDUP_LIMIT = 1024
+
+    def __init__(self, events: Iterable[Union[HeucodEvent, HeucodCompactEvent]] = ()):
+        self.__columns: Dict[str, list] = {}
+        self.__strings: Dict[str, dict] = {}
+        self.__length = 0
+        self.extend(events)
+
+    def __len__(self) -> int:
+        return self.__length
+
+    def __getitem__(self, index: int) -> HeucodCompactEvent:
+        if index < 0:
+            index += self.__length
+        if not 0 <= index < self.__length:
+            raise IndexError("HeucodEventBatch index out of range")
+
+        attributes = {k: c[index] for k, c in self.__columns.items() if c[index] is not None}
+
+        return HeucodCompactEvent.create(**attributes)
+
+    def __iter__(self) -> Iterator[HeucodCompactEvent]:
+        for i in range(self.__length):
+            yield self[i]
+
+    @property
+    def attributes(self) -> List[str]:
+        return list(self.__columns)
+
+    def column(self, name: str) -> List[Any]:
+        """ Returns the values of an attribute, one per event. The list must not be modified.
+        """
+        column = self.__columns.get(name)
+
+        return column if column is not None else [None] * self.__length
+
+    def append(self, event: Union[HeucodEvent, HeucodCompactEvent]) -> None:
+        attributes = event.items() if isinstance(event, HeucodCompactEvent) else event.__dict__.items()
+        self.__append(attributes)
+
+    def append_json(self, event: str) -> None:
+        """ Adds an event encoded in JSON, without creating an event object.
+        """
+        self.__append((_snake_key(k), v) for k, v in _decode(event).items())
+
+    def extend(self, events: Iterable[Union[HeucodEvent, HeucodCompactEvent]]) -> None:
+        for event in events:
+            self.append(event)
+
+    def __append(self, attributes: Iterable[Tuple[str, Any]]) -> None:
+        index = self.__length
+        self.__length += 1
+
+        for name, value in attributes:
+            if value is None:
+                continue
+            column = self.__columns.get(name)
+            if column is None:
+                # The events added before did not have this attribute.
+                column = self.__columns[name] = [None] * index
+                self.__strings[name] = {}
+            if type(value) is str:
+                strings = self.__strings[name]
+                if strings is not None:
+                    value = strings.setdefault(value, value)
+                    if len(strings) > self.DEDUP_LIMIT:
+                        self.__strings[name] = None
+            column.append(value)
+
+        # Columns of the attributes that this event does not have.
+        for column in self.__columns.values():
+            if len(column) < self.__length:
+                column.append(None)
+
 
-    
 class HeucodEventType(Enum):
     def __new__(cls, type_: int, description: str):
         obj = object.__new__(cls)
@@ -322,3 +653,7 @@ class HeucodEventType(Enum):
     GeneralNotification = (82286, "OpenCare.EVODAY.Notifications.GeneralNotification")
     MovementInHomeWhileUserNotHome = (83366,
                                       "OpenCare.EVODAY.Notifications.MovementInHomeWhileUserNotHome")
+
+
+# Names of the attributes of a HEUCOD event.
+HEUCOD_ATTRIBUTES = frozenset(HeucodEvent.__annotations__)
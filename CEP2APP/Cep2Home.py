@@ -0,0 +1,418 @@
+from datetime import datetime, timedelta
+from threading import RLock
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple, Union
+from Cep2Effects import Cep2LightEffects
+from Cep2EventStore import Cep2EventStore
+from Cep2Metrics import METRICS
+from Cep2Model import Cep2Model, Cep2ZigbeeDevice
+from Cep2Occupancy import Cep2OccupancyEngine
+from Cep2Reminder import Cep2MedicationReminder, Cep2ReminderPhase
+from Cep2Rules import Cep2RuleSet, Cep2RulesFile, default_rules
+from Cep2Scheduler import Cep2Scheduler
+from Cep2WebClient import Cep2AsyncWebUplink, Cep2WebDeviceEvent, Cep2WebUplink
+from Cep2Zigbee2mqttClient import (Cep2AsyncZigbee2mqttClient, Cep2Zigbee2mqttClient,
+                                   Cep2Zigbee2mqttMessage, Cep2Zigbee2mqttMessageType)
+
+# Latencies of the handling of a message by a home, see Cep2Metrics.
+_FIND_SECONDS = METRICS.histogram("cep2_home_find_seconds", "Time to look up the device of a message")
+_HEUCOD_SECONDS = METRICS.histogram("cep2_home_heucod_seconds",
+                                    "Time to build and serialize the HEUCOD event of a message")
+
+
+class Cep2Home:
+    """ This class represents one home (apartment) served by the controller: its devices, the
+    connection between its sensors and lights, the medication schedule of its patients and the room
+    where the patient currently is. The room is decided by fusing the reports of the motion sensors,
+    see Cep2Occupancy, so a stray report does not move the patient (and the reminder lights).
+
+    The reactions of the home to the events of its sensors are rules, see Cep2Rules. They are read
+    from the rules file of the home if it has one, and otherwise created from sensorToActuator and
+    pillboxToPatient.
+
+    A controller can serve many homes with a single MQTT connection and a single uplink. Each home
+    has its own zigbee2mqtt instance, configured with a different base topic (e.g.
+    zigbee2mqtt_home1), which is how the messages of the homes are told apart.
+
+    The class attributes below are the default configuration. They can be overridden for each home
+    in the initializer.
+    """
+
+    #Below is the dictionary containing the medication times of each patient, as (hour, minute)
+    medicationTimes = {
+        "patient": [(16, 18)],
+    }
+    timeWindowBefore = 1 #time window before medication time for the patient to take the medication
+    timeWindowAfter = 1 #time window after medication time for the patient to take the medication
+    currentRoom = "Stue"
+    HeucodNum = 0 #number for identifying the event in the Heucod standard
+    EventDescription = "" #variable for the description of the Heucod event
+    #Below is the dictionary containing the connection between the motion sensors and the lights in the rooms
+    sensorToActuator = {
+        "bedRoom": "bedroomLight",
+        "livingRoom": "livingroomLight",
+    }
+    #Below is the dictionary containing the patient whose medication is in each pillbox
+    pillboxToPatient = {
+        "pillboxSensor": "patient",
+    }
+    #Below is the dictionary containing the color (x, y) of the lights in each reminder phase
+    phaseColors = {
+        Cep2ReminderPhase.PRE_WINDOW: (0.15, 0.75),
+        Cep2ReminderPhase.DUE: (0.45, 0.5),
+        Cep2ReminderPhase.OVERDUE: (0.7, 0.29),
+    }
+    reminderLight = "kitchenLight" #light that is always on while the patient is being reminded
+    #Below is the dictionary containing the zigbee2mqtt groups of the lights, used to change several lights
+    #with one message. The groups must also be configured in zigbee2mqtt
+    lightGroups = {}
+    nativeEffectLights = set() #lights that support the effect and transition commands of zigbee2mqtt
+    rulesPath = None #JSON file with the rules of the home, see Cep2Rules. It is reloaded when it changes
+    #Below is the dictionary containing the weight (0 to 1) of the reports of the motion sensors that are more or
+    #less reliable than the default, see Cep2OccupancyEngine
+    sensorWeights = {}
+    occupancyMargin = 0.2 #confidence by which a room must exceed the current room for the patient to move there
+    occupancyDwell = 5 #seconds during which a room must exceed the current room for the patient to move there
+
+    def __init__(self,
+                 home_id: str,
+                 devices_model: Cep2Model,
+                 base_topic: str = "zigbee2mqtt",
+                 config_url: Optional[str] = None,
+                 medication_times: Optional[Dict[str, List[Tuple[int, int]]]] = None,
+                 sensor_to_actuator: Optional[Dict[str, str]] = None,
+                 pillbox_to_patient: Optional[Dict[str, str]] = None,
+                 reminder_light: Optional[str] = None,
+                 light_groups: Optional[Dict[str, List[str]]] = None,
+                 rules_path: Optional[str] = None,
+                 sensor_weights: Optional[Dict[str, float]] = None) -> None:
+        """ Class initializer. The arguments that are None keep the default configuration given by
+        the class attributes.
+
+        Args:
+            home_id (str): ID of the home. It is sent as the location of the HEUCOD events.
+            devices_model (Cep2Model): the devices of the home.
+            base_topic (str): base topic of the home's zigbee2mqtt instance. Defaults to
+                "zigbee2mqtt".
+            config_url (Optional[str]): URL from where the medication schedule is retrieved every
+                day. If None, the controller's default is used.
+            medication_times (Optional[Dict[str, List[Tuple[int, int]]]]): medication times of each
+                patient, as (hour, minute).
+            sensor_to_actuator (Optional[Dict[str, str]]): light of the room of each motion sensor.
+            pillbox_to_patient (Optional[Dict[str, str]]): patient of each pillbox sensor.
+            reminder_light (Optional[str]): light that is on while the patient is being reminded.
+            light_groups (Optional[Dict[str, List[str]]]): lights of each zigbee2mqtt group of the
+                home, by the friendly name of the group.
+            rules_path (Optional[str]): JSON file with the rules of the home.
+            sensor_weights (Optional[Dict[str, float]]): weight of the reports of the motion
+                sensors, see Cep2OccupancyEngine.
+
+        Raises:
+            OSError: if the rules file can not be read.
+            Cep2RuleError: if the rules file is not valid.
+        """
+        self.home_id = home_id
+        self.base_topic = base_topic
+        self.config_url = config_url
+        self.devices_model = devices_model
+        if medication_times is not None:
+            self.medicationTimes = medication_times
+        if sensor_to_actuator is not None:
+            self.sensorToActuator = sensor_to_actuator
+        if pillbox_to_patient is not None:
+            self.pillboxToPatient = pillbox_to_patient
+        if reminder_light is not None:
+            self.reminderLight = reminder_light
+        if light_groups is not None:
+            self.lightGroups = light_groups
+        if rules_path is not None:
+            self.rulesPath = rules_path
+        if sensor_weights is not None:
+            self.sensorWeights = sensor_weights
+
+        #the rules are compiled once here, and again only when the rules file changes
+        self.__rules_file = Cep2RulesFile(self.rulesPath) if self.rulesPath else None
+        if self.__rules_file:
+            self.__rules = self.__rules_file.rules
+        else:
+            self.__rules = Cep2RuleSet.from_config(default_rules(self.sensorToActuator,
+                                                                 self.pillboxToPatient,
+                                                                 self.reminderLight))
+
+        # The events of different devices are handled in parallel, so the state of the home
+        # (current room, phase of the lights, ...) is protected by this lock.
+        self.__state_lock = RLock()
+        self.__z2m_client = None
+        self.__uplink = None
+        self.__scheduler = None
+        self.__event_store = None
+        self.__effects = None
+        self.__reminders = {}
+        #phase shown by the lights, used to only publish when it changes
+        self.__lightsPhase = Cep2ReminderPhase.IDLE
+        self.__occupancy = Cep2OccupancyEngine(sensor_weights=self.sensorWeights,
+                                               margin=self.occupancyMargin,
+                                               dwell=self.occupancyDwell)
+        #timer confirming the room that is replacing the current room, see enter_room
+        self.__occupancyTimer = None
+        self.__occupancyDeadline = None
+        #room changed event of the pending room, sent when the room is confirmed by the timer
+        self.__pendingRoomEvent = None
+        self.__observedRoom = None
+
+    def attach(self,
+               z2m_client: Union[Cep2Zigbee2mqttClient, Cep2AsyncZigbee2mqttClient],
+               uplink: Union[Cep2WebUplink, Cep2AsyncWebUplink],
+               scheduler: Cep2Scheduler,
+               event_store: Optional[Cep2EventStore] = None) -> None:
+        """ Gives the home the services shared by all the homes of the controller, and creates the
+        medication reminders of its patients. The threaded and the asyncio variants of the services
+        can be used, since they have the same synchronous interface for the home. If an event store
+        is given, the events sent to the server are also kept in it.
+        """
+        self.__z2m_client = z2m_client
+        self.__uplink = uplink
+        self.__scheduler = scheduler
+        self.__event_store = event_store
+        if self.lightGroups:
+            z2m_client.set_groups(self.lightGroups, base_topic=self.base_topic)
+        self.__effects = Cep2LightEffects(z2m_client, scheduler, self.base_topic,
+                                          native_lights=self.nativeEffectLights)
+        self.__reminders = {
+            patient: Cep2MedicationReminder(patient,
+                                            scheduler,
+                                            self.__reminder_phase_changed,
+                                            doses,
+                                            self.timeWindowBefore,
+                                            self.timeWindowAfter)
+            for patient, doses in self.medicationTimes.items()
+        }
+
+    def reminder(self, patient_id: str) -> Optional[Cep2MedicationReminder]:
+        return self.__reminders.get(patient_id)
+
+    @property
+    def effects(self) -> Cep2LightEffects:
+        return self.__effects
+
+    @property
+    def rules(self) -> Cep2RuleSet:
+        return self.__rules
+
+    @property
+    def occupancy(self) -> Cep2OccupancyEngine:
+        return self.__occupancy
+
+    #Function compiling the rules file again if it changed. The events being handled keep using the
+    #previous rules, and the MQTT connection is not affected. Returns True if the rules were reloaded
+    def reload_rules(self) -> bool:
+        if self.__rules_file is None:
+            return False
+        rules = self.__rules_file.reload_if_changed()
+        if rules is None:
+            return False
+        self.__rules = rules
+
+        return True
+
+    def now(self) -> datetime:
+        return self.__scheduler.now()
+
+    def start(self) -> None:
+        for reminder in self.__reminders.values():
+            reminder.start()
+
+    #Function called with the medication schedule retrieved from the server. The windows apply to all the
+    #patients. The server gives either the times of each patient, as {patient: [[hour, minute], ...]}, or a
+    #single [hour, minute], which only describes the schedule of a home with one patient taking one dose a
+    #day. Otherwise, the configured times of the patients are kept
+    def update_schedule(self, var1: Union[List[int], Dict[str, List[List[int]]]], timeWindowBefore: int,
+                        timeWindowAfter: int) -> None:
+        with self.__state_lock:
+            self.timeWindowBefore = timeWindowBefore
+            self.timeWindowAfter = timeWindowAfter
+            if isinstance(var1, dict):
+                times = {patient: [(t[0], t[1]) for t in doses] for patient, doses in var1.items()}
+            elif len(self.__reminders) == 1 and all(len(r.doses) == 1 for r in self.__reminders.values()):
+                times = {patient: [(var1[0], var1[1])] for patient in self.__reminders}
+            else:
+                print(f"The medication time {var1} of the server is not used in {self.home_id}: "
+                      "the home has several patients or doses")
+                times = {}
+            for patient, reminder in self.__reminders.items():
+                reminder.set_schedule(times.get(patient, reminder.doses), timeWindowBefore, timeWindowAfter)
+
+    #Function for blinking a light. The steps are scheduled on the scheduler by the effects engine, so
+    #the caller (a dispatcher thread or the event loop) is not blocked while the light blinks
+    def blink(self, light_sensor_id) -> None:
+        self.__effects.blink(light_sensor_id, color=(0.7, 0.28), times=2, period=timedelta(seconds=2))
+
+    #Function for changing a light. An effect running on the light is cancelled first, so its remaining
+    #steps do not override the new state
+    def __change_state(self, light: str, state: str, color_x: float, color_y: float) -> None:
+        self.__effects.cancel(light)
+        self.__z2m_client.change_state(light, state, color_x, color_y, base_topic=self.base_topic)
+
+    def __change_state_many(self, lights: List[str], state: str, color_x: float, color_y: float) -> None:
+        for light in lights:
+            self.__effects.cancel(light)
+        self.__z2m_client.change_state_many(lights, state, color_x, color_y, base_topic=self.base_topic)
+
+    #Actions of the rules, see Cep2Rules. They are called while holding the state lock
+
+    def set_light(self, light: str, state: str, color_x: float, color_y: float) -> None:
+        self.__change_state(light, state, color_x, color_y)
+
+    #Function registering that the patient took the medication. It only succeeds inside the window, the
+    #lights are turned off by the phase change
+    def take_medication(self, patient_id: str) -> bool:
+        reminder = self.__reminders.get(patient_id)
+        if reminder is None or not reminder.mark_taken():
+            return False
+        print("Medication has been taken")
+
+        return True
+
+    #Function called when a motion sensor detects the patient. The patient only moves to the room once the
+    #occupancy engine confirms it, possibly later from the timer. Returns True if the patient moved
+    def enter_room(self, room: str, sensor: Optional[str] = None) -> bool:
+        with self.__state_lock:
+            self.__observedRoom = room
+            newRoom = self.__occupancy.observe(room, self.now().timestamp(), sensor)
+            self.__schedule_occupancy_check()
+            if newRoom is None:
+                return False
+            self.__move_to(newRoom)
+
+            return True
+
+    def __move_to(self, room: str) -> None:
+        #This case is for when the patient is being reminded but is changing rooms, the reminder
+        #follows the patient
+        if room != self.currentRoom and self.__lightsPhase in self.phaseColors and \
+                room in self.sensorToActuator:
+            color_x, color_y = self.phaseColors[self.__lightsPhase]
+            if self.currentRoom in self.sensorToActuator:
+                self.__change_state(self.sensorToActuator[self.currentRoom], "OFF", 0, 0)
+            self.__change_state(self.sensorToActuator[room], "ON", color_x, color_y)
+        self.currentRoom = room
+        self.__pendingRoomEvent = None
+        print(f"Current room is {self.currentRoom}")
+
+    #Function scheduling the confirmation of the pending room at its deadline, called with the state lock
+    def __schedule_occupancy_check(self) -> None:
+        deadline = self.__occupancy.pending_deadline
+        if deadline == self.__occupancyDeadline:
+            return
+        if self.__occupancyTimer is not None:
+            self.__occupancyTimer.cancel()
+            self.__occupancyTimer = None
+        self.__occupancyDeadline = deadline
+        if deadline is not None:
+            delay = max(0.0, deadline - self.now().timestamp())
+            self.__occupancyTimer = self.__scheduler.schedule_in(timedelta(seconds=delay),
+                                                                 self.__check_occupancy)
+
+    #Function called by the timer when no sensor reported until the deadline of the pending room
+    def __check_occupancy(self) -> None:
+        with self.__state_lock:
+            self.__occupancyTimer = None
+            self.__occupancyDeadline = None
+            event = self.__pendingRoomEvent
+            newRoom = self.__occupancy.evaluate(self.now().timestamp())
+            self.__schedule_occupancy_check()
+            if newRoom is None:
+                return
+            self.__move_to(newRoom)
+            if event is not None and event[0] == newRoom:
+                self.__send_event(*event[1:])
+
+    #Function returning the most urgent reminder phase among all the patients
+    def __most_urgent_phase(self) -> Cep2ReminderPhase:
+        return max((r.phase for r in self.__reminders.values()),
+                   key=lambda p: p.value,
+                   default=Cep2ReminderPhase.IDLE)
+
+    #Function called by the reminders each time their phase changes. The lights are only changed here
+    #and when the patient changes room, instead of being published periodically
+    def __reminder_phase_changed(self, reminder: Cep2MedicationReminder, phase: Cep2ReminderPhase) -> None:
+        print(f"Reminder of {reminder.patient_id} in {self.home_id} is {phase.name}")
+        with self.__state_lock:
+            newPhase = self.__most_urgent_phase()
+            if newPhase == self.__lightsPhase:
+                return
+
+            lights = [self.reminderLight]
+            if self.currentRoom in self.sensorToActuator:
+                lights.append(self.sensorToActuator[self.currentRoom])
+            else:
+                print(f"Unknown room: {self.currentRoom}")
+
+            #all the lights are changed with one call, so they change at the same time
+            if newPhase in self.phaseColors:
+                color_x, color_y = self.phaseColors[newPhase]
+                self.__change_state_many(lights, "ON", color_x, color_y)
+            elif self.__lightsPhase in self.phaseColors:
+                self.__change_state_many(lights, "OFF", 0, 0)
+            self.__lightsPhase = newPhase
+
+    #Function for handling the Zigbee2Mqtt events of this home, this is running on the dispatcher's threads
+    #(or on the event loop, with Cep2AsyncController). Only the rules of the device of the event are evaluated
+    def handle_message(self, message: Cep2Zigbee2mqttMessage) -> None:
+        if message.type_ != Cep2Zigbee2mqttMessageType.DEVICE_EVENT or message.event is None:
+            return
+
+        device_id = message.device_id
+        #the rules are read once, so a reload while the event is handled does not affect it
+        rules = self.__rules
+
+        with self.__state_lock:
+            #the conditions of all the rules are evaluated before executing any action
+            fired = rules.match(device_id, message.event, self)
+            if not fired:
+                return
+
+            timed = METRICS.enabled
+            if timed:
+                start = perf_counter()
+            device = self.devices_model.find(device_id)
+            if timed:
+                _FIND_SECONDS.observe(perf_counter() - start)
+
+            self.__observedRoom = None
+            for rule, value in fired:
+                executed = rule.execute(self, device_id, value)
+                if rule.heucod_code is None:
+                    continue
+                if not executed:
+                    #the patient was detected in a room without moving there yet. The event is kept in case
+                    #the timer confirms the room
+                    if self.__observedRoom is not None and self.__observedRoom == self.__occupancy.pending:
+                        self.__pendingRoomEvent = (self.__observedRoom, device_id, device, rule.heucod_code,
+                                                   rule.description(value))
+                    continue
+
+                #an event is sent to the server for each rule with a HEUCOD code i.e. the patient moved to a
+                #different room or picked up the pillbox
+                self.__send_event(device_id, device, rule.heucod_code, rule.description(value))
+
+    #Function sending a HEUCOD event to the server, and keeping it in the event store
+    def __send_event(self, device_id: str, device: Optional[Cep2ZigbeeDevice], heucod_code: int,
+                     description: Any) -> None:
+        self.HeucodNum = heucod_code
+        self.EventDescription = description
+        print(f"sending event: {self.EventDescription}")
+        timed = METRICS.enabled
+        if timed:
+            start = perf_counter()
+        web_event = Cep2WebDeviceEvent(device_id=device_id,
+                                       device_type=device.type_ if device else None,
+                                       measurement=self.EventDescription,
+                                       heucod_event=self.HeucodNum,
+                                       location=self.home_id)
+        heucod = web_event.to_heucod(self.now())
+        if timed:
+            _HEUCOD_SECONDS.observe(perf_counter() - start)
+        self.__uplink.enqueue(heucod)
+        if self.__event_store is not None:
+            self.__event_store.append(heucod)
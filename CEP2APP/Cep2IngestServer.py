@@ -0,0 +1,401 @@
+""" HEUCOD ingestion service, a drop-in replacement of receive_data.php and
+retrieve_variables.php.
+
+It accepts the requests of Cep2WebClient: a single JSON event (send_event), a JSON array of events
+(send_events) or a batch in the binary format of Cep2WireFormat, optionally compressed. The events
+are validated with HeucodEvent and stored in a SQLite database in WAL mode. GET requests return the
+medication schedule, with an ETag so that Cep2ConfigCache can use conditional requests.
+
+Usage:
+    python Cep2IngestServer.py [--host HOST] [--port PORT] [--db FILE] [--variables FILE]
+
+The gateway is pointed to it with:
+
+    Cep2Controller.HTTP_HOST = "http://<host>:<port>/receive_data.php"
+    Cep2Controller.HTTP_HOST_RETRIEVE = "http://<host>:<port>/retrieve_variables.php"
+
+All the writes are done by a single thread, with one transaction for all the events received since
+the previous one (group commit): while a transaction is committed, the events of the next requests
+are queued, so the cost of the commit is shared by many requests. A request is answered once its
+events are committed, so the at-least-once delivery of the uplink is kept. Invalid events (without
+eventTypeEnum, timestamp and either id or location, or with attributes that are not HEUCOD
+attributes) are answered with 400 and the whole request is discarded, since sending it again would
+not help.
+"""
+import argparse
+import json
+import sqlite3
+import struct
+from collections import deque
+from dataclasses import dataclass
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Event, Lock, Thread
+from time import time
+from typing import Any, Dict, List, Optional
+from zlib import crc32, error as ZlibError
+from Cep2Heucod import HEUCOD_ATTRIBUTES, HeucodEvent
+from Cep2WireFormat import CONTENT_TYPE as BINARY_CONTENT_TYPE, decode_batch
+
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = lambda obj: orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    _loads = json.loads
+    _dumps = lambda obj: json.dumps(obj, separators=(",", ":"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    rowid INTEGER PRIMARY KEY,
+    received_at REAL NOT NULL,
+    gateway TEXT,
+    device_id TEXT,
+    event_type_enum INTEGER,
+    description TEXT,
+    timestamp TEXT,
+    location TEXT,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_location_received_at ON events (location, received_at);
+"""
+_INSERT = "INSERT INTO events (received_at, gateway, device_id, event_type_enum, description, " \
+          "timestamp, location, document) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+@dataclass
+class Cep2IngestStats:
+    """ Snapshot of the counters of a Cep2IngestServer.
+    """
+
+    requests: int = 0
+    events: int = 0
+    rejected: int = 0
+    transactions: int = 0
+
+
+def _row(event: HeucodEvent, document: str, received_at: float, gateway: str) -> tuple:
+    attributes = event.__dict__
+    event_type_enum = attributes.get("event_type_enum")
+    if event_type_enum is not None and type(event_type_enum) is not int:
+        raise ValueError(f"eventTypeEnum must be an integer, not {event_type_enum!r}")
+    description = attributes.get("description")
+    if description is not None and not isinstance(description, str):
+        # Keeps the type of the value, e.g. the occupancy of a motion sensor is a boolean.
+        description = _dumps(description)
+    device_id = attributes.get("id_")
+    timestamp = attributes.get("timestamp")
+    location = attributes.get("location")
+
+    return (received_at,
+            gateway,
+            device_id if device_id is None else str(device_id),
+            event_type_enum,
+            description,
+            timestamp if timestamp is None else str(timestamp),
+            location if location is None else str(location),
+            document)
+
+
+def _validate(event: HeucodEvent) -> HeucodEvent:
+    attributes = event.__dict__
+    unknown = attributes.keys() - HEUCOD_ATTRIBUTES
+    if unknown:
+        raise ValueError(f"Unknown attributes: {', '.join(sorted(unknown))}")
+    if attributes.get("event_type_enum") is None or attributes.get("timestamp") is None:
+        raise ValueError("eventTypeEnum and timestamp are required")
+    if attributes.get("id_") is None and attributes.get("location") is None:
+        raise ValueError("id or location is required")
+
+    return event
+
+
+def parse_events(body: bytes,
+                 content_type: Optional[str],
+                 content_encoding: Optional[str] = None) -> List[tuple]:
+    """ Validates the body of a request and returns its events, as (HeucodEvent, JSON document).
+
+    Raises:
+        ValueError: if the body is not valid.
+    """
+    if content_type == BINARY_CONTENT_TYPE:
+        events = decode_batch(body, content_encoding)
+        return [(_validate(e), HeucodEvent.serializer.to_json(e)) for e in events]
+
+    if content_encoding and content_encoding != "identity":
+        raise ValueError(f"Unsupported Content-Encoding for JSON: {content_encoding}")
+    if not body:
+        raise ValueError("Empty body")
+    data = _loads(body)
+    if isinstance(data, list):
+        return [(_validate(HeucodEvent.from_dict(d)), _dumps(d)) for d in data]
+
+    return [(_validate(HeucodEvent.from_dict(data)), body.decode("utf-8"))]
+
+
+class _Cep2EventWriter:
+    """ Thread writing the events to the database, see the group commit in the documentation of the
+    module.
+    """
+
+    def __init__(self, path: str, stats: Cep2IngestStats, stats_lock: Lock):
+        self.__path = path
+        self.__stats = stats
+        self.__stats_lock = stats_lock
+        # Each item is [rows, done event, error].
+        self.__pending = deque()
+        self.__condition = Condition()
+        self.__running = True
+        self.__ready = Event()
+        self.__error: Optional[Exception] = None
+        self.__thread = Thread(target=self.__worker, daemon=True)
+        self.__thread.start()
+        self.__ready.wait()
+        if self.__error:
+            raise self.__error
+
+    def write(self, rows: List[tuple]) -> None:
+        """ Queues rows and waits until they are committed.
+
+        Raises:
+            sqlite3.Error: if the transaction failed.
+        """
+        item = [rows, Event(), None]
+        with self.__condition:
+            if not self.__running:
+                raise sqlite3.OperationalError("The writer is stopped")
+            self.__pending.append(item)
+            self.__condition.notify()
+        item[1].wait()
+        if item[2] is not None:
+            raise item[2]
+
+    def stop(self) -> None:
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        self.__thread.join()
+
+    def __worker(self) -> None:
+        try:
+            connection = sqlite3.connect(self.__path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # With WAL, NORMAL only syncs at checkpoints: a power loss can lose the last
+            # transactions, but never corrupts the database.
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(_SCHEMA)
+        except sqlite3.Error as ex:
+            self.__error = ex
+            self.__ready.set()
+            return
+        self.__ready.set()
+
+        while True:
+            with self.__condition:
+                while self.__running and not self.__pending:
+                    self.__condition.wait()
+                if not self.__pending:
+                    break
+                items = list(self.__pending)
+                self.__pending.clear()
+
+            try:
+                with connection:
+                    # The statement is prepared once and cached by the connection.
+                    connection.executemany(_INSERT, (r for rows, _, _ in items for r in rows))
+                with self.__stats_lock:
+                    self.__stats.transactions += 1
+            except sqlite3.Error as ex:
+                for item in items:
+                    item[2] = ex
+            for item in items:
+                item[1].set()
+
+        connection.close()
+
+
+class Cep2IngestServer:
+    """ The ingestion service. It can be embedded, e.g. in integration and load tests:
+
+        server = Cep2IngestServer("events.db", port=0)
+        server.start()
+        client = Cep2WebClient(server.url)
+        ...
+        server.stop()
+    """
+
+    def __init__(self,
+                 db_path: str,
+                 host: str = "127.0.0.1",
+                 port: int = 8080,
+                 variables: Optional[Dict[str, Any]] = None,
+                 binary: bool = True):
+        """ Class initializer. The database is created if it does not exist.
+
+        Args:
+            db_path (str): path of the SQLite database.
+            host (str): address the server listens on. Defaults to the local host only.
+            port (int): port of the server. If 0, a free port is used. Defaults to 8080.
+            variables (Optional[Dict[str, Any]]): medication schedule returned by the GET
+                requests, see parse_variables().
+            binary (bool): whether the binary format of Cep2WireFormat is accepted. If False, it
+                is rejected with 415, like the PHP server.
+        """
+        self.__db_path = db_path
+        self.__binary = binary
+        self.__stats = Cep2IngestStats()
+        self.__stats_lock = Lock()
+        self.__variables_lock = Lock()
+        self.set_variables(variables or {"variable1": [16, 18], "variable2": 1, "variable3": 1})
+        self.__writer = _Cep2EventWriter(db_path, self.__stats, self.__stats_lock)
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1, so the connections of the web clients are kept alive.
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                server.handle_post(self)
+
+            def do_GET(self):
+                server.handle_get(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer((host, port), Handler)
+        self.__server.daemon_threads = True
+        self.__thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.__server.server_address[:2]
+        return f"http://{host}:{port}/receive_data.php"
+
+    @property
+    def variables_url(self) -> str:
+        host, port = self.__server.server_address[:2]
+        return f"http://{host}:{port}/retrieve_variables.php"
+
+    @property
+    def stats(self) -> Cep2IngestStats:
+        with self.__stats_lock:
+            return Cep2IngestStats(**self.__stats.__dict__)
+
+    def set_variables(self, variables: Dict[str, Any]) -> None:
+        """ Changes the medication schedule returned by the GET requests.
+        """
+        body = json.dumps(variables).encode("utf-8")
+        with self.__variables_lock:
+            self.__variables = (body, f'"{crc32(body):08x}"', formatdate(time(), usegmt=True))
+
+    def count(self, location: Optional[str] = None) -> int:
+        """ Returns the number of events stored, of all the homes or of one home.
+        """
+        with sqlite3.connect(self.__db_path) as connection:
+            if location is None:
+                return connection.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+            return connection.execute("SELECT COUNT(*) FROM events WHERE location = ?",
+                                      (location,)).fetchone()[0]
+
+    def start(self) -> None:
+        self.__thread = Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+
+    def serve_forever(self) -> None:
+        self.__server.serve_forever()
+
+    def stop(self) -> None:
+        if self.__thread:
+            self.__server.shutdown()
+        self.__server.server_close()
+        self.__writer.stop()
+
+    def handle_post(self, request: BaseHTTPRequestHandler) -> None:
+        body = request.rfile.read(int(request.headers.get("Content-Length", 0)))
+        content_type = request.headers.get("Content-Type")
+        if content_type == BINARY_CONTENT_TYPE and not self.__binary:
+            self.__respond(request, 415, b"", rejected=True)
+            return
+
+        try:
+            events = parse_events(body, content_type, request.headers.get("Content-Encoding"))
+            received_at = time()
+            gateway = request.client_address[0]
+            rows = [_row(e, d, received_at, gateway) for e, d in events]
+        except (ValueError, EOFError, OSError, ZlibError, struct.error) as ex:
+            # Invalid JSON or HEUCOD events, or a corrupted compressed body.
+            self.__respond(request, 400, f"Invalid events: {ex}".encode("utf-8"), rejected=True)
+            return
+
+        try:
+            self.__writer.write(rows)
+        except sqlite3.Error as ex:
+            # The uplink retries the requests answered with 5xx.
+            self.__respond(request, 503, f"Error storing the events: {ex}".encode("utf-8"))
+            return
+
+        with self.__stats_lock:
+            self.__stats.events += len(rows)
+        self.__respond(request, 200, b"")
+
+    def handle_get(self, request: BaseHTTPRequestHandler) -> None:
+        with self.__variables_lock:
+            body, etag, last_modified = self.__variables
+        if request.headers.get("If-None-Match") == etag:
+            request.send_response(304)
+            request.send_header("ETag", etag)
+            request.send_header("Content-Length", "0")
+            request.end_headers()
+            return
+
+        request.send_response(200)
+        request.send_header("ETag", etag)
+        request.send_header("Last-Modified", last_modified)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def __respond(self, request: BaseHTTPRequestHandler, status: int, body: bytes,
+                  rejected: bool = False) -> None:
+        with self.__stats_lock:
+            self.__stats.requests += 1
+            if rejected:
+                self.__stats.rejected += 1
+        request.send_response(status)
+        if status == 415:
+            request.send_header("Accept-Post", "application/json")
+        request.send_header("Content-Type", "text/plain")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HEUCOD ingestion service")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8080, help="port (default: 8080)")
+    parser.add_argument("--db", default="heucod_events.db",
+                        help="SQLite database (default: heucod_events.db)")
+    parser.add_argument("--variables", help="JSON file with the medication schedule")
+    parser.add_argument("--no-binary", action="store_true",
+                        help="reject the binary format, like the PHP server")
+    args = parser.parse_args()
+
+    variables = None
+    if args.variables:
+        with open(args.variables, "r", encoding="utf-8") as variables_file:
+            variables = json.load(variables_file)
+
+    ingest = Cep2IngestServer(args.db, args.host, args.port, variables, binary=not args.no_binary)
+    print(f"Receiving events at {ingest.url}, schedule at {ingest.variables_url}")
+    try:
+        ingest.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ingest.stop()
+        print(f"{ingest.stats.events} events stored in {args.db}")
@@ -0,0 +1,245 @@
+""" Latency histograms of the stages of the gateway, exposed in the Prometheus text format.
+
+The modules of the gateway declare their histograms at import time on the shared registry METRICS
+and observe them only when METRICS.enabled is True:
+
+    _PARSE_SECONDS = METRICS.histogram("cep2_zigbee2mqtt_parse_seconds", "Time to parse a message")
+    ...
+    if METRICS.enabled:
+        start = perf_counter()
+    ...
+    if METRICS.enabled:
+        _PARSE_SECONDS.observe(perf_counter() - start)
+
+so the cost of the instrumentation while it is disabled is one attribute lookup per hook. The
+registry is enabled by the controller when METRICS_PORT or METRICS_DUMP_INTERVAL is set. The metrics
+can then be read at http://<host>:<port>/metrics, or are printed periodically.
+"""
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Upper bounds, in seconds, of the buckets of the histograms: from 10 us to 60 s, with about 3
+# buckets per decade. Fixed bounds make observe() a bisect and an increment.
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Cep2Histogram:
+    """ A histogram of durations with fixed buckets. It can be observed from several threads.
+    """
+
+    def __init__(self, name: str, help_: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_
+        self.buckets = tuple(buckets)
+        self.__lock = Lock()
+        # One counter per bucket, plus one for the values above the last bound.
+        self.__counts = [0] * (len(self.buckets) + 1)
+        self.__sum = 0.0
+        self.__count = 0
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self.buckets, value)
+        with self.__lock:
+            self.__counts[i] += 1
+            self.__sum += value
+            self.__count += 1
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        """ Returns the counters of the histogram.
+
+        Returns:
+            Tuple[List[int], float, int]: the cumulative count of each bucket (the last one is
+                +Inf), the sum of the values and the number of values.
+        """
+        with self.__lock:
+            counts = list(self.__counts)
+            total, count = self.__sum, self.__count
+
+        cumulative = []
+        running = 0
+        for c in counts:
+            running += c
+            cumulative.append(running)
+
+        return cumulative, total, count
+
+    def quantile(self, q: float) -> Optional[float]:
+        """ Estimates a quantile, interpolating linearly inside its bucket like Prometheus'
+        histogram_quantile(). Values above the last bound are reported as the last bound.
+
+        Returns:
+            Optional[float]: the estimate, or None if nothing was observed.
+        """
+        cumulative, _, count = self.snapshot()
+        if count == 0:
+            return None
+
+        rank = q * count
+        i = bisect_left(cumulative, rank)
+        if i >= len(self.buckets):
+            return self.buckets[-1]
+        lower = self.buckets[i - 1] if i > 0 else 0.0
+        below = cumulative[i - 1] if i > 0 else 0
+        in_bucket = cumulative[i] - below
+
+        return lower + (self.buckets[i] - lower) * ((rank - below) / in_bucket if in_bucket else 1)
+
+    def reset(self) -> None:
+        with self.__lock:
+            self.__counts = [0] * (len(self.buckets) + 1)
+            self.__sum = 0.0
+            self.__count = 0
+
+
+class Cep2Metrics:
+    """ Registry of the histograms and gauges of the gateway.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.__histograms: Dict[str, Cep2Histogram] = {}
+        self.__gauges: Dict[str, Tuple[str, Callable[[], float]]] = {}
+        self.__lock = Lock()
+        self.__server = None
+        self.__dump_stop = Event()
+        self.__dump_thread = None
+
+    def histogram(self,
+                  name: str,
+                  help_: str,
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Cep2Histogram:
+        """ Returns the histogram with the given name, creating it if needed.
+        """
+        with self.__lock:
+            histogram = self.__histograms.get(name)
+            if histogram is None:
+                histogram = self.__histograms[name] = Cep2Histogram(name, help_, buckets)
+
+            return histogram
+
+    def gauge(self, name: str, help_: str, function: Callable[[], float]) -> None:
+        """ Registers a gauge, whose value is read by calling the function when the metrics are
+        rendered, e.g. the depth of a queue. A gauge with the same name is replaced.
+        """
+        with self.__lock:
+            self.__gauges[name] = (help_, function)
+
+    def render(self) -> str:
+        """ Returns the metrics in the Prometheus text exposition format.
+        """
+        with self.__lock:
+            histograms = list(self.__histograms.values())
+            gauges = list(self.__gauges.items())
+
+        lines = []
+        for histogram in histograms:
+            cumulative, total, count = histogram.snapshot()
+            lines.append(f"# HELP {histogram.name} {histogram.help}")
+            lines.append(f"# TYPE {histogram.name} histogram")
+            for bound, value in zip(histogram.buckets, cumulative):
+                lines.append(f'{histogram.name}_bucket{{le="{bound:g}"}} {value}')
+            lines.append(f'{histogram.name}_bucket{{le="+Inf"}} {cumulative[-1]}')
+            lines.append(f"{histogram.name}_sum {total}")
+            lines.append(f"{histogram.name}_count {count}")
+        for name, (help_, function) in gauges:
+            try:
+                value = function()
+            except Exception as ex:
+                print(f"Error reading gauge {name}: {ex}")
+                continue
+            lines.append(f"# HELP {name} {help_}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """ Returns a short human readable summary: count, p50, p99 and mean of each histogram
+        with values.
+        """
+        with self.__lock:
+            histograms = list(self.__histograms.values())
+
+        lines = []
+        for histogram in histograms:
+            _, total, count = histogram.snapshot()
+            if count:
+                lines.append(f"{histogram.name}: n={count} "
+                             f"p50={histogram.quantile(0.5) * 1000:.3f}ms "
+                             f"p99={histogram.quantile(0.99) * 1000:.3f}ms "
+                             f"mean={total / count * 1000:.3f}ms")
+
+        return "\n".join(lines)
+
+    def reset(self) -> None:
+        with self.__lock:
+            histograms = list(self.__histograms.values())
+        for histogram in histograms:
+            histogram.reset()
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> int:
+        """ Enables the metrics and serves them at http://<host>:<port>/metrics, from a thread.
+
+        Args:
+            port (int): port of the server. If 0, a free port is used.
+            host (str): address the server listens on. Defaults to the local host only.
+
+        Returns:
+            int: the port of the server.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.enabled = True
+        self.__server = ThreadingHTTPServer((host, port), Handler)
+        Thread(target=self.__server.serve_forever, daemon=True).start()
+
+        return self.__server.server_port
+
+    def start_dump(self, interval: float) -> None:
+        """ Enables the metrics and prints their summary every interval seconds.
+        """
+        self.enabled = True
+        self.__dump_stop.clear()
+
+        def dump():
+            while not self.__dump_stop.wait(interval):
+                summary = self.summary()
+                if summary:
+                    print(summary)
+
+        self.__dump_thread = Thread(target=dump, daemon=True)
+        self.__dump_thread.start()
+
+    def stop(self) -> None:
+        """ Stops the server and the periodic dump. The metrics stay enabled.
+        """
+        if self.__server:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+        self.__dump_stop.set()
+        if self.__dump_thread:
+            self.__dump_thread.join()
+            self.__dump_thread = None
+
+
+# Registry shared by all the modules of the gateway.
+METRICS = Cep2Metrics()
@@ -1,11 +1,14 @@
 from dataclasses import dataclass
-from typing import List, Optional, Union
+from enum import Enum
+from threading import Lock
+from typing import Callable, Iterable, List, Optional, Union
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Cep2ZigbeeDevice:
     """ This class represents a Zigbee device. It has an ID and type, both strings that the user can
     assign at its will. Since this is used as a companion class of the zigbee2mqtt client, the id_
-    can be the device address (or friendly name) and the type_ can be user custom.
+    can be the device address (or friendly name) and the type_ can be user custom. Optionally, the
+    room where the device is installed can be given.
     """
 
     # A note on the name of these class attributes: id and type are names of Python built-in
@@ -15,24 +18,59 @@ class Cep2ZigbeeDevice:
     # For more information check:
     # https://stackoverflow.com/questions/77552/id-is-a-bad-variable-name-in-python
 
+    # A note on slots: by default, each Python object stores its attributes in a dictionary. With
+    # slots=True, the attributes are stored in fixed positions of the object instead, which uses
+    # less memory and is faster to access. This matters when a gateway stores hundreds of devices.
+    # The devices are frozen (immutable), since the model indexes them by type and room: to change a
+    # device, a new object is added to the model, e.g. dataclasses.replace(device, room="kitchen").
+
     id_: str
     type_: str
+    room: Optional[str] = None
+
+
+class Cep2ModelChange(Enum):
+    """ Enumeration with the changes that the model notifies to its subscribers.
+    """
+
+    ADDED = "added"
+    UPDATED = "updated"
+    REMOVED = "removed"
 
 
 class Cep2Model:
     """ The model class is responsible for representing and managing access to data. In this case,
-    the class is a basic dictionary that uses the devices's ID as key to reference the device
-    object. This is a very simplistic database and more evolved approaches can be used. For example,
-    this class might abstract the access to a database such as MySQL.
+    the class is a registry of devices that uses the devices's ID as key to reference the device
+    object. Besides the main dictionary, it maintains indexes of the devices by type and by room, so
+    that all lookups are done in constant time, without iterating over all devices. This is still a
+    simple database and more evolved approaches can be used. For example, this class might abstract
+    the access to a database such as MySQL.
+
+    Devices are immutable, so the indexes can not become stale. To change a device, add a new object
+    with the same ID.
     """
 
+    ACTUATOR_TYPES = {"led", "power plug"}
+    SENSOR_TYPES = {"pir"}
+
     def __init__(self):
         self.__devices = {}
+        # Secondary indexes: type (or room) -> {device ID -> device}. Dictionaries are used instead
+        # of lists since they keep the insertion order and allow removing a device in constant time.
+        self.__by_type = {}
+        self.__by_room = {}
+        self.__lock = Lock()
+        self.__subscribers = []
+
+    def __contains__(self, device_id: str) -> bool:
+        return device_id in self.__devices
+
+    def __len__(self) -> int:
+        return len(self.__devices)
 
     @property
     def actuators_list(self) -> List[Cep2ZigbeeDevice]:
-        return list(filter(lambda s: s.type_ in {"led", "power plug"},
-                           self.__devices.values()))
+        return self.__list_types(self.ACTUATOR_TYPES)
 
     @property
     def devices_list(self) -> List[Cep2ZigbeeDevice]:
@@ -40,24 +78,66 @@ class Cep2Model:
 
     @property
     def sensors_list(self) -> List[Cep2ZigbeeDevice]:
-        return list(filter(lambda s: s.type_ in {"pir"},
-                           self.__devices.values()))
+        return self.__list_types(self.SENSOR_TYPES)
 
-    def add(self, device: Union[Cep2ZigbeeDevice, List[Cep2ZigbeeDevice]]) -> None:
-        """ Add a new devices to the database.
+    @property
+    def rooms(self) -> List[str]:
+        return list(self.__by_room)
+
+    def subscribe(self, callback: Callable[[Cep2ModelChange, Cep2ZigbeeDevice], None]) -> None:
+        """ Registers a function that is called each time a device is added, updated or removed.
+        The function is called after the model is changed, from the thread that changed it.
+
+        Args:
+            callback (Callable[[Cep2ModelChange, Cep2ZigbeeDevice], None]): function that receives
+                the change and the device. For REMOVED, the device is the removed object.
+        """
+        self.__subscribers.append(callback)
+
+    def add(self, device: Union[Cep2ZigbeeDevice, Iterable[Cep2ZigbeeDevice]]) -> None:
+        """ Add a new devices to the database. If a device with the same ID is already stored, it is
+        replaced.
 
         Args:
-            device (Union[Cep2ZigbeeDevice, List[Cep2ZigbeeDevice]]): a device object, or a list of
-            device objects to store.
+            device (Union[Cep2ZigbeeDevice, Iterable[Cep2ZigbeeDevice]]): a device object, or a list
+            of device objects to store.
         """
         # If the value given as argument is a Cep2ZigbeeDevice, then create a list with it so that
         # later only a list of objects has to be inserted.
         list_devices = [device] if isinstance(device, Cep2ZigbeeDevice)\
             else device
 
-        # Insert list of devices, where the device ID is the key of the dictionary.
-        for s in list_devices:
-            self.__devices[s.id_] = s
+        changes = []
+        with self.__lock:
+            # Insert list of devices, where the device ID is the key of the dictionary.
+            for s in list_devices:
+                old = self.__devices.get(s.id_)
+                if old is not None:
+                    self.__unindex(old)
+                self.__devices[s.id_] = s
+                self.__index(s)
+                changes.append((Cep2ModelChange.ADDED if old is None else Cep2ModelChange.UPDATED,
+                                s))
+
+        self.__notify(changes)
+
+    def remove(self, device_id: Union[str, Iterable[str]]) -> None:
+        """ Remove devices from the database. IDs that are not stored are ignored.
+
+        Args:
+            device_id (Union[str, Iterable[str]]): ID of the device, or a list of IDs, to remove.
+        """
+        list_ids = [device_id] if isinstance(device_id, str) else device_id
+
+        changes = []
+        with self.__lock:
+            for i in list_ids:
+                old = self.__devices.pop(i, None)
+                if old is not None:
+                    self.__unindex(old)
+                    changes.append((Cep2ModelChange.REMOVED, old))
+
+        self.__notify(changes)
 
     def find(self, device_id: str) -> Optional[Cep2ZigbeeDevice]:
         """ Retrieve a device from the database by its ID.
@@ -68,10 +148,50 @@ class Cep2Model:
         Returns:
             Optional[Cep2ZigbeeDevice]: a device. If the device is not stored, then None is returned
         """
-        # Use the bult-in function filter to get the device. The output of filter is a filter object
-        # that is then casted to a list. The, the first result, if any, is returned; otherwise None.
-        # Instead of None, am exception can also be raised.
-        devices = list(filter(lambda kv: kv[0] == device_id,
-                              self.__devices.items()))
+        # A dictionary lookup is done in constant time and does not allocate any object. Instead of
+        # None, an exception can also be raised.
+        return self.__devices.get(device_id)
+
+    def find_by_type(self, type_: str) -> List[Cep2ZigbeeDevice]:
+        """ Retrieve the devices of a type.
+
+        Args:
+            type_ (str): type of the devices.
+
+        Returns:
+            List[Cep2ZigbeeDevice]: the devices of the given type, in the order they were added.
+        """
+        return list(self.__by_type.get(type_, {}).values())
+
+    def find_by_room(self, room: str) -> List[Cep2ZigbeeDevice]:
+        """ Retrieve the devices installed in a room.
 
-        return devices[0][1] if len(devices) >= 1 else None
\ No newline at end of file
+        Args:
+            room (str): name of the room.
+
+        Returns:
+            List[Cep2ZigbeeDevice]: the devices in the given room, in the order they were added.
+        """
+        return list(self.__by_room.get(room, {}).values())
+
+    def __list_types(self, types: Iterable[str]) -> List[Cep2ZigbeeDevice]:
+        return [d for t in types for d in self.__by_type.get(t, {}).values()]
+
+    def __index(self, device: Cep2ZigbeeDevice) -> None:
+        self.__by_type.setdefault(device.type_, {})[device.id_] = device
+        if device.room is not None:
+            self.__by_room.setdefault(device.room, {})[device.id_] = device
+
+    def __unindex(self, device: Cep2ZigbeeDevice) -> None:
+        for index, key in ((self.__by_type, device.type_), (self.__by_room, device.room)):
+            devices = index.get(key)
+            if devices is not None:
+                devices.pop(device.id_, None)
+                # Remove empty entries, so that e.g. rooms only lists rooms with devices.
+                if not devices:
+                    del index[key]
+
+    def __notify(self, changes: list) -> None:
+        for change, device in changes:
+            for callback in self.__subscribers:
+                callback(change, device)
@@ -0,0 +1,255 @@
+""" Fusion of the reports of the motion sensors into the room where the patient most likely is.
+
+Each report of occupancy is evidence that the patient is in the room of the sensor now, and that
+they are not in the other rooms. The engine keeps a confidence per room, between 0 and 1, updated
+like a belief: a report of a sensor with weight w multiplies the confidence of every room by 1 - w
+and adds w to its own room. Several sensors of the same room, or repeated reports, add up (1 - (1 -
+w1)(1 - w2) for two reports), while a single report in another room only moves the patient there if
+it is not contradicted. With time, all the confidences decay towards 0 (unknown) with a half life.
+
+The room of the patient only changes when a new room is confirmed:
+
+    hysteresis  the confidence of the new room is at least threshold, and exceeds the confidence of
+                the current room by margin.
+    dwell       the new room keeps doing so for dwell seconds. A report of the current room in the
+                meantime, e.g. the patient did not leave, cancels the change.
+
+Since every room is multiplied by the same factor, the factor is kept once for all rooms (the scale)
+instead of updating each room, and a report only changes its own room. The most likely room can
+then only be the current room or the room of the report, so each report is handled in constant
+time, regardless of the number of rooms.
+"""
+from dataclasses import dataclass, field
+from typing import Dict, Mapping, Optional
+
+# The scale is applied to the rooms, and reset to 1, when it gets this small.
+_MIN_SCALE = 1e-150
+
+
+@dataclass
+class Cep2RoomOccupancy:
+    """ Snapshot of the occupancy of a room.
+    """
+
+    room: str
+    confidence: float
+    # Time of the last report of occupancy in the room, in seconds since the epoch.
+    last_seen: float
+    # Time of the last report of each sensor of the room.
+    sensors: Dict[str, float] = field(default_factory=dict)
+
+
+@dataclass
+class Cep2OccupancyStats:
+    """ Counters of a Cep2OccupancyEngine.
+    """
+
+    # Reports of occupancy.
+    observations: int = 0
+    # Changes of the room of the patient.
+    transitions: int = 0
+    # Rooms that started a change, by exceeding the current room.
+    challenges: int = 0
+    # Changes cancelled before the dwell time, i.e. transitions avoided.
+    rejected: int = 0
+
+
+class _Cep2Room:
+    __slots__ = ("score", "last_seen", "sensors")
+
+    def __init__(self):
+        # Confidence divided by the scale of the engine.
+        self.score = 0.0
+        self.last_seen = 0.0
+        self.sensors: Dict[str, float] = {}
+
+
+class Cep2OccupancyEngine:
+    """ This class decides the room where the patient is from the reports of the motion sensors,
+    see the documentation of the module. It is not thread safe: Cep2Home calls it while holding its
+    state lock.
+
+    The times are given by the caller, in seconds, so the engine follows the clock of the scheduler
+    (e.g. a Cep2ManualClock in accelerated time).
+    """
+
+    def __init__(self,
+                 sensor_weights: Optional[Mapping[str, float]] = None,
+                 default_weight: float = 0.7,
+                 threshold: float = 0.5,
+                 margin: float = 0.2,
+                 dwell: float = 5.0,
+                 half_life: float = 300.0):
+        """ Class initializer.
+
+        Args:
+            sensor_weights (Optional[Mapping[str, float]]): weight of the reports of each sensor,
+                for sensors more or less reliable than the default.
+            default_weight (float): weight of the reports of the other sensors, between 0 and 1
+                (excluded). Defaults to 0.7.
+            threshold (float): minimum confidence of a room to become the room of the patient.
+                Defaults to 0.5.
+            margin (float): confidence by which a room must exceed the current room to replace it.
+                Defaults to 0.2.
+            dwell (float): seconds during which a room must exceed the current room to replace it.
+                Defaults to 5.
+            half_life (float): seconds after which the confidences are halved. Defaults to 300.
+
+        Raises:
+            ValueError: if a weight is not between 0 and 1, or a duration is negative.
+        """
+        self.__weights = dict(sensor_weights or {})
+        if not all(0 < w < 1 for w in [default_weight, *self.__weights.values()]):
+            raise ValueError("The weights of the sensors must be between 0 and 1")
+        if dwell < 0 or half_life <= 0:
+            raise ValueError("The dwell time can not be negative, and the half life must be positive")
+
+        self.__default_weight = default_weight
+        self.__threshold = threshold
+        self.__margin = margin
+        self.__dwell = dwell
+        self.__half_life = half_life
+        self.__rooms: Dict[str, _Cep2Room] = {}
+        # Factor of the confidence of all the rooms, and time until which it is decayed.
+        self.__scale = 1.0
+        self.__updated_at: Optional[float] = None
+        self.__room: Optional[str] = None
+        self.__pending: Optional[str] = None
+        self.__pending_since = 0.0
+        self.__stats = Cep2OccupancyStats()
+
+    @property
+    def most_likely(self) -> Optional[str]:
+        """ The room of the patient, or None before the first report.
+        """
+        return self.__room
+
+    @property
+    def pending(self) -> Optional[str]:
+        """ The room that is replacing the room of the patient, if it keeps doing so until
+        pending_deadline.
+        """
+        return self.__pending
+
+    @property
+    def pending_deadline(self) -> Optional[float]:
+        """ Time at which the pending room replaces the room of the patient, or None.
+        """
+        return self.__pending_since + self.__dwell if self.__pending is not None else None
+
+    @property
+    def stats(self) -> Cep2OccupancyStats:
+        return Cep2OccupancyStats(**self.__stats.__dict__)
+
+    def confidence(self, room: str, now: Optional[float] = None) -> float:
+        """ Returns the confidence that the patient is in a room, at the time of the last report or
+        at the given time.
+        """
+        entry = self.__rooms.get(room)
+        if entry is None:
+            return 0.0
+
+        return entry.score * self.__scale * self.__decay(now)
+
+    def rooms(self, now: Optional[float] = None) -> Dict[str, Cep2RoomOccupancy]:
+        """ Returns the occupancy of every room reported so far, by room.
+        """
+        scale = self.__scale * self.__decay(now)
+
+        return {room: Cep2RoomOccupancy(room, entry.score * scale, entry.last_seen,
+                                        dict(entry.sensors))
+                for room, entry in self.__rooms.items()}
+
+    def observe(self, room: str, now: float, sensor: Optional[str] = None) -> Optional[str]:
+        """ Handles a report of occupancy in a room.
+
+        Args:
+            room (str): room of the sensor.
+            now (float): time of the report, in seconds.
+            sensor (Optional[str]): sensor that reported, which gives the weight of the report.
+                Defaults to None, i.e. the default weight.
+
+        Returns:
+            Optional[str]: the new room of the patient, or None if it did not change.
+        """
+        self.__advance(now)
+        weight = self.__weights.get(sensor, self.__default_weight)
+        self.__scale *= 1 - weight
+        entry = self.__rooms.get(room)
+        if entry is None:
+            entry = self.__rooms[room] = _Cep2Room()
+        entry.score += weight / self.__scale
+        entry.last_seen = now
+        if sensor is not None:
+            entry.sensors[sensor] = now
+        if self.__scale < _MIN_SCALE:
+            self.__rescale()
+        self.__stats.observations += 1
+
+        if self.__room is None:
+            # The first room is taken without waiting, since there is no room to keep.
+            return self.__commit(room) if self.confidence(room) >= self.__threshold else None
+
+        if room != self.__room and room != self.__pending and self.__exceeds(room):
+            if self.__pending is not None:
+                self.__stats.rejected += 1
+            self.__pending = room
+            self.__pending_since = now
+            self.__stats.challenges += 1
+
+        return self.__confirm(now)
+
+    def evaluate(self, now: float) -> Optional[str]:
+        """ Replaces the room of the patient by the pending room if the dwell time has passed. It
+        is meant to be called at pending_deadline, when no report arrives in the meantime.
+
+        Returns:
+            Optional[str]: the new room of the patient, or None if it did not change.
+        """
+        self.__advance(now)
+
+        return self.__confirm(now)
+
+    def __decay(self, now: Optional[float]) -> float:
+        if now is None or self.__updated_at is None or now <= self.__updated_at:
+            return 1.0
+
+        return 0.5 ** ((now - self.__updated_at) / self.__half_life)
+
+    def __advance(self, now: float) -> None:
+        self.__scale *= self.__decay(now)
+        if self.__updated_at is None or now > self.__updated_at:
+            self.__updated_at = now
+        if self.__scale < _MIN_SCALE:
+            # After a long time without reports (e.g. a holiday) the scale would underflow to 0.
+            self.__rescale()
+
+    def __rescale(self) -> None:
+        for entry in self.__rooms.values():
+            entry.score *= self.__scale
+        self.__scale = 1.0
+
+    def __exceeds(self, room: str) -> bool:
+        confidence = self.confidence(room)
+
+        return confidence >= self.__threshold and \
+            confidence - self.confidence(self.__room) >= self.__margin
+
+    def __confirm(self, now: float) -> Optional[str]:
+        if self.__pending is None:
+            return None
+        if not self.__exceeds(self.__pending):
+            self.__pending = None
+            self.__stats.rejected += 1
+            return None
+        if now - self.__pending_since < self.__dwell:
+            return None
+
+        return self.__commit(self.__pending)
+
+    def __commit(self, room: str) -> str:
+        self.__room = room
+        self.__pending = None
+        self.__stats.transitions += 1
+
+        return room
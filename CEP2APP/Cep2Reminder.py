@@ -0,0 +1,224 @@
+from datetime import datetime, time, timedelta
+from enum import Enum
+from threading import RLock
+from typing import Callable, List, Optional, Tuple
+from Cep2Scheduler import Cep2Scheduler
+
+
+class Cep2ReminderPhase(Enum):
+    """ Enumeration with the phases of a medication reminder. The value is the urgency of the phase,
+    so phases can be compared, e.g. to find the most urgent of several patients.
+    """
+
+    # No dose is close, the patient does not need to be reminded.
+    IDLE = 0
+    # The last dose has been taken.
+    TAKEN = 1
+    # The window before the medication time has started.
+    PRE_WINDOW = 2
+    # The medication time has passed.
+    DUE = 3
+    # The window after the medication time has passed and the dose was not taken yet.
+    OVERDUE = 4
+
+
+class Cep2MedicationReminder:
+    """ This class implements the reminder state machine of one patient.
+
+    A patient can have several medication times per day (doses). For each dose, the reminder goes
+    through the phases PRE_WINDOW (window_before minutes before the dose), DUE (at the medication
+    time) and OVERDUE (window_after minutes after the dose), until the dose is taken. Each phase is
+    a deadline in the scheduler, so the reminder does nothing between transitions, and the callback
+    given in the initializer is only called when the phase changes.
+
+    A dose that is not taken remains OVERDUE until the window of the next dose starts.
+    """
+
+    def __init__(self,
+                 patient_id: str,
+                 scheduler: Cep2Scheduler,
+                 on_phase_change: Callable[["Cep2MedicationReminder", Cep2ReminderPhase], None],
+                 doses: List[Tuple[int, int]],
+                 window_before: int = 1,
+                 window_after: int = 1):
+        """ Class initializer.
+
+        Args:
+            patient_id (str): ID of the patient.
+            scheduler (Cep2Scheduler): scheduler used for the deadlines of the phases.
+            on_phase_change (Callable[[Cep2MedicationReminder, Cep2ReminderPhase], None]): function
+                called each time the phase changes.
+            doses (List[Tuple[int, int]]): medication times of a day, as (hour, minute) tuples.
+            window_before (int): minutes before the medication time when the patient starts being
+                reminded. Defaults to 1.
+            window_after (int): minutes after the medication time when the dose becomes overdue.
+                Defaults to 1.
+        """
+        self.__patient_id = patient_id
+        self.__scheduler = scheduler
+        self.__on_phase_change = on_phase_change
+        self.__lock = RLock()
+        self.__doses = []
+        self.__window_before = timedelta()
+        self.__window_after = timedelta()
+        self.__phase = Cep2ReminderPhase.IDLE
+        self.__dose = None
+        self.__last_taken = None
+        self.__timers = []
+        self.__started = False
+        self.set_schedule(doses, window_before, window_after)
+
+    @property
+    def patient_id(self) -> str:
+        return self.__patient_id
+
+    @property
+    def phase(self) -> Cep2ReminderPhase:
+        return self.__phase
+
+    @property
+    def dose(self) -> Optional[datetime]:
+        """ Medication time of the dose the patient is currently reminded of, or will be next.
+        """
+        return self.__dose
+
+    @property
+    def doses(self) -> List[Tuple[int, int]]:
+        """ Medication times of a day, as (hour, minute) tuples.
+        """
+        return [(t.hour, t.minute) for t in self.__doses]
+
+    @property
+    def in_window(self) -> bool:
+        """ True if the patient is being reminded, i.e. taking the medication now is expected.
+        """
+        return self.__phase in (Cep2ReminderPhase.PRE_WINDOW,
+                                Cep2ReminderPhase.DUE,
+                                Cep2ReminderPhase.OVERDUE)
+
+    def start(self) -> None:
+        """ Schedules the phases of the next dose.
+        """
+        with self.__lock:
+            self.__started = True
+            changes = self.__arm(self.__next_dose(self.__scheduler.now()))
+        self.__notify(changes)
+
+    def set_schedule(self,
+                     doses: List[Tuple[int, int]],
+                     window_before: int,
+                     window_after: int) -> None:
+        """ Changes the medication times and the windows. If the reminder is started, the phases
+        are scheduled again according to the new schedule.
+
+        Args:
+            doses (List[Tuple[int, int]]): medication times of a day, as (hour, minute) tuples.
+            window_before (int): minutes of the window before the medication time.
+            window_after (int): minutes of the window after the medication time.
+        """
+        if not doses:
+            raise ValueError("At least one medication time is required")
+
+        with self.__lock:
+            self.__doses = sorted(time(hour, minute) for hour, minute in doses)
+            self.__window_before = timedelta(minutes=window_before)
+            self.__window_after = timedelta(minutes=window_after)
+            changes = []
+            if self.__started:
+                changes = self.__arm(self.__next_dose(self.__scheduler.now()))
+        self.__notify(changes)
+
+    def mark_taken(self) -> bool:
+        """ Registers that the patient took the medication.
+
+        Returns:
+            bool: True if the patient was being reminded, i.e. the dose was taken inside its window.
+            False if the medication was taken outside the window.
+        """
+        with self.__lock:
+            if not self.in_window:
+                return False
+
+            self.__last_taken = self.__dose
+            self.__cancel_timers()
+            changes = self.__set_phase(Cep2ReminderPhase.TAKEN)
+            # Start reminding of the next dose when its window starts.
+            next_dose = self.__next_dose(self.__dose + timedelta(seconds=1), after_dose=True)
+            self.__dose = next_dose
+            self.__timers.append(self.__scheduler.schedule_at(next_dose - self.__window_before,
+                                                              lambda: self.__transition(next_dose,
+                                                                                        None)))
+        self.__notify(changes)
+
+        return True
+
+    def __next_dose(self, now: datetime, after_dose: bool = False) -> datetime:
+        """ Returns the first dose whose window has not ended at the given time (or, if after_dose
+        is True, the first dose after the given time). Doses already taken are skipped.
+        """
+        day = now.date()
+        while True:
+            for dose_time in self.__doses:
+                dose = datetime.combine(day, dose_time)
+                if self.__last_taken and dose <= self.__last_taken:
+                    continue
+                if (dose if after_dose else dose + self.__window_after) > now:
+                    return dose
+            day = day + timedelta(days=1)
+
+    def __arm(self, dose: datetime) -> list:
+        """ Schedules the deadlines of the phases of a dose. The phases whose deadline has already
+        passed are applied immediately.
+        """
+        self.__cancel_timers()
+        self.__dose = dose
+        now = self.__scheduler.now()
+        deadlines = [(dose - self.__window_before, Cep2ReminderPhase.PRE_WINDOW),
+                     (dose, Cep2ReminderPhase.DUE),
+                     (dose + self.__window_after, Cep2ReminderPhase.OVERDUE)]
+
+        current = Cep2ReminderPhase.IDLE
+        for deadline, phase in deadlines:
+            if deadline <= now:
+                current = phase
+            else:
+                # The default arguments bind the current values of the loop variables.
+                self.__timers.append(self.__scheduler.schedule_at(
+                    deadline, lambda d=dose, p=phase: self.__transition(d, p)))
+
+        # Once overdue, the next dose is armed when its window starts.
+        next_dose = self.__next_dose(dose + timedelta(seconds=1), after_dose=True)
+        self.__timers.append(self.__scheduler.schedule_at(
+            next_dose - self.__window_before, lambda: self.__transition(next_dose, None)))
+
+        return self.__set_phase(current)
+
+    def __transition(self, dose: datetime, phase: Optional[Cep2ReminderPhase]) -> None:
+        """ Callback of the scheduler's timers. If phase is None, the given dose is armed.
+        """
+        with self.__lock:
+            if phase is None:
+                changes = self.__arm(dose)
+            elif dose == self.__dose:
+                changes = self.__set_phase(phase)
+            else:
+                changes = []
+        self.__notify(changes)
+
+    def __set_phase(self, phase: Cep2ReminderPhase) -> list:
+        if phase == self.__phase:
+            return []
+        self.__phase = phase
+
+        return [phase]
+
+    def __notify(self, changes: list) -> None:
+        # The callback is called without holding the lock, so that it can take other locks (e.g.
+        # the controller's state lock) without risking a deadlock.
+        for phase in changes:
+            self.__on_phase_change(self, phase)
+
+    def __cancel_timers(self) -> None:
+        for timer in self.__timers:
+            timer.cancel()
+        self.__timers = []
@@ -0,0 +1,506 @@
+""" Replay of zigbee2mqtt traffic through the controller, to measure its latency and throughput.
+
+The messages go through the real path (Cep2Zigbee2mqttClient → dispatcher → Cep2Controller →
+Cep2Home → uplink), but the MQTT broker is replaced by an in-process fake broker and the PHP server
+by a local HTTP sink. The controller uses a simulated clock, which is moved forward with the
+messages, so a recording of a whole day (including the reminders) can be replayed in seconds.
+
+Usage:
+    python Cep2Replay.py [--stream FILE] [--count N] [--rate R] [--workers N] [--start HH:MM]
+
+The stream can be a recording in JSON lines format, where each line is an object with the fields
+"topic", "payload" and, optionally, "time" (seconds since the beginning of the recording). Without
+a recording, a synthetic stream is generated, see Cep2Benchmark.synthetic_stream().
+"""
+import argparse
+import contextlib
+import io
+import json
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Lock, Thread
+from time import monotonic, perf_counter, sleep
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from zlib import crc32
+from paho.mqtt.client import MQTTMessage, MQTT_ERR_SUCCESS, topic_matches_sub
+from Cep2Benchmark import load_stream, synthetic_stream
+from Cep2Controller import Cep2Controller
+from Cep2Home import Cep2Home
+from Cep2Metrics import METRICS
+from Cep2Model import Cep2Model, Cep2ZigbeeDevice
+from Cep2Scheduler import Cep2ManualClock
+from Cep2WireFormat import CONTENT_TYPE as BINARY_CONTENT_TYPE, decode_documents
+from Cep2Zigbee2mqttClient import Cep2Zigbee2mqttMessage
+
+
+class _Cep2FakeMessageInfo:
+    """ Result of Cep2FakeMqttClient.publish(), like paho's MQTTMessageInfo.
+    """
+
+    def __init__(self, mid: int):
+        self.mid = mid
+        self.rc = MQTT_ERR_SUCCESS
+
+    def wait_for_publish(self, timeout: Optional[float] = None) -> None:
+        pass
+
+    def is_published(self) -> bool:
+        return True
+
+
+class Cep2FakeMqttClient:
+    """ A client of Cep2FakeBroker with the interface of paho's Client used by
+    Cep2Zigbee2mqttClient. Like paho, the callbacks are called by a network thread, started with
+    loop_start().
+    """
+
+    def __init__(self, broker: "Cep2FakeBroker"):
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.__broker = broker
+        self.__subscriptions = set()
+        self.__inbox = deque()
+        self.__condition = Condition()
+        self.__thread = None
+        self.__running = False
+        self.__busy = False
+        self.__mid = 0
+
+    @property
+    def subscriptions(self) -> List[str]:
+        return list(self.__subscriptions)
+
+    def connect(self, host: str = "localhost", port: int = 1883, keepalive: int = 60) -> int:
+        self.__broker.register(self)
+        # paho calls on_connect from the network thread, once the broker accepts the connection.
+        self.__deliver(lambda: self.on_connect and self.on_connect(self, None, {}, 0))
+
+        return MQTT_ERR_SUCCESS
+
+    def reconnect_delay_set(self, min_delay: float = 1, max_delay: float = 120) -> None:
+        # The fake broker never drops the connection.
+        pass
+
+    def disconnect(self) -> int:
+        self.__broker.unregister(self)
+        if self.on_disconnect:
+            self.on_disconnect(self, None, 0)
+
+        return MQTT_ERR_SUCCESS
+
+    def subscribe(self, topic: str, qos: int = 0) -> Tuple[int, int]:
+        self.__subscriptions.add(topic)
+
+        return MQTT_ERR_SUCCESS, self.__next_mid()
+
+    def unsubscribe(self, topic: str) -> Tuple[int, int]:
+        self.__subscriptions.discard(topic)
+
+        return MQTT_ERR_SUCCESS, self.__next_mid()
+
+    def publish(self,
+                topic: str,
+                payload: Any = None,
+                qos: int = 0,
+                retain: bool = False) -> _Cep2FakeMessageInfo:
+        self.__broker.publish(topic, payload)
+
+        return _Cep2FakeMessageInfo(self.__next_mid())
+
+    def loop_start(self) -> None:
+        if self.__running:
+            return
+
+        self.__running = True
+        self.__thread = Thread(target=self.__loop, daemon=True)
+        self.__thread.start()
+
+    def loop_stop(self) -> None:
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        if self.__thread:
+            self.__thread.join()
+
+    @property
+    def pending(self) -> int:
+        """ Number of messages received that were not given to on_message yet.
+        """
+        with self.__condition:
+            return len(self.__inbox) + self.__busy
+
+    def matches(self, topic: str) -> bool:
+        return any(topic_matches_sub(s, topic) for s in self.__subscriptions)
+
+    def receive(self, topic: str, payload: bytes) -> None:
+        """ Called by the broker with a message of a subscribed topic.
+        """
+        def deliver():
+            message = MQTTMessage(topic=topic.encode("utf-8"))
+            message.payload = payload
+            # paho sets the timestamp when the message is received from the socket.
+            message.timestamp = monotonic()
+            if self.on_message:
+                self.on_message(self, None, message)
+
+        self.__deliver(deliver)
+
+    def __deliver(self, action: Callable[[], None]) -> None:
+        with self.__condition:
+            self.__inbox.append(action)
+            self.__condition.notify()
+
+    def __loop(self) -> None:
+        while True:
+            with self.__condition:
+                while self.__running and not self.__inbox:
+                    self.__condition.wait()
+                if not self.__running:
+                    return
+                action = self.__inbox.popleft()
+                self.__busy = True
+            try:
+                action()
+            finally:
+                with self.__condition:
+                    self.__busy = False
+
+    def __next_mid(self) -> int:
+        self.__mid += 1
+
+        return self.__mid
+
+
+class Cep2FakeBroker:
+    """ An in-process MQTT broker, for replaying traffic without a real broker. The messages
+    published by any client (or with publish()) are given to the clients subscribed to a matching
+    topic, and recorded so they can be inspected (e.g. the commands sent to the lights).
+    """
+
+    def __init__(self):
+        self.__clients: List[Cep2FakeMqttClient] = []
+        self.__lock = Lock()
+        # Messages published, as (time.monotonic(), topic, payload) tuples.
+        self.published: List[Tuple[float, str, bytes]] = []
+
+    def client(self) -> Cep2FakeMqttClient:
+        return Cep2FakeMqttClient(self)
+
+    def register(self, client: Cep2FakeMqttClient) -> None:
+        with self.__lock:
+            if client not in self.__clients:
+                self.__clients.append(client)
+
+    def unregister(self, client: Cep2FakeMqttClient) -> None:
+        with self.__lock:
+            if client in self.__clients:
+                self.__clients.remove(client)
+
+    @property
+    def pending(self) -> int:
+        """ Number of messages waiting to be given to the clients.
+        """
+        with self.__lock:
+            return sum(c.pending for c in self.__clients)
+
+    def publish(self, topic: str, payload: Any = None) -> None:
+        if payload is None:
+            payload = b""
+        elif isinstance(payload, str):
+            payload = payload.encode("utf-8")
+
+        with self.__lock:
+            self.published.append((monotonic(), topic, payload))
+            clients = [c for c in self.__clients if c.matches(topic)]
+        for client in clients:
+            client.receive(topic, payload)
+
+
+class Cep2HttpSink:
+    """ A local HTTP server that replaces the PHP server: it accepts the events posted by the
+    uplink and answers the requests of the medication schedule. If binary is False, batches in the
+    binary format of Cep2WireFormat are rejected with 415, like the PHP server does.
+    """
+
+    def __init__(self, variables: Optional[Dict[str, Any]] = None, binary: bool = True):
+        sink = self
+        self.events = 0
+        self.requests = 0
+        self.config_requests = 0
+        # Bytes of the bodies of the accepted requests.
+        self.received_bytes = 0
+        self.__lock = Lock()
+        self.variables = json.dumps(variables or {"variable1": [16, 18],
+                                                  "variable2": 1,
+                                                  "variable3": 1}).encode("utf-8")
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Type") == BINARY_CONTENT_TYPE:
+                    if not binary:
+                        self.send_response(415)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    events = decode_documents(body, self.headers.get("Content-Encoding"))
+                else:
+                    events = json.loads(body)
+                sink.received(events, len(body))
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                sink.config_requested()
+                # The variables are served with an ETag, like a server supporting conditional
+                # requests, see Cep2ConfigCache.
+                etag = f'"{crc32(sink.variables):08x}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(sink.variables)))
+                self.end_headers()
+                self.wfile.write(sink.variables)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.__thread = Thread(target=self.__server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.__server.server_port}/"
+
+    def config_requested(self) -> None:
+        with self.__lock:
+            self.config_requests += 1
+
+    def received(self, events: Any, size: int = 0) -> None:
+        with self.__lock:
+            self.requests += 1
+            self.received_bytes += size
+            self.events += len(events) if isinstance(events, list) else 1
+
+    def start(self) -> None:
+        self.__thread.start()
+
+    def stop(self) -> None:
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+class _Cep2ReplayHome(Cep2Home):
+    """ A home that records the latency of each message it handles, from the moment the MQTT client
+    received it until the controller finished handling it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies: List[float] = []
+        self.__lock = Lock()
+
+    def handle_message(self, message: Cep2Zigbee2mqttMessage) -> None:
+        super().handle_message(message)
+        latency = monotonic() - message.received_at
+        with self.__lock:
+            self.latencies.append(latency)
+
+
+@dataclass
+class Cep2ReplayReport:
+    """ Results of a replay.
+    """
+
+    messages: int = 0
+    handled: int = 0
+    duration: float = 0.0
+    # Latency percentiles, in milliseconds, by percentile.
+    latency: Dict[float, float] = field(default_factory=dict)
+    max_latency: float = 0.0
+    coalesced: int = 0
+    dropped: int = 0
+    # Repeated sensor reports discarded by the controller, see Cep2EventDebouncer.
+    collapsed: int = 0
+    commands: int = 0
+    events_sent: int = 0
+
+    @property
+    def throughput(self) -> float:
+        return self.handled / self.duration if self.duration else 0.0
+
+    def __str__(self) -> str:
+        latency = ", ".join(f"p{p:g} {v:.3f} ms" for p, v in self.latency.items())
+        return (f"{self.messages} messages replayed in {self.duration:.2f} s, "
+                f"{self.handled} handled ({self.throughput:,.0f} messages/s)\n"
+                f"latency: {latency}, max {self.max_latency:.3f} ms\n"
+                f"coalesced: {self.coalesced}, dropped: {self.dropped}, "
+                f"collapsed: {self.collapsed}, "
+                f"commands to lights: {self.commands}, events sent to the server: {self.events_sent}")
+
+
+def percentiles(values: List[float], points=(50, 90, 99, 99.9)) -> Dict[float, float]:
+    """ Returns the given percentiles of a list of values (nearest rank).
+    """
+    if not values:
+        return {p: float("nan") for p in points}
+    ordered = sorted(values)
+
+    return {p: ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points}
+
+
+def timed_stream(stream: List[Tuple[str, str]], rate: float) -> List[Tuple[float, str, str]]:
+    """ Gives the messages of a stream without times one every 1/rate seconds.
+    """
+    return [(i / rate, topic, payload) for i, (topic, payload) in enumerate(stream)]
+
+
+def load_timed_stream(path: str, rate: float) -> List[Tuple[float, str, str]]:
+    """ Loads a recording, using its times if it has them.
+    """
+    with open(path, "r", encoding="utf-8") as recording:
+        records = [json.loads(line) for line in recording if line.strip()]
+
+    if records and all("time" in r for r in records):
+        return [(float(r["time"]), r["topic"], r["payload"]) for r in records]
+
+    return timed_stream(load_stream(path), rate)
+
+
+def replay(stream: List[Tuple[float, str, str]],
+           rate: float = 0,
+           workers: int = Cep2Controller.DISPATCH_WORKERS,
+           start: datetime = datetime(2024, 5, 16, 16, 0),
+           homes: Optional[List[Cep2Home]] = None,
+           timeout: float = 60.0,
+           verbose: bool = False) -> Cep2ReplayReport:
+    """ Replays a stream through a controller connected to a fake broker and a local HTTP sink.
+
+    Args:
+        stream (List[Tuple[float, str, str]]): messages as (time, topic, payload) tuples. The time,
+            in seconds since the start, is the simulated time of the message.
+        rate (float): messages published per second of real time. If 0, they are published as fast
+            as possible. Defaults to 0.
+        workers (int): number of dispatcher workers of the controller.
+        start (datetime): simulated time of the beginning of the stream.
+        homes (Optional[List[Cep2Home]]): homes of the controller. They must be instances of
+            _Cep2ReplayHome to measure the latency. Defaults to a home with the devices of
+            Cep2Main.
+        timeout (float): seconds to wait for the controller to handle the messages.
+        verbose (bool): if False, the output of the controller is hidden.
+
+    Returns:
+        Cep2ReplayReport: the results.
+    """
+    broker = Cep2FakeBroker()
+    sink = Cep2HttpSink()
+    sink.start()
+    clock = Cep2ManualClock(start)
+
+    if homes is None:
+        devices_model = Cep2Model()
+        devices_model.add([Cep2ZigbeeDevice("bedRoom", "pir"),
+                           Cep2ZigbeeDevice("livingRoom", "pir"),
+                           Cep2ZigbeeDevice("pillboxSensor", "vibration sensor")])
+        homes = [_Cep2ReplayHome("home", devices_model)]
+
+    class ReplayController(Cep2Controller):
+        HTTP_HOST = sink.url
+        HTTP_HOST_RETRIEVE = sink.url
+        DISPATCH_WORKERS = workers
+        UPLINK_SPOOL_PATH = None
+        EVENT_STORE_PATH = None
+        HEALTH_CHECK_ON_START = False
+        CONFIG_CACHE_PATH = None
+
+    report = Cep2ReplayReport(messages=len(stream))
+    output = None if verbose else io.StringIO()
+    with contextlib.redirect_stdout(output) if output else contextlib.nullcontext():
+        controller = ReplayController(homes, clock=clock, mqtt_client=broker.client())
+        controller.start()
+
+        began = perf_counter()
+        for i, (offset, topic, payload) in enumerate(stream):
+            if rate > 0:
+                delay = began + i / rate - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+            # The simulated time is moved to the time of the message, executing the reminders'
+            # deadlines on the way.
+            now = start + timedelta(seconds=offset)
+            if now > clock.now():
+                controller.scheduler.advance(now - clock.now())
+            broker.publish(topic, payload)
+
+        # Wait until all the messages are handled.
+        deadline = monotonic() + timeout
+        while monotonic() < deadline:
+            stats = controller.zigbee2mqtt_client.dispatcher_stats
+            if broker.pending == 0 and stats.pending == 0 and \
+                    stats.processed + stats.coalesced + stats.dropped >= stats.submitted:
+                break
+            sleep(0.001)
+        report.duration = perf_counter() - began
+
+        # Give the uplink time to deliver the last batch.
+        uplink_deadline = monotonic() + 5
+        while controller.uplink.stats.queue_depth and monotonic() < uplink_deadline:
+            sleep(0.05)
+        controller.stop()
+    sink.stop()
+
+    stats = controller.zigbee2mqtt_client.dispatcher_stats
+    latencies = [l for h in homes for l in getattr(h, "latencies", [])]
+    report.handled = len(latencies)
+    report.latency = {p: v * 1000 for p, v in percentiles(latencies).items()}
+    report.max_latency = max(latencies, default=0.0) * 1000
+    report.coalesced = stats.coalesced
+    report.dropped = stats.dropped
+    debouncer_stats = controller.debouncer_stats
+    report.collapsed = debouncer_stats.collapsed if debouncer_stats else 0
+    report.commands = sum(1 for _, topic, _ in broker.published if topic.endswith("/set"))
+    report.events_sent = sink.events
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays zigbee2mqtt traffic through the controller")
+    parser.add_argument("--stream", help="recorded zigbee2mqtt stream, in JSON lines format")
+    parser.add_argument("--count", type=int, default=10000,
+                        help="number of synthetic messages (default: 10000)")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="messages per second, 0 for as fast as possible (default: 0)")
+    parser.add_argument("--sim-rate", type=float, default=10,
+                        help="simulated messages per second, for streams without times "
+                             "(default: 10)")
+    parser.add_argument("--workers", type=int, default=Cep2Controller.DISPATCH_WORKERS,
+                        help="dispatcher workers")
+    parser.add_argument("--start", default="16:00",
+                        help="simulated time of the beginning of the stream, as HH:MM")
+    parser.add_argument("--verbose", action="store_true", help="show the controller's output")
+    parser.add_argument("--metrics", action="store_true",
+                        help="show the latency of each stage, see Cep2Metrics")
+    args = parser.parse_args()
+
+    if args.stream:
+        stream = load_timed_stream(args.stream, args.sim_rate)
+    else:
+        stream = timed_stream(synthetic_stream(args.count), args.sim_rate)
+    hour, minute = map(int, args.start.split(":"))
+    start = datetime.combine(datetime.now().date(), datetime.min.time()).replace(hour=hour,
+                                                                                 minute=minute)
+
+    METRICS.enabled = args.metrics
+    print(replay(stream, rate=args.rate, workers=args.workers, start=start, verbose=args.verbose))
+    if args.metrics:
+        print(METRICS.summary())
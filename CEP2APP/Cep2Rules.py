@@ -0,0 +1,393 @@
+""" Declarative rules for the reactions of a home to the events of its sensors.
+
+A rule has a trigger (a device and an attribute of its events), optional conditions, actions on the
+lights and the medication reminders, and the HEUCOD event sent to the server when it fires. Rules
+are written in JSON, e.g.:
+
+    {"rules": [
+        {"name": "medication taken",
+         "device": "pillboxSensor", "attribute": "vibration",
+         "when": [{"window": "inside", "patient": "patient"}],
+         "do": [{"action": "take_medication", "patient": "patient"}],
+         "heucod": {"code": 82295, "description": "Medication taken"}},
+        {"name": "pillbox moved",
+         "device": "pillboxSensor", "attribute": "vibration",
+         "when": [{"window": "outside", "patient": "patient"}],
+         "do": [{"action": "blink", "light": "kitchenLight"}],
+         "heucod": {"code": 81493, "description": "Pillbox moved outside window"}},
+        {"name": "room changed",
+         "devices": ["bedRoom", "livingRoom"], "attribute": "occupancy",
+         "do": [{"action": "enter_room"}],
+         "heucod": {"code": 82099, "description": "$value"}}
+    ]}
+
+Trigger: "device" (or "devices") and "attribute". A rule fires when the attribute is in the event
+and its value is truthy, or equal to "equals" if given.
+
+Conditions ("when", all of them must hold):
+    {"window": "inside" | "outside", "patient": p}: the patient is (not) being reminded.
+    {"phase": ["DUE", "OVERDUE"], "patient": p}: phase of the reminder of the patient.
+    {"dose": {"before": minutes, "after": minutes}, "patient": p}: the current time is around the
+        next dose of the patient.
+    {"time": {"from": "HH:MM", "to": "HH:MM"}}: time of the day. The range can cross midnight.
+
+Actions ("do"):
+    {"action": "set_light", "light": l, "state": "ON" | "OFF", "color": [x, y]}
+    {"action": "blink", "light": l}
+    {"action": "take_medication", "patient": p}
+    {"action": "enter_room", "room": r}: the patient was detected in the room r, by default the
+        device. The room of the patient only changes once confirmed, see Cep2Occupancy.
+
+The description of the HEUCOD event can be "$value", the value of the attribute. The event is not
+sent if an action reports that it had no effect, e.g. enter_room when the room of the patient did
+not change.
+
+The rules are compiled when they are loaded into a Cep2RuleSet: the conditions and actions become
+functions, and the rules are indexed by device and attribute, so an event only evaluates the rules
+of its device. The conditions of all the rules triggered by an event are evaluated before any
+action is executed, so an action (e.g. take_medication ending the window) does not change which
+rules fire for the same event.
+
+The conditions and actions are executed on a target, the home, which must provide:
+
+    reminder(patient) -> Optional[Cep2MedicationReminder]
+    now() -> datetime
+    set_light(light, state, color_x, color_y)
+    blink(light)
+    take_medication(patient) -> bool
+    enter_room(room, sensor) -> bool
+"""
+import json
+import os
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from datetime import time, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from Cep2Reminder import Cep2ReminderPhase
+
+_Condition = Callable[[Any], bool]
+_Action = Callable[[Any, str, Any], None]
+
+
+class Cep2RuleError(ValueError):
+    """ Raised when a rule is not valid. The message includes the name of the rule.
+    """
+
+
+@dataclass
+class Cep2Rule:
+    """ A compiled rule, for one device.
+    """
+
+    name: str
+    device: str
+    attribute: str
+    # Checks the value of the attribute.
+    trigger: Callable[[Any], bool]
+    conditions: List[_Condition] = field(default_factory=list)
+    actions: List[_Action] = field(default_factory=list)
+    heucod_code: Optional[int] = None
+    # Description of the HEUCOD event. If None, the value of the attribute is used.
+    heucod_description: Any = None
+
+    def matches(self, target: Any) -> bool:
+        return all(condition(target) for condition in self.conditions)
+
+    def execute(self, target: Any, device_id: str, value: Any) -> bool:
+        """ Executes the actions of the rule. Returns False if an action had no effect, in which
+        case the HEUCOD event of the rule is not sent.
+        """
+        results = [action(target, device_id, value) for action in self.actions]
+
+        return all(result is not False for result in results)
+
+    def description(self, value: Any) -> Any:
+        return value if self.heucod_description is None else self.heucod_description
+
+
+class Cep2RuleSet:
+    """ A set of compiled rules, indexed by device and attribute. It is immutable, so it can be
+    replaced by a new one (e.g. when the rules file changes) while events are being handled.
+    """
+
+    def __init__(self, rules: Iterable[Cep2Rule] = ()):
+        self.__rules = list(rules)
+        # Dispatch table: device -> [(attribute, rules of the device and attribute)], in the order
+        # of the rules.
+        table: Dict[str, Dict[str, List[Cep2Rule]]] = {}
+        for rule in self.__rules:
+            table.setdefault(rule.device, {}).setdefault(rule.attribute, []).append(rule)
+        self.__table = {device: [(a, tuple(r)) for a, r in attributes.items()]
+                        for device, attributes in table.items()}
+
+    @classmethod
+    def from_config(cls, config: Mapping) -> "Cep2RuleSet":
+        """ Compiles the rules of a configuration, {"rules": [...]}.
+
+        Raises:
+            Cep2RuleError: if a rule is not valid.
+        """
+        specs = config.get("rules")
+        if not isinstance(specs, list):
+            raise Cep2RuleError("The configuration must have a list of rules")
+
+        rules = []
+        for i, spec in enumerate(specs):
+            rules.extend(compile_rule(spec, default_name=f"rule {i + 1}"))
+
+        return cls(rules)
+
+    @classmethod
+    def load(cls, path: str) -> "Cep2RuleSet":
+        """ Compiles the rules of a JSON file.
+
+        Raises:
+            OSError: if the file can not be read.
+            Cep2RuleError: if the file or a rule is not valid.
+        """
+        with open(path, "r", encoding="utf-8") as rules_file:
+            try:
+                config = json.load(rules_file)
+            except ValueError as ex:
+                raise Cep2RuleError(f"Invalid rules file {path}: {ex}") from ex
+
+        return cls.from_config(config)
+
+    def __len__(self) -> int:
+        return len(self.__rules)
+
+    @property
+    def rules(self) -> List[Cep2Rule]:
+        return list(self.__rules)
+
+    @property
+    def devices(self) -> List[str]:
+        return list(self.__table)
+
+    def match(self, device_id: str, event: Mapping, target: Any) -> List[Tuple[Cep2Rule, Any]]:
+        """ Returns the rules fired by an event, with the value of their attribute.
+
+        Args:
+            device_id (str): friendly name of the device of the event.
+            event (Mapping): payload of the event.
+            target (Any): the home, on which the conditions are evaluated.
+        """
+        attributes = self.__table.get(device_id)
+        if not attributes:
+            return []
+
+        fired = []
+        for attribute, rules in attributes:
+            value = event.get(attribute)
+            if value is None:
+                continue
+            for rule in rules:
+                if rule.trigger(value) and rule.matches(target):
+                    fired.append((rule, value))
+
+        return fired
+
+
+def compile_rule(spec: Mapping, default_name: str = "rule") -> List[Cep2Rule]:
+    """ Compiles a rule, see the documentation of the module.
+
+    Returns:
+        List[Cep2Rule]: one rule per device of the specification.
+
+    Raises:
+        Cep2RuleError: if the rule is not valid.
+    """
+    name = spec.get("name", default_name) if isinstance(spec, Mapping) else default_name
+    try:
+        if not isinstance(spec, Mapping):
+            raise ValueError("a rule must be an object")
+        devices = spec.get("devices", [spec["device"]] if "device" in spec else None)
+        if not devices or not all(isinstance(d, str) for d in devices):
+            raise ValueError("the rule must have a device or a list of devices")
+        attribute = spec["attribute"]
+        trigger = _compile_trigger(spec)
+        conditions = [_compile_condition(c) for c in spec.get("when", [])]
+        actions = [_compile_action(a) for a in spec.get("do", [])]
+        heucod = spec.get("heucod")
+        code, description = None, None
+        if heucod is not None:
+            code = int(heucod["code"])
+            description = heucod.get("description", "$value")
+            if description == "$value":
+                description = None
+    except (KeyError, TypeError, ValueError) as ex:
+        message = f"missing {ex}" if isinstance(ex, KeyError) else str(ex)
+        raise Cep2RuleError(f"Invalid rule {name}: {message}") from ex
+
+    return [Cep2Rule(name=name,
+                     device=device,
+                     attribute=attribute,
+                     trigger=trigger,
+                     conditions=conditions,
+                     actions=actions,
+                     heucod_code=code,
+                     heucod_description=description)
+            for device in devices]
+
+
+def default_rules(sensor_to_actuator: Mapping[str, str],
+                  pillbox_to_patient: Mapping[str, str],
+                  reminder_light: str) -> Dict[str, list]:
+    """ Returns the configuration of the rules of a home that does not have a rules file: the
+    pillboxes mark the medication of their patient as taken, or blink the reminder light outside
+    the window, and the motion sensors track the room of the patient.
+    """
+    rules = []
+    for pillbox, patient in pillbox_to_patient.items():
+        rules.append({"name": f"{pillbox} medication taken",
+                      "device": pillbox,
+                      "attribute": "vibration",
+                      "when": [{"window": "inside", "patient": patient}],
+                      "do": [{"action": "take_medication", "patient": patient}],
+                      "heucod": {"code": 82295, "description": "Medication taken"}})
+        rules.append({"name": f"{pillbox} moved outside window",
+                      "device": pillbox,
+                      "attribute": "vibration",
+                      "when": [{"window": "outside", "patient": patient}],
+                      "do": [{"action": "blink", "light": reminder_light}],
+                      "heucod": {"code": 81493, "description": "Pillbox moved outside window"}})
+    if sensor_to_actuator:
+        rules.append({"name": "room changed",
+                      "devices": list(sensor_to_actuator),
+                      "attribute": "occupancy",
+                      "do": [{"action": "enter_room"}],
+                      "heucod": {"code": 82099, "description": "$value"}})
+
+    return {"rules": rules}
+
+
+def _compile_trigger(spec: Mapping) -> Callable[[Any], bool]:
+    if "equals" in spec:
+        expected = spec["equals"]
+        return lambda value: value == expected
+
+    return bool
+
+
+def _reminder(target: Any, patient: str):
+    reminder = target.reminder(patient)
+    if reminder is None:
+        print(f"Unknown patient in rule: {patient}")
+
+    return reminder
+
+
+def _compile_condition(spec: Mapping) -> _Condition:
+    if "window" in spec:
+        inside = {"inside": True, "outside": False}[spec["window"]]
+        patient = spec["patient"]
+
+        def window(target):
+            reminder = _reminder(target, patient)
+            return reminder is not None and reminder.in_window == inside
+        return window
+
+    if "phase" in spec:
+        unknown = [p for p in spec["phase"] if p not in Cep2ReminderPhase.__members__]
+        if unknown:
+            raise ValueError(f"unknown phases {unknown}")
+        phases = frozenset(Cep2ReminderPhase[p] for p in spec["phase"])
+        patient = spec["patient"]
+
+        def phase(target):
+            reminder = _reminder(target, patient)
+            return reminder is not None and reminder.phase in phases
+        return phase
+
+    if "dose" in spec:
+        before = timedelta(minutes=spec["dose"].get("before", 0))
+        after = timedelta(minutes=spec["dose"].get("after", 0))
+        patient = spec["patient"]
+
+        def dose(target):
+            reminder = _reminder(target, patient)
+            if reminder is None or reminder.dose is None:
+                return False
+            return reminder.dose - before <= target.now() <= reminder.dose + after
+        return dose
+
+    if "time" in spec:
+        start = time.fromisoformat(spec["time"]["from"])
+        end = time.fromisoformat(spec["time"]["to"])
+
+        def time_of_day(target):
+            now = target.now().time()
+            return start <= now < end if start <= end else (now >= start or now < end)
+        return time_of_day
+
+    raise ValueError(f"unknown condition {dict(spec)}")
+
+
+def _compile_action(spec: Mapping) -> _Action:
+    action = spec["action"]
+
+    if action == "set_light":
+        light = spec["light"]
+        state = spec.get("state", "ON")
+        if state not in ("ON", "OFF"):
+            raise ValueError(f"invalid state {state}")
+        color_x, color_y = spec.get("color", (0, 0))
+        return lambda target, device_id, value: target.set_light(light, state, color_x, color_y)
+
+    if action == "blink":
+        light = spec["light"]
+        return lambda target, device_id, value: target.blink(light)
+
+    if action == "take_medication":
+        patient = spec["patient"]
+
+        def take_medication(target, device_id, value):
+            # The result is not returned, so the event is sent even if the medication was already
+            # marked as taken.
+            target.take_medication(patient)
+
+        return take_medication
+
+    if action == "enter_room":
+        room = spec.get("room")
+        return lambda target, device_id, value: target.enter_room(room or device_id, device_id)
+
+    raise ValueError(f"unknown action {action}")
+
+
+class Cep2RulesFile:
+    """ A rules file that is compiled again when it changes, so the rules of a home can be changed
+    while the controller is running.
+    """
+
+    def __init__(self, path: str):
+        """ Class initializer. The file is compiled immediately.
+
+        Raises:
+            OSError: if the file can not be read.
+            Cep2RuleError: if the file or a rule is not valid.
+        """
+        self.path = path
+        self.__mtime = os.stat(path).st_mtime_ns
+        self.rules = Cep2RuleSet.load(path)
+
+    def reload_if_changed(self) -> Optional[Cep2RuleSet]:
+        """ Compiles the file again if it was modified since it was last compiled. If the new rules
+        are not valid, the error is printed and the previous rules are kept.
+
+        Returns:
+            Optional[Cep2RuleSet]: the new rules, or None if they did not change.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self.__mtime:
+                return None
+            self.__mtime = mtime
+            self.rules = Cep2RuleSet.load(self.path)
+        except (OSError, Cep2RuleError) as ex:
+            print(f"Error reloading the rules {self.path}, keeping the previous rules: {ex}")
+            return None
+
+        print(f"Rules reloaded from {self.path}: {len(self.rules)} rules")
+
+        return self.rules
@@ -0,0 +1,265 @@
+import asyncio
+import heapq
+from datetime import datetime, timedelta
+from itertools import count
+from threading import Condition, Thread
+from typing import Callable, Optional
+
+
+class Cep2Clock:
+    """ This class gives the current time to the scheduler and to the classes that use it. By
+    default it returns the wall clock time, but it can be replaced by a Cep2ManualClock so that the
+    time can be controlled, e.g. to run the reminders in accelerated time.
+    """
+
+    def now(self) -> datetime:
+        return datetime.now()
+
+
+class Cep2ManualClock(Cep2Clock):
+    """ A clock whose time only changes when it is explicitly set. It is meant to be used together
+    with Cep2Scheduler.advance().
+    """
+
+    def __init__(self, start: datetime):
+        self.__now = start
+
+    def now(self) -> datetime:
+        return self.__now
+
+    def set(self, now: datetime) -> None:
+        if now < self.__now:
+            raise ValueError("The time of a manual clock can not go backwards")
+        self.__now = now
+
+
+class Cep2Timer:
+    """ A callback scheduled to be executed at a given time. Instances are returned by
+    Cep2Scheduler.schedule_at() and can be used to cancel the callback.
+    """
+
+    __slots__ = ("when", "callback", "cancelled")
+
+    def __init__(self, when: datetime, callback: Callable[[], None]):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class Cep2Scheduler:
+    """ This class executes callbacks at given times (deadlines).
+
+    The deadlines are kept in a heap, so scheduling a callback and getting the next one to execute
+    are cheap operations, and nothing is done between deadlines. When started, a thread sleeps until
+    the next deadline and then executes the callbacks that are due. Alternatively, with a
+    Cep2ManualClock, advance() moves the time forward and executes the callbacks in the caller's
+    thread, which allows to test the behavior of a whole day in a fraction of a second.
+
+    Callbacks are executed in the scheduler thread, so they should not block for long.
+    """
+
+    # Maximum time the thread sleeps without checking the clock. This handles changes of the wall
+    # clock (e.g. NTP adjustments) while waiting for a deadline far in the future.
+    MAX_WAIT = 60.0
+
+    def __init__(self, clock: Optional[Cep2Clock] = None):
+        self.__clock = clock if clock else Cep2Clock()
+        self.__condition = Condition()
+        # Each item of the heap is a tuple (deadline, sequence number, timer). The sequence number
+        # keeps the order of timers with the same deadline and avoids comparing the timers.
+        self.__heap = []
+        self.__sequence = count()
+        self.__running = False
+        self.__thread = None
+
+    @property
+    def clock(self) -> Cep2Clock:
+        return self.__clock
+
+    def now(self) -> datetime:
+        return self.__clock.now()
+
+    def schedule_at(self, when: datetime, callback: Callable[[], None]) -> Cep2Timer:
+        """ Schedules a callback to be executed at the given time. If the time has already passed,
+        the callback is executed as soon as possible.
+
+        Args:
+            when (datetime): time at which the callback is executed.
+            callback (Callable[[], None]): function to execute.
+
+        Returns:
+            Cep2Timer: the timer, which can be used to cancel the callback.
+        """
+        timer = Cep2Timer(when, callback)
+
+        with self.__condition:
+            heapq.heappush(self.__heap, (when, next(self.__sequence), timer))
+            # Wake up the thread, since the new deadline might be earlier than the one it waits for.
+            self.__condition.notify()
+
+        return timer
+
+    def schedule_in(self, delay: timedelta, callback: Callable[[], None]) -> Cep2Timer:
+        return self.schedule_at(self.now() + delay, callback)
+
+    def next_deadline(self) -> Optional[datetime]:
+        with self.__condition:
+            self.__discard_cancelled()
+
+            return self.__heap[0][0] if self.__heap else None
+
+    def run_pending(self) -> int:
+        """ Executes the callbacks whose deadline has passed.
+
+        Returns:
+            int: number of callbacks executed.
+        """
+        executed = 0
+
+        while True:
+            timer = self.__pop_due(self.now())
+            if not timer:
+                return executed
+            self.__execute(timer)
+            executed += 1
+
+    def advance(self, delta: timedelta) -> int:
+        """ Moves the time of a Cep2ManualClock forward, executing the callbacks in the order of
+        their deadlines. Before each callback, the clock is set to its deadline, so the callbacks
+        see the time at which they were supposed to run.
+
+        Args:
+            delta (timedelta): how much the time moves forward.
+
+        Returns:
+            int: number of callbacks executed.
+        """
+        if not isinstance(self.__clock, Cep2ManualClock):
+            raise TypeError("Only the time of a Cep2ManualClock can be advanced")
+
+        end = self.now() + delta
+        executed = 0
+
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > end:
+                break
+            if deadline > self.now():
+                self.__clock.set(deadline)
+            executed += self.run_pending()
+
+        self.__clock.set(end)
+
+        return executed
+
+    def start(self) -> None:
+        if self.__running:
+            return
+
+        self.__running = True
+        self.__thread = Thread(target=self.__worker, daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+
+    def __discard_cancelled(self) -> None:
+        # NOTE: this must be called while holding the condition's lock.
+        while self.__heap and self.__heap[0][2].cancelled:
+            heapq.heappop(self.__heap)
+
+    def __pop_due(self, now: datetime) -> Optional[Cep2Timer]:
+        with self.__condition:
+            self.__discard_cancelled()
+            if self.__heap and self.__heap[0][0] <= now:
+                return heapq.heappop(self.__heap)[2]
+
+            return None
+
+    def __execute(self, timer: Cep2Timer) -> None:
+        try:
+            timer.callback()
+        except Exception as ex:
+            # An exception in a callback must not stop the scheduler, otherwise no other callback
+            # would be executed.
+            print(f"Error executing scheduled callback: {ex}")
+
+    def __worker(self) -> None:
+        while True:
+            with self.__condition:
+                if not self.__running:
+                    return
+                self.__discard_cancelled()
+                if self.__heap:
+                    wait = (self.__heap[0][0] - self.now()).total_seconds()
+                else:
+                    wait = self.MAX_WAIT
+                if wait > 0:
+                    self.__condition.wait(timeout=min(wait, self.MAX_WAIT))
+                    continue
+
+            self.run_pending()
+
+
+class Cep2AsyncScheduler(Cep2Scheduler):
+    """ A scheduler that executes the callbacks in an asyncio event loop instead of a thread.
+
+    Only one timer of the event loop is used, set to the next deadline (or to MAX_WAIT, whichever is
+    earlier). When it fires, the clock is checked again and the callbacks that are due are executed,
+    so changes of the wall clock are handled as in Cep2Scheduler. Callbacks are executed in the event
+    loop, so they must not block.
+    """
+
+    def __init__(self, clock: Optional[Cep2Clock] = None):
+        super().__init__(clock)
+        self.__loop = None
+        self.__handle = None
+
+    def schedule_at(self, when: datetime, callback: Callable[[], None]) -> Cep2Timer:
+        timer = super().schedule_at(when, callback)
+
+        if self.__loop:
+            # The new deadline might be earlier than the one the loop's timer is set to. Callbacks
+            # might also be scheduled from other threads, e.g. the web client's.
+            self.__loop.call_soon_threadsafe(self.__rearm)
+
+        return timer
+
+    def start(self) -> None:
+        """ Starts executing the callbacks in the running event loop. It must be called from a
+        coroutine or a callback of the event loop.
+        """
+        if self.__loop:
+            return
+
+        self.__loop = asyncio.get_running_loop()
+        self.__rearm()
+
+    def stop(self) -> None:
+        if self.__handle:
+            self.__handle.cancel()
+        self.__handle = None
+        self.__loop = None
+
+    def __rearm(self) -> None:
+        if not self.__loop:
+            return
+
+        if self.__handle:
+            self.__handle.cancel()
+
+        deadline = self.next_deadline()
+        wait = self.MAX_WAIT
+        if deadline is not None:
+            wait = min(max((deadline - self.now()).total_seconds(), 0), self.MAX_WAIT)
+        self.__handle = self.__loop.call_later(wait, self.__fire)
+
+    def __fire(self) -> None:
+        self.__handle = None
+        self.run_pending()
+        self.__rearm()
@@ -1,9 +1,18 @@
+import asyncio
 import json
+import os
+from collections import deque
 from dataclasses import dataclass
-from typing import Any
-from Cep2Heucod import HeucodEvent, HeucodEventJsonEncoder
+from threading import Condition, Lock, Thread
+from time import monotonic
+from typing import Any, List, Optional, Tuple, Union
+from Cep2Heucod import HeucodEvent
+from Cep2Metrics import METRICS
+from Cep2WireFormat import CONTENT_TYPE as BINARY_CONTENT_TYPE, compressions, encode_batch
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
 @dataclass
 class Cep2WebDeviceEvent:
@@ -11,42 +20,982 @@ class Cep2WebDeviceEvent:
     device_type: str
     measurement: Any
     heucod_event: int
+    # ID of the home (apartment) where the event occurred, for controllers serving several homes.
+    location: Optional[str] = None
 
-    # function for converting to Heucod format using the HeucodEvent class
-    def to_heucod(self) -> str:
+    # function for converting to Heucod format using the HeucodEvent class. The timestamp is the
+    # given time, e.g. the clock of the scheduler when it runs in accelerated time, or now.
+    def to_heucod(self, timestamp: Optional[datetime] = None) -> str:
         event_heucod = HeucodEvent()
         event_heucod.id = self.device_id
         event_heucod.event_type_enum = self.heucod_event
         event_heucod.description = self.measurement
-        event_heucod.timestamp = datetime.now().isoformat()
+        event_heucod.timestamp = (timestamp or datetime.now()).isoformat()
         event_heucod.device_model = self.device_type
+        event_heucod.location = self.location
 
         return event_heucod.to_json()
 
+# Latencies of the uplink, see Cep2Metrics.
+_POST_SECONDS = METRICS.histogram("cep2_uplink_post_seconds",
+                                  "Time of the request that delivers a batch of events")
+_DELIVERY_SECONDS = METRICS.histogram("cep2_uplink_delivery_seconds",
+                                      "Time from the enqueue of an event until it is delivered")
+
+
+@dataclass
+class Cep2ConfigResponse:
+    """ Response of a conditional request of the configuration, see
+    Cep2WebClient.retrieve_config(). If the configuration did not change, the status is 304 and
+    the body is None.
+    """
+
+    status: int
+    body: Optional[bytes] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """ Returns the seconds to wait given by a Retry-After header, either a number of seconds or a
+    date, or None if the header is missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+def _conditional_headers(etag: Optional[str], last_modified: Optional[str]) -> dict:
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    return headers
+
+
+def _check_time(value: Any) -> None:
+    """ Raises ValueError if value is not a medication time, [hour, minute].
+    """
+    if not isinstance(value, (list, tuple)) or len(value) != 2 or \
+            not all(isinstance(v, int) and not isinstance(v, bool) for v in value) or \
+            not (0 <= value[0] < 24 and 0 <= value[1] < 60):
+        raise ValueError(f"Invalid medication time: {value!r}")
+
+
+def check_variables(variables: tuple) -> tuple:
+    """ Checks a medication schedule, (variable1, variable2, variable3), before it is used or
+    cached. variable1 is a medication time, [hour, minute], or the times of each patient, as
+    {patient: [[hour, minute], ...]}. variable2 and variable3 are the windows, in minutes.
+
+    Returns:
+        tuple: the schedule.
+
+    Raises:
+        ValueError: if the schedule is not valid.
+    """
+    if not isinstance(variables, (list, tuple)) or len(variables) != 3:
+        raise ValueError(f"Invalid medication schedule: {variables!r}")
+    var1, var2, var3 = variables
+    if isinstance(var1, dict):
+        for doses in var1.values():
+            if not isinstance(doses, list) or not doses:
+                raise ValueError(f"Invalid medication times: {doses!r}")
+            for dose in doses:
+                _check_time(dose)
+    else:
+        _check_time(var1)
+    for window in (var2, var3):
+        if not isinstance(window, int) or isinstance(window, bool) or window < 0:
+            raise ValueError(f"Invalid medication window: {window!r}")
+
+    return tuple(variables)
+
+
+def parse_variables(data: dict) -> tuple:
+    """ Returns the medication schedule of a configuration document of the server, as
+    (variable1, variable2, variable3).
+
+    Raises:
+        ValueError: if the document is not a valid schedule, see check_variables().
+    """
+    if not isinstance(data, dict):
+        raise ValueError(f"Invalid configuration document: {data!r}")
+    var1 = data.get('variable1', [0, 0])  # Default to [0, 0] if not found
+    var2 = data.get('variable2', 0)  # Default to 0 if not found
+    var3 = data.get('variable3', 0)  # Default to 0 if not found
+
+    return check_variables((var1, var2, var3))
+
+
+def _batch_body(events: List[Union[str, bytes]]) -> bytes:
+    """ Builds the body of a batch request, a JSON array with the given events. The events are
+    already JSON documents, so they are joined instead of being decoded and encoded again.
+    """
+    return b"[" + b",".join(e if isinstance(e, bytes) else e.encode("utf-8") for e in events) + b"]"
+
+
+class _Cep2WireNegotiation:
+    """ Chooses the format of the batches sent by a web client. With the binary format (see
+    Cep2WireFormat), a server that does not support it answers the first batch with 415
+    (Unsupported Media Type), 400 or 501: the batch is sent again as JSON, and JSON is used until
+    retry_interval seconds have passed, when the binary format is tried again (e.g. the server was
+    updated).
+    """
+
+    # Status codes of the servers that do not accept the binary format.
+    REJECTED = (400, 415, 501)
+
+    def __init__(self, wire_format: str, compression: Optional[str], retry_interval: float):
+        if wire_format not in ("json", "binary"):
+            raise ValueError(f"Unknown wire format: {wire_format}")
+        if compression is not None and compression not in compressions():
+            raise ValueError(f"Unsupported compression: {compression}")
+        self.__binary = wire_format == "binary"
+        self.__compression = compression
+        self.__retry_interval = retry_interval
+        # Time until which JSON is used, after the server rejected the binary format.
+        self.__json_until = 0.0
+
+    @property
+    def wire_format(self) -> str:
+        """ Format of the next batch, "binary" or "json".
+        """
+        return "binary" if self.__binary and monotonic() >= self.__json_until else "json"
+
+    def body(self, events: List[Union[str, bytes]]) -> Tuple[bytes, dict]:
+        """ Returns the body and the headers of a batch request.
+        """
+        if self.wire_format == "binary":
+            headers = {"Content-Type": BINARY_CONTENT_TYPE}
+            if self.__compression:
+                headers["Content-Encoding"] = self.__compression
+            return encode_batch(events, self.__compression), headers
+
+        return _batch_body(events), {"Content-Type": "application/json"}
+
+    def rejected(self, headers: dict, status: int) -> bool:
+        """ Checks whether a server rejected a binary batch. If so, JSON is used from now on and the
+        batch must be sent again.
+        """
+        if headers.get("Content-Type") != BINARY_CONTENT_TYPE or status not in self.REJECTED:
+            return False
+
+        print(f"The server does not accept {BINARY_CONTENT_TYPE} (status {status}), using JSON")
+        self.__json_until = monotonic() + self.__retry_interval
+
+        return True
+
+
 class Cep2WebClient:
-    def __init__(self, host: str) -> None:
+    def __init__(self,
+                 host: str,
+                 pool_size: int = 4,
+                 timeout: float = 5.0,
+                 wire_format: str = "json",
+                 compression: Optional[str] = None,
+                 format_retry_interval: float = 3600.0) -> None:
+        """ Class initializer.
+
+        Args:
+            host (str): URL of the server.
+            pool_size (int): maximum number of connections kept open. Defaults to 4.
+            timeout (float): timeout of the requests, in seconds. Defaults to 5 seconds.
+            wire_format (str): format of the batches of send_events(), "json" or "binary" (see
+                Cep2WireFormat). If the server does not accept the binary format, JSON is used.
+                Defaults to "json".
+            compression (Optional[str]): compression of the binary batches, "gzip" or "zstd".
+            format_retry_interval (float): seconds after which the binary format is tried again,
+                once the server rejected it. Defaults to 1 hour.
+        """
         self.__host = host
+        self.__timeout = timeout
+        self.__negotiation = _Cep2WireNegotiation(wire_format, compression, format_retry_interval)
+        self.__retry_after = None
+        # A single session is kept for the lifetime of the client, so the TCP connection to the
+        # server is reused (keep-alive) instead of being opened again for every event.
+        self.__session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.__session.mount("http://", adapter)
+        self.__session.mount("https://", adapter)
+
+    @property
+    def host(self) -> str:
+        return self.__host
+
+    @property
+    def wire_format(self) -> str:
+        return self.__negotiation.wire_format
 
-    def send_event(self, event: str) -> int:
+    @property
+    def retry_after(self) -> Optional[float]:
+        """ Seconds the server asked to wait before sending again (Retry-After header of the last
+        response), or None.
+        """
+        return self.__retry_after
+
+    def close(self) -> None:
+        self.__session.close()
+
+    def send_event(self, event: Union[str, bytes], headers: Optional[dict] = None) -> int:
         try:
-            headers = {'Content-Type': 'application/json'}
-            response = requests.post(self.__host, data=event, headers=headers)
+            headers = headers or {'Content-Type': 'application/json'}
+            response = self.__session.post(self.__host, data=event, headers=headers,
+                                           timeout=self.__timeout)
+            self.__retry_after = _parse_retry_after(response.headers.get("Retry-After"))
 
             return response.status_code
         except requests.exceptions.ConnectionError:
             raise ConnectionError(f"Error connecting to {self.__host}")
-    
+
+    def send_events(self, events: List[Union[str, bytes]]) -> int:
+        """ Sends a batch of events in a single request. The body is a JSON array whose elements
+        are the HEUCOD events, as returned by Cep2WebDeviceEvent.to_heucod() or
+        HeucodEvent.to_bytes(), or a binary batch if the client uses the binary format.
+
+        Args:
+            events (List[Union[str, bytes]]): list of JSON encoded HEUCOD events.
+
+        Returns:
+            int: the status code of the response.
+        """
+        body, headers = self.__negotiation.body(events)
+        status = self.send_event(body, headers)
+        if self.__negotiation.rejected(headers, status):
+            body, headers = self.__negotiation.body(events)
+            status = self.send_event(body, headers)
+
+        return status
+
     #this function retrieves the potentially new medication time from the server
     def retrieve_variables(self) -> tuple:
         try:
-            response = requests.get(self.__host)
-            data = response.json()
-            var1 = data.get('variable1', [0, 0])  # Default to [0, 0] if not found
-            var2 = data.get('variable2', 0)  # Default to 0 if not found
-            var3 = data.get('variable3', 0)  # Default to 0 if not found
+            response = self.__session.get(self.__host, timeout=self.__timeout)
 
-            return var1, var2, var3
+            return parse_variables(response.json())
         except requests.exceptions.ConnectionError:
             raise ConnectionError(f"Error connecting to {self.__host}")
         except Exception as e:
-            raise RuntimeError(f"Error retrieving variables: {e}")
\ No newline at end of file
+            raise RuntimeError(f"Error retrieving variables: {e}")
+
+    def retrieve_config(self,
+                        etag: Optional[str] = None,
+                        last_modified: Optional[str] = None) -> Cep2ConfigResponse:
+        """ Requests the configuration only if it changed since it was last retrieved, using the
+        ETag and Last-Modified headers of the previous response. See Cep2ConfigCache.
+
+        Args:
+            etag (Optional[str]): ETag of the previous response.
+            last_modified (Optional[str]): Last-Modified of the previous response.
+
+        Returns:
+            Cep2ConfigResponse: the response. Its body is None if the status is 304 (not modified).
+        """
+        try:
+            response = self.__session.get(self.__host,
+                                          headers=_conditional_headers(etag, last_modified),
+                                          timeout=self.__timeout)
+        except requests.exceptions.RequestException:
+            raise ConnectionError(f"Error connecting to {self.__host}")
+        if response.status_code not in (200, 304):
+            raise RuntimeError(f"Error retrieving variables: status {response.status_code}")
+
+        return Cep2ConfigResponse(status=response.status_code,
+                                  body=response.content if response.status_code == 200 else None,
+                                  etag=response.headers.get("ETag"),
+                                  last_modified=response.headers.get("Last-Modified"))
+
+
+@dataclass
+class Cep2WebUplinkStats:
+    """ Snapshot of the counters of a Cep2WebUplink. Used to size the queue and the batches of the
+    uplink for each home.
+    """
+
+    queue_depth: int = 0
+    spooled: int = 0
+    sent: int = 0
+    batches: int = 0
+    last_batch_size: int = 0
+    max_batch_size: int = 0
+    last_flush_latency: float = 0.0
+    max_flush_latency: float = 0.0
+    failed_flushes: int = 0
+    # Events removed from memory because the queue was full and there is no spool, i.e. lost.
+    dropped: int = 0
+    # Events currently only kept in the spool, because the queue was full. They are loaded once it
+    # empties.
+    spilled: int = 0
+    # Events that the server refused (4xx status). They are not sent again.
+    rejected: int = 0
+
+
+class _Cep2Spool:
+    """ On-disk journal of the events that have not been delivered yet, one JSON event per line.
+    It is shared by Cep2WebUplink and Cep2AsyncWebUplink. If the path is None, nothing is stored.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        # Held by the uplinks while appending an event and queuing it, and while truncating, so the
+        # spool is never truncated with an event that was not delivered.
+        self.lock = Lock()
+
+    def append(self, events: List[str]) -> int:
+        """ Appends events to the journal. The caller must hold the lock.
+
+        Returns:
+            int: number of events written.
+        """
+        if not self.path:
+            return 0
+
+        with open(self.path, "a", encoding="utf-8") as spool:
+            # Events are JSON documents without new lines, so one event is stored per line.
+            spool.writelines(f"{e}\n" for e in events)
+            spool.flush()
+            os.fsync(spool.fileno())
+
+        return len(events)
+
+    def read(self) -> List[str]:
+        """ Returns the events of the journal. The caller must hold the lock.
+
+        Lines that were only partially written, e.g. during a power loss, are skipped and removed
+        from the journal, so each line of the journal is an event of the uplink's queue.
+        """
+        if not self.path or not os.path.exists(self.path):
+            return []
+
+        with open(self.path, "r", encoding="utf-8") as spool:
+            events = []
+            skipped = False
+            for line in spool:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    json.loads(line)
+                except json.JSONDecodeError:
+                    skipped = True
+                    continue
+                events.append(line)
+        if skipped:
+            self.rewrite(events)
+
+        return events
+
+    def rewrite(self, events: List[str]) -> None:
+        """ Replaces the content of the journal by the given events. The new journal is written
+        aside and then renamed, so a power loss leaves either the old or the new one. The caller
+        must hold the lock.
+        """
+        if not self.path:
+            return
+
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as spool:
+            spool.writelines(f"{e}\n" for e in events)
+            spool.flush()
+            os.fsync(spool.fileno())
+        os.replace(temporary, self.path)
+
+    def truncate(self) -> None:
+        """ Empties the journal. The caller must hold the lock.
+        """
+        if self.path:
+            open(self.path, "w", encoding="utf-8").close()
+
+
+class _Cep2UplinkQueue:
+    """ The events waiting to be delivered by an uplink, shared by Cep2WebUplink and
+    Cep2AsyncWebUplink. It is not thread safe: Cep2WebUplink uses it while holding its condition.
+
+    At most max_queue events are kept in memory. When the queue is full, the new events are only
+    kept in the spool (spilled) and are loaded from it once the queue is empty. Without a spool,
+    the oldest event is dropped instead. The lines of the spool are thus always the events
+    delivered since it was emptied, followed by the events of the queue and then the spilled ones,
+    so the spool is never emptied while it holds an event that was not delivered.
+    """
+
+    def __init__(self, spool: _Cep2Spool, max_queue: int, stats: Cep2WebUplinkStats):
+        self.__spool = spool
+        self.__max_queue = max_queue
+        self.__stats = stats
+        # Each item is a tuple (sequence number, enqueue time, event).
+        self.__items = deque()
+        self.__sequence = 0
+        self.__spilled = 0
+        # Number of lines at the beginning of the spool whose events were delivered.
+        self.__delivered = 0
+
+    def __len__(self) -> int:
+        return len(self.__items)
+
+    @property
+    def oldest(self) -> float:
+        """ Enqueue time of the oldest event in memory. The queue must not be empty.
+        """
+        return self.__items[0][1]
+
+    def push(self, event: str) -> None:
+        if self.__spilled or len(self.__items) >= self.__max_queue:
+            if self.__spool.path:
+                # The event is already in the spool. The next ones are spilled too, to keep the
+                # order of the spool.
+                self.__spilled += 1
+                self.__stats.spilled = self.__spilled
+                return
+            self.__items.popleft()
+            self.__stats.dropped += 1
+        self.__items.append((self.__sequence, monotonic(), event))
+        self.__sequence += 1
+
+    def batch(self, size: int) -> List[Tuple[int, float, str]]:
+        """ Returns the first size events. They are not removed from the queue.
+        """
+        return [self.__items[i] for i in range(min(size, len(self.__items)))]
+
+    def remove(self, batch: List[Tuple[int, float, str]]) -> None:
+        """ Removes the events of a batch that was delivered (or rejected). Events of the batch that
+        were dropped while it was sent are not in the queue anymore, and other events are kept.
+        """
+        last = batch[-1][0]
+        while self.__items and self.__items[0][0] <= last:
+            self.__items.popleft()
+        self.__delivered += len(batch)
+
+    def update_spool(self) -> None:
+        """ Once the queue is empty, empties the spool, or loads the spilled events from it. The
+        caller must hold the lock of the spool.
+        """
+        if self.__items:
+            return
+        if not self.__spilled:
+            self.__spool.truncate()
+            self.__delivered = 0
+            return
+
+        pending = self.__spool.read()[self.__delivered:]
+        self.__spool.rewrite(pending)
+        self.__delivered = 0
+        self.__spilled = 0
+        self.__stats.spilled = 0
+        for event in pending:
+            self.push(event)
+
+
+# Statuses of a batch that are retried like the server errors: the server did not refuse the events,
+# it asked to wait (429), the request timed out (408), or the request was redirected (3xx).
+_RETRIED_STATUSES = frozenset({408, 429})
+
+
+def _is_final(status_code: Optional[int]) -> bool:
+    """ Returns whether a batch answered with status_code was delivered (2xx) or refused (the other
+    4xx), and must not be sent again. None is a batch that could not be sent.
+    """
+    if status_code is None or status_code in _RETRIED_STATUSES:
+        return False
+
+    return 200 <= status_code < 300 or 400 <= status_code < 500
+
+
+def _retry_delay(client: Union[Cep2WebClient, "Cep2AsyncWebClient"],
+                 status_code: Optional[int],
+                 backoff: float) -> float:
+    """ Returns the seconds to wait before sending a batch again: the Retry-After of the server if
+    it answered with one, otherwise the backoff.
+    """
+    retry_after = client.retry_after if status_code is not None else None
+
+    return backoff if retry_after is None else retry_after
+
+
+def _record_batch(stats: Cep2WebUplinkStats,
+                  batch: List[Tuple[int, float, str]],
+                  status_code: int,
+                  latency: float) -> None:
+    """ Updates the counters of an uplink with a batch answered by the server, shared by the
+    uplinks. Batches answered with a 4xx status were rejected, not delivered, see _is_final().
+    """
+    if status_code >= 400:
+        print(f"The server rejected {len(batch)} events (status {status_code})")
+        stats.rejected += len(batch)
+        return
+
+    stats.sent += len(batch)
+    stats.batches += 1
+    stats.last_batch_size = len(batch)
+    stats.max_batch_size = max(stats.max_batch_size, len(batch))
+    stats.last_flush_latency = latency
+    stats.max_flush_latency = max(stats.max_flush_latency, latency)
+    if METRICS.enabled:
+        _POST_SECONDS.observe(latency)
+        now = monotonic()
+        for _, enqueued_at, _ in batch:
+            _DELIVERY_SECONDS.observe(now - enqueued_at)
+
+
+class Cep2WebUplink:
+    """ This class sends HEUCOD events to the server in the background.
+
+    Events are added to an in-memory queue with enqueue(), which never blocks the caller. A worker
+    thread flushes the queue in batches, either when batch_size events are waiting or when the
+    oldest event has waited flush_interval seconds. If a batch can not be delivered, it is retried
+    with an exponential backoff.
+
+    Every event is first appended to an on-disk journal (the spool) and the journal is only
+    truncated once all the events in it have been delivered. This way, events are not lost if the
+    server is down for a long time or the gateway is restarted: the spool is read back when the
+    uplink is started. Since the spool is only truncated when the queue is empty, the delivery is
+    at-least-once: after a restart, some events might be sent again.
+
+    A batch answered with a 4xx status is not sent again, since the server would refuse it again
+    and block the events behind it. Its events are counted as rejected. The exceptions are 408 and
+    429, and the redirections (3xx), which are retried like the server errors. The Retry-After
+    header of the server is used as the delay, instead of the backoff, when given.
+    """
+
+    def __init__(self,
+                 client: Cep2WebClient,
+                 spool_path: Optional[str] = None,
+                 batch_size: int = 32,
+                 flush_interval: float = 1.0,
+                 max_queue: int = 10000,
+                 backoff_initial: float = 1.0,
+                 backoff_max: float = 60.0):
+        """ Class initializer.
+
+        Args:
+            client (Cep2WebClient): web client used to deliver the batches.
+            spool_path (Optional[str]): path of the journal file. If None, events are only kept in
+                memory.
+            batch_size (int): maximum number of events sent in one request. Defaults to 32.
+            flush_interval (float): maximum time, in seconds, an event waits before being sent.
+                Defaults to 1 second.
+            max_queue (int): maximum number of events kept in memory. When full, the new events are
+                only kept in the spool, and loaded when the queue empties. Without a spool, the
+                oldest events are dropped. Defaults to 10000.
+            backoff_initial (float): delay, in seconds, before retrying a failed batch. Defaults to
+                1 second.
+            backoff_max (float): maximum delay between retries. Defaults to 60 seconds.
+        """
+        self.__client = client
+        self.__spool = _Cep2Spool(spool_path)
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+        self.__backoff_initial = backoff_initial
+        self.__backoff_max = backoff_max
+        self.__stats = Cep2WebUplinkStats()
+        self.__queue = _Cep2UplinkQueue(self.__spool, max_queue, self.__stats)
+        self.__condition = Condition()
+        self.__running = False
+        self.__worker_thread = None
+
+    @property
+    def stats(self) -> Cep2WebUplinkStats:
+        with self.__condition:
+            self.__stats.queue_depth = len(self.__queue)
+
+            return Cep2WebUplinkStats(**self.__stats.__dict__)
+
+    def start(self) -> None:
+        """ Loads the events left in the spool by a previous run and starts the worker thread.
+        """
+        if self.__running:
+            return
+
+        with self.__spool.lock:
+            for event in self.__spool.read():
+                self.__push(event)
+
+        self.__running = True
+        self.__worker_thread = Thread(target=self.__worker, daemon=True)
+        self.__worker_thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """ Stops the worker thread, trying to flush the pending events first. Events that could
+        not be delivered remain in the spool.
+        """
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+
+        if self.__worker_thread:
+            self.__worker_thread.join(timeout=timeout)
+
+    def enqueue(self, event: str) -> None:
+        """ Adds an event to the uplink. This function does not block on the network.
+
+        Args:
+            event (str): JSON encoded HEUCOD event.
+        """
+        # The event is written to the spool and queued while holding the spool lock, so the worker
+        # can not truncate the spool between both steps.
+        with self.__spool.lock:
+            spooled = self.__spool.append([event])
+            self.__push(event, spooled)
+
+    def __push(self, event: str, spooled: int = 0) -> None:
+        with self.__condition:
+            self.__stats.spooled += spooled
+            self.__queue.push(event)
+            # The worker waits without a timeout while the queue is empty: it is woken up by the
+            # first event, to start its flush interval, and by a full batch.
+            if len(self.__queue) == 1 or len(self.__queue) >= self.__batch_size:
+                self.__condition.notify()
+
+    def __next_batch(self) -> List[Tuple[int, float, str]]:
+        """ Waits until a batch is ready, i.e. there are batch_size events or the oldest event has
+        waited for flush_interval seconds. The events are not removed from the queue.
+        """
+        with self.__condition:
+            while self.__running:
+                if len(self.__queue) >= self.__batch_size:
+                    break
+                if self.__queue:
+                    remaining = self.__queue.oldest + self.__flush_interval - monotonic()
+                    if remaining <= 0:
+                        break
+                    self.__condition.wait(timeout=remaining)
+                else:
+                    self.__condition.wait()
+
+            return self.__queue.batch(self.__batch_size)
+
+    def __worker(self) -> None:
+        backoff = self.__backoff_initial
+
+        while True:
+            batch = self.__next_batch()
+            if not batch:
+                if not self.__running:
+                    return
+                continue
+
+            start = monotonic()
+            try:
+                status_code = self.__client.send_events([e for _, _, e in batch])
+            except (ConnectionError, requests.exceptions.RequestException) as ex:
+                print(f"{ex}")
+                status_code = None
+            latency = monotonic() - start
+
+            if _is_final(status_code):
+                backoff = self.__backoff_initial
+                with self.__condition:
+                    self.__queue.remove(batch)
+                    _record_batch(self.__stats, batch, status_code, latency)
+                    empty = not self.__queue
+                if empty:
+                    self.__update_spool()
+            else:
+                with self.__condition:
+                    self.__stats.failed_flushes += 1
+                    if not self.__running:
+                        # Stopping: the pending events stay in the spool for the next run.
+                        return
+                    # Wait before retrying, unless the uplink is stopped meanwhile.
+                    self.__condition.wait(timeout=_retry_delay(self.__client, status_code, backoff))
+                backoff = min(backoff * 2, self.__backoff_max)
+
+    def __update_spool(self) -> None:
+        with self.__spool.lock:
+            # Nothing is done if an event was enqueued meanwhile.
+            with self.__condition:
+                self.__queue.update_spool()
+
+
+class Cep2AsyncWebClient:
+    """ asyncio variant of Cep2WebClient, based on aiohttp. The connections to the server are kept
+    in a pool and reused. aiohttp is only required if this class is used.
+    """
+
+    def __init__(self,
+                 host: str,
+                 pool_size: int = 4,
+                 timeout: float = 5.0,
+                 wire_format: str = "json",
+                 compression: Optional[str] = None,
+                 format_retry_interval: float = 3600.0) -> None:
+        """ Class initializer, see Cep2WebClient.
+        """
+        self.__host = host
+        self.__pool_size = pool_size
+        self.__timeout = timeout
+        self.__negotiation = _Cep2WireNegotiation(wire_format, compression, format_retry_interval)
+        self.__retry_after = None
+        # The session is created on first use, since it must be created inside the event loop.
+        self.__session = None
+
+    @property
+    def host(self) -> str:
+        return self.__host
+
+    @property
+    def wire_format(self) -> str:
+        return self.__negotiation.wire_format
+
+    @property
+    def retry_after(self) -> Optional[float]:
+        """ See Cep2WebClient.retry_after.
+        """
+        return self.__retry_after
+
+    async def close(self) -> None:
+        if self.__session:
+            await self.__session.close()
+            self.__session = None
+
+    async def send_event(self, event: Union[str, bytes], headers: Optional[dict] = None) -> int:
+        import aiohttp
+
+        try:
+            headers = headers or {'Content-Type': 'application/json'}
+            async with self.__get_session().post(self.__host, data=event, headers=headers) as response:
+                self.__retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+                return response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            raise ConnectionError(f"Error connecting to {self.__host}")
+
+    async def send_events(self, events: List[Union[str, bytes]]) -> int:
+        """ Sends a batch of events in a single request, see Cep2WebClient.send_events().
+        """
+        body, headers = self.__negotiation.body(events)
+        status = await self.send_event(body, headers)
+        if self.__negotiation.rejected(headers, status):
+            body, headers = self.__negotiation.body(events)
+            status = await self.send_event(body, headers)
+
+        return status
+
+    async def retrieve_variables(self) -> tuple:
+        import aiohttp
+
+        try:
+            async with self.__get_session().get(self.__host) as response:
+                data = await response.json(content_type=None)
+
+            return parse_variables(data)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            raise ConnectionError(f"Error connecting to {self.__host}")
+        except Exception as e:
+            raise RuntimeError(f"Error retrieving variables: {e}")
+
+    async def retrieve_config(self,
+                              etag: Optional[str] = None,
+                              last_modified: Optional[str] = None) -> Cep2ConfigResponse:
+        """ Conditional request of the configuration, see Cep2WebClient.retrieve_config().
+        """
+        import aiohttp
+
+        try:
+            async with self.__get_session().get(
+                    self.__host, headers=_conditional_headers(etag, last_modified)) as response:
+                body = await response.read() if response.status == 200 else None
+                status = response.status
+                headers = response.headers
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            raise ConnectionError(f"Error connecting to {self.__host}")
+        if status not in (200, 304):
+            raise RuntimeError(f"Error retrieving variables: status {status}")
+
+        return Cep2ConfigResponse(status=status,
+                                  body=body,
+                                  etag=headers.get("ETag"),
+                                  last_modified=headers.get("Last-Modified"))
+
+    def __get_session(self):
+        import aiohttp
+
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.__pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.__timeout))
+
+        return self.__session
+
+
+class Cep2AsyncWebUplink:
+    """ asyncio variant of Cep2WebUplink. The batches are sent by a task of the event loop instead
+    of a thread, with the same batching, backoff and spool behavior. enqueue() must be called from
+    the event loop.
+
+    enqueue() does not wait for the disk either: the events are appended to the spool by a task, in
+    the default executor, with one fsync for all the events enqueued meanwhile (group commit). The
+    spool is only emptied or read back once all the events enqueued are in it.
+    """
+
+    def __init__(self,
+                 client: Cep2AsyncWebClient,
+                 spool_path: Optional[str] = None,
+                 batch_size: int = 32,
+                 flush_interval: float = 1.0,
+                 max_queue: int = 10000,
+                 backoff_initial: float = 1.0,
+                 backoff_max: float = 60.0):
+        """ Class initializer. The arguments are the same as in Cep2WebUplink.
+        """
+        self.__client = client
+        self.__spool = _Cep2Spool(spool_path)
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+        self.__backoff_initial = backoff_initial
+        self.__backoff_max = backoff_max
+        self.__stats = Cep2WebUplinkStats()
+        self.__queue = _Cep2UplinkQueue(self.__spool, max_queue, self.__stats)
+        self.__wakeup = asyncio.Event()
+        self.__running = False
+        self.__worker_task = None
+        # Events enqueued but not yet appended to the spool, and the task appending them.
+        self.__unsynced: List[str] = []
+        self.__sync_task = None
+
+    @property
+    def stats(self) -> Cep2WebUplinkStats:
+        self.__stats.queue_depth = len(self.__queue)
+
+        return Cep2WebUplinkStats(**self.__stats.__dict__)
+
+    async def start(self) -> None:
+        """ Loads the events left in the spool by a previous run and starts the worker task.
+        """
+        if self.__running:
+            return
+
+        with self.__spool.lock:
+            for event in self.__spool.read():
+                self.__push(event)
+
+        self.__running = True
+        self.__worker_task = asyncio.get_running_loop().create_task(self.__worker())
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """ Stops the worker task, trying to flush the pending events first. Events that could not
+        be delivered remain in the spool.
+        """
+        self.__running = False
+        self.__wakeup.set()
+
+        if self.__worker_task:
+            try:
+                await asyncio.wait_for(self.__worker_task, timeout)
+            except asyncio.TimeoutError:
+                pass
+        await self.__sync_spool()
+        await self.__client.close()
+
+    def enqueue(self, event: str) -> None:
+        """ Adds an event to the uplink. This function does not wait for the network nor the disk.
+
+        Args:
+            event (str): JSON encoded HEUCOD event.
+        """
+        if self.__spool.path:
+            self.__unsynced.append(event)
+            self.__schedule_sync()
+        self.__push(event)
+
+    def __schedule_sync(self) -> asyncio.Task:
+        if self.__sync_task is None or self.__sync_task.done():
+            self.__sync_task = asyncio.get_running_loop().create_task(self.__sync())
+
+        return self.__sync_task
+
+    async def __sync(self) -> None:
+        loop = asyncio.get_running_loop()
+        # The events enqueued while a group is written form the next group.
+        while self.__unsynced:
+            events, self.__unsynced = self.__unsynced, []
+            try:
+                self.__stats.spooled += await loop.run_in_executor(None, self.__append, events)
+            except OSError as ex:
+                print(f"Error writing {len(events)} events to the spool: {ex}")
+
+    def __append(self, events: List[str]) -> int:
+        with self.__spool.lock:
+            return self.__spool.append(events)
+
+    async def __sync_spool(self) -> None:
+        # Waits until all the events enqueued so far are in the spool.
+        while self.__unsynced or (self.__sync_task is not None and not self.__sync_task.done()):
+            await asyncio.shield(self.__schedule_sync())
+
+    def __push(self, event: str) -> None:
+        self.__queue.push(event)
+        # The worker is woken up by the first event, to start its flush interval, see Cep2WebUplink.
+        if len(self.__queue) == 1 or len(self.__queue) >= self.__batch_size:
+            self.__wakeup.set()
+
+    async def __wait(self, timeout: Optional[float]) -> None:
+        self.__wakeup.clear()
+        try:
+            await asyncio.wait_for(self.__wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def __next_batch(self) -> List[Tuple[int, float, str]]:
+        """ Waits until a batch is ready, see Cep2WebUplink. The events are not removed from the
+        queue.
+        """
+        while self.__running:
+            if len(self.__queue) >= self.__batch_size:
+                break
+            if self.__queue:
+                remaining = self.__queue.oldest + self.__flush_interval - monotonic()
+                if remaining <= 0:
+                    break
+                await self.__wait(remaining)
+            else:
+                await self.__wait(None)
+
+        return self.__queue.batch(self.__batch_size)
+
+    async def __worker(self) -> None:
+        backoff = self.__backoff_initial
+
+        while True:
+            batch = await self.__next_batch()
+            if not batch:
+                if not self.__running:
+                    return
+                continue
+
+            start = monotonic()
+            try:
+                status_code = await self.__client.send_events([e for _, _, e in batch])
+            except ConnectionError as ex:
+                print(f"{ex}")
+                status_code = None
+            latency = monotonic() - start
+
+            if _is_final(status_code):
+                backoff = self.__backoff_initial
+                self.__queue.remove(batch)
+                _record_batch(self.__stats, batch, status_code, latency)
+                if not self.__queue:
+                    # The spilled events, and the delivered ones, must be in the spool before it is
+                    # read or emptied. Nothing is enqueued between __sync_spool() and the update.
+                    await self.__sync_spool()
+                    with self.__spool.lock:
+                        self.__queue.update_spool()
+            else:
+                self.__stats.failed_flushes += 1
+                if not self.__running:
+                    # Stopping: the pending events stay in the spool for the next run.
+                    return
+                # Wait before retrying, unless the uplink is stopped meanwhile.
+                await self.__wait(_retry_delay(self.__client, status_code, backoff))
+                backoff = min(backoff * 2, self.__backoff_max)
@@ -0,0 +1,352 @@
+""" Compact binary encoding of batches of HEUCOD events, for gateways on metered links.
+
+The uplink normally sends each batch as a JSON array of HEUCOD documents, whose camel case keys and
+ISO timestamps are most of the bytes. In this format, a batch is:
+
+    header    b"HB", schema version (1 byte), schema ID (4 bytes, big endian)
+    count     number of events (varint)
+    events    for each event: number of fields (varint), and for each field its ID (varint) and
+              its value
+
+The ID of a field is its position (from 1) in the list of attributes of HeucodEvent, so it does not
+have to be sent. The schema ID is the CRC32 of that list: the decoder refuses batches encoded with
+a different list, instead of assigning the values to the wrong fields. Keys that are not HEUCOD
+attributes are sent with ID 0, followed by the key as a string value.
+
+Each value starts with a tag byte:
+
+    0 None, 1 False, 2 True
+    3 integer (zigzag varint)
+    4 float (8 bytes, big endian)
+    5 string (varint length and UTF-8 bytes). It is added to the string table of the batch
+    6 reference to the string table (varint index), for strings repeated in the batch
+    7 other JSON value, e.g. a list (varint length and UTF-8 JSON)
+    8 ISO timestamp without time zone (zigzag varint of microseconds since 1970-01-01T00:00:00),
+      decoded back to the same string
+
+Since the device IDs, locations and descriptions repeat in a batch, most strings are sent once. The
+batch can then be compressed with gzip or zstd (if the zstandard package is installed), signaled
+with the Content-Encoding header.
+"""
+import gzip
+import json
+import struct
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple, Union
+from zlib import crc32, error as ZlibError
+from Cep2Heucod import HeucodCompactEvent, HeucodEvent, _snake_key
+
+# Content type of the batches in this format.
+CONTENT_TYPE = "application/vnd.cep2.heucod-batch"
+SCHEMA_VERSION = 1
+# Fields of the schema: the ID of a field is its index plus 1. New HeucodEvent attributes must be
+# added at the end of the class, otherwise the IDs change (and so does the schema ID).
+FIELDS: Tuple[str, ...] = tuple(HeucodEvent.__annotations__)
+SCHEMA_ID = crc32(",".join(FIELDS).encode("ascii"))
+
+_MAGIC = b"HB"
+_HEADER = struct.Struct(">2sBI")
+_DOUBLE = struct.Struct(">d")
+_EPOCH = datetime(1970, 1, 1)
+
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STR, _STR_REF, _JSON, _TIMESTAMP = range(9)
+
+_FIELD_IDS = {name: i + 1 for i, name in enumerate(FIELDS)}
+
+
+def _json_key(field: str) -> str:
+    # Same conversion as HeucodEventSerializer: id_ is id, other names are converted to camel case.
+    if field == "id_":
+        return "id"
+    first, *others = field.split("_")
+    if first == "id" or not others:
+        return field
+
+    return "".join([first.lower(), *map(str.title, others)])
+
+
+# JSON key of each field, by ID, and ID of the field of each JSON key. Other keys are sent by name.
+_FIELD_KEYS = [None] + [_json_key(f) for f in FIELDS]
+_KEY_IDS: Dict[str, int] = {key: i for i, key in enumerate(_FIELD_KEYS) if key}
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+
+def compressions() -> List[str]:
+    """ Returns the compressions available, as values of the Content-Encoding header.
+    """
+    available = ["gzip"]
+    try:
+        import zstandard  # noqa: F401
+        available.append("zstd")
+    except ImportError:
+        pass
+
+    return available
+
+
+def compress(data: bytes, encoding: Optional[str]) -> bytes:
+    """ Compresses a body with the given Content-Encoding (None, "gzip" or "zstd").
+    """
+    if not encoding:
+        return data
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    if encoding == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress(data)
+
+    raise ValueError(f"Unsupported compression: {encoding}")
+
+
+def decompress(data: bytes, encoding: Optional[str]) -> bytes:
+    """ Decompresses a body with the given Content-Encoding.
+
+    Raises:
+        ValueError: if the compression is not supported or the body is corrupt.
+    """
+    if not encoding or encoding == "identity":
+        return data
+    if encoding == "gzip":
+        try:
+            return gzip.decompress(data)
+        except (OSError, EOFError, ZlibError) as ex:
+            # gzip.BadGzipFile is an OSError.
+            raise ValueError(f"Corrupt gzip body: {ex}") from ex
+    if encoding == "zstd":
+        import zstandard
+        try:
+            return zstandard.ZstdDecompressor().decompress(data)
+        except zstandard.ZstdError as ex:
+            raise ValueError(f"Corrupt zstd body: {ex}") from ex
+
+    raise ValueError(f"Unsupported compression: {encoding}")
+
+
+def _varint(out: bytearray, value: int) -> None:
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _timestamp(value: str) -> Optional[int]:
+    """ Returns the microseconds since the epoch of an ISO timestamp without time zone, or None if
+    the string is not one or would not be decoded to the same string.
+    """
+    if not 19 <= len(value) <= 26 or value[10] != "T" or value[4] != "-":
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None or parsed.isoformat() != value:
+        return None
+
+    return (parsed - _EPOCH) // timedelta(microseconds=1)
+
+
+class _Cep2Encoder:
+    """ State of the encoding of one batch: the output and the string table.
+    """
+
+    def __init__(self):
+        self.out = bytearray()
+        self.strings: Dict[str, int] = {}
+
+    def value(self, value: Any) -> None:
+        out = self.out
+        # bool is checked before int, since it is a subclass of int.
+        if value is None:
+            out.append(_NONE)
+        elif value is True:
+            out.append(_TRUE)
+        elif value is False:
+            out.append(_FALSE)
+        elif type(value) is int:
+            out.append(_INT)
+            _varint(out, _zigzag(value))
+        elif type(value) is float:
+            out.append(_FLOAT)
+            out += _DOUBLE.pack(value)
+        elif isinstance(value, str):
+            index = self.strings.get(value)
+            if index is not None:
+                out.append(_STR_REF)
+                _varint(out, index)
+                return
+            timestamp = _timestamp(value)
+            if timestamp is not None:
+                out.append(_TIMESTAMP)
+                _varint(out, _zigzag(timestamp))
+                return
+            self.strings[value] = len(self.strings)
+            encoded = value.encode("utf-8")
+            out.append(_STR)
+            _varint(out, len(encoded))
+            out += encoded
+        else:
+            encoded = json.dumps(value, separators=(",", ":")).encode("utf-8")
+            out.append(_JSON)
+            _varint(out, len(encoded))
+            out += encoded
+
+    def document(self, document: Dict[str, Any]) -> None:
+        _varint(self.out, len(document))
+        for key, value in document.items():
+            field = _KEY_IDS.get(key, 0)
+            _varint(self.out, field)
+            if field == 0:
+                self.value(key)
+            self.value(value)
+
+
+def encode_batch(events: List[Union[str, bytes, HeucodEvent, HeucodCompactEvent]],
+                 compression: Optional[str] = None) -> bytes:
+    """ Encodes a batch of events.
+
+    Args:
+        events (List[Union[str, bytes, HeucodEvent, HeucodCompactEvent]]): the events, as JSON
+            documents (e.g. the events queued in the uplink) or as objects.
+        compression (Optional[str]): compression of the batch, see compressions().
+
+    Returns:
+        bytes: the body of the request.
+    """
+    encoder = _Cep2Encoder()
+    encoder.out += _HEADER.pack(_MAGIC, SCHEMA_VERSION, SCHEMA_ID)
+    _varint(encoder.out, len(events))
+    for event in events:
+        if isinstance(event, (str, bytes)):
+            document = _loads(event)
+        else:
+            document = HeucodEvent.serializer.to_dict(event)
+        encoder.document(document)
+
+    return compress(bytes(encoder.out), compression)
+
+
+class _Cep2Decoder:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.position = 0
+        self.strings: List[str] = []
+
+    def varint(self) -> int:
+        data = self.data
+        result = 0
+        shift = 0
+        while True:
+            byte = data[self.position]
+            self.position += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def signed(self) -> int:
+        value = self.varint()
+        return value >> 1 if not value & 1 else -(value >> 1) - 1
+
+    def bytes(self) -> bytes:
+        length = self.varint()
+        start = self.position
+        self.position += length
+        if self.position > len(self.data):
+            raise ValueError("Truncated batch")
+
+        return self.data[start:self.position]
+
+    def value(self) -> Any:
+        tag = self.data[self.position]
+        self.position += 1
+        if tag == _STR:
+            value = self.bytes().decode("utf-8")
+            self.strings.append(value)
+            return value
+        if tag == _STR_REF:
+            return self.strings[self.varint()]
+        if tag == _INT:
+            return self.signed()
+        if tag == _TRUE:
+            return True
+        if tag == _FALSE:
+            return False
+        if tag == _NONE:
+            return None
+        if tag == _FLOAT:
+            if self.position + _DOUBLE.size > len(self.data):
+                raise ValueError("Truncated batch")
+            value = _DOUBLE.unpack_from(self.data, self.position)[0]
+            self.position += _DOUBLE.size
+            return value
+        if tag == _TIMESTAMP:
+            return (_EPOCH + timedelta(microseconds=self.signed())).isoformat()
+        if tag == _JSON:
+            return json.loads(self.bytes())
+
+        raise ValueError(f"Unknown value tag {tag}")
+
+
+def _decode(data: bytes, compression: Optional[str], keys: List[Optional[str]]) -> List[dict]:
+    data = decompress(data, compression)
+    if len(data) < _HEADER.size:
+        raise ValueError("Truncated batch")
+    magic, version, schema_id = _HEADER.unpack_from(data)
+    if magic != _MAGIC:
+        raise ValueError("Not a HEUCOD batch")
+    if version != SCHEMA_VERSION or schema_id != SCHEMA_ID:
+        raise ValueError(f"Unsupported schema: version {version}, ID {schema_id:08x}")
+
+    decoder = _Cep2Decoder(data)
+    decoder.position = _HEADER.size
+    documents = []
+    try:
+        for _ in range(decoder.varint()):
+            document = {}
+            for _ in range(decoder.varint()):
+                field = decoder.varint()
+                key = keys[field] if field else decoder.value()
+                document[key] = decoder.value()
+            documents.append(document)
+    except (IndexError, struct.error, OverflowError, TypeError):
+        # Reads past the end of the data, references to fields or strings that do not exist,
+        # timestamps out of range or keys that are not strings.
+        raise ValueError("Truncated or corrupt batch") from None
+
+    return documents
+
+
+def decode_documents(data: bytes, compression: Optional[str] = None) -> List[dict]:
+    """ Decodes a batch into the JSON documents of its events, i.e. the objects that the JSON
+    format would have sent.
+
+    Raises:
+        ValueError: if the batch is not valid or uses a different schema.
+    """
+    return _decode(data, compression, _FIELD_KEYS)
+
+
+def decode_batch(data: bytes, compression: Optional[str] = None) -> List[HeucodEvent]:
+    """ Decodes a batch into HeucodEvent objects.
+
+    Raises:
+        ValueError: if the batch is not valid or uses a different schema.
+    """
+    events = []
+    for attributes in _decode(data, compression, [None, *FIELDS]):
+        event = HeucodEvent()
+        # Keys that are not HEUCOD attributes are converted like HeucodEvent.from_json() does.
+        event.__dict__.update({k if k in _FIELD_IDS else _snake_key(k): v
+                               for k, v in attributes.items()})
+        events.append(event)
+
+    return events
@@ -1,13 +1,35 @@
 from __future__ import annotations
+import asyncio
 import json
-from dataclasses import dataclass
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, replace
+from collections.abc import Mapping
 from enum import Enum
 from queue import Empty, Queue
-from threading import Event, Thread
-from time import sleep
-from typing import Any, Callable, List, Optional
-from paho.mqtt.client import Client as MqttClient, MQTTMessage
-from paho.mqtt import publish, subscribe
+from itertools import count
+from socket import gethostname
+from threading import Event, Lock, Thread, get_ident
+from time import monotonic, perf_counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from paho.mqtt.client import Client as MqttClient, MQTTMessage, topic_matches_sub
+from Cep2ActuatorCache import Cep2ActuatorCache, Cep2ActuatorCacheStats, Cep2ActuatorState
+from Cep2Dispatcher import Cep2Dispatcher, Cep2DispatcherStats, Cep2OverflowPolicy
+from Cep2Metrics import METRICS
+
+# Latencies of the stages of a message in the client, see Cep2Metrics. The times are measured from
+# the moment paho received the message (MQTTMessage.timestamp).
+_CALLBACK_SECONDS = METRICS.histogram("cep2_zigbee2mqtt_callback_delay_seconds",
+                                      "Time from the reception of a message to on_message")
+_QUEUE_SECONDS = METRICS.histogram("cep2_zigbee2mqtt_queue_seconds",
+                                   "Time from the reception of a message until a worker takes it")
+_PARSE_SECONDS = METRICS.histogram("cep2_zigbee2mqtt_parse_seconds",
+                                   "Time to parse a message")
+_HANDLER_SECONDS = METRICS.histogram("cep2_zigbee2mqtt_handler_seconds",
+                                     "Time spent in the callback of the user for a message")
+# QoS of the commands to the actuators and of the subscriptions. With a persistent session, the
+# broker keeps the messages of QoS 1 while the client is disconnected, and paho sends again the
+# commands that were not acknowledged.
+_QOS = 1
 
 
 class Cep2Zigbee2mqttMessageType(Enum):
@@ -29,6 +51,57 @@ class Cep2Zigbee2mqttMessageType(Enum):
     UNKNOWN = None
 
 
+# The JSON decoder used for the payloads. It can be replaced by a faster one with
+# Cep2Zigbee2mqttMessage.set_json_backend().
+_json_loads = json.loads
+
+
+class Cep2LazyPayload(Mapping):
+    """ A JSON object payload that is only decoded when one of its fields is accessed.
+
+    Most messages received from zigbee2mqtt are from devices the user of the client is not
+    interested in, so decoding them when they are received is wasted work. This class behaves like a
+    read-only dictionary, so it can be used as the decoded payload, e.g. payload["occupancy"].
+    """
+
+    __slots__ = ("raw", "__decoded")
+
+    def __init__(self, raw: str):
+        self.raw = raw
+        self.__decoded = None
+
+    @property
+    def decoded(self) -> Any:
+        """ The decoded payload. Payloads that are not a JSON object (e.g. a number) are also
+        returned as decoded, but can not be accessed as a dictionary.
+        """
+        if self.__decoded is None:
+            self.__decoded = _json_loads(self.raw)
+
+        return self.__decoded
+
+    def __getitem__(self, key: str) -> Any:
+        return self.decoded[key]
+
+    def __iter__(self):
+        return iter(self.decoded)
+
+    def __len__(self) -> int:
+        return len(self.decoded)
+
+    def __repr__(self) -> str:
+        return repr(self.decoded)
+
+
+class _Cep2TopicRoute(Enum):
+    """ Actions taken by Cep2Zigbee2mqttMessage.parse() for the topics of the bridge.
+    """
+
+    STATE = "state"
+    LOG = "log"
+    IGNORE = "ignore"
+
+
 @dataclass
 class Cep2Zigbee2mqttMessage:
     """ This class represents a zigbee2mqtt message. The fields vary with the topic, so not all
@@ -53,17 +126,72 @@ class Cep2Zigbee2mqttMessage:
     meta: Any = None
     status: str = None
     state: str = None
+    # Friendly name of the device that published a DEVICE_EVENT, i.e. zigbee2mqtt/<device_id>.
+    device_id: str = None
+    # Base topic of the zigbee2mqtt instance that published the message. A client can receive the
+    # messages of several instances (e.g. one per home), each with its own base topic.
+    base_topic: str = "zigbee2mqtt"
+    # Time (time.monotonic()) at which the MQTT message was received by the client, used to measure
+    # the latency of the processing.
+    received_at: float = None
+
+    # Routes of the topics published by the bridge, keyed by the topic without the base topic
+    # (e.g. zigbee2mqtt/). Topics of the bridge that are not in this table are ignored.
+    BRIDGE_ROUTES = {
+        "bridge/state": (_Cep2TopicRoute.STATE, Cep2Zigbee2mqttMessageType.BRIDGE_STATE),
+        "bridge/event": (_Cep2TopicRoute.LOG, Cep2Zigbee2mqttMessageType.BRIDGE_EVENT),
+        "bridge/log": (_Cep2TopicRoute.LOG, Cep2Zigbee2mqttMessageType.BRIDGE_LOG),
+        "bridge/logging": (_Cep2TopicRoute.LOG, Cep2Zigbee2mqttMessageType.BRIDGE_LOG),
+    }
+    # Sub-topics of a device that are not events of the device: the commands sent to it (including
+    # the ones published by this client) and its availability.
+    IGNORED_DEVICE_SUBTOPICS = {"set", "get", "availability"}
 
     @classmethod
-    def parse(cls, topic: str, message: str) -> Cep2Zigbee2mqttMessage:
+    def set_json_backend(cls, use_orjson: bool = True) -> bool:
+        """ Selects the JSON decoder of the payloads. orjson is considerably faster than the
+        standard library's json module, but it is an optional dependency.
+
+        Args:
+            use_orjson (bool): if True, use orjson if it is installed. Otherwise, use json.
+
+        Returns:
+            bool: True if orjson is being used.
+        """
+        global _json_loads
+
+        if use_orjson:
+            try:
+                import orjson
+            except ImportError:
+                print("orjson is not installed, using json")
+            else:
+                _json_loads = orjson.loads
+                return True
+
+        _json_loads = json.loads
+
+        return False
+
+    @classmethod
+    def parse(cls,
+              topic: str,
+              message: str,
+              base_topic: str = "zigbee2mqtt") -> Optional[Cep2Zigbee2mqttMessage]:
         """ Parse a zigbee2mqtt JSON message, based on the received topic.
 
+        The topic is classified with a single dictionary lookup, and the payload of device events is
+        only decoded when one of its fields is accessed (see Cep2LazyPayload).
+
         Args:
             topic (str): message's topic
             message (str): JSON message that will be parsed
+            base_topic (str): base topic of the zigbee2mqtt instance that published the message.
+                Defaults to "zigbee2mqtt".
 
         Returns:
-            Cep2Zigbee2mqttMessage: an object with the parsed message values
+            Optional[Cep2Zigbee2mqttMessage]: an object with the parsed message values, or None if
+                the topic is ignored.
         """
         # A note about class methods: these methods can be used to instantiate the class where it is
         # declared. In this case, this method returns an instance of Cep2Zigbee2mqttMessage based on
@@ -77,38 +205,308 @@ class Cep2Zigbee2mqttMessage:
         #     - Class methods: https://stackabuse.com/pythons-classmethod-and-staticmethod-explained/
         #     - Factory design pattern: https://refactoring.guru/design-patterns/factory-method
 
-        if topic == "zigbee2mqtt/bridge/state":
-            instance = cls(type_=Cep2Zigbee2mqttMessageType.BRIDGE_STATE,
-                           topic=topic,
-                           state=message)
-        elif topic in ["zigbee2mqtt/bridge/event", "zigbee2mqtt/bridge/logging"]:
-            type_ = {"zigbee2mqtt/bridge/event": Cep2Zigbee2mqttMessageType.BRIDGE_EVENT,
-                     "zigbee2mqtt/bridge/log": Cep2Zigbee2mqttMessageType.BRIDGE_LOG}.get(topic)
-            message_json = json.loads(message)
-            instance = cls(type_=type_,
-                           topic=topic,
-                           data=message_json.get("data"),
-                           message=message_json.get("message"),
-                           meta=message_json.get("meta"))
-        elif topic in ["zigbee2mqtt/bridge/config",
-                       "zigbee2mqtt/bridge/info",
-                       "zigbee2mqtt/bridge/devices",
-                       "zigbee2mqtt/bridge/groups",
-                       "zigbee2mqtt/bridge/request/health_check",
-                       "zigbee2mqtt/bridge/response/health_check"]:
-            instance = None
-        else:
-            instance = cls(type_=Cep2Zigbee2mqttMessageType.DEVICE_EVENT,
-                           topic=topic,
-                           event=json.loads(message))
+        # Remove the base topic, e.g. zigbee2mqtt/bridge/state -> bridge/state.
+        subtopic = topic[len(base_topic) + 1:]
+        device_id, _, device_subtopic = subtopic.partition("/")
+
+        if device_id != "bridge":
+            if device_subtopic in cls.IGNORED_DEVICE_SUBTOPICS:
+                return None
+
+            return cls(type_=Cep2Zigbee2mqttMessageType.DEVICE_EVENT,
+                       topic=topic,
+                       event=Cep2LazyPayload(message),
+                       device_id=device_id,
+                       base_topic=base_topic)
+
+        route, type_ = cls.BRIDGE_ROUTES.get(subtopic, (_Cep2TopicRoute.IGNORE, None))
+        if route == _Cep2TopicRoute.STATE:
+            return cls(type_=type_,
+                       topic=topic,
+                       state=message,
+                       base_topic=base_topic)
+        if route == _Cep2TopicRoute.LOG:
+            message_json = _json_loads(message)
+            return cls(type_=type_,
+                       topic=topic,
+                       data=message_json.get("data"),
+                       message=message_json.get("message"),
+                       meta=message_json.get("meta"),
+                       base_topic=base_topic)
+
+        return None
+
+
+def _state_payload(state: str, color_x: float, color_y: float) -> str:
+    """ Returns the payload of a zigbee2mqtt/<device>/set message that changes a light.
+    """
+    return json.dumps({
+        "color": {"x": color_x, "y": color_y},
+        "state": state
+    })
+
+
+def _publish_many(cache: Cep2ActuatorCache,
+                  groups: Dict[str, frozenset],
+                  publish: Callable[[str, str], None],
+                  base_topic: str,
+                  device_ids: List[str],
+                  state: Cep2ActuatorState,
+                  force: bool) -> int:
+    """ Publishes a state to several actuators, shared by the clients' change_state_many().
+
+    The actuators whose state must change are decided by the cache, like in change_state(). Then,
+    the zigbee2mqtt groups whose members were all requested are used to command the actuators with
+    one message per group, starting with the group that covers the most actuators. The actuators
+    left are commanded one by one. Members of a group that already had the state receive it again,
+    which has no visible effect.
+
+    Returns:
+        int: number of messages published.
+    """
+    requested = set(device_ids)
+    pending = {d for d in device_ids
+               if cache.should_publish(f"{base_topic}/{d}", state, force=force)}
+    payload = _state_payload(state.state, state.color_x, state.color_y)
+    published = 0
+
+    candidates = [(name, members) for name, members in groups.items() if members <= requested]
+    while pending and candidates:
+        name, members = max(candidates, key=lambda c: len(c[1] & pending))
+        if len(members & pending) < 2:
+            # A group is only worth it if it replaces several messages.
+            break
+        publish(f"{base_topic}/{name}/set", payload)
+        published += 1
+        pending -= members
+        candidates.remove((name, members))
+
+    # The order of the requested actuators is kept for the ones commanded individually.
+    for device_id in device_ids:
+        if device_id in pending:
+            publish(f"{base_topic}/{device_id}/set", payload)
+            pending.discard(device_id)
+            published += 1
+
+    return published
+
+
+def _replay_desired(cache: Cep2ActuatorCache,
+                    groups: Dict[str, Dict[str, frozenset]],
+                    base_topics: _Cep2BaseTopics,
+                    publish: Callable[[str, str], None]) -> int:
+    """ Publishes again the desired state of every actuator, shared by the clients' reconnection.
+    The broker, zigbee2mqtt or the devices may have restarted while the client was disconnected,
+    and the states requested meanwhile were only recorded. The actuators with the same state are
+    commanded together, see _publish_many().
+
+    Returns:
+        int: number of messages published.
+    """
+    by_state: Dict[Tuple[str, Cep2ActuatorState], List[str]] = {}
+    for key, state in cache.desired_states().items():
+        base_topic = base_topics.resolve(key)
+        if base_topic is not None:
+            by_state.setdefault((base_topic, state), []).append(key[len(base_topic) + 1:])
+
+    return sum(_publish_many(cache, groups.get(base_topic, {}), publish, base_topic, device_ids,
+                             state, True)
+               for (base_topic, state), device_ids in by_state.items())
+
+
+def _default_client_id(base_topics: List[str]) -> str:
+    """ Returns the ID of the MQTT session of a client, which must be the same after a restart of
+    the process to resume its persistent session.
+    """
+    return f"cep2-{gethostname()}-{base_topics[0]}"
+
+
+class _Cep2BaseTopics:
+    """ The base topics of the zigbee2mqtt instances served by a client.
+    """
+
+    def __init__(self, base_topics: List[str]):
+        if not base_topics:
+            raise ValueError("At least one base topic is required")
+
+        self.default = base_topics[0]
+        self.all = list(base_topics)
+        self.subscriptions = [f"{b}/#" for b in base_topics]
+        # Base topics are usually a single level, e.g. zigbee2mqtt_home1, so they are found with a
+        # set lookup of the first level of the topic. Base topics with several levels are checked
+        # one by one.
+        self.__single_level = {b for b in base_topics if "/" not in b}
+        self.__multi_level = [b for b in base_topics if "/" in b]
+
+    def resolve(self, topic: str) -> Optional[str]:
+        """ Returns the base topic of a topic, or None if it is not under any of the base topics.
+        """
+        base_topic = topic.partition("/")[0]
+        if base_topic in self.__single_level:
+            return base_topic
+
+        for b in self.__multi_level:
+            if topic.startswith(b + "/"):
+                return b
+
+        return None
+
 
-        return instance
+@dataclass
+class Cep2HealthStatus:
+    """ Last known health of a zigbee2mqtt instance. The times are time.monotonic() values, or None
+    if nothing was received yet.
+    """
+
+    base_topic: str
+    # Result of the last health check: "ok", "fail" or "unknown" if it was never checked.
+    status: str = "unknown"
+    checked_at: Optional[float] = None
+    # Seconds between the request of the last health check and its response.
+    latency: Optional[float] = None
+    # State published by the bridge on <base topic>/bridge/state, e.g. "online" or "offline".
+    bridge_state: Optional[str] = None
+    bridge_state_at: Optional[float] = None
+
+    @property
+    def age(self) -> Optional[float]:
+        """ Seconds since the last health check, or None if it was never checked.
+        """
+        return monotonic() - self.checked_at if self.checked_at is not None else None
+
+    def is_stale(self, max_age: float) -> bool:
+        return self.checked_at is None or self.age > max_age
+
+
+def _decode_payload(payload: bytes) -> str:
+    """ Transforms the payload of a message into a string, following the utf-8 encoding. Invalid
+    bytes are replaced, since an exception would stop the thread of the client.
+    """
+    return payload.decode("utf-8", errors="replace")
+
+
+class _Cep2HealthTracker:
+    """ Health checks over the connection of a client, shared by Cep2Zigbee2mqttClient and
+    Cep2AsyncZigbee2mqttClient.
+
+    Each request carries a transaction ID, which zigbee2mqtt copies in its response, so concurrent
+    checks (of the same or of different instances) are matched with their responses. Responses
+    without a transaction, from older versions of zigbee2mqtt, resolve all the pending checks of
+    their instance. The last result of each instance and the state of its bridge are cached.
+    """
+
+    RESPONSE_SUBTOPIC = "bridge/response/health_check"
+    STATE_SUBTOPIC = "bridge/state"
+
+    def __init__(self, base_topics: List[str]):
+        self.__statuses = {b: Cep2HealthStatus(b) for b in base_topics}
+        # Pending checks: transaction -> (base topic, request time, function called with the result).
+        self.__pending: Dict[str, Tuple[str, float, Callable[[str], None]]] = {}
+        self.__sequence = count()
+        self.__lock = Lock()
+
+    @classmethod
+    def topics(cls, base_topic: str) -> List[str]:
+        """ Topics that must be subscribed to receive the health of an instance.
+        """
+        return [f"{base_topic}/{cls.RESPONSE_SUBTOPIC}", f"{base_topic}/{cls.STATE_SUBTOPIC}"]
+
+    def status(self, base_topic: str) -> Cep2HealthStatus:
+        with self.__lock:
+            return replace(self.__statuses.setdefault(base_topic, Cep2HealthStatus(base_topic)))
+
+    def request(self, base_topic: str, resolve: Callable[[str], None]) -> Tuple[str, str, str]:
+        """ Registers a health check.
+
+        Returns:
+            Tuple[str, str, str]: the transaction, and the topic and payload of the request to
+                publish.
+        """
+        transaction = f"cep2-{next(self.__sequence)}"
+        with self.__lock:
+            self.__pending[transaction] = (base_topic, monotonic(), resolve)
+
+        return (transaction,
+                f"{base_topic}/bridge/request/health_check",
+                json.dumps({"transaction": transaction}))
+
+    def timeout(self, transaction: str) -> None:
+        """ Records a check that was not answered in time as failed.
+        """
+        with self.__lock:
+            pending = self.__pending.pop(transaction, None)
+            if pending is not None:
+                self.__record(pending[0], "fail", None)
+
+    def handle(self, base_topic: str, topic: str, payload: str) -> bool:
+        """ Processes a message of the bridge related with its health.
+
+        Returns:
+            bool: True if the message is a health check response, which must not be processed
+                further.
+        """
+        subtopic = topic[len(base_topic) + 1:]
+        if subtopic == self.STATE_SUBTOPIC:
+            # zigbee2mqtt publishes "online"/"offline", or {"state": "online"} since version 1.29.
+            try:
+                state = _json_loads(payload)
+            except ValueError:
+                state = payload
+            if isinstance(state, dict):
+                state = state.get("state")
+            with self.__lock:
+                status = self.__statuses.setdefault(base_topic, Cep2HealthStatus(base_topic))
+                status.bridge_state = state
+                status.bridge_state_at = monotonic()
+            return False
+
+        if subtopic != self.RESPONSE_SUBTOPIC:
+            return False
+
+        try:
+            response = _json_loads(payload)
+        except ValueError:
+            response = None
+        if not isinstance(response, dict):
+            # Not a response of zigbee2mqtt (e.g. [] or "ok"): the check failed.
+            response = {}
+        data = response.get("data")
+        healthy = data.get("healthy", True) if isinstance(data, dict) else True
+        result = "ok" if response.get("status") == "ok" and healthy else "fail"
+        transaction = response.get("transaction")
+        if transaction is not None and not isinstance(transaction, str):
+            transaction = str(transaction)
+
+        with self.__lock:
+            if transaction in self.__pending:
+                resolved = [self.__pending.pop(transaction)]
+            elif transaction is None:
+                resolved = [self.__pending.pop(t) for t, (b, _, _) in list(self.__pending.items())
+                            if b == base_topic]
+            else:
+                # The response of a check that timed out, or of another client.
+                resolved = []
+            for _, requested_at, _ in resolved:
+                self.__record(base_topic, result, monotonic() - requested_at)
+
+        for _, _, resolve in resolved:
+            resolve(result)
+
+        return True
+
+    def __record(self, base_topic: str, result: str, latency: Optional[float]) -> None:
+        status = self.__statuses.setdefault(base_topic, Cep2HealthStatus(base_topic))
+        status.status = result
+        status.checked_at = monotonic()
+        status.latency = latency
 
 
 class Cep2Zigbee2mqttClient:
     """ This class implements a simple zigbee2mqtt client.
 
-    By default it subscribes to all events of the default topic (zigbee2mqtt/#). No methods for
+    By default it subscribes to all events of the default topic (zigbee2mqtt/#). Several base topics
+    can be given, so that one client (and one connection to the broker) serves several zigbee2mqtt
+    instances, e.g. one per home, each configured with its own base_topic. No methods for
     explicitly publishing to zigbee2mqtt are provided, since the class can provide higher level
     abstraction methods for this. An example implemented example is this class' check_health().
 
@@ -118,6 +516,24 @@ class Cep2Zigbee2mqttClient:
     an event and invokes the callback, no new events will be processed. Careful should be taken with
     methods that might take too much time to process the events or that might eventually block (for
     example, sending an event to another service).
+
+    To avoid this, the client can run in dispatcher mode by setting the number of workers in the
+    initializer. In this mode, messages are distributed by device (the friendly name in the topic)
+    to a pool of worker threads. The messages of each device are still processed in order, but a
+    callback that blocks on the messages of one device does not delay the others. Since the callback
+    can then be invoked from several threads at the same time, it must be thread safe.
+
+    The client keeps the last state requested for each actuator and the last state reported by it
+    (received on the device's topic), so change_state() does not publish a state that the device
+    already has.
+
+    If the connection with the broker is lost, paho reconnects in the background, waiting between
+    attempts from min_reconnect_delay seconds, doubled after each failed attempt up to
+    max_reconnect_delay. Meanwhile, change_state() only records the states requested. Once
+    connected again, the client subscribes to its topics again and publishes the desired state of
+    every actuator in a single burst. The session is persistent (clean_session=False) and the
+    commands are published with QoS 1, so the broker keeps the messages of the client during short
+    disconnections.
     """
     ROOT_TOPIC = "zigbee2mqtt/#"
 
@@ -125,7 +541,17 @@ class Cep2Zigbee2mqttClient:
                  host: str,
                  on_message_clbk: Callable[[Optional[Cep2Zigbee2mqttMessage]], None],
                  port: int = 1883,
-                 topics: List[str] = [ROOT_TOPIC]):
+                 topics: Optional[List[str]] = None,
+                 base_topics: List[str] = ["zigbee2mqtt"],
+                 workers: int = 0,
+                 max_queue: int = 1000,
+                 overflow_policy: Cep2OverflowPolicy = Cep2OverflowPolicy.DROP_NEWEST,
+                 keep_fields: Iterable[str] = (),
+                 refresh_interval: Optional[float] = None,
+                 mqtt_client: Optional[MqttClient] = None,
+                 client_id: Optional[str] = None,
+                 min_reconnect_delay: float = 0.1,
+                 max_reconnect_delay: float = 1.0):
         """ Class initializer where the MQTT broker's host and port can be set, the list of topics
         to subscribe and a callback to handle events from zigbee2mqtt.
 
@@ -135,13 +561,56 @@ class Cep2Zigbee2mqttClient:
                 a message is received from zigbee2mqtt. This returns None if the 
             port (int): network port of the MQTT broker. Defaults to 1883.
             topics (List[str], optional): a list of topics that the client will subscribe to.
-                Defaults to ["zigbee2mqtt/#"].
+                Defaults to all the topics of the base topics, e.g. ["zigbee2mqtt/#"].
+            base_topics (List[str], optional): base topics of the zigbee2mqtt instances. The first
+                one is the default of change_state() and check_health(). Defaults to
+                ["zigbee2mqtt"].
+            workers (int, optional): number of worker threads of the dispatcher mode. If 0, the
+                messages are processed serially by a single worker. Defaults to 0.
+            max_queue (int, optional): maximum number of pending messages per worker in dispatcher
+                mode. Defaults to 1000.
+            overflow_policy (Cep2OverflowPolicy, optional): what to do when a worker queue is full
+                in dispatcher mode. The network thread of paho never waits for the workers.
+                Defaults to Cep2OverflowPolicy.DROP_NEWEST.
+            keep_fields (Iterable[str], optional): fields of the device events whose messages are
+                never coalesced with Cep2OverflowPolicy.COALESCE, e.g. the vibration of a pillbox.
+                Defaults to none.
+            refresh_interval (Optional[float], optional): if set, change_state() publishes an
+                unchanged state again after this number of seconds. Defaults to None, i.e. unchanged
+                states are not published.
+            mqtt_client (Optional[MqttClient], optional): MQTT client used to connect to the
+                broker. Any object with the interface of paho's Client can be given, e.g. the fake
+                client of Cep2Replay. Defaults to None, i.e. a new paho Client.
+            client_id (Optional[str], optional): ID of the persistent session in the broker. Clients
+                connected to the same broker must have different IDs. Defaults to None, i.e.
+                cep2-<host name>-<first base topic>.
+            min_reconnect_delay (float, optional): seconds before the first attempt to reconnect.
+                Defaults to 0.1.
+            max_reconnect_delay (float, optional): maximum seconds between attempts to reconnect.
+                Defaults to 1.
         """
-        self.__client = MqttClient()
+        self.__actuator_cache = Cep2ActuatorCache(refresh_interval=refresh_interval)
+        self.__client = mqtt_client if mqtt_client is not None else \
+            MqttClient(client_id=client_id or _default_client_id(base_topics), clean_session=False)
         self.__client.on_connect = self.__on_connect
         self.__client.on_disconnect = self.__on_disconnect
         self.__client.on_message = self.__on_message
+        self.__client.reconnect_delay_set(min_reconnect_delay, max_reconnect_delay)
         self.__connected = False
+        self.__started = False
+        # Taken while publishing and when the connection changes, so the states requested during a
+        # reconnection are neither lost nor published before the replay of the older ones.
+        self.__publish_lock = Lock()
+        # The raw payload is searched for the fields, so the messages are not decoded on the
+        # network thread.
+        quoted_fields = tuple(f'"{f}"'.encode("utf-8") for f in keep_fields)
+        can_coalesce = (lambda m: not any(f in m.payload for f in quoted_fields)) \
+            if quoted_fields else None
+        self.__dispatcher = Cep2Dispatcher(self.__process_message,
+                                           workers=workers,
+                                           max_queue=max_queue,
+                                           overflow_policy=overflow_policy,
+                                           can_coalesce=can_coalesce) if workers > 0 else None
         self.__events_queue = Queue()
         self.__host = host
         self.__on_message_clbk = on_message_clbk
@@ -149,97 +618,219 @@ class Cep2Zigbee2mqttClient:
         self.__stop_worker = Event()
         self.__subscriber_thread = Thread(target=self.__worker,
                                           daemon=True)
-        self.__topics = topics
+        self.__base_topics = _Cep2BaseTopics(base_topics)
+        self.__topics = topics if topics is not None else self.__base_topics.subscriptions
+        self.__health = _Cep2HealthTracker(self.__base_topics.all)
+        # zigbee2mqtt groups of each instance, see set_groups().
+        self.__groups: Dict[str, Dict[str, frozenset]] = {}
+        self.__health_thread = None
 
     def connect(self) -> None:
-        """ Connects to the MQTT broker specified in the initializer. This is a blocking function.
+        """ Connects to the MQTT broker specified in the initializer. This is a blocking function,
+        unless the broker is not reachable: then paho keeps trying to connect in the background.
         """
-        # In the client is already connected then stop here.
-        if self.__connected:
+        # In the client is already started then stop here.
+        if self.__started:
             return
+        self.__started = True
 
-        # Connect to the host given in initializer.
-        self.__client.connect(self.__host,
-                              self.__port)
+        # Connect to the host given in initializer. The topics are subscribed by __on_connect().
+        try:
+            self.__client.connect(self.__host,
+                                  self.__port)
+        except OSError as e:
+            print(f"MQTT broker not reachable ({e}), retrying in the background")
+            self.__client.connect_async(self.__host,
+                                        self.__port)
         self.__client.loop_start()
-        # Subscribe to all topics given in the initializer.
-        for t in self.__topics:
-            self.__client.subscribe(t)
-        # Start the subscriber thread.
-        self.__subscriber_thread.start()
-
-    def change_state(self, device_id: str, state: str, color_x : float, color_y : float)  -> None:
-        if not self.__connected:
-            raise RuntimeError("The client is not connected. Connect first.")
-
-        self.__client.publish(
-            topic=f"zigbee2mqtt/{device_id}/set",
-            payload=json.dumps({
-                "color": {"x": color_x, "y": color_y},
-                "state": state
-            })
-        )
-        
-
-
-    def check_health(self) -> str:
+        # Start the subscriber thread, or the dispatcher's workers in dispatcher mode.
+        if self.__dispatcher:
+            self.__dispatcher.start()
+        else:
+            self.__subscriber_thread.start()
+
+    @property
+    def dispatcher_stats(self) -> Optional[Cep2DispatcherStats]:
+        """ Counters of the dispatcher, or None if the client is not in dispatcher mode.
+        """
+        return self.__dispatcher.stats if self.__dispatcher else None
+
+    def device_lag(self) -> Dict[str, float]:
+        """ Returns, for each device with messages waiting to be processed, for how long (in
+        seconds) the oldest of them has been waiting. Only available in dispatcher mode; otherwise
+        an empty dictionary is returned.
+        """
+        return self.__dispatcher.device_lag() if self.__dispatcher else {}
+
+    @property
+    def actuator_stats(self) -> Cep2ActuatorCacheStats:
+        """ Counters of the publishes sent and suppressed by change_state().
+        """
+        return self.__actuator_cache.stats
+
+    def change_state(self,
+                     device_id: str,
+                     state: str,
+                     color_x: float,
+                     color_y: float,
+                     force: bool = False,
+                     base_topic: Optional[str] = None) -> bool:
+        """ Sets the state and color of a light. Nothing is published if the light already has, or
+        was already requested to have, the same state and color.
+
+        Args:
+            device_id (str): friendly name of the light.
+            state (str): "ON" or "OFF".
+            color_x (float): x coordinate of the color, in the CIE xy color space.
+            color_y (float): y coordinate of the color, in the CIE xy color space.
+            force (bool, optional): publish even if the state is unchanged. Defaults to False.
+            base_topic (Optional[str], optional): base topic of the zigbee2mqtt instance of the
+                light. Defaults to the first base topic.
+
+        Returns:
+            bool: True if the state was published, False if it was suppressed or, while the client
+            is not connected, recorded to be published on reconnection.
+        """
+        base_topic = base_topic or self.__base_topics.default
+        desired = Cep2ActuatorState(state, color_x, color_y)
+        with self.__publish_lock:
+            if not self.__connected:
+                self.__actuator_cache.set_desired(f"{base_topic}/{device_id}", desired)
+                return False
+
+            if not self.__actuator_cache.should_publish(f"{base_topic}/{device_id}",
+                                                        desired,
+                                                        force=force):
+                return False
+
+            self.__publish(f"{base_topic}/{device_id}/set",
+                           _state_payload(state, color_x, color_y))
+
+        return True
+
+    def send_command(self,
+                     device_id: str,
+                     command: Dict[str, Any],
+                     base_topic: Optional[str] = None) -> None:
+        """ Publishes a command to a device without going through the actuator cache, e.g. an
+        effect or a step of an effect (see Cep2LightEffects). The state desired for the device is
+        not changed, so it can be restored with change_state(..., force=True). Commands given
+        while the client is not connected are discarded.
+
+        Args:
+            device_id (str): friendly name of the device.
+            command (Dict[str, Any]): payload of the <base topic>/<device>/set message, e.g.
+                {"effect": "blink"}.
+            base_topic (Optional[str], optional): base topic of the zigbee2mqtt instance of the
+                device. Defaults to the first base topic.
+        """
+        with self.__publish_lock:
+            if self.__connected:
+                self.__publish(f"{base_topic or self.__base_topics.default}/{device_id}/set",
+                               json.dumps(command))
+
+    def desired_state(self,
+                      device_id: str,
+                      base_topic: Optional[str] = None) -> Optional[Cep2ActuatorState]:
+        """ Returns the last state requested for an actuator with change_state(), or None.
+        """
+        base_topic = base_topic or self.__base_topics.default
+
+        return self.__actuator_cache.desired(f"{base_topic}/{device_id}")
+
+    def set_groups(self, groups: Dict[str, List[str]], base_topic: Optional[str] = None) -> None:
+        """ Declares the zigbee2mqtt groups of an instance, which change_state_many() uses to
+        command several lights with a single message. The groups must be configured in
+        zigbee2mqtt with the same friendly names and members.
+
+        Args:
+            groups (Dict[str, List[str]]): friendly names of the members of each group, by the
+                friendly name of the group.
+            base_topic (Optional[str], optional): base topic of the zigbee2mqtt instance. Defaults
+                to the first base topic.
+        """
+        self.__groups[base_topic or self.__base_topics.default] = \
+            {name: frozenset(members) for name, members in groups.items()}
+
+    def change_state_many(self,
+                          device_ids: List[str],
+                          state: str,
+                          color_x: float,
+                          color_y: float,
+                          force: bool = False,
+                          base_topic: Optional[str] = None) -> int:
+        """ Sets the same state and color to several lights, see change_state(). The lights are
+        commanded through their zigbee2mqtt groups when possible (see set_groups()), and the rest
+        are published one after the other, so paho writes them to the socket together and the
+        lights change at the same time.
+
+        Returns:
+            int: number of messages published. While the client is not connected, the states are
+            only recorded, and 0 is returned.
+        """
+        base_topic = base_topic or self.__base_topics.default
+        desired = Cep2ActuatorState(state, color_x, color_y)
+        with self.__publish_lock:
+            if not self.__connected:
+                for device_id in device_ids:
+                    self.__actuator_cache.set_desired(f"{base_topic}/{device_id}", desired)
+                return 0
+
+            return _publish_many(self.__actuator_cache,
+                                 self.__groups.get(base_topic, {}),
+                                 self.__publish,
+                                 base_topic,
+                                 list(device_ids),
+                                 desired,
+                                 force)
+
+    def check_health(self, base_topic: Optional[str] = None, timeout: float = 5) -> str:
         """ Allows to check whether zigbee2mqtt is healthy, i.e. the service is running properly.
-        
+
         Refer to zigbee2mqtt for more information. This is a blocking function that waits for a
-        response to the health request.
+        response to the health request. The request is published with the client's connection, and
+        the response is matched to it by its transaction ID.
+
+        Args:
+            base_topic (Optional[str], optional): base topic of the zigbee2mqtt instance to check.
+                Defaults to the first base topic.
+            timeout (float, optional): seconds to wait for the response. Defaults to 5.
 
         Returns:
-            A string with a description of zigbee2mqtt's health. This can be 'ok' or 'fail'. 
-        """
-        health_status = "fail"
-        health_response_received = Event()
-
-        # This function will run the subscriber on a thread. The subscriber must be started first,
-        # so that the health_check message is received, even if the broker does not have message
-        # persistence active. This should also avoid that messages with QoS 0 are not received.
-        # Also, if the subscriber is started after, it could happen the message to be received by
-        # another subscriber and never by this one.
-        # More information can be found in
-        # https://pagefault.blog/2020/02/05/how-to-set-up-persistent-storage-for-mosquitto-mqtt-broker
-        def health_check_subscriber():
-            message = subscribe.simple(hostname=self.__host,
-                                       port=self.__port,
-                                       topics="zigbee2mqtt/bridge/response/health_check")
-
-            if message:
-                # Decode and parse JSON payload.
-                payload = message.payload.decode("utf-8")
-                health = json.loads(payload)
-
-                # The nonlocal keyword is used to set the variable health_status that is not defined
-                # in this function's scope. For more information got to
-                # https://www.programiz.com/python-programming/global-local-nonlocal-variables
-                nonlocal health_status
-                health_status = health.get("status", "fail")
-                # Set the flag so that the function exits.
-                health_response_received.set()
-
-        # Start a thread with the subscriber that will wait for the response of the health_check.
-        Thread(target=health_check_subscriber, daemon=True).start()
-        # Wait for the subscriber to establish a connection with the broker.
-        sleep(.5)
-        # Publish the health_check request.
-        publish.single(hostname=self.__host,
-                       port=self.__port,
-                       topic="zigbee2mqtt/bridge/request/health_check")
-        # Wait until the response is received. If it is not received within 5 seconds, then return
-        # the default state: "fail".
-        health_response_received.wait(timeout=5)
-
-        return health_status
+            A string with a description of zigbee2mqtt's health. This can be 'ok' or 'fail'.
+        """
+        transaction, future = self.__request_health(base_topic or self.__base_topics.default)
+
+        return self.__wait_health(transaction, future, timeout)
+
+    def health(self, base_topic: Optional[str] = None) -> Cep2HealthStatus:
+        """ Returns the cached health of a zigbee2mqtt instance, updated by check_health() and by
+        the health monitor, see start_health_monitor(). This function does not block.
+        """
+        return self.__health.status(base_topic or self.__base_topics.default)
+
+    def start_health_monitor(self, interval: float, timeout: float = 5) -> None:
+        """ Checks the health of all the zigbee2mqtt instances every interval seconds, from a
+        thread, until the client is disconnected. Changes of the health are printed.
+        """
+        if self.__health_thread is not None:
+            return
+
+        self.__health_thread = Thread(target=self.__monitor_health,
+                                      args=(interval, timeout),
+                                      daemon=True)
+        self.__health_thread.start()
 
     def disconnect(self) -> None:
         """ Disconnects from the MQTT broker.
         """
+        self.__started = False
         self.__stop_worker.set()
+        if self.__dispatcher:
+            self.__dispatcher.stop()
         self.__client.loop_stop()
         # Unsubscribe from all topics given in the initializer.
-        for t in self.__topics:
+        for t in self.__topics + self.__health_topics():
             self.__client.unsubscribe(t)
         self.__client.disconnect()
 
@@ -250,10 +841,26 @@ class Cep2Zigbee2mqttClient:
         https://www.eclipse.org/paho/index.php?page=clients/python/docs/index.php#callbacks
         """
 
-        # Set connected flag to true. This is later used if multiple calls to connect are made. This
-        # way the user does not need to very if the client is connected.
-        self.__connected = True
-        print("MQTT client connected")
+        if rc != 0:
+            # The broker refused the connection. paho tries again after the reconnect delay.
+            print(f"MQTT connection refused ({rc})")
+            return
+
+        # Subscribe to all topics given in the initializer, and to the topics of the health of each
+        # instance that they do not include. This is done on every connection, since a broker that
+        # restarted without persistence does not have the subscriptions of the session anymore.
+        for t in self.__topics + self.__health_topics():
+            self.__client.subscribe(t, qos=_QOS)
+
+        # Set connected flag to true, and publish the states of the actuators, including the ones
+        # requested while the client was disconnected.
+        with self.__publish_lock:
+            self.__connected = True
+            replayed = _replay_desired(self.__actuator_cache,
+                                       self.__groups,
+                                       self.__base_topics,
+                                       self.__publish)
+        print(f"MQTT client connected, {replayed} actuator states published")
 
     def __on_disconnect(self, client, userdata, rc) -> None:
         """ Callback invoked when the client disconnects from the MQTT broker occurs.
@@ -262,10 +869,14 @@ class Cep2Zigbee2mqttClient:
         https://www.eclipse.org/paho/index.php?page=clients/python/docs/index.php#callbacks
         """
 
-        # Set connected flag to false. This is later used if multiple calls to connect are made.
-        # This way the user does not need to very if the client is connected.
-        self.__connected = False
-        print("MQTT client disconnected")
+        # Set connected flag to false, so the states requested until the reconnection are only
+        # recorded. paho reconnects by itself unless disconnect() was called.
+        with self.__publish_lock:
+            self.__connected = False
+        if rc != 0:
+            print(f"MQTT client disconnected ({rc}), reconnecting")
+        else:
+            print("MQTT client disconnected")
 
     def __on_message(self, client, userdata, message: MQTTMessage) -> None:
         """ Callback invoked when a message has been received on a topic that the client subscribed.
@@ -273,9 +884,94 @@ class Cep2Zigbee2mqttClient:
         Refer to paho-mqtt documentation for more information on this callback:
         https://www.eclipse.org/paho/index.php?page=clients/python/docs/index.php#callbacks
         """
+        if METRICS.enabled:
+            _CALLBACK_SECONDS.observe(monotonic() - message.timestamp)
+
+        # The responses of the health checks are handled here, so they do not wait in the queues
+        # behind the events of the devices.
+        if "/bridge/" in message.topic:
+            base_topic = self.__base_topics.resolve(message.topic)
+            if base_topic and self.__health.handle(base_topic,
+                                                   message.topic,
+                                                   _decode_payload(message.payload)):
+                return
+
+        if self.__dispatcher:
+            # In dispatcher mode, the message is sent to the worker responsible for the device. The
+            # topic, e.g. zigbee2mqtt/<friendly name>, identifies the device even when several
+            # zigbee2mqtt instances have devices with the same friendly name.
+            self.__dispatcher.submit(message.topic, message)
+        else:
+            # Push a message to the queue. This will later be processed by the worker.
+            self.__events_queue.put(message)
+
+    def __publish(self, topic: str, payload: str) -> None:
+        self.__client.publish(topic=topic, payload=payload, qos=_QOS)
+
+    def __health_topics(self) -> List[str]:
+        return [t for b in self.__base_topics.all for t in _Cep2HealthTracker.topics(b)
+                if not any(topic_matches_sub(s, t) for s in self.__topics)]
+
+    def __request_health(self, base_topic: str) -> Tuple[str, Future]:
+        future = Future()
+        transaction, topic, payload = self.__health.request(base_topic, future.set_result)
+        self.__client.publish(topic=topic, payload=payload)
+
+        return transaction, future
+
+    def __wait_health(self, transaction: str, future: Future, timeout: float) -> str:
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self.__health.timeout(transaction)
+            return "fail"
+
+    def __monitor_health(self, interval: float, timeout: float) -> None:
+        while not self.__stop_worker.is_set():
+            previous = {b: self.__health.status(b).status for b in self.__base_topics.all}
+            # All the instances are checked at the same time, so a check takes at most timeout
+            # seconds regardless of the number of instances.
+            requests = {b: self.__request_health(b) for b in self.__base_topics.all}
+            deadline = monotonic() + timeout
+            for base_topic, (transaction, future) in requests.items():
+                status = self.__wait_health(transaction, future, max(0, deadline - monotonic()))
+                if status != previous[base_topic]:
+                    print(f"Zigbee2Mqtt {base_topic} is {status}")
+            if self.__stop_worker.wait(interval):
+                return
+
+    def __process_message(self, message: MQTTMessage) -> None:
+        """ Parses a message received from the broker and gives it to the user's callback.
+        """
+        timed = METRICS.enabled
+        if timed:
+            _QUEUE_SECONDS.observe(monotonic() - message.timestamp)
+            start = perf_counter()
 
-        # Push a message to the queue. This will later be processed by the worker.
-        self.__events_queue.put(message)
+        base_topic = self.__base_topics.resolve(message.topic)
+        if base_topic is None:
+            # The message was received on a topic subscribed explicitly, outside the base topics.
+            self.__on_message_clbk(None)
+            return
+
+        parsed = Cep2Zigbee2mqttMessage.parse(message.topic,
+                                              _decode_payload(message.payload),
+                                              base_topic)
+
+        if parsed:
+            # paho sets the timestamp of the messages when they are received.
+            parsed.received_at = message.timestamp
+        # Messages published on zigbee2mqtt/<device> carry the state reported by the device. The
+        # payload is only decoded if the device is an actuator known by the cache.
+        if parsed and parsed.type_ == Cep2Zigbee2mqttMessageType.DEVICE_EVENT:
+            self.__actuator_cache.update_reported(f"{base_topic}/{parsed.device_id}", parsed.event)
+
+        if timed:
+            parsed_at = perf_counter()
+            _PARSE_SECONDS.observe(parsed_at - start)
+        self.__on_message_clbk(parsed)
+        if timed:
+            _HANDLER_SECONDS.observe(perf_counter() - parsed_at)
 
     def __worker(self) -> None:
         """ This method pulls zigbee2mqtt messages from the queue of received messages, pushed when
@@ -295,7 +991,381 @@ class Cep2Zigbee2mqttClient:
                 # If a message was successfully pulled from the queue, then process it.
                 # NOTE: this else condition is part of the try and it is executed when the action
                 # inside the try does not throws and exception.
-                # The decode() transforms a byte array into a string, following the utf-8 encoding.
                 if message:
-                    self.__on_message_clbk(Cep2Zigbee2mqttMessage.parse(message.topic,
-                                                                        message.payload.decode("utf-8")))
\ No newline at end of file
+                    self.__process_message(message)
+
+
+class Cep2AsyncZigbee2mqttClient:
+    """ This class implements a zigbee2mqtt client for asyncio applications.
+
+    Unlike Cep2Zigbee2mqttClient, it does not start any thread: the network operations of the MQTT
+    client are executed by the asyncio event loop, when the socket is ready to be read or written.
+    The received messages are parsed and can be consumed with an async for loop:
+
+        client = Cep2AsyncZigbee2mqttClient("localhost")
+        await client.connect()
+        async for message in client:
+            ...
+
+    The iteration ends when the client is disconnected. Messages on ignored topics (see
+    Cep2Zigbee2mqttMessage.parse()) are not returned. If the consumer is slower than the broker and
+    the queue of received messages is full, the oldest message is discarded.
+
+    Like Cep2Zigbee2mqttClient, the client reconnects when the connection is lost, with the same
+    exponential backoff, and then subscribes again and publishes the desired states of the
+    actuators. The reconnection is a task of the event loop. The blocking part of a connection
+    (resolving the host and opening the socket) runs in the default executor of the loop.
+    """
+
+    # Interval, in seconds, at which the MQTT client's periodic tasks (e.g. keep alive) are run.
+    MISC_INTERVAL = 1.0
+
+    def __init__(self,
+                 host: str,
+                 port: int = 1883,
+                 base_topics: List[str] = ["zigbee2mqtt"],
+                 max_queue: int = 1000,
+                 refresh_interval: Optional[float] = None,
+                 client_id: Optional[str] = None,
+                 min_reconnect_delay: float = 0.1,
+                 max_reconnect_delay: float = 1.0):
+        """ Class initializer.
+
+        Args:
+            host (str): string with the hostname, or IP address, of the MQTT broker.
+            port (int): network port of the MQTT broker. Defaults to 1883.
+            base_topics (List[str], optional): base topics of the zigbee2mqtt instances. Defaults to
+                ["zigbee2mqtt"].
+            max_queue (int, optional): maximum number of received messages waiting to be consumed.
+                Defaults to 1000.
+            refresh_interval (Optional[float], optional): if set, change_state() publishes an
+                unchanged state again after this number of seconds. Defaults to None.
+            client_id (Optional[str], optional): ID of the persistent session in the broker, see
+                Cep2Zigbee2mqttClient. Defaults to None, i.e. cep2-<host name>-<first base topic>.
+            min_reconnect_delay (float, optional): seconds before the first attempt to reconnect.
+                Defaults to 0.1.
+            max_reconnect_delay (float, optional): maximum seconds between attempts to reconnect.
+                Defaults to 1.
+        """
+        self.__actuator_cache = Cep2ActuatorCache(refresh_interval=refresh_interval)
+        self.__base_topics = _Cep2BaseTopics(base_topics)
+        self.__client = MqttClient(client_id=client_id or _default_client_id(base_topics),
+                                   clean_session=False)
+        self.__client.on_connect = self.__on_connect
+        self.__client.on_disconnect = self.__on_disconnect
+        self.__client.on_message = self.__on_message
+        self.__client.on_socket_open = self.__on_socket_open
+        self.__client.on_socket_close = self.__on_socket_close
+        self.__client.on_socket_register_write = self.__on_socket_register_write
+        self.__client.on_socket_unregister_write = self.__on_socket_unregister_write
+        self.__host = host
+        self.__port = port
+        self.__max_queue = max_queue
+        self.__loop = None
+        self.__loop_thread = None
+        self.__queue = None
+        self.__connected = None
+        # Result code of the first CONNACK, awaited by connect().
+        self.__connack = None
+        self.__misc_task = None
+        self.__reconnect_task = None
+        self.__min_reconnect_delay = min_reconnect_delay
+        self.__max_reconnect_delay = max_reconnect_delay
+        self.__closing = False
+        self.__dropped = 0
+        self.__health = _Cep2HealthTracker(self.__base_topics.all)
+        # zigbee2mqtt groups of each instance, see set_groups().
+        self.__groups: Dict[str, Dict[str, frozenset]] = {}
+
+    @property
+    def actuator_stats(self) -> Cep2ActuatorCacheStats:
+        return self.__actuator_cache.stats
+
+    @property
+    def dropped(self) -> int:
+        """ Number of messages discarded because the queue of received messages was full.
+        """
+        return self.__dropped
+
+    async def connect(self, timeout: float = 10) -> bool:
+        """ Connects to the MQTT broker and subscribes to the base topics. If the broker is not
+        reachable, refuses the connection or does not answer within the timeout, the client keeps
+        trying to connect in the background, like Cep2Zigbee2mqttClient.connect().
+
+        Args:
+            timeout (float, optional): seconds to wait for the broker to accept the connection.
+                Defaults to 10.
+
+        Returns:
+            bool: whether the client is connected.
+        """
+        if self.__misc_task is not None and not self.__misc_task.done():
+            return self.__connected.is_set()
+
+        self.__loop = asyncio.get_running_loop()
+        self.__loop_thread = get_ident()
+        self.__queue = asyncio.Queue(maxsize=self.__max_queue)
+        self.__connected = asyncio.Event()
+        self.__connack = self.__loop.create_future()
+        self.__closing = False
+        self.__misc_task = self.__loop.create_task(self.__misc())
+
+        # The socket is opened in the executor, and then registered in the event loop by
+        # __on_socket_open(). The base topics are subscribed by __on_connect().
+        try:
+            await self.__loop.run_in_executor(None, self.__client.connect, self.__host, self.__port)
+        except OSError as e:
+            print(f"MQTT broker not reachable ({e}), retrying in the background")
+            self.__start_reconnect()
+            return False
+
+        try:
+            # A refused connection is retried by __reconnect(), once the broker closes it.
+            await asyncio.wait_for(asyncio.shield(self.__connack), timeout)
+        except asyncio.TimeoutError:
+            print(f"MQTT broker did not answer in {timeout} seconds, retrying in the background")
+
+        return self.__connected.is_set()
+
+    async def disconnect(self) -> None:
+        self.__closing = True
+        self.__client.disconnect()
+        for task in (self.__misc_task, self.__reconnect_task):
+            if task:
+                task.cancel()
+        # Wake up the consumer, so that the iteration ends.
+        if self.__queue:
+            self.__put(None)
+
+    def change_state(self,
+                     device_id: str,
+                     state: str,
+                     color_x: float,
+                     color_y: float,
+                     force: bool = False,
+                     base_topic: Optional[str] = None) -> bool:
+        """ Sets the state and color of a light, see Cep2Zigbee2mqttClient.change_state(). This
+        function does not block: the message is written when the socket is ready. While the client
+        is not connected, the state is only recorded.
+        """
+        base_topic = base_topic or self.__base_topics.default
+        desired = Cep2ActuatorState(state, color_x, color_y)
+        if not self.__connected or not self.__connected.is_set():
+            self.__actuator_cache.set_desired(f"{base_topic}/{device_id}", desired)
+            return False
+
+        if not self.__actuator_cache.should_publish(f"{base_topic}/{device_id}",
+                                                    desired,
+                                                    force=force):
+            return False
+
+        self.__publish(f"{base_topic}/{device_id}/set", _state_payload(state, color_x, color_y))
+
+        return True
+
+    def send_command(self,
+                     device_id: str,
+                     command: Dict[str, Any],
+                     base_topic: Optional[str] = None) -> None:
+        """ Publishes a command to a device without going through the actuator cache, see
+        Cep2Zigbee2mqttClient.send_command(). Commands given while the client is not connected are
+        discarded.
+        """
+        if self.__connected and self.__connected.is_set():
+            self.__publish(f"{base_topic or self.__base_topics.default}/{device_id}/set",
+                           json.dumps(command))
+
+    def desired_state(self,
+                      device_id: str,
+                      base_topic: Optional[str] = None) -> Optional[Cep2ActuatorState]:
+        """ Returns the last state requested for an actuator with change_state(), or None.
+        """
+        base_topic = base_topic or self.__base_topics.default
+
+        return self.__actuator_cache.desired(f"{base_topic}/{device_id}")
+
+    def set_groups(self, groups: Dict[str, List[str]], base_topic: Optional[str] = None) -> None:
+        """ Declares the zigbee2mqtt groups of an instance, see Cep2Zigbee2mqttClient.set_groups().
+        """
+        self.__groups[base_topic or self.__base_topics.default] = \
+            {name: frozenset(members) for name, members in groups.items()}
+
+    def change_state_many(self,
+                          device_ids: List[str],
+                          state: str,
+                          color_x: float,
+                          color_y: float,
+                          force: bool = False,
+                          base_topic: Optional[str] = None) -> int:
+        """ Sets the same state and color to several lights, see
+        Cep2Zigbee2mqttClient.change_state_many(). The messages are written together when the
+        socket is ready.
+        """
+        base_topic = base_topic or self.__base_topics.default
+        desired = Cep2ActuatorState(state, color_x, color_y)
+        if not self.__connected or not self.__connected.is_set():
+            for device_id in device_ids:
+                self.__actuator_cache.set_desired(f"{base_topic}/{device_id}", desired)
+            return 0
+
+        return _publish_many(self.__actuator_cache,
+                             self.__groups.get(base_topic, {}),
+                             self.__publish,
+                             base_topic,
+                             list(device_ids),
+                             desired,
+                             force)
+
+    async def check_health(self, base_topic: Optional[str] = None, timeout: float = 5) -> str:
+        """ Checks whether zigbee2mqtt is healthy, using the client's connection. The response is
+        matched to the request by its transaction ID, see Cep2Zigbee2mqttClient.check_health().
+
+        Args:
+            base_topic (Optional[str], optional): base topic of the zigbee2mqtt instance to check.
+                Defaults to the first base topic.
+            timeout (float, optional): seconds to wait for the response. Defaults to 5.
+
+        Returns:
+            str: 'ok' or 'fail'.
+        """
+        future = self.__loop.create_future()
+        transaction, topic, payload = self.__health.request(base_topic or self.__base_topics.default,
+                                                            future.set_result)
+        self.__client.publish(topic=topic, payload=payload)
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.__health.timeout(transaction)
+            return "fail"
+
+    def health(self, base_topic: Optional[str] = None) -> Cep2HealthStatus:
+        """ Returns the cached health of a zigbee2mqtt instance, see Cep2Zigbee2mqttClient.health().
+        """
+        return self.__health.status(base_topic or self.__base_topics.default)
+
+    async def monitor_health(self, interval: float, timeout: float = 5) -> None:
+        """ Checks the health of all the zigbee2mqtt instances every interval seconds, until the
+        task is cancelled. Changes of the health are printed.
+        """
+        while True:
+            previous = {b: self.__health.status(b).status for b in self.__base_topics.all}
+            results = await asyncio.gather(*(self.check_health(b, timeout)
+                                             for b in self.__base_topics.all))
+            for base_topic, status in zip(self.__base_topics.all, results):
+                if status != previous[base_topic]:
+                    print(f"Zigbee2Mqtt {base_topic} is {status}")
+            await asyncio.sleep(interval)
+
+    def __publish(self, topic: str, payload: str) -> None:
+        self.__client.publish(topic=topic, payload=payload, qos=_QOS)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Cep2Zigbee2mqttMessage:
+        if self.__queue is None:
+            raise StopAsyncIteration
+
+        message = await self.__queue.get()
+        if message is None:
+            raise StopAsyncIteration
+
+        return message
+
+    def __put(self, message: Optional[Cep2Zigbee2mqttMessage]) -> None:
+        if self.__queue.full():
+            self.__queue.get_nowait()
+            self.__dropped += 1
+        self.__queue.put_nowait(message)
+
+    async def __misc(self) -> None:
+        # loop_misc() fails while the client is disconnected, until __reconnect() succeeds.
+        while not self.__closing:
+            self.__client.loop_misc()
+            await asyncio.sleep(self.MISC_INTERVAL)
+
+    def __start_reconnect(self) -> None:
+        if self.__reconnect_task is None or self.__reconnect_task.done():
+            self.__reconnect_task = self.__loop.create_task(self.__reconnect())
+
+    async def __reconnect(self) -> None:
+        delay = self.__min_reconnect_delay
+        while not self.__closing:
+            await asyncio.sleep(delay)
+            try:
+                await self.__loop.run_in_executor(None, self.__client.reconnect)
+                return
+            except OSError:
+                delay = min(delay * 2, self.__max_reconnect_delay)
+
+    def __in_loop(self, callback: Callable, *args) -> None:
+        # The socket callbacks are also called by connect() and reconnect(), in the executor.
+        if get_ident() == self.__loop_thread:
+            callback(*args)
+        else:
+            self.__loop.call_soon_threadsafe(callback, *args)
+
+    def __on_socket_open(self, client, userdata, sock) -> None:
+        self.__in_loop(self.__loop.add_reader, sock, client.loop_read)
+
+    def __on_socket_close(self, client, userdata, sock) -> None:
+        self.__in_loop(self.__loop.remove_reader, sock)
+
+    def __on_socket_register_write(self, client, userdata, sock) -> None:
+        self.__in_loop(self.__loop.add_writer, sock, client.loop_write)
+
+    def __on_socket_unregister_write(self, client, userdata, sock) -> None:
+        self.__in_loop(self.__loop.remove_writer, sock)
+
+    def __on_connect(self, client, userdata, flags, rc) -> None:
+        if not self.__connack.done():
+            self.__connack.set_result(rc)
+        if rc != 0:
+            print(f"MQTT connection refused ({rc})")
+            return
+
+        for t in self.__base_topics.subscriptions:
+            self.__client.subscribe(t, qos=_QOS)
+        self.__connected.set()
+        replayed = _replay_desired(self.__actuator_cache,
+                                   self.__groups,
+                                   self.__base_topics,
+                                   self.__publish)
+        print(f"MQTT client connected, {replayed} actuator states published")
+
+    def __on_disconnect(self, client, userdata, rc) -> None:
+        self.__connected.clear()
+        if self.__closing:
+            print("MQTT client disconnected")
+            return
+
+        print(f"MQTT client disconnected ({rc}), reconnecting")
+        self.__start_reconnect()
+
+    def __on_message(self, client, userdata, message: MQTTMessage) -> None:
+        timed = METRICS.enabled
+        if timed:
+            _CALLBACK_SECONDS.observe(monotonic() - message.timestamp)
+            start = perf_counter()
+
+        base_topic = self.__base_topics.resolve(message.topic)
+        if base_topic is None:
+            return
+
+        payload = _decode_payload(message.payload)
+
+        if "/bridge/" in message.topic and self.__health.handle(base_topic, message.topic, payload):
+            return
+
+        parsed = Cep2Zigbee2mqttMessage.parse(message.topic, payload, base_topic)
+        if parsed is None:
+            return
+        parsed.received_at = message.timestamp
+
+        if parsed.type_ == Cep2Zigbee2mqttMessageType.DEVICE_EVENT:
+            self.__actuator_cache.update_reported(f"{base_topic}/{parsed.device_id}", parsed.event)
+
+        if timed:
+            _PARSE_SECONDS.observe(perf_counter() - start)
+        self.__put(parsed)
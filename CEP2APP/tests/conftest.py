@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of the application are imported by their name, as when running from CEP2APP.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
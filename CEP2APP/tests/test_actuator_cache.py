@@ -0,0 +1,46 @@
+from Cep2ActuatorCache import Cep2ActuatorCache, Cep2ActuatorState
+
+_ON = Cep2ActuatorState("ON", 0.3, 0.3)
+
+
+def test_unchanged_states_are_suppressed():
+    cache = Cep2ActuatorCache()
+
+    assert cache.should_publish("light", _ON)
+    assert not cache.should_publish("light", Cep2ActuatorState("ON", 0.305, 0.295))
+    assert cache.should_publish("light", Cep2ActuatorState("ON", 0.5, 0.3))
+    assert cache.should_publish("light", Cep2ActuatorState("OFF"))
+    assert not cache.should_publish("light", Cep2ActuatorState("OFF", 0.1, 0.1))
+    assert cache.should_publish("light", Cep2ActuatorState("OFF"), force=True)
+    assert cache.stats.sent == 4
+    assert cache.stats.suppressed == 2
+
+
+def test_reported_state_different_from_desired_is_published_again():
+    cache = Cep2ActuatorCache(settle_time=0)
+    assert cache.should_publish("light", _ON)
+
+    cache.update_reported("light", {"state": "ON", "color": {"x": 0.3, "y": 0.3}})
+    assert not cache.should_publish("light", _ON)
+    # The command was lost: the device is still off.
+    cache.update_reported("light", {"state": "OFF"})
+    assert cache.reported("light") == Cep2ActuatorState("OFF")
+    assert cache.should_publish("light", _ON)
+
+
+def test_sensors_and_invalid_payloads_are_not_cached():
+    cache = Cep2ActuatorCache()
+    cache.update_reported("pir", {"occupancy": True})
+    assert cache.reported("pir") is None
+
+    cache.should_publish("light", _ON)
+    cache.update_reported("light", {"brightness": 10})
+    assert cache.reported("light") is None
+    assert cache.desired_states() == {"light": _ON}
+
+
+def test_refresh_interval():
+    cache = Cep2ActuatorCache(refresh_interval=0)
+
+    assert cache.should_publish("light", _ON)
+    assert cache.should_publish("light", _ON)
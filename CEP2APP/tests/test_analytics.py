@@ -0,0 +1,50 @@
+from datetime import datetime
+from Cep2Analytics import Cep2AdherenceAnalyzer
+
+TAKEN = Cep2AdherenceAnalyzer.TAKEN
+ROOM = Cep2AdherenceAnalyzer.ROOM_MOVEMENT
+
+
+def _ts(*args) -> float:
+    return datetime(*args).timestamp()
+
+
+def _analyzer() -> Cep2AdherenceAnalyzer:
+    return Cep2AdherenceAnalyzer({"patient": [(16, 18)]}, window_before=1, window_after=1)
+
+
+def test_doses_taken_on_time_and_late():
+    events = ([_ts(2024, 5, 16, 10), _ts(2024, 5, 16, 16, 18, 30), _ts(2024, 5, 17, 16, 40),
+               _ts(2024, 5, 18, 12)],
+              [ROOM, TAKEN, TAKEN, ROOM],
+              ["bedRoom", "pillboxSensor", "pillboxSensor", "bedRoom"])
+    report, = _analyzer().analyze(*events)
+    assert (report.doses, report.on_time, report.late, report.missed) == (2, 1, 1, 0)
+    assert report.ack_rooms == {"bedRoom": 2}
+
+
+def test_last_dose_is_not_attributed_to_the_previous_day():
+    # The window of the dose of the 17th did not end at the end of the period (the last event).
+    report, = _analyzer().analyze([_ts(2024, 5, 16, 10), _ts(2024, 5, 17, 16, 18)],
+                                  [ROOM, TAKEN],
+                                  ["bedRoom", "pillboxSensor"])
+    assert (report.doses, report.on_time, report.late, report.missed) == (1, 0, 0, 1)
+    assert len(report.lateness) == 0
+
+
+def test_event_before_the_next_window_belongs_to_the_previous_dose():
+    report, = _analyzer().analyze([_ts(2024, 5, 16, 10), _ts(2024, 5, 17, 16, 16)],
+                                  [ROOM, TAKEN],
+                                  ["bedRoom", "pillboxSensor"],
+                                  end=datetime(2024, 5, 18))
+    assert (report.doses, report.late, report.missed) == (2, 1, 1)
+
+
+def test_patients_without_events_are_reported():
+    analyzer = Cep2AdherenceAnalyzer({"patient": [(16, 18)], "other": [(8, 0)]})
+    reports = analyzer.analyze([_ts(2024, 5, 16, 10)], [ROOM], ["bedRoom"], ["home1"],
+                               end=datetime(2024, 5, 17))
+    by_patient = {r.patient_id: r for r in reports}
+    assert set(by_patient) == {"patient", "other"}
+    assert by_patient["other"].missed == 1
+    assert by_patient["other"].location == "home1"
@@ -0,0 +1,123 @@
+import asyncio
+import socket
+from time import monotonic
+from Cep2Zigbee2mqttClient import Cep2AsyncZigbee2mqttClient
+
+
+class _FakeBroker:
+    """ An MQTT broker that answers the CONNECT packets with the given result code (or not at all
+    if None) and ignores the other packets.
+    """
+
+    def __init__(self, port: int, rc=0):
+        self.port = port
+        self.rc = rc
+        self.connections = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.__handle, "127.0.0.1", self.port)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def __handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length |= (byte & 0x7f) << shift
+                    shift += 7
+                    if byte < 0x80:
+                        break
+                await reader.readexactly(length)
+                if header == 0x10 and self.rc is not None:
+                    writer.write(bytes([0x20, 2, 0, self.rc]))
+                    await writer.drain()
+                    if self.rc:
+                        break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _connected(client) -> bool:
+    return client._Cep2AsyncZigbee2mqttClient__connected.is_set()
+
+
+async def _until(condition, timeout: float = 5.0) -> bool:
+    deadline = monotonic() + timeout
+    while not condition():
+        if monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.02)
+    return True
+
+
+def test_unreachable_broker_is_retried_in_the_background():
+    async def run():
+        port = _free_port()
+        client = Cep2AsyncZigbee2mqttClient("127.0.0.1", port,
+                                            min_reconnect_delay=0.05, max_reconnect_delay=0.1)
+        assert not await client.connect(timeout=1)
+
+        broker = _FakeBroker(port)
+        await broker.start()
+        try:
+            assert await _until(lambda: _connected(client))
+            # While the client is started, connect() only reports the state of the connection.
+            assert await client.connect()
+        finally:
+            await client.disconnect()
+            await broker.stop()
+
+    asyncio.run(run())
+
+
+def test_refused_connection_does_not_hang():
+    async def run():
+        port = _free_port()
+        broker = _FakeBroker(port, rc=5)
+        await broker.start()
+        client = Cep2AsyncZigbee2mqttClient("127.0.0.1", port,
+                                            min_reconnect_delay=0.05, max_reconnect_delay=0.1)
+        try:
+            start = monotonic()
+            assert not await client.connect(timeout=5)
+            assert monotonic() - start < 1
+
+            broker.rc = 0
+            assert await _until(lambda: _connected(client))
+            assert broker.connections >= 2
+        finally:
+            await client.disconnect()
+            await broker.stop()
+
+    asyncio.run(run())
+
+
+def test_silent_broker_times_out():
+    async def run():
+        port = _free_port()
+        broker = _FakeBroker(port, rc=None)
+        await broker.start()
+        client = Cep2AsyncZigbee2mqttClient("127.0.0.1", port)
+        try:
+            start = monotonic()
+            assert not await client.connect(timeout=0.2)
+            assert monotonic() - start < 1
+        finally:
+            await client.disconnect()
+            await broker.stop()
+
+    asyncio.run(run())
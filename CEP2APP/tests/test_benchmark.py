@@ -0,0 +1,35 @@
+import argparse
+import json
+from Cep2Benchmark import BENCHMARKS, StageResult, compare_history
+
+
+def _args(**kwargs) -> argparse.Namespace:
+    args = dict(count=200, stream=None, devices=5, requests=5, batch_size=10, clients=1,
+                pipeline_count=100, history=None, max_regression=None)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def test_all_benchmarks_run_at_a_small_count(tmp_path, capsys):
+    history = tmp_path / "history.jsonl"
+    for name, benchmark in BENCHMARKS.items():
+        assert benchmark(_args(history=str(history))) is not False, name
+
+    output = capsys.readouterr().out
+    for stage in ("parse", "model.find", "HeucodEventSerializer", "send_events(10)", "pipeline"):
+        assert stage in output
+    run = json.loads(history.read_text())
+    assert {r["name"] for r in run["results"]} >= {"parse", "pipeline"}
+
+
+def test_regressions_fail_the_comparison(tmp_path):
+    path = str(tmp_path / "history.jsonl")
+    parameters = {"count": 200}
+    assert compare_history(path, parameters, [StageResult("parse", 200, 1000.0, 1.0, 2.0)], 10)
+
+    # Other parameters are not compared.
+    assert compare_history(path, {"count": 100}, [StageResult("parse", 100, 10.0, 1.0, 2.0)], 10)
+    assert compare_history(path, parameters, [StageResult("parse", 200, 950.0, 1.0, 2.1)], 10)
+    assert not compare_history(path, parameters, [StageResult("parse", 200, 800.0, 1.0, 2.0)], 10)
+    assert not compare_history(path, parameters, [StageResult("parse", 200, 800.0, 1.0, 3.0)], 10)
+    assert len(open(path).read().splitlines()) == 5
@@ -0,0 +1,85 @@
+import json
+import pytest
+from Cep2ConfigCache import Cep2ConfigCache
+from Cep2WebClient import Cep2ConfigResponse
+
+_URL = "http://server/retrieve_variables.php"
+
+
+class _FakeClient:
+    """ A server answering the conditional requests like retrieve_variables.php, recording the
+    validators it received.
+    """
+
+    host = _URL
+
+    def __init__(self, document):
+        self.up = True
+        self.requests = []
+        self.set(document)
+
+    def set(self, document, etag=None):
+        self.body = json.dumps(document).encode("utf-8")
+        self.etag = etag or f'"{len(self.requests)}-{hash(self.body)}"'
+
+    def retrieve_config(self, etag=None, last_modified=None):
+        self.requests.append(etag)
+        if not self.up:
+            raise ConnectionError("server down")
+        if etag == self.etag:
+            return Cep2ConfigResponse(status=304, etag=self.etag)
+        return Cep2ConfigResponse(status=200, body=self.body, etag=self.etag)
+
+
+def test_conditional_requests(tmp_path):
+    cache = Cep2ConfigCache(str(tmp_path / "cache.json"))
+    client = _FakeClient({"variable1": [16, 18], "variable2": 1, "variable3": 2})
+
+    assert cache.refresh(client) == (([16, 18], 1, 2), True)
+    # The ETag of the first response is sent, and the server answers 304.
+    assert cache.refresh(client) == (([16, 18], 1, 2), False)
+    assert client.requests == [None, client.etag]
+
+    # Same body with another ETag: not a change.
+    client.set({"variable1": [16, 18], "variable2": 1, "variable3": 2}, etag='"other"')
+    assert cache.refresh(client) == (([16, 18], 1, 2), False)
+    assert cache.entry(_URL).etag == '"other"'
+
+    client.set({"variable1": [9, 0], "variable2": 1, "variable3": 2})
+    assert cache.refresh(client) == (([9, 0], 1, 2), True)
+
+
+def test_cached_schedule_is_used_when_the_server_is_down(tmp_path):
+    path = str(tmp_path / "cache.json")
+    client = _FakeClient({"variable1": [16, 18], "variable2": 1, "variable3": 2})
+    Cep2ConfigCache(path).refresh(client)
+
+    # After a restart, the schedule is read from the file.
+    cache = Cep2ConfigCache(path)
+    assert cache.get(_URL) == ([16, 18], 1, 2)
+    client.up = False
+    assert cache.refresh(client) == (([16, 18], 1, 2), False)
+    assert Cep2ConfigCache(str(tmp_path / "missing.json")).refresh(client) == (None, False)
+
+
+@pytest.mark.parametrize("document", [{"variable1": [25, 0], "variable2": 1, "variable3": 1},
+                                      {"variable1": "16:18", "variable2": 1, "variable3": 1},
+                                      {"variable1": [16, 18], "variable2": "1", "variable3": 1},
+                                      {"variable1": {"patient": []}, "variable2": 1, "variable3": 1},
+                                      [16, 18]])
+def test_invalid_documents_are_not_cached(tmp_path, document):
+    path = str(tmp_path / "cache.json")
+    cache = Cep2ConfigCache(path)
+    client = _FakeClient({"variable1": [16, 18], "variable2": 1, "variable3": 2})
+    cache.refresh(client)
+
+    client.set(document)
+    assert cache.refresh(client) == (([16, 18], 1, 2), False)
+    assert Cep2ConfigCache(path).get(_URL) == ([16, 18], 1, 2)
+
+
+def test_invalid_cache_file_is_ignored(tmp_path):
+    path = tmp_path / "cache.json"
+    path.write_text(json.dumps([{"url": _URL, "variables": ["16:18", 1, 1]}]))
+
+    assert Cep2ConfigCache(str(path)).get(_URL) is None
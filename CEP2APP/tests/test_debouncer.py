@@ -0,0 +1,69 @@
+import json
+from Cep2Debouncer import Cep2EventDebouncer
+from Cep2Zigbee2mqttClient import (Cep2LazyPayload, Cep2Zigbee2mqttMessage,
+                                   Cep2Zigbee2mqttMessageType)
+
+
+def _report(device: str, at: float, base_topic: str = "zigbee2mqtt", **fields):
+    return Cep2Zigbee2mqttMessage(topic=f"{base_topic}/{device}",
+                                  type_=Cep2Zigbee2mqttMessageType.DEVICE_EVENT,
+                                  event=Cep2LazyPayload(json.dumps(fields)), device_id=device,
+                                  base_topic=base_topic, received_at=at)
+
+
+def test_repeated_values_are_forwarded_again_after_the_window():
+    debouncer = Cep2EventDebouncer(window=30)
+
+    assert debouncer.accept(_report("pir", 0, occupancy=True))
+    assert not debouncer.accept(_report("pir", 10, occupancy=True, battery=90))
+    assert not debouncer.accept(_report("pir", 29.9, occupancy=True))
+    assert debouncer.accept(_report("pir", 30, occupancy=True))
+    # The window starts again from the last forwarded report.
+    assert not debouncer.accept(_report("pir", 59, occupancy=True))
+    assert debouncer.accept(_report("pir", 60, occupancy=True))
+
+    stats = debouncer.stats
+    assert (stats.forwarded, stats.collapsed) == (3, 3)
+    assert stats.collapsed_by_device == {"zigbee2mqtt/pir": 3}
+
+
+def test_changes_are_always_forwarded():
+    debouncer = Cep2EventDebouncer(window=None)
+
+    assert debouncer.accept(_report("pillbox", 0, vibration=False))
+    assert debouncer.accept(_report("pillbox", 1, vibration=True))
+    assert not debouncer.accept(_report("pillbox", 1000, vibration=True))
+    # A change of any of the watched fields is forwarded.
+    assert debouncer.accept(_report("pillbox", 1001, vibration=True, occupancy=True))
+    assert debouncer.accept(_report("pillbox", 1002, vibration=False, occupancy=True))
+
+
+def test_devices_and_homes_are_debounced_separately():
+    debouncer = Cep2EventDebouncer(fields=("occupancy",))
+
+    assert debouncer.accept(_report("pir", 0, occupancy=True))
+    assert debouncer.accept(_report("pir", 1, "home2", occupancy=True))
+    assert debouncer.accept(_report("pir2", 1, occupancy=True))
+    assert not debouncer.accept(_report("pir", 2, "home2", occupancy=True))
+
+    debouncer.reset("home2/pir")
+    assert debouncer.accept(_report("pir", 3, "home2", occupancy=True))
+    assert not debouncer.accept(_report("pir", 3, occupancy=True))
+    debouncer.reset()
+    assert debouncer.accept(_report("pir", 4, occupancy=True))
+
+
+def test_other_messages_are_forwarded_without_decoding():
+    debouncer = Cep2EventDebouncer(fields=("vibration",))
+
+    assert debouncer.accept(_report("plug", 0, power=3))
+    assert debouncer.accept(_report("plug", 0, power=3))
+    # The payload is only searched for the fields: an invalid payload would fail to decode.
+    plug = _report("plug", 0)
+    plug.event = Cep2LazyPayload('{"power": 3, invalid')
+    assert debouncer.accept(plug)
+    state = Cep2Zigbee2mqttMessage(topic="zigbee2mqtt/bridge/state",
+                                   type_=Cep2Zigbee2mqttMessageType.BRIDGE_STATE, state="online")
+    assert debouncer.accept(state)
+    assert debouncer.accept(state)
+    assert debouncer.stats.forwarded == 0
@@ -0,0 +1,145 @@
+from threading import Event, Lock
+from time import monotonic, sleep
+from zlib import crc32
+from Cep2Dispatcher import Cep2Dispatcher, Cep2OverflowPolicy
+
+
+def _wait(condition, timeout: float = 5.0) -> bool:
+    deadline = monotonic() + timeout
+    while not condition():
+        if monotonic() > deadline:
+            return False
+        sleep(0.005)
+    return True
+
+
+def _keys_of_different_shards(workers: int):
+    keys = {}
+    for i in range(100):
+        keys.setdefault(crc32(f"device{i}".encode()) % workers, f"device{i}")
+    return list(keys.values())
+
+
+class _Recorder:
+    def __init__(self, blocked: str = None):
+        self.handled = []
+        self.lock = Lock()
+        self.release = Event()
+        self.started = Event()
+        self.blocked = blocked
+
+    def __call__(self, item):
+        key, value = item
+        if key == self.blocked and not self.release.is_set():
+            self.started.set()
+            self.release.wait(5)
+        with self.lock:
+            self.handled.append(item)
+
+
+def test_messages_of_a_device_are_handled_in_order():
+    recorder = _Recorder()
+    dispatcher = Cep2Dispatcher(recorder, workers=4)
+    dispatcher.start()
+    items = [(f"device{i % 5}", i) for i in range(200)]
+    for item in items:
+        dispatcher.submit(item[0], item)
+    assert _wait(lambda: dispatcher.stats.processed == 200)
+    dispatcher.stop()
+
+    for device in {k for k, _ in items}:
+        assert [v for k, v in recorder.handled if k == device] == \
+            [v for k, v in items if k == device]
+
+
+def test_blocked_device_does_not_delay_the_others():
+    slow, fast = _keys_of_different_shards(2)[:2]
+    recorder = _Recorder(blocked=slow)
+    dispatcher = Cep2Dispatcher(recorder, workers=2)
+    dispatcher.start()
+    dispatcher.submit(slow, (slow, 0))
+    assert recorder.started.wait(5)
+    dispatcher.submit(fast, (fast, 1))
+    assert _wait(lambda: (fast, 1) in recorder.handled)
+    assert (slow, 0) not in recorder.handled
+    assert dispatcher.device_lag() == {}
+
+    recorder.release.set()
+    assert _wait(lambda: len(recorder.handled) == 2)
+    dispatcher.stop()
+
+
+def test_handler_errors_do_not_stop_the_worker():
+    handled = []
+
+    def handler(item):
+        if item == "bad":
+            raise RuntimeError("bad message")
+        handled.append(item)
+
+    dispatcher = Cep2Dispatcher(handler, workers=1)
+    dispatcher.start()
+    for item in ("bad", "good"):
+        dispatcher.submit("device", item)
+    assert _wait(lambda: handled == ["good"])
+    dispatcher.stop()
+
+
+def test_overflow_policies():
+    for policy, expected in ((Cep2OverflowPolicy.DROP_NEWEST, [0, 1, 2]),
+                             (Cep2OverflowPolicy.DROP_OLDEST, [0, 3, 4]),
+                             (Cep2OverflowPolicy.COALESCE, [0, 1, 4])):
+        recorder = _Recorder(blocked="device")
+        dispatcher = Cep2Dispatcher(recorder, workers=1, max_queue=2, overflow_policy=policy)
+        dispatcher.start()
+        dispatcher.submit("device", ("device", 0))
+        assert recorder.started.wait(5)
+        # The worker is blocked with message 0: 1 and 2 fill the queue.
+        for value in (1, 2, 3, 4):
+            dispatcher.submit("device", ("device", value))
+
+        recorder.release.set()
+        assert _wait(lambda: dispatcher.stats.pending == 0 and
+                     len(recorder.handled) == len(expected))
+        dispatcher.stop()
+        assert [v for _, v in recorder.handled] == expected
+
+
+def test_full_queue_does_not_block_the_caller():
+    recorder = _Recorder(blocked="device")
+    dispatcher = Cep2Dispatcher(recorder, workers=1, max_queue=2)
+    dispatcher.start()
+    dispatcher.submit("device", ("device", 0))
+    assert recorder.started.wait(5)
+
+    start = monotonic()
+    for value in range(1, 100):
+        dispatcher.submit("device", ("device", value))
+    assert monotonic() - start < 1
+    assert dispatcher.stats.dropped == 97
+
+    recorder.release.set()
+    assert _wait(lambda: len(recorder.handled) == 3)
+    dispatcher.stop()
+
+
+def test_watched_messages_are_not_coalesced():
+    recorder = _Recorder(blocked="device")
+    dispatcher = Cep2Dispatcher(recorder, workers=1, max_queue=2,
+                                overflow_policy=Cep2OverflowPolicy.COALESCE,
+                                can_coalesce=lambda item: item[1] != "vibration")
+    dispatcher.start()
+    dispatcher.submit("device", ("device", "first"))
+    assert recorder.started.wait(5)
+    # The queue is full with a battery report and the pillbox being picked up.
+    dispatcher.submit("device", ("device", "battery"))
+    dispatcher.submit("device", ("device", "vibration"))
+    # A later report does not replace the vibration: the oldest report is dropped instead.
+    dispatcher.submit("device", ("device", "linkquality"))
+
+    recorder.release.set()
+    assert _wait(lambda: dispatcher.stats.pending == 0 and len(recorder.handled) == 3)
+    dispatcher.stop()
+    assert [v for _, v in recorder.handled] == ["first", "vibration", "linkquality"]
+    assert dispatcher.stats.dropped == 1
+    assert dispatcher.stats.coalesced == 0
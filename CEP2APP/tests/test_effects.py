@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta
+from Cep2ActuatorCache import Cep2ActuatorState
+from Cep2Effects import Cep2LightEffects
+from Cep2Scheduler import Cep2ManualClock, Cep2Scheduler
+
+
+class _FakeZigbee2mqttClient:
+    """ Records the commands of the effects, keeping the desired states like the real client.
+    """
+
+    def __init__(self):
+        self.commands = []
+        self.desired = {}
+
+    def change_state(self, device_id, state, color_x=None, color_y=None, force=False,
+                     base_topic=None):
+        self.desired[device_id] = Cep2ActuatorState(state, color_x, color_y)
+        self.commands.append((device_id, {"state": state, "color": (color_x, color_y)}))
+        return True
+
+    def send_command(self, device_id, command, base_topic=None):
+        self.commands.append((device_id, command))
+
+    def desired_state(self, device_id, base_topic=None):
+        return self.desired.get(device_id)
+
+
+def _effects(native_lights=()):
+    scheduler = Cep2Scheduler(Cep2ManualClock(datetime(2024, 5, 16, 9, 0)))
+    client = _FakeZigbee2mqttClient()
+    return Cep2LightEffects(client, scheduler, native_lights=native_lights), client, scheduler
+
+
+def test_blink_restores_the_desired_state():
+    effects, client, scheduler = _effects()
+    client.change_state("kitchenLight", "ON", 0.3, 0.3)
+    client.commands.clear()
+
+    effect = effects.blink("kitchenLight", times=2, period=timedelta(seconds=2))
+    assert effects.running("kitchenLight") is effect
+    scheduler.advance(timedelta(seconds=2.5))
+    assert [c.get("state") for _, c in client.commands] == ["ON", "OFF", "ON"]
+
+    scheduler.advance(timedelta(seconds=1.5))
+    assert effect.finished and not effect.running
+    assert effects.running("kitchenLight") is None
+    assert client.commands[-2:] == [("kitchenLight", {"state": "OFF"}),
+                                    ("kitchenLight", {"state": "ON", "color": (0.3, 0.3)})]
+
+    # A light that should be off is left off.
+    client.commands.clear()
+    effects.blink("bedLight", times=1)
+    scheduler.advance(timedelta(seconds=2))
+    assert client.commands[-1] == ("bedLight", {"state": "OFF"})
+
+
+def test_starting_an_effect_cancels_the_previous_one():
+    effects, client, scheduler = _effects()
+    blink = effects.blink("kitchenLight", times=5)
+    scheduler.advance(timedelta(seconds=1))
+    pulse = effects.pulse("kitchenLight", (0.5, 0.4), duration=timedelta(seconds=2))
+
+    assert blink.cancelled and not blink.running
+    client.commands.clear()
+    scheduler.advance(timedelta(seconds=10))
+    # Only the steps of the pulse are published, then the light is turned off again.
+    assert [c.get("brightness") for _, c in client.commands[:-1]] == [254, 40, 254]
+    assert client.commands[-1] == ("kitchenLight", {"state": "OFF"})
+    assert pulse.finished
+
+
+def test_cancel_does_not_restore_the_state():
+    effects, client, scheduler = _effects()
+    effects.blink("kitchenLight", times=3)
+    effects.blink("bedLight", times=3)
+    assert effects.cancel("kitchenLight")
+    assert not effects.cancel("kitchenLight")
+    effects.cancel_all()
+
+    client.commands.clear()
+    scheduler.advance(timedelta(minutes=1))
+    assert client.commands == []
+
+
+def test_ramp_keeps_the_final_color():
+    effects, client, scheduler = _effects()
+    effects.ramp("kitchenLight", (0.1, 0.1), (0.5, 0.3), timedelta(seconds=4), steps=4)
+    scheduler.advance(timedelta(seconds=4))
+
+    colors = [c["color"] for _, c in client.commands[:-1]]
+    assert colors == [{"x": 0.1, "y": 0.1}, {"x": 0.2, "y": 0.15},
+                      {"x": 0.1 + 0.4 * 0.5, "y": 0.2}, {"x": 0.4, "y": 0.25}]
+    assert client.desired["kitchenLight"] == Cep2ActuatorState("ON", 0.5, 0.3)
+
+
+def test_native_lights_run_the_effect_themselves():
+    effects, client, scheduler = _effects(native_lights=["hueLight"])
+    effects.blink("hueLight")
+    scheduler.advance(timedelta(seconds=5))
+    assert client.commands == [("hueLight", {"effect": "blink"})]
+
+    client.commands.clear()
+    effects.pulse("hueLight", (0.5, 0.4), duration=timedelta(seconds=30))
+    scheduler.advance(timedelta(seconds=1))
+    assert effects.cancel("hueLight")
+    assert client.commands == [("hueLight", {"effect": "breathe"}),
+                               ("hueLight", {"effect": "stop_effect"})]
@@ -0,0 +1,74 @@
+import os
+from datetime import datetime, timedelta
+import pytest
+from Cep2EventStore import Cep2EventStore
+
+_START = datetime(2024, 1, 1)
+
+
+class _Crash(Exception):
+    pass
+
+
+def _store(path, events: int = 10) -> Cep2EventStore:
+    store = Cep2EventStore(str(path), segment_capacity=4)
+    # Appended out of order, so compact() sorts them.
+    for i in reversed(range(events)):
+        store.append_record(_START + timedelta(hours=i), 1, f"device{i % 3}", i, "home")
+    return store
+
+
+def _hours(store: Cep2EventStore):
+    return [round((e.timestamp - _START).total_seconds() / 3600) for e in store.query()]
+
+
+def test_compact_sorts_and_removes_old_events(tmp_path):
+    store = _store(tmp_path)
+
+    assert store.compact(_START + timedelta(hours=4)) == 4
+    assert _hours(store) == list(range(4, 10))
+    assert store.segments == 2
+    assert [e.description for e in store.query(device_id="device1")] == [4, 7]
+    store.close()
+
+    reopened = Cep2EventStore(str(tmp_path), segment_capacity=4)
+    assert _hours(reopened) == list(range(4, 10))
+    assert not [n for n in os.listdir(tmp_path) if n.endswith(".tmp")]
+
+
+def test_compaction_interrupted_before_commit_keeps_old_segments(tmp_path, monkeypatch):
+    store = _store(tmp_path)
+    store.flush()
+
+    def crash(*args):
+        raise _Crash()
+
+    # The crash happens while the marker of the compaction is written, after the new segments.
+    monkeypatch.setattr("Cep2EventStore.json.dump", crash)
+    with pytest.raises(_Crash):
+        store.compact(_START + timedelta(hours=4))
+    monkeypatch.undo()
+    assert any(n.endswith(".tmp") for n in os.listdir(tmp_path))
+
+    reopened = Cep2EventStore(str(tmp_path), segment_capacity=4)
+    assert sorted(_hours(reopened)) == list(range(10))
+    assert not [n for n in os.listdir(tmp_path) if n.endswith(".tmp")]
+
+
+def test_compaction_interrupted_after_commit_is_completed(tmp_path, monkeypatch):
+    store = _store(tmp_path)
+
+    def crash(self):
+        raise _Crash()
+
+    # The crash happens right after the commit, before any segment is renamed or removed.
+    monkeypatch.setattr(Cep2EventStore, "_Cep2EventStore__recover", crash)
+    with pytest.raises(_Crash):
+        store.compact(_START + timedelta(hours=4))
+    monkeypatch.undo()
+    assert os.path.exists(tmp_path / Cep2EventStore.COMPACTION_FILE)
+
+    reopened = Cep2EventStore(str(tmp_path), segment_capacity=4)
+    assert _hours(reopened) == list(range(4, 10))
+    assert not os.path.exists(tmp_path / Cep2EventStore.COMPACTION_FILE)
+    assert not [n for n in os.listdir(tmp_path) if n.endswith(".tmp")]
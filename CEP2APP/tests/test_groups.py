@@ -0,0 +1,70 @@
+import json
+from time import monotonic, sleep
+from Cep2Replay import Cep2FakeBroker
+from Cep2Zigbee2mqttClient import Cep2Zigbee2mqttClient
+
+_GROUPS = {"downstairs": ["kitchenLight", "livingLight"],
+           "upstairs": ["bedLight", "bathLight"],
+           "house": ["kitchenLight", "livingLight", "bedLight", "bathLight"]}
+
+
+def _connected_client(broker: Cep2FakeBroker) -> Cep2Zigbee2mqttClient:
+    mqtt_client = broker.client()
+    client = Cep2Zigbee2mqttClient("localhost", lambda message: None, mqtt_client=mqtt_client,
+                                   base_topics=["zigbee2mqtt", "home2"])
+    client.set_groups(_GROUPS)
+    client.connect()
+    deadline = monotonic() + 5
+    while not mqtt_client.subscriptions and monotonic() < deadline:
+        sleep(0.005)
+
+    return client
+
+
+def _commands(broker: Cep2FakeBroker, since: int = 0):
+    return [(topic, json.loads(payload)["state"]) for _, topic, payload in broker.published[since:]
+            if topic.endswith("/set")]
+
+
+def test_groups_cover_the_most_lights():
+    broker = Cep2FakeBroker()
+    client = _connected_client(broker)
+    try:
+        assert client.change_state_many(["kitchenLight", "livingLight", "bedLight", "bathLight",
+                                         "reminderLight"], "ON", 0.3, 0.3) == 2
+        assert _commands(broker) == [("zigbee2mqtt/house/set", "ON"),
+                                     ("zigbee2mqtt/reminderLight/set", "ON")]
+
+        # Only the group whose members were all requested is used.
+        start = len(broker.published)
+        assert client.change_state_many(["kitchenLight", "livingLight", "bedLight"],
+                                        "OFF", 0, 0) == 2
+        assert _commands(broker, start) == [("zigbee2mqtt/downstairs/set", "OFF"),
+                                            ("zigbee2mqtt/bedLight/set", "OFF")]
+
+        # The lights that already have the state are not commanded, and a group is not used
+        # for a single light.
+        start = len(broker.published)
+        assert client.change_state_many(["kitchenLight", "livingLight", "bathLight"],
+                                        "OFF", 0, 0) == 1
+        assert _commands(broker, start) == [("zigbee2mqtt/bathLight/set", "OFF")]
+        assert client.change_state_many(["kitchenLight", "livingLight"], "OFF", 0, 0) == 0
+    finally:
+        client.disconnect()
+
+
+def test_groups_belong_to_their_instance():
+    broker = Cep2FakeBroker()
+    client = _connected_client(broker)
+    try:
+        assert client.change_state_many(["kitchenLight", "livingLight"], "ON", 0.3, 0.3,
+                                        base_topic="home2") == 2
+        assert _commands(broker) == [("home2/kitchenLight/set", "ON"),
+                                     ("home2/livingLight/set", "ON")]
+
+        client.set_groups({"downstairs": ["kitchenLight", "livingLight"]}, base_topic="home2")
+        assert client.change_state_many(["kitchenLight", "livingLight"], "OFF", 0, 0,
+                                        base_topic="home2") == 1
+        assert _commands(broker)[-1] == ("home2/downstairs/set", "OFF")
+    finally:
+        client.disconnect()
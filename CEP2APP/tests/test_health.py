@@ -0,0 +1,46 @@
+from queue import Queue
+import pytest
+from paho.mqtt.client import MQTTMessage
+from Cep2Zigbee2mqttClient import Cep2Zigbee2mqttClient, _Cep2HealthTracker
+
+_RESPONSE = "zigbee2mqtt/bridge/response/health_check"
+
+
+@pytest.mark.parametrize("payload", ["[]", '"ok"', "not json", "{\"data\": []}",
+                                     '{"status": "ok", "transaction": [1]}',
+                                     b"\xff\xfe".decode("utf-8", errors="replace")])
+def test_invalid_response_fails_the_check(payload):
+    tracker = _Cep2HealthTracker(["zigbee2mqtt"])
+    results = []
+    tracker.request("zigbee2mqtt", results.append)
+
+    assert tracker.handle("zigbee2mqtt", _RESPONSE, payload)
+    # A response without a (valid) transaction resolves the pending checks of its instance.
+    if "transaction" not in payload:
+        assert results == ["fail"]
+        assert tracker.status("zigbee2mqtt").status == "fail"
+
+
+def test_response_resolves_its_transaction():
+    tracker = _Cep2HealthTracker(["zigbee2mqtt"])
+    results = []
+    transaction, topic, _ = tracker.request("zigbee2mqtt", results.append)
+
+    assert topic == "zigbee2mqtt/bridge/request/health_check"
+    assert tracker.handle("zigbee2mqtt", _RESPONSE,
+                          f'{{"status": "ok", "data": {{"healthy": true}}, '
+                          f'"transaction": "{transaction}"}}')
+    assert results == ["ok"]
+
+
+def test_invalid_utf8_payload_does_not_raise():
+    received = Queue()
+    client = Cep2Zigbee2mqttClient("localhost", received.put)
+    for topic in (_RESPONSE, "zigbee2mqtt/kitchen_pir"):
+        message = MQTTMessage(topic=topic.encode())
+        message.payload = b"{\"occupancy\": \xff}"
+        client._Cep2Zigbee2mqttClient__on_message(None, None, message)
+
+    # The subscriber thread is not started: process the queued device message here.
+    client._Cep2Zigbee2mqttClient__process_message(message)
+    assert received.get_nowait().device_id == "kitchen_pir"
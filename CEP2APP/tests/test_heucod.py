@@ -0,0 +1,77 @@
+import json
+import random
+from datetime import datetime, timezone
+from uuid import UUID
+import pytest
+from Cep2Heucod import (HEUCOD_ATTRIBUTES, HeucodCompactEvent, HeucodEvent, HeucodEventJsonEncoder,
+                        HeucodEventSerializer, HeucodEventType, _snake_key)
+
+
+@pytest.mark.parametrize("key", ["items", "toJson", "fromEvent", "1x", "a-b", "a b"])
+def test_compact_event_with_invalid_slot_names(key):
+    document = {"id": "pir1", "location": "kitchen", key: 3}
+    event = HeucodCompactEvent.from_json(json.dumps(document))
+
+    assert event.id_ == "pir1"
+    assert event.location == "kitchen"
+    assert event.timestamp is None
+    assert dict(event.items())[_snake_key(key)] == 3
+    assert json.loads(event.to_json()) == document
+    assert event.to_event().location == "kitchen"
+    with pytest.raises(AttributeError):
+        event.location = "bedroom"
+
+
+def test_compact_event_with_names_of_the_class():
+    event = HeucodCompactEvent.create(_fields=1, __class__=2, location="kitchen")
+
+    assert dict(event.items()) == {"_fields": 1, "__class__": 2, "location": "kitchen"}
+    assert event == HeucodCompactEvent.create(_fields=1, __class__=2, location="kitchen")
+
+
+def test_compact_event_round_trip():
+    event = HeucodEvent()
+    event.id_ = "pir1"
+    event.event_type_enum = 82099
+    event.location = "kitchen"
+    compact = HeucodCompactEvent.from_event(event)
+
+    assert compact == HeucodCompactEvent.from_json(event.to_json())
+    assert compact.to_event().__dict__ == event.__dict__
+    assert compact.patient_id is None
+
+
+def _random_event(rng: random.Random) -> HeucodEvent:
+    values = [None, "kitchen", "", "k\u00f8kken", 0, -7, 3.25, True, False,
+              UUID(int=rng.getrandbits(128)), datetime(2024, 5, 16, 12, 0, tzinfo=timezone.utc),
+              datetime(2024, 5, 16, 12, 0, 30), HeucodEventType.RoomMovementEvent,
+              {"nested": [1, "two"]}, [0.5, None]]
+    event = HeucodEvent()
+    for attribute in rng.sample(sorted(HEUCOD_ATTRIBUTES), rng.randint(0, 12)):
+        setattr(event, attribute, rng.choice(values))
+
+    return event
+
+
+def test_serializer_produces_the_documents_of_the_encoder():
+    rng = random.Random(7)
+    serializer = HeucodEventSerializer()
+    for _ in range(500):
+        event = _random_event(rng)
+        expected = json.loads(json.dumps(event, cls=HeucodEventJsonEncoder))
+
+        assert json.loads(serializer.to_json(event)) == expected
+        assert json.loads(serializer.to_bytes(event)) == expected
+        assert json.loads(event.to_json()) == expected
+        assert json.loads(HeucodCompactEvent.from_event(event).to_json()) == expected
+
+
+def test_serializer_renames_the_attributes():
+    event = HeucodEvent()
+    event.id_ = UUID(int=1)
+    event.event_type_enum = 82099
+    event.patient_id = "p1"
+    event.sensor_rtc_clock = None
+
+    assert json.loads(HeucodEventSerializer().to_json(event)) == \
+        {"id": str(UUID(int=1)), "eventTypeEnum": 82099, "patientId": "p1"}
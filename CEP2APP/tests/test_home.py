@@ -0,0 +1,100 @@
+import json
+from datetime import datetime, timedelta
+from Cep2Controller import Cep2Controller
+from Cep2Debouncer import Cep2EventDebouncer
+from Cep2Home import Cep2Home
+from Cep2Model import Cep2Model, Cep2ZigbeeDevice
+from Cep2Scheduler import Cep2ManualClock, Cep2Scheduler
+from Cep2Zigbee2mqttClient import Cep2Zigbee2mqttMessage, Cep2Zigbee2mqttMessageType
+
+
+class _FakeZigbee2mqttClient:
+    def __init__(self):
+        self.states = []
+
+    def set_groups(self, groups, base_topic=None):
+        pass
+
+    def change_state(self, device_id, state, **kwargs):
+        self.states.append((device_id, state))
+        return True
+
+
+class _FakeUplink:
+    def __init__(self):
+        self.events = []
+
+    def enqueue(self, event):
+        self.events.append(json.loads(event))
+
+
+def _occupancy(room: str, received_at: float = None) -> Cep2Zigbee2mqttMessage:
+    return Cep2Zigbee2mqttMessage(topic=f"zigbee2mqtt/{room}",
+                                  type_=Cep2Zigbee2mqttMessageType.DEVICE_EVENT,
+                                  event={"occupancy": True}, device_id=room,
+                                  received_at=received_at)
+
+
+def test_events_have_the_time_of_the_scheduler():
+    start = datetime(2024, 5, 16, 9, 30)
+    scheduler = Cep2Scheduler(Cep2ManualClock(start))
+    model = Cep2Model()
+    model.add([Cep2ZigbeeDevice("bedRoom", "pir")])
+    home = Cep2Home("home", model)
+    uplink = _FakeUplink()
+    home.attach(_FakeZigbee2mqttClient(), uplink, scheduler)
+
+    home.handle_message(_occupancy("bedRoom"))
+
+    assert len(uplink.events) == 1
+    assert uplink.events[0]["timestamp"] == start.isoformat()
+    assert uplink.events[0]["location"] == "home"
+    assert uplink.events[0]["deviceModel"] == "pir"
+
+
+def test_debounced_motion_reports_keep_the_patient_in_the_room():
+    start = datetime(2024, 5, 16, 9, 30)
+    scheduler = Cep2Scheduler(Cep2ManualClock(start))
+    model = Cep2Model()
+    model.add([Cep2ZigbeeDevice("bedRoom", "pir"), Cep2ZigbeeDevice("livingRoom", "pir")])
+    home = Cep2Home("home", model)
+    uplink = _FakeUplink()
+    home.attach(_FakeZigbee2mqttClient(), uplink, scheduler)
+    debouncer = Cep2EventDebouncer(Cep2Controller.DEBOUNCE_FIELDS, Cep2Controller.DEBOUNCE_WINDOW)
+
+    # The patient stays in the bedroom, whose sensor reports every 2 seconds. The sensor of the
+    # living room reports once by mistake.
+    reports = [(t, "bedRoom") for t in range(0, 80, 2)] + [(41, "livingRoom")]
+    for t, room in sorted(reports):
+        scheduler.advance(start + timedelta(seconds=t) - scheduler.now())
+        message = _occupancy(room, received_at=t)
+        if debouncer.accept(message):
+            home.handle_message(message)
+        assert home.currentRoom == "bedRoom"
+    scheduler.advance(timedelta(minutes=1))
+
+    assert home.currentRoom == "bedRoom"
+    # Only the first report of the bedroom is a room change.
+    assert len(uplink.events) == 1
+
+
+def test_schedule_of_the_server_keeps_the_schedules_of_the_patients():
+    scheduler = Cep2Scheduler(Cep2ManualClock(datetime(2024, 5, 16, 7, 0)))
+    home = Cep2Home("home", Cep2Model(),
+                    medication_times={"patient": [(8, 0), (20, 0)], "p2": [(9, 0)]})
+    home.attach(_FakeZigbee2mqttClient(), _FakeUplink(), scheduler)
+
+    # A single time does not say which patient or dose it is.
+    home.update_schedule([16, 18], 5, 10)
+    assert home.reminder("patient").doses == [(8, 0), (20, 0)]
+    assert home.reminder("p2").doses == [(9, 0)]
+    assert home.timeWindowAfter == 10
+
+    home.update_schedule({"p2": [[10, 30], [22, 0]]}, 5, 10)
+    assert home.reminder("patient").doses == [(8, 0), (20, 0)]
+    assert home.reminder("p2").doses == [(10, 30), (22, 0)]
+
+    single = Cep2Home("single", Cep2Model(), medication_times={"patient": [(8, 0)]})
+    single.attach(_FakeZigbee2mqttClient(), _FakeUplink(), scheduler)
+    single.update_schedule([16, 18], 1, 1)
+    assert single.reminder("patient").doses == [(16, 18)]
@@ -0,0 +1,62 @@
+import json
+import pytest
+import requests
+from Cep2Heucod import _SNAKE_KEYS
+from Cep2IngestServer import Cep2IngestServer, parse_events
+from Cep2WebClient import Cep2WebClient, Cep2WebDeviceEvent
+from Cep2WireFormat import CONTENT_TYPE as BINARY_CONTENT_TYPE, encode_batch
+
+_EVENT = {"id": "pir1", "eventTypeEnum": 82099, "timestamp": "2024-01-01T10:00:00",
+          "location": "home", "description": True}
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = Cep2IngestServer(str(tmp_path / "events.db"), port=0)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.mark.parametrize("wire_format", ["json", "binary"])
+def test_events_are_stored(server, wire_format):
+    client = Cep2WebClient(server.url, wire_format=wire_format)
+    events = [Cep2WebDeviceEvent("pir1", "pir", True, 82099, "home").to_heucod()
+              for _ in range(3)]
+    try:
+        assert client.send_event(events[0]) == 200
+        assert client.send_events(events[1:]) == 200
+    finally:
+        client.close()
+
+    assert server.count("home") == 3
+    assert server.stats.events == 3
+
+
+@pytest.mark.parametrize("change", [{"eventTypeEnum": None}, {"timestamp": None},
+                                    {"id": None, "location": None}, {"unknownKey": 1}])
+def test_invalid_events_are_rejected(server, change):
+    event = {k: v for k, v in {**_EVENT, **change}.items() if v is not None}
+    response = requests.post(server.url, data=json.dumps([_EVENT, event]),
+                             headers={"Content-Type": "application/json"})
+
+    assert response.status_code == 400
+    assert server.count() == 0
+    assert server.stats.rejected == 1
+
+
+def test_truncated_binary_batch_is_rejected(server):
+    body = encode_batch([json.dumps(_EVENT)])
+    for end in range(len(body)):
+        response = requests.post(server.url, data=body[:end],
+                                 headers={"Content-Type": BINARY_CONTENT_TYPE})
+        assert response.status_code == 400
+    assert server.count() == 0
+
+
+def test_unknown_keys_are_not_cached():
+    for i in range(100):
+        with pytest.raises(ValueError):
+            parse_events(json.dumps({**_EVENT, f"key{i}": i}).encode(), "application/json")
+
+    assert not [k for k in _SNAKE_KEYS if k.startswith("key")]
@@ -0,0 +1,60 @@
+import urllib.error
+import urllib.request
+import pytest
+from Cep2Metrics import Cep2Histogram, Cep2Metrics
+
+
+def test_quantiles_are_interpolated_in_their_bucket():
+    histogram = Cep2Histogram("h", "help", buckets=(1, 2, 4))
+    assert histogram.quantile(0.5) is None
+
+    for value in (0.5, 0.5, 1.5, 1.5):
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == 1.0
+    assert histogram.quantile(0.75) == 1.5
+    assert histogram.snapshot() == ([2, 4, 4, 4], 4.0, 4)
+
+    # The values above the last bound are reported as the last bound.
+    for _ in range(4):
+        histogram.observe(100)
+    assert histogram.quantile(0.99) == 4
+    histogram.reset()
+    assert histogram.snapshot() == ([0, 0, 0, 0], 0.0, 0)
+
+
+def test_render_in_the_prometheus_format():
+    metrics = Cep2Metrics()
+    histogram = metrics.histogram("cep2_test_seconds", "Test stage", buckets=(0.001, 0.01))
+    assert metrics.histogram("cep2_test_seconds", "Other help") is histogram
+    histogram.observe(0.001)
+    histogram.observe(0.5)
+    metrics.gauge("cep2_queue", "Queue depth", lambda: 3)
+    metrics.gauge("cep2_broken", "Broken gauge", lambda: 1 / 0)
+
+    assert metrics.render().splitlines() == [
+        "# HELP cep2_test_seconds Test stage",
+        "# TYPE cep2_test_seconds histogram",
+        'cep2_test_seconds_bucket{le="0.001"} 1',
+        'cep2_test_seconds_bucket{le="0.01"} 1',
+        'cep2_test_seconds_bucket{le="+Inf"} 2',
+        "cep2_test_seconds_sum 0.501",
+        "cep2_test_seconds_count 2",
+        "# HELP cep2_queue Queue depth",
+        "# TYPE cep2_queue gauge",
+        "cep2_queue 3",
+    ]
+    assert metrics.summary().startswith("cep2_test_seconds: n=2 p50=1.000ms")
+
+
+def test_metrics_endpoint():
+    metrics = Cep2Metrics()
+    metrics.histogram("cep2_test_seconds", "Test stage").observe(0.002)
+    port = metrics.serve(0)
+    try:
+        assert metrics.enabled
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert "cep2_test_seconds_count 1" in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/other")
+    finally:
+        metrics.stop()
@@ -0,0 +1,50 @@
+import dataclasses
+import pytest
+from Cep2Model import Cep2Model, Cep2ModelChange, Cep2ZigbeeDevice
+
+
+def _model() -> Cep2Model:
+    model = Cep2Model()
+    model.add([Cep2ZigbeeDevice("bedRoom", "pir", "bedroom"),
+               Cep2ZigbeeDevice("bedLight", "led", "bedroom"),
+               Cep2ZigbeeDevice("kitchenLight", "led", "kitchen"),
+               Cep2ZigbeeDevice("pillboxSensor", "vibration sensor")])
+    return model
+
+
+def test_indexes():
+    model = _model()
+
+    assert [d.id_ for d in model.find_by_type("led")] == ["bedLight", "kitchenLight"]
+    assert [d.id_ for d in model.find_by_room("bedroom")] == ["bedRoom", "bedLight"]
+    assert [d.id_ for d in model.actuators_list] == ["bedLight", "kitchenLight"]
+    assert [d.id_ for d in model.sensors_list] == ["bedRoom"]
+    assert model.rooms == ["bedroom", "kitchen"]
+    assert model.find_by_type("power plug") == []
+    assert model.find("pillboxSensor").type_ == "vibration sensor"
+
+
+def test_replacing_and_removing_devices_update_the_indexes():
+    model = _model()
+    changes = []
+    model.subscribe(lambda change, device: changes.append((change, device.id_)))
+
+    moved = dataclasses.replace(model.find("kitchenLight"), room="bedroom")
+    model.add([moved, Cep2ZigbeeDevice("plug", "power plug", "kitchen")])
+    assert [d.id_ for d in model.find_by_room("bedroom")] == ["bedRoom", "bedLight", "kitchenLight"]
+    assert [d.id_ for d in model.find_by_room("kitchen")] == ["plug"]
+
+    model.remove(["plug", "bedRoom", "unknown"])
+    assert model.rooms == ["bedroom"]
+    assert model.find_by_type("pir") == []
+    assert "plug" not in model
+    assert len(model) == 3
+    assert changes == [(Cep2ModelChange.UPDATED, "kitchenLight"), (Cep2ModelChange.ADDED, "plug"),
+                       (Cep2ModelChange.REMOVED, "plug"), (Cep2ModelChange.REMOVED, "bedRoom")]
+
+
+def test_devices_are_immutable():
+    model = _model()
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        model.find("bedLight").room = "kitchen"
+    assert [d.id_ for d in model.find_by_room("bedroom")] == ["bedRoom", "bedLight"]
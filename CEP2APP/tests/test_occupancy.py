@@ -0,0 +1,53 @@
+import pytest
+from Cep2Occupancy import Cep2OccupancyEngine
+
+
+def test_first_report_sets_the_room():
+    engine = Cep2OccupancyEngine()
+    assert engine.observe("bedRoom", 0) == "bedRoom"
+    assert engine.most_likely == "bedRoom"
+
+
+def test_stray_report_is_cancelled_by_the_current_room():
+    engine = Cep2OccupancyEngine(dwell=5)
+    engine.observe("bedRoom", 0)
+    engine.observe("bedRoom", 10)
+    assert engine.observe("livingRoom", 12) is None
+    assert engine.pending == "livingRoom"
+    assert engine.observe("bedRoom", 14) is None
+    assert engine.pending is None
+    assert engine.evaluate(20) is None
+    assert engine.most_likely == "bedRoom"
+    assert engine.stats.rejected == 1
+
+
+def test_move_is_confirmed_after_the_dwell_time():
+    engine = Cep2OccupancyEngine(dwell=5)
+    engine.observe("bedRoom", 0)
+    assert engine.observe("livingRoom", 20) is None
+    assert engine.pending_deadline == 25
+    assert engine.evaluate(22) is None
+    assert engine.evaluate(25) == "livingRoom"
+    assert engine.most_likely == "livingRoom"
+
+
+def test_sensors_of_a_room_are_fused():
+    engine = Cep2OccupancyEngine(sensor_weights={"a": 0.3, "b": 0.3}, dwell=0)
+    assert engine.observe("kitchen", 0, "a") is None
+    assert engine.observe("kitchen", 1, "b") == "kitchen"
+    assert engine.confidence("kitchen") == pytest.approx(0.51, abs=0.01)
+
+
+def test_long_absence_does_not_break_the_engine():
+    engine = Cep2OccupancyEngine(half_life=300)
+    engine.observe("bedRoom", 0)
+    # More than 1074 half lives without reports: the scale would underflow.
+    assert engine.observe("livingRoom", 4 * 86400) is None
+    assert engine.observe("livingRoom", 4 * 86400 + 1) is None
+    assert engine.evaluate(4 * 86400 + 10) == "livingRoom"
+    assert engine.confidence("bedRoom") == 0
+
+
+def test_invalid_weights_are_rejected():
+    with pytest.raises(ValueError):
+        Cep2OccupancyEngine(default_weight=1)
@@ -0,0 +1,48 @@
+import json
+from datetime import datetime
+from Cep2Replay import load_timed_stream, percentiles, replay
+
+
+def test_replay_during_a_medication_window():
+    # The default schedule of the home is 16:18, with 1 minute windows: the patient is reminded
+    # from the start. The messages are handled in parallel, so the simulated time does not move.
+    occupancy = json.dumps({"occupancy": True, "battery": 100, "linkquality": 80})
+    vibration = json.dumps({"vibration": True})
+    stream = [(0, "zigbee2mqtt/bedRoom", occupancy),
+              (0, "zigbee2mqtt/bridge/state", "online"),
+              (0, "zigbee2mqtt/plug", json.dumps({"power": 3})),
+              (0, "zigbee2mqtt/bedRoom", occupancy),
+              (0, "zigbee2mqtt/pillboxSensor", vibration),
+              (0, "zigbee2mqtt/pillboxSensor", vibration)]
+
+    report = replay(stream, start=datetime(2024, 5, 16, 16, 17, 30))
+
+    assert report.messages == 6
+    # The repeated vibration is discarded before reaching the home.
+    assert report.handled == 5
+    assert report.collapsed == 1
+    assert report.dropped == 0
+    # The patient entered the bedroom and took the medication.
+    assert report.events_sent == 2
+    # The lights of the reminder were turned on, and off once the medication was taken.
+    assert report.commands >= 2
+    assert set(report.latency) == {50, 90, 99, 99.9}
+
+
+def test_recording_with_and_without_times(tmp_path):
+    path = tmp_path / "recording.jsonl"
+    path.write_text('{"topic": "zigbee2mqtt/pir", "payload": "{}", "time": 1.5}\n\n'
+                    '{"topic": "zigbee2mqtt/pir", "payload": "{}", "time": 3}\n')
+    assert load_timed_stream(str(path), rate=100) == [(1.5, "zigbee2mqtt/pir", "{}"),
+                                                      (3.0, "zigbee2mqtt/pir", "{}")]
+
+    path.write_text('{"topic": "zigbee2mqtt/a", "payload": "1"}\n'
+                    '{"topic": "zigbee2mqtt/b", "payload": "2"}\n')
+    assert load_timed_stream(str(path), rate=4) == [(0.0, "zigbee2mqtt/a", "1"),
+                                                    (0.25, "zigbee2mqtt/b", "2")]
+
+
+def test_percentiles():
+    values = list(range(1, 101))
+    assert percentiles(values, (50, 99, 100)) == {50: 51, 99: 100, 100: 100}
+    assert all(v != v for v in percentiles([]).values())
@@ -0,0 +1,110 @@
+from datetime import datetime
+import pytest
+from Cep2Reminder import Cep2ReminderPhase
+from Cep2Rules import Cep2RuleError, Cep2RuleSet, default_rules
+
+
+class _Reminder:
+    def __init__(self, phase: Cep2ReminderPhase):
+        self.phase = phase
+        self.dose = datetime(2024, 5, 16, 10, 0)
+
+    @property
+    def in_window(self) -> bool:
+        return self.phase in (Cep2ReminderPhase.PRE_WINDOW, Cep2ReminderPhase.DUE,
+                              Cep2ReminderPhase.OVERDUE)
+
+
+class _Home:
+    """ The target of the rules, recording the actions.
+    """
+
+    def __init__(self, phase=Cep2ReminderPhase.IDLE, now=datetime(2024, 5, 16, 10, 0)):
+        self.reminders = {"patient": _Reminder(phase)}
+        self.time = now
+        self.actions = []
+
+    def reminder(self, patient):
+        return self.reminders.get(patient)
+
+    def now(self):
+        return self.time
+
+    def set_light(self, light, state, color_x, color_y):
+        self.actions.append(("set_light", light, state))
+
+    def blink(self, light):
+        self.actions.append(("blink", light))
+
+    def take_medication(self, patient):
+        self.actions.append(("take_medication", patient))
+        # Ends the window, like Cep2MedicationReminder.mark_taken().
+        self.reminders[patient].phase = Cep2ReminderPhase.TAKEN
+        return True
+
+    def enter_room(self, room, sensor):
+        self.actions.append(("enter_room", room))
+        return room != "bedRoom"
+
+
+def _fire(rules, device, event, home):
+    fired = rules.match(device, event, home)
+    sent = []
+    for rule, value in fired:
+        if rule.execute(home, device, value) and rule.heucod_code is not None:
+            sent.append((rule.heucod_code, rule.description(value)))
+    return sent
+
+
+def test_default_rules():
+    rules = Cep2RuleSet.from_config(default_rules({"bedRoom": "bedLight",
+                                                   "livingRoom": "livingLight"},
+                                                  {"pillboxSensor": "patient"}, "kitchenLight"))
+    assert sorted(rules.devices) == ["bedRoom", "livingRoom", "pillboxSensor"]
+
+    home = _Home(Cep2ReminderPhase.DUE)
+    # The conditions are evaluated before the actions: taking the medication does not make the
+    # "moved outside window" rule fire too.
+    assert _fire(rules, "pillboxSensor", {"vibration": True}, home) == [(82295, "Medication taken")]
+    assert home.actions == [("take_medication", "patient")]
+    assert _fire(rules, "pillboxSensor", {"vibration": True}, home) == \
+        [(81493, "Pillbox moved outside window")]
+    assert _fire(rules, "pillboxSensor", {"vibration": False}, home) == []
+
+    # enter_room reports that the room did not change: no event.
+    assert _fire(rules, "livingRoom", {"occupancy": True}, home) == [(82099, True)]
+    assert _fire(rules, "bedRoom", {"occupancy": True}, home) == []
+    assert _fire(rules, "unknownSensor", {"occupancy": True}, home) == []
+
+
+def test_conditions():
+    rules = Cep2RuleSet.from_config({"rules": [
+        {"name": "night", "device": "door", "attribute": "contact", "equals": False,
+         "when": [{"time": {"from": "22:00", "to": "06:00"}}],
+         "do": [{"action": "set_light", "light": "hall", "state": "ON", "color": [0.3, 0.3]}]},
+        {"name": "late", "device": "door", "attribute": "contact", "equals": False,
+         "when": [{"phase": ["OVERDUE"], "patient": "patient"},
+                  {"dose": {"before": 0, "after": 30}, "patient": "patient"}],
+         "do": [{"action": "blink", "light": "hall"}]}]})
+
+    assert [r.name for r, _ in rules.match("door", {"contact": False},
+                                            _Home(now=datetime(2024, 5, 16, 23, 0)))] == ["night"]
+    assert rules.match("door", {"contact": True}, _Home(now=datetime(2024, 5, 16, 23, 0))) == []
+    assert [r.name for r, _ in rules.match("door", {"contact": False},
+                                            _Home(Cep2ReminderPhase.OVERDUE,
+                                                  datetime(2024, 5, 16, 10, 20)))] == ["late"]
+
+
+@pytest.mark.parametrize("spec", [{"attribute": "occupancy"},
+                                  {"device": "pir"},
+                                  {"device": "pir", "attribute": "occupancy",
+                                   "when": [{"window": "sometimes", "patient": "p"}]},
+                                  {"device": "pir", "attribute": "occupancy",
+                                   "when": [{"phase": ["LATE"], "patient": "p"}]},
+                                  {"device": "pir", "attribute": "occupancy",
+                                   "do": [{"action": "dance"}]},
+                                  {"device": "pir", "attribute": "occupancy",
+                                   "heucod": {"code": "not a number"}}])
+def test_invalid_rules(spec):
+    with pytest.raises(Cep2RuleError):
+        Cep2RuleSet.from_config({"rules": [spec]})
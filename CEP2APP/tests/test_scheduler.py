@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+import pytest
+from Cep2Reminder import Cep2MedicationReminder, Cep2ReminderPhase
+from Cep2Scheduler import Cep2ManualClock, Cep2Scheduler
+
+_START = datetime(2024, 5, 16, 9, 50)
+
+
+def _scheduler() -> Cep2Scheduler:
+    return Cep2Scheduler(Cep2ManualClock(_START))
+
+
+def test_advance_runs_the_callbacks_at_their_deadlines():
+    scheduler = _scheduler()
+    executed = []
+    for minutes in (3, 1, 2):
+        scheduler.schedule_in(timedelta(minutes=minutes),
+                              lambda m=minutes: executed.append((m, scheduler.now())))
+    scheduler.schedule_in(timedelta(minutes=2), lambda: executed.append("cancelled")).cancel()
+
+    assert scheduler.advance(timedelta(minutes=2)) == 2
+    assert executed == [(1, _START + timedelta(minutes=1)), (2, _START + timedelta(minutes=2))]
+    assert scheduler.next_deadline() == _START + timedelta(minutes=3)
+    assert scheduler.advance(timedelta(hours=1)) == 1
+    assert scheduler.now() == _START + timedelta(hours=1, minutes=2)
+
+
+def test_manual_clock_can_not_go_backwards():
+    clock = Cep2ManualClock(_START)
+    with pytest.raises(ValueError):
+        clock.set(_START - timedelta(seconds=1))
+
+
+def test_reminder_phases_of_a_dose():
+    scheduler = _scheduler()
+    changes = []
+    reminder = Cep2MedicationReminder("patient", scheduler, lambda r, p: changes.append(p),
+                                      [(10, 0)], window_before=5, window_after=5)
+    reminder.start()
+    assert reminder.phase == Cep2ReminderPhase.IDLE
+    assert not reminder.mark_taken()
+
+    scheduler.advance(timedelta(minutes=5))
+    assert reminder.phase == Cep2ReminderPhase.PRE_WINDOW
+    scheduler.advance(timedelta(minutes=5))
+    assert reminder.phase == Cep2ReminderPhase.DUE
+    scheduler.advance(timedelta(minutes=5))
+    assert reminder.phase == Cep2ReminderPhase.OVERDUE
+    assert changes == [Cep2ReminderPhase.PRE_WINDOW, Cep2ReminderPhase.DUE,
+                       Cep2ReminderPhase.OVERDUE]
+
+    assert reminder.mark_taken()
+    assert reminder.phase == Cep2ReminderPhase.TAKEN
+    assert reminder.dose == datetime(2024, 5, 17, 10, 0)
+    # The window of the next dose starts the next day.
+    scheduler.advance(timedelta(hours=23, minutes=49))
+    assert reminder.phase == Cep2ReminderPhase.TAKEN
+    scheduler.advance(timedelta(minutes=1))
+    assert reminder.phase == Cep2ReminderPhase.PRE_WINDOW
+
+
+def test_reminder_schedule_change():
+    scheduler = _scheduler()
+    reminder = Cep2MedicationReminder("patient", scheduler, lambda r, p: None, [(10, 0)])
+    reminder.start()
+    reminder.set_schedule([(9, 52)], 5, 5)
+
+    assert reminder.phase == Cep2ReminderPhase.PRE_WINDOW
+    assert reminder.dose == datetime(2024, 5, 16, 9, 52)
+    with pytest.raises(ValueError):
+        reminder.set_schedule([], 5, 5)
@@ -0,0 +1,265 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Event, Lock, Thread, get_ident
+from time import monotonic, sleep
+from Cep2WebClient import Cep2AsyncWebUplink, Cep2WebClient, Cep2WebUplink
+
+
+def _event(i: int) -> str:
+    return json.dumps({"id": f"event{i}"})
+
+
+class _FakeClient:
+    """ A web client whose server can be taken down and up, recording the events delivered.
+    """
+
+    def __init__(self, status: int = 200):
+        self.up = False
+        self.status = status
+        # Answers given before status, as (status, Retry-After seconds).
+        self.answers = []
+        self.retry_after = None
+        self.attempts = []
+        self.received = []
+        self.lock = Lock()
+
+    def send_events(self, events):
+        with self.lock:
+            if not self.up:
+                raise ConnectionError("server down")
+            self.attempts.append(monotonic())
+            status, self.retry_after = self.answers.pop(0) if self.answers else (self.status, None)
+            if 200 <= status < 300:
+                self.received.extend(json.loads(e)["id"] for e in events)
+            return status
+
+
+class _FakeAsyncClient(_FakeClient):
+    async def send_events(self, events):
+        return _FakeClient.send_events(self, events)
+
+    async def close(self):
+        pass
+
+
+def _wait(condition, timeout: float = 5.0) -> bool:
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if condition():
+            return True
+        sleep(0.005)
+    return condition()
+
+
+def _uplink(client, spool_path, **kwargs) -> Cep2WebUplink:
+    return Cep2WebUplink(client, spool_path=spool_path, batch_size=2, flush_interval=0.01,
+                         backoff_initial=0.01, backoff_max=0.02, **kwargs)
+
+
+def test_overflow_while_server_down_keeps_events_in_spool(tmp_path):
+    client = _FakeClient()
+    spool = tmp_path / "spool.jsonl"
+    uplink = _uplink(client, str(spool), max_queue=3)
+    uplink.start()
+    for i in range(6):
+        uplink.enqueue(_event(i))
+    assert uplink.stats.spilled == 3
+    assert uplink.stats.dropped == 0
+
+    client.up = True
+    assert _wait(lambda: len(client.received) == 6)
+    uplink.stop()
+
+    assert client.received == [f"event{i}" for i in range(6)]
+    assert _wait(lambda: spool.read_text() == "")
+
+
+def test_spool_is_not_truncated_with_spilled_events(tmp_path):
+    client = _FakeClient()
+    spool = tmp_path / "spool.jsonl"
+    uplink = _uplink(client, str(spool), max_queue=3)
+    uplink.start()
+    for i in range(6):
+        uplink.enqueue(_event(i))
+    uplink.stop()
+
+    # A new run delivers everything that was not delivered.
+    client.up = True
+    uplink = _uplink(client, str(spool), max_queue=3)
+    uplink.start()
+    assert _wait(lambda: len(client.received) == 6)
+    uplink.stop()
+    assert sorted(client.received) == [f"event{i}" for i in range(6)]
+
+
+def test_overflow_during_send_without_spool_keeps_unsent_events():
+    sending = Event()
+    release = Event()
+
+    class _SlowClient(_FakeClient):
+        def send_events(self, events):
+            sending.set()
+            release.wait(5)
+            return super().send_events(events)
+
+    client = _SlowClient()
+    client.up = True
+    uplink = Cep2WebUplink(client, batch_size=2, flush_interval=0.01, max_queue=2)
+    uplink.start()
+    uplink.enqueue(_event(0))
+    uplink.enqueue(_event(1))
+    assert sending.wait(5)
+    # Events 0 and 1 are being sent: the queue overflows, dropping them from memory.
+    uplink.enqueue(_event(2))
+    uplink.enqueue(_event(3))
+    release.set()
+    assert _wait(lambda: len(client.received) == 4)
+    uplink.stop()
+    assert client.received == [f"event{i}" for i in range(4)]
+    assert uplink.stats.dropped == 2
+
+
+def test_rejected_batches_are_not_delivered(tmp_path):
+    client = _FakeClient(status=422)
+    client.up = True
+    uplink = _uplink(client, str(tmp_path / "spool.jsonl"))
+    uplink.start()
+    uplink.enqueue(_event(0))
+    uplink.enqueue(_event(1))
+    assert _wait(lambda: uplink.stats.rejected == 2)
+    uplink.stop()
+    assert uplink.stats.sent == 0
+    assert uplink.stats.queue_depth == 0
+
+
+def test_throttled_timed_out_and_redirected_batches_are_retried(tmp_path):
+    client = _FakeClient()
+    client.answers = [(429, 0.3), (408, None), (307, None)]
+    client.up = True
+    uplink = _uplink(client, str(tmp_path / "spool.jsonl"))
+    uplink.start()
+    uplink.enqueue(_event(0))
+    assert _wait(lambda: client.received == ["event0"])
+    uplink.stop()
+
+    assert uplink.stats.rejected == 0
+    assert uplink.stats.failed_flushes == 3
+    # The Retry-After of the 429 is waited instead of the backoff.
+    assert client.attempts[1] - client.attempts[0] >= 0.3
+    assert client.attempts[2] - client.attempts[1] < 0.3
+
+
+def test_async_throttled_and_timed_out_batches_are_retried(tmp_path):
+    async def run():
+        client = _FakeAsyncClient()
+        client.answers = [(429, 0.2), (408, None)]
+        client.up = True
+        uplink = Cep2AsyncWebUplink(client, spool_path=str(tmp_path / "spool.jsonl"),
+                                    batch_size=2, flush_interval=0.01,
+                                    backoff_initial=0.01, backoff_max=0.02)
+        await uplink.start()
+        uplink.enqueue(_event(0))
+        for _ in range(500):
+            if client.received:
+                break
+            await asyncio.sleep(0.01)
+        await uplink.stop()
+        return client, uplink.stats
+
+    client, stats = asyncio.run(run())
+    assert client.received == ["event0"]
+    assert stats.rejected == 0
+    assert stats.failed_flushes == 2
+    assert client.attempts[1] - client.attempts[0] >= 0.2
+
+
+def test_retry_after_of_the_server(tmp_path):
+    retry_after = []
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            self.send_response(429)
+            if retry_after[-1] is not None:
+                self.send_header("Retry-After", retry_after[-1])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), _Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    client = Cep2WebClient(f"http://127.0.0.1:{server.server_port}/")
+    try:
+        date = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=60), usegmt=True)
+        for value, check in (("120", lambda r: r == 120),
+                             (date, lambda r: 55 < r <= 60),
+                             ("soon", lambda r: r is None),
+                             (None, lambda r: r is None)):
+            retry_after.append(value)
+            assert client.send_events([_event(0)]) == 429
+            assert check(client.retry_after), value
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_async_overflow_while_server_down(tmp_path):
+    async def main():
+        client = _FakeAsyncClient()
+        spool = tmp_path / "spool.jsonl"
+        uplink = Cep2AsyncWebUplink(client, spool_path=str(spool), batch_size=2,
+                                    flush_interval=0.01, max_queue=3, backoff_initial=0.01,
+                                    backoff_max=0.02)
+        await uplink.start()
+        for i in range(6):
+            uplink.enqueue(_event(i))
+        await asyncio.sleep(0.05)
+        client.up = True
+        deadline = monotonic() + 5
+        while len(client.received) < 6 and monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        await uplink.stop()
+
+        return client.received, spool.read_text()
+
+    received, spool = asyncio.run(main())
+    assert received == [f"event{i}" for i in range(6)]
+    assert spool == ""
+
+
+def test_async_spool_is_written_in_groups_outside_the_loop(tmp_path, monkeypatch):
+    fsyncs = []
+    fsync = os.fsync
+
+    def recording_fsync(fd):
+        fsyncs.append(get_ident())
+        fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", recording_fsync)
+
+    async def main():
+        client = _FakeAsyncClient()
+        spool = tmp_path / "spool.jsonl"
+        uplink = Cep2AsyncWebUplink(client, spool_path=str(spool), batch_size=1000,
+                                    flush_interval=10)
+        await uplink.start()
+        for i in range(200):
+            uplink.enqueue(_event(i))
+        # The events are written when stopping at the latest, and are kept since the server is
+        # down.
+        await uplink.stop(timeout=0.1)
+
+        return spool.read_text().splitlines(), uplink.stats.spooled
+
+    events, spooled = asyncio.run(main())
+    assert events == [_event(i) for i in range(200)]
+    assert spooled == 200
+    assert 0 < len(fsyncs) < 10
+    assert get_ident() not in fsyncs
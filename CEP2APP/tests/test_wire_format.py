@@ -0,0 +1,48 @@
+import gzip
+import json
+import random
+import pytest
+from Cep2WireFormat import decode_batch, decode_documents, encode_batch
+
+
+def _batch(compression=None) -> bytes:
+    return encode_batch([json.dumps({"id": "event1", "timestamp": "2024-01-01T10:00:00",
+                                     "location": "kitchen", "value": 21.5})],
+                        compression)
+
+
+def test_round_trip():
+    events = [json.dumps({"id": f"event{i}", "timestamp": "2024-01-01T10:00:00",
+                          "location": "kitchen", "value": i + 0.5, "extraKey": [1, 2]})
+              for i in range(3)]
+
+    assert decode_documents(encode_batch(events, "gzip"), "gzip") == [json.loads(e)
+                                                                       for e in events]
+
+
+def test_truncated_float_is_value_error():
+    data = _batch()
+
+    # The float is the last value of the batch: cut it in the middle.
+    with pytest.raises(ValueError):
+        decode_batch(data[:-3])
+
+
+@pytest.mark.parametrize("body", [b"not gzip at all", gzip.compress(b"HB", mtime=0)[:-6],
+                                  gzip.compress(b"HB", mtime=0)[:12] + b"\xff" * 8])
+def test_corrupt_gzip_is_value_error(body):
+    with pytest.raises(ValueError):
+        decode_documents(body, "gzip")
+
+
+def test_corrupt_batches_raise_only_value_error():
+    data = _batch()
+    rng = random.Random(1)
+    for _ in range(2000):
+        corrupt = bytearray(data)
+        for _ in range(rng.randint(1, 3)):
+            corrupt[rng.randrange(len(corrupt))] = rng.randrange(256)
+        try:
+            decode_documents(bytes(corrupt[:rng.randint(0, len(corrupt))]))
+        except ValueError:
+            pass
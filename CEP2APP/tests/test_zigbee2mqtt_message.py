@@ -0,0 +1,52 @@
+import json
+import pytest
+from Cep2Zigbee2mqttClient import (Cep2LazyPayload, Cep2Zigbee2mqttMessage,
+                                   Cep2Zigbee2mqttMessageType)
+
+
+def test_device_events_are_decoded_on_access():
+    message = Cep2Zigbee2mqttMessage.parse("home2/pillboxSensor",
+                                           '{"vibration": true, "battery": 90}',
+                                           base_topic="home2")
+
+    assert message.type_ == Cep2Zigbee2mqttMessageType.DEVICE_EVENT
+    assert message.device_id == "pillboxSensor"
+    assert message.base_topic == "home2"
+    assert isinstance(message.event, Cep2LazyPayload)
+    assert message.event.get("vibration") is True
+    assert message.event.get("occupancy") is None
+    assert dict(message.event) == {"vibration": True, "battery": 90}
+
+    # An invalid payload only fails when it is accessed.
+    invalid = Cep2Zigbee2mqttMessage.parse("zigbee2mqtt/pir", "{not json")
+    assert invalid.event.raw == "{not json"
+    with pytest.raises(ValueError):
+        invalid.event.get("occupancy")
+
+
+def test_bridge_topics_are_routed():
+    state = Cep2Zigbee2mqttMessage.parse("zigbee2mqtt/bridge/state", "online")
+    assert state.type_ == Cep2Zigbee2mqttMessageType.BRIDGE_STATE
+    assert state.state == "online"
+
+    log = Cep2Zigbee2mqttMessage.parse("zigbee2mqtt/bridge/log",
+                                       json.dumps({"message": "joined", "meta": {"x": 1}}))
+    assert log.type_ == Cep2Zigbee2mqttMessageType.BRIDGE_LOG
+    assert (log.message, log.meta, log.data) == ("joined", {"x": 1}, None)
+
+    for topic in ("zigbee2mqtt/bridge/devices", "zigbee2mqtt/lamp/set",
+                  "zigbee2mqtt/lamp/availability"):
+        assert Cep2Zigbee2mqttMessage.parse(topic, "{}") is None
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_json_backends_decode_the_same_payload(use_orjson):
+    payload = '{"occupancy": true, "illuminance": 12.5, "name": "k\\u00f8kken"}'
+    if use_orjson:
+        pytest.importorskip("orjson")
+    try:
+        assert Cep2Zigbee2mqttMessage.set_json_backend(use_orjson) == use_orjson
+        event = Cep2Zigbee2mqttMessage.parse("zigbee2mqtt/pir", payload).event
+        assert dict(event) == json.loads(payload)
+    finally:
+        Cep2Zigbee2mqttMessage.set_json_backend(False)